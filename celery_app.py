@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
 from celery import Celery
+from celery.signals import worker_ready
 
 load_dotenv()
 
@@ -26,36 +27,115 @@ celery.conf.update(
     enable_utc=True,
     task_track_started=True,
     worker_max_tasks_per_child=50,
+    # Prioridades 0 (alta) .. 9 (baja) en el transporte Redis (ver src/utils/jobs.py)
+    broker_transport_options={"priority_steps": list(range(10)), "queue_order_strategy": "priority"},
+    # Un job largo no debe acaparar tareas prefetched de otros
+    worker_prefetch_multiplier=1,
 )
 
 
+@worker_ready.connect
+def _resume_jobs_on_start(**_kwargs):
+    """Tras un reinicio/deploy, re-despacha los jobs durables que quedaron a medias."""
+    from src.utils.jobs import resume_jobs
+    try:
+        resume_jobs()
+    except Exception as e:
+        print(f"⚠️ No se pudieron reanudar jobs: {e}")
+
+
 def _build_progress_callback(task):
     async def _callback(message):
         task.update_state(state="PROGRESS", meta={"message": message})
     return _callback
 
 
+@celery.task(bind=True, acks_late=True)
+def run_job(self, job_id):
+    """Ejecuta (o reanuda) un job durable; el progreso queda en la BD y en su log.
+
+    acks_late: si el worker muere, el broker re-entrega la tarea. Re-ejecutarla
+    es seguro: solo reclama el job si sigue en cola o su latido caducó.
+    """
+    import asyncio
+    from src.utils.jobs import run_job as run_durable_job
+
+    return asyncio.run(run_durable_job(int(job_id)))
+
+
+@celery.task(bind=True)
+def process_job_batch(self, job_id, item_ids):
+    """Un lote de un job con fan-out. Con la cuota agotada reintenta con countdown."""
+    import asyncio
+    from src.utils.jobs import run_job_batch, JobPause, JOB_FANOUT_RETRIES
+
+    try:
+        return asyncio.run(run_job_batch(int(job_id), item_ids))
+    except JobPause as pause:
+        if self.request.retries >= JOB_FANOUT_RETRIES:
+            # Sin más reintentos: las unidades ya volvieron a la cola; el callback re-encola el job
+            return {"paused": len(item_ids)}
+        raise self.retry(countdown=min(pause.delay * 2 ** self.request.retries, 3600),
+                         max_retries=JOB_FANOUT_RETRIES)
+
+
+@celery.task(bind=True)
+def aggregate_job(self, reports, job_id):
+    """Callback del chord de process_job_batch: agrega el informe del job."""
+    from src.utils.jobs import aggregate_job as aggregate
+
+    return aggregate(int(job_id), reports)
+
+
+@celery.task
+def job_fanout_failed(request, exc, traceback, job_id):
+    """Errback del chord de process_job_batch: una tarea falló y aggregate_job no se llamará."""
+    from src.utils.jobs import fanout_failed
+
+    return fanout_failed(int(job_id), exc)
+
+
 @celery.task(bind=True)
 def generate_embeddings(self, limite=10):
+    """Compatibilidad: lanza el job de embeddings, que se reparte en lotes (fan-out)."""
+    from src.utils.jobs import submit_job
+
+    return submit_job('embeddings', {"limite": int(limite)})
+
+
+@celery.task(bind=True)
+def run_full_indexer(self):
     import asyncio
-    from src.scripts.indexador import generar_embeddings_pendientes
+    from src.scripts.indexador import procesar_archivos_viejos
 
     async def run():
         callback = _build_progress_callback(self)
-        result = await generar_embeddings_pendientes(int(limite), callback)
+        result = await procesar_archivos_viejos(callback)
         return result
 
     return asyncio.run(run())
 
 
 @celery.task(bind=True)
-def run_full_indexer(self):
+def backfill_cloud_ids(self, limite=0, servicio=None):
     import asyncio
-    from src.scripts.indexador import procesar_archivos_viejos
+    from src.scripts.indexador import rellenar_cloud_ids
 
     async def run():
         callback = _build_progress_callback(self)
-        result = await procesar_archivos_viejos(callback)
+        return await rellenar_cloud_ids(int(limite), callback, servicio=servicio)
+
+    return asyncio.run(run())
+
+
+@celery.task(bind=True)
+def reembed_shadow(self, limite=0):
+    import asyncio
+    from src.scripts.indexador import reembeber_en_sombra
+
+    async def run():
+        callback = _build_progress_callback(self)
+        result = await reembeber_en_sombra(int(limite), callback)
         return result
 
     return asyncio.run(run())
@@ -44,6 +44,9 @@ from src.init_services import db, dropbox_svc, drive_svc, onedrive_svc, openai_c
 from src.handlers.message_handlers import start, handle_any_file, show_cloud_menu, get_file_category, FILE_CATEGORIES
 from src.handlers.auth_handler import auth_middleware
 from src.utils.ai_handler import AIHandler, QuotaExceededError
+from src.utils.ai_scheduler import in_ai_lane, LANE_SEARCH, LANE_UPLOAD
+from src.utils.cost_planner import plan_pending_index, get_plan, plan_progress, format_duration
+from src.utils.jobs import submit_job
 
 # ================================================================================================
 # CACHE GLOBAL DE CARPETAS
@@ -390,6 +393,52 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         texto += f"{status_dot(drv_online)}  Google Drive API\n"
         texto += f"{status_dot(od_online)}  OneDrive API\n"
         texto += f"{status_dot(ai_online)}  OpenAI\n"
+        texto += f"\n{RULE}\n"
+
+        # Executor CPU compartido (parseo PDF/DOCX/ZIP) de este proceso
+        from src.utils.cpu_executor import get_executor_metrics
+        cpu = get_executor_metrics()
+        texto += "*Procesamiento*\n"
+        texto += kv_row("Cola CPU", f"{cpu['queue_depth']}/{cpu['capacity']} (máx. {cpu['max_depth']})") + "\n"
+        texto += kv_row("Tareas CPU", f"{cpu['completed']} ok · {cpu['failed']} err · {cpu['timeouts']} timeout") + "\n"
+        texto += kv_row("Espera media", f"{cpu['avg_wait_ms']} ms") + "\n"
+        texto += f"\n{RULE}\n"
+
+        # Margen de cuota del proveedor (cabeceras x-ratelimit-*, compartido entre procesos)
+        import asyncio
+        from src.utils.quota_governor import get_quota_headroom
+        # Lee Redis: fuera del event loop del bot
+        cuota = await asyncio.to_thread(get_quota_headroom)
+        texto += "*Cuota OpenAI*\n"
+        if cuota.get("age_s") is None:
+            texto += kv_row("Estado", "sin datos recientes") + "\n"
+        for unit, label in (("requests", "Peticiones"), ("tokens", "Tokens")):
+            info = cuota.get(unit)
+            if info:
+                texto += kv_row(label, f"{info['available']}/{info['limit']} ({info['pct']}%)") + "\n"
+                texto += kv_row(f"Reinicio {label.lower()}", f"{info['reset_in_s']} s") + "\n"
+        if cuota["cooldown_s"]:
+            texto += kv_row("Pausa tras 429", f"{cuota['cooldown_s']} s") + "\n"
+        texto += f"\n{RULE}\n"
+
+        # Plazos de la búsqueda IA y cuántas veces se degradó (este proceso)
+        from src.search.hybrid_search import get_search_latency_metrics
+        lat = get_search_latency_metrics()
+        texto += "*Búsqueda IA*\n"
+        texto += kv_row("Búsquedas", str(lat['searches'])) + "\n"
+        texto += kv_row("Embedding medio", f"{lat['embed_avg_ms']} ms · hedge {lat['embed_hedge_wins']}/{lat['embed_hedges']}") + "\n"
+        texto += kv_row("Reranker medio", f"{lat['rerank_avg_ms']} ms") + "\n"
+        texto += kv_row("Sólo léxica", f"{lat['lexical_fallbacks']} ({lat['embed_timeouts']} por plazo)") + "\n"
+        texto += kv_row("Orden RRF", f"{lat['rrf_fallbacks']} ({lat['rerank_timeouts']} por plazo)") + "\n"
+        texto += f"\n{RULE}\n"
+
+        # Imágenes enviadas a Visión: reducción y descripciones reutilizadas (este proceso)
+        from src.utils.image_prep import get_image_prep_metrics
+        vis = get_image_prep_metrics()
+        texto += "*Visión*\n"
+        texto += kv_row("Imágenes", str(vis['images'])) + "\n"
+        texto += kv_row("Reutilizadas", f"{vis['saved_calls']} ({vis['near_hits']} casi idénticas)") + "\n"
+        texto += kv_row("Tamaño enviado", f"{round(100 * vis['bytes_ratio'])}% del original") + "\n"
         texto += f"\n{RULE}"
 
         db.log_event("INFO", "BOT", "Comando /stats consultado con éxito.")
@@ -398,6 +447,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
          db.log_event("ERROR", "BOT", f"Error en /stats: {e}")
          await update.message.reply_text(f"❌ Error al consultar estadísticas: {e}")
 
+@in_ai_lane(LANE_SEARCH)
 async def ask_document_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
         return await update.message.reply_text(
@@ -498,6 +548,7 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await send_name_search_page(update, context)
 
+@in_ai_lane(LANE_SEARCH)
 async def inline_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query_text = update.inline_query.query.strip() if update.inline_query else ""
     if not query_text:
@@ -562,10 +613,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 cloud_deleted = False
                 try:
-                    if service == 'dropbox':
-                        cloud_deleted = await dropbox_svc.delete_file(f"/{name}")
-                    elif service == 'drive':
-                        cloud_deleted = await drive_svc.delete_file(name)
+                    cloud_deleted = await delete_from_cloud(name, service)
                 except Exception as e:
                     print(f"Error borrado cloud: {e}")
 
@@ -644,6 +692,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 # 4. PROCESO DE SUBIDA Y CALLBACKS
+@in_ai_lane(LANE_UPLOAD)
 async def upload_process(update, context, target_files_info: list, predefined_embedding=None):
     user_data = context.user_data
     selected_clouds = user_data.get('selected_clouds', set())
@@ -662,16 +711,19 @@ async def upload_process(update, context, target_files_info: list, predefined_em
         try:
             texto = await AIHandler.extract_text(local_path)
             vector = predefined_embedding
+            vector_next = None
             resumen = None
             ext = file_name.split('.')[-1].lower()
             desc_tec = f"Archivo {ext.upper()}"
 
             if texto and texto.strip():
-                print(f"🧠 IA: Texto extraído de '{file_name}' ({len(texto)} chars). Generando embedding...")
+                print(f"🧠 IA: Texto extraído de '{file_name}' ({len(texto)} chars). Generando embedding y resumen...")
                 if not vector:
-                    vector = await AIHandler.get_embedding(texto)
+                    # Resumen y embedding en paralelo
+                    resumen, vector, vector_next = await AIHandler.generate_summary_and_embedding(texto)
                     print(f"🔢 Embedding: {'✅ OK (' + str(len(vector)) + ' dims)' if vector else '❌ FALLÓ (None)'}")
-                resumen = await AIHandler.generate_summary(texto)
+                else:
+                    resumen = await AIHandler.generate_summary(texto)
             else:
                 print(f"⚠️ IA: No se extrajo texto de '{file_name}' (ext={ext}). Sin embedding.")
                 resumen = f"Documento binario/comprimido ({ext}). No se extrajo texto."
@@ -679,6 +731,7 @@ async def upload_process(update, context, target_files_info: list, predefined_em
             print(f"⚠️ Cuota de IA agotada enviando desde bot: {qe}")
             texto = None
             vector = None
+            vector_next = None
             resumen = f"IA temporalmente saturada (429). {qe}"
             ext = file_name.split('.')[-1].lower()
             desc_tec = f"Archivo {ext.upper()}"
@@ -692,17 +745,18 @@ async def upload_process(update, context, target_files_info: list, predefined_em
         
         cloud_links = []
         for cloud in selected_clouds:
+            meta = None
             try:
                 if cloud == 'dropbox':
                     folder_arg = CATEGORY_FOLDER_CACHE['dropbox'].get(category, category)
-                    url = await dropbox_svc.upload(local_path, file_name, folder=folder_arg)
+                    meta = await dropbox_svc.upload_with_meta(local_path, file_name, folder=folder_arg)
                 elif cloud == 'drive':
                     folder_id = CATEGORY_FOLDER_CACHE['drive'].get(category)
                     if not folder_id:
                         folder_id = await drive_svc.create_folder(category, parent_id=None)
                         if folder_id:
                             CATEGORY_FOLDER_CACHE['drive'][category] = folder_id
-                    url = await drive_svc.upload(local_path, file_name, folder_id=folder_id) if folder_id else None
+                    meta = await drive_svc.upload_with_meta(local_path, file_name, folder_id=folder_id) if folder_id else None
                 elif cloud == 'onedrive':
                     folder_id = CATEGORY_FOLDER_CACHE['onedrive'].get(category)
                     if not folder_id:
@@ -713,10 +767,11 @@ async def upload_process(update, context, target_files_info: list, predefined_em
                             logger.warning(f"⚠️ OneDrive: No se pudo obtener folder_id para '{category}', se subirá a raíz.")
                     
                     logger.info(f"🚀 OneDrive: Iniciando subida de '{file_name}'...")
-                    url = await onedrive_svc.upload(local_path, file_name, folder_id=folder_id)
-                    if not url:
+                    meta = await onedrive_svc.upload_with_meta(local_path, file_name, folder_id=folder_id)
+                    if not meta:
                         logger.error(f"❌ OneDrive: La subida de '{file_name}' no devolvió URL.")
                 
+                url = meta["url"] if meta else None
                 if url:
                     cloud_links.append(f"[✅ {cloud.capitalize()}]({url})")
                     
@@ -730,7 +785,10 @@ async def upload_process(update, context, target_files_info: list, predefined_em
                         embedding=vector,
                         summary=resumen,
                         technical_description=desc_tec,
-                        folder_id=original_info.get('folder_id', user_data.get('current_folder_id'))
+                        folder_id=original_info.get('folder_id', user_data.get('current_folder_id')),
+                        embedding_next=vector_next,
+                        cloud_id=meta.get("cloud_id"),
+                        cloud_path=meta.get("cloud_path")
                     )
             except Exception as e:
                 print(f"Error subiendo a {cloud}: {e}")
@@ -939,6 +997,51 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
     elif data == 'embed_all':
+        # Plan en seco de la página antes de gastar nada
+        page = context.user_data.get('index_page', 0)
+        plan = plan_pending_index(db, limite=INDEX_PAGE_SIZE, offset=page * INDEX_PAGE_SIZE)
+        if not plan["files"]:
+            return await query.edit_message_text("✅ No hay archivos pendientes en esta página.")
+        context.user_data['index_plan'] = plan
+        keyboard = [
+            [InlineKeyboardButton(f"✅ Indexar estos {plan['files']}", callback_data="embed_all_go")],
+            [InlineKeyboardButton("⬅️ Volver", callback_data="embed_page_back"),
+             InlineKeyboardButton("❌ Cerrar", callback_data="embed_close")],
+        ]
+        await query.edit_message_text(_format_index_plan(plan, f"Plan de la página {page + 1}"),
+                                      reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+
+    elif data == 'embed_plan_all':
+        plan = plan_pending_index(db)
+        if not plan["files"]:
+            return await query.edit_message_text("✅ No hay archivos pendientes de indexar.")
+        keyboard = [
+            [InlineKeyboardButton("🚀 Lanzar en segundo plano", callback_data=f"embed_plan_run_{plan['plan_id']}")],
+            [InlineKeyboardButton("⬅️ Volver", callback_data="embed_page_back"),
+             InlineKeyboardButton("❌ Cerrar", callback_data="embed_close")],
+        ]
+        await query.edit_message_text(_format_index_plan(plan, "Plan de todos los pendientes"),
+                                      reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+
+    elif data.startswith('embed_plan_run_'):
+        plan = get_plan(data.replace('embed_plan_run_', ''))
+        if not plan:
+            return await query.edit_message_text("⌛ El plan ha caducado. Vuelve a calcularlo con /indexar.")
+        job = submit_job('embeddings', {"limite": plan["limite"], "plan_id": plan["plan_id"]})
+        if not job:
+            return await query.edit_message_text("❌ No se pudo crear el job de embeddings.")
+        db.log_event("INFO", "BOT", f"Job de embeddings #{job['job_id']} lanzado con el plan {plan['plan_id']}")
+        await query.edit_message_text(
+            f"🚀 *Job #{job['job_id']} lanzado* ({plan['files']} archivos).\n"
+            f"Previsto: ~{format_duration(plan['eta_seconds'])} · ~${plan['cost_usd']['total']:.2f}\n\n"
+            f"El avance frente al plan se ve en el panel web (/jobs/{job['job_id']}).",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    elif data == 'embed_page_back':
+        return await send_indexar_page(update, context, edit=True)
+
+    elif data == 'embed_all_go':
         page = context.user_data.get('index_page', 0)
         offset = page * INDEX_PAGE_SIZE
         archivos = db.get_files_without_embedding(limit=INDEX_PAGE_SIZE, offset=offset)
@@ -951,17 +1054,24 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ok_count = 0
         fail_count = 0
         quota_hit = False
+        plan = context.user_data.pop('index_plan', None)
+        started = time.time()
 
         for idx, archivo in enumerate(archivos, 1):
             fid = archivo['id'] if isinstance(archivo, dict) else archivo[0]
             fname = archivo['name'] if isinstance(archivo, dict) else archivo[1]
 
             try:
+                vs_plan = ""
+                if plan:
+                    prog = plan_progress(plan, ok_count, fail_count, started)
+                    vs_plan = (f"\n⏱️ {format_duration(prog['elapsed_s'])} de ~{format_duration(plan['eta_seconds'])} "
+                               f"previstos · quedan ~{format_duration(prog['eta_s'])}")
                 await query.edit_message_text(
                     "🚀 *Indexando en lote...*\n"
                     "━" * 18 + "\n"
                     f"Archivo {idx}/{total}: `{fname}`\n"
-                    f"✅ Éxitos: {ok_count} │ ❌ Fallos: {fail_count}",
+                    f"✅ Éxitos: {ok_count} │ ❌ Fallos: {fail_count}" + vs_plan,
                     parse_mode=ParseMode.MARKDOWN
                 )
             except Exception:
@@ -1005,6 +1115,26 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # 5. BÚSQUEDA IA Y ELIMINAR
 
 
+def _format_index_plan(plan, title):
+    """Texto Markdown de un plan de indexación (ver src/utils/cost_planner.py)."""
+    from src.utils.telegram_format import RULE, kv_row
+    calls, cost = plan["calls"], plan["cost_usd"]
+    texto = f"📊 *{title}*\n{RULE}\n"
+    texto += kv_row("Archivos", f"{plan['files']} ({plan['downloads']} a descargar)") + "\n"
+    texto += kv_row("Por tipo", ", ".join(f"{g['category']} {g['files']}" for g in plan["groups"])) + "\n"
+    texto += kv_row("Embeddings", str(calls["embedding"])) + "\n"
+    texto += kv_row("Resúmenes", f"{calls['summary']} peticiones") + "\n"
+    if calls["vision"]:
+        texto += kv_row("Visión", f"{calls['vision']} peticiones") + "\n"
+    if calls["whisper_minutes"]:
+        texto += kv_row("Whisper", f"~{calls['whisper_minutes']} min") + "\n"
+    texto += kv_row("Tokens", f"{plan['tokens']['input']:,} in · {plan['tokens']['output']:,} out") + "\n"
+    texto += kv_row("Coste estimado", f"${cost['total']:.2f}") + "\n"
+    texto += kv_row("Duración estimada", f"~{format_duration(plan['eta_seconds'])} (límite: {plan['bottleneck']})") + "\n"
+    texto += f"{RULE}\n_Estimación: sin texto guardado se usa un tamaño típico por tipo._"
+    return texto
+
+
 async def indexar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler del comando /indexar: muestra archivos sin embedding para indexar."""
     context.user_data['index_page'] = 0
@@ -1070,6 +1200,9 @@ async def send_indexar_page(update: ContextTypes.DEFAULT_TYPE, context: ContextT
             callback_data="embed_all"
         )
     ])
+    keyboard.append([
+        InlineKeyboardButton(f"📊 Plan y coste de los {total} pendientes", callback_data="embed_plan_all")
+    ])
     keyboard.append([InlineKeyboardButton("❌ Cerrar", callback_data="embed_close")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1155,22 +1288,22 @@ async def _process_single_embed(file_id: int, update: Update, context: ContextTy
         logger.warning(f"⚠️ Sin texto extraible de '{name}'. Skipping embedding.")
         return False
 
-    # Generar embedding y resumen
-    vector = await AIHandler.get_embedding(texto)  # puede lanzar QuotaExceededError
+    # Generar embedding y resumen en paralelo (puede lanzar QuotaExceededError)
+    resumen, vector, vector_next = await AIHandler.generate_summary_and_embedding(texto)
     if not vector:
         logger.error(f"❌ Embedding nulo para '{name}'")
         return False
 
-    resumen = await AIHandler.generate_summary(texto)
-
     # Guardar en DB
     return db.update_file_embedding(
         file_id=file_id,
         embedding=vector,
         summary=resumen,
-        content_text=texto
+        content_text=texto,
+        embedding_next=vector_next
     )
 
+@in_ai_lane(LANE_SEARCH)
 async def search_ia_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Búsqueda inteligente tipo Google usando motor híbrido.
@@ -1448,13 +1581,17 @@ async def send_name_search_page(update, context, edit=False):
             parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True,
         )
 
+async def delete_from_cloud(name, service):
+    """Borra en la nube por cloud_id si está registrado (sin búsqueda por nombre)."""
+    svc = {'dropbox': dropbox_svc, 'drive': drive_svc, 'onedrive': onedrive_svc}.get(service)
+    if not svc:
+        return False
+    ref = db.get_cloud_ref(name, service) or {}
+    return await svc.delete_by_ref(ref.get('cloud_id'), name)
+
 async def execute_full_deletion(fid, name, service, update):
     try:
-        success = False
-        if service == 'dropbox':
-            success = await dropbox_svc.delete_file(f"/{name}") 
-        elif service == 'drive':
-            success = await drive_svc.delete_file(name) 
+        success = await delete_from_cloud(name, service)
 
         db.delete_file_by_id(fid)
         
@@ -1582,6 +1719,8 @@ async def post_stop(application):
     """Acciones a realizar al detener el bot"""
     print("\n🛑 Deteniendo CloudGram PRO...")
     await AIHandler.close_async_client()
+    if onedrive_svc:
+        await onedrive_svc.close()
     db.log_event("INFO", "SISTEMA", "Bot detenido correctamente.")
 
 async def error_handler(update, context):
@@ -1,5 +1,5 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_batch, execute_values
 import json
 import numpy as np
 from datetime import datetime
@@ -10,6 +10,24 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Modelo con el que se creó la columna `embedding` original (migrate_pgvector.py).
+# Se usa para sembrar el registro `embedding_models` en bases ya existentes.
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+LEGACY_EMBEDDING_DIMS = 1536
+
+# Límite de dimensiones de pgvector para índices HNSW sobre `vector`.
+HNSW_MAX_DIMS = 2000
+
+# Índice compacto para la búsqueda semántica (pgvector >= 0.7):
+#   none    → HNSW sobre `embedding` a precisión completa (comportamiento original)
+#   halfvec → HNSW sobre embedding::halfvec (índice ~2x más pequeño)
+#   binary  → HNSW sobre binary_quantize(embedding)::bit (índice ~32x más pequeño)
+# Con halfvec/binary se recuperan limit*EMBEDDING_RESCORE_FACTOR candidatos del
+# índice compacto y se reordenan con la distancia coseno a precisión completa.
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "none").lower()
+EMBEDDING_RESCORE_FACTOR = int(os.getenv("EMBEDDING_RESCORE_FACTOR", "4"))
+QUANTIZATION_MODES = ("none", "halfvec", "binary")
+
 class ConnectionWrapper:
     """Envoltorio para asegurar que la conexión se cierre al salir de un bloque with."""
     def __init__(self, conn):
@@ -42,6 +60,8 @@ class DatabaseHandler:
             print(f"✅ Variable detectada: {self.db_url[:15]}...")
         
         self._setup_initial_db()
+        if EMBEDDING_QUANTIZATION != "none":
+            self.ensure_quantized_index()
 
     def _connect(self):
         # Si la URL es de Postgres, usamos psycopg2 con reintentos
@@ -142,12 +162,94 @@ class DatabaseHandler:
                     )
                 ''')
 
+                # 6. Registro de modelos de embedding (qué modelo/dims hay en cada columna)
+                #    status: 'active' → columna `embedding` (la que sirve las búsquedas)
+                #            'building' → columna sombra `embedding_next` en re-embedding
+                #            'retired' → histórico
+                #    provider: 'openai' / 'local' — cada proveedor es un espacio vectorial propio
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS embedding_models (
+                        id SERIAL PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        dims INTEGER NOT NULL,
+                        provider TEXT NOT NULL DEFAULT 'openai',
+                        status TEXT NOT NULL DEFAULT 'building',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        activated_at TIMESTAMP
+                    )
+                ''')
+                cur.execute("ALTER TABLE embedding_models ADD COLUMN IF NOT EXISTS provider TEXT NOT NULL DEFAULT 'openai'")
+                cur.execute('''
+                    CREATE UNIQUE INDEX IF NOT EXISTS embedding_models_one_per_status
+                    ON embedding_models (status) WHERE status IN ('active', 'building')
+                ''')
+                cur.execute('''
+                    INSERT INTO embedding_models (model, dims, status, activated_at)
+                    SELECT %s, %s, 'active', CURRENT_TIMESTAMP
+                    WHERE NOT EXISTS (SELECT 1 FROM embedding_models WHERE status = 'active')
+                ''', (LEGACY_EMBEDDING_MODEL, LEGACY_EMBEDDING_DIMS))
+
+                # 7. Cursores de sincronización incremental (uno por servicio)
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS sync_cursors (
+                        service TEXT PRIMARY KEY,
+                        cursor TEXT NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # 8. Jobs durables: un job por ejecución larga y una fila por unidad de trabajo.
+                #    jobs.status: queued | running | done | failed | cancelled
+                #    job_items.status: pending | claimed | done | failed (claimed con lease
+                #    caducado vuelve a ser reclamable → reanudación tras caída)
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id SERIAL PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        params JSONB NOT NULL DEFAULT '{}'::jsonb,
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        priority INTEGER NOT NULL DEFAULT 0,
+                        concurrency INTEGER NOT NULL DEFAULT 1,
+                        planned BOOLEAN NOT NULL DEFAULT FALSE,
+                        worker TEXT,
+                        heartbeat_at TIMESTAMP,
+                        run_after TIMESTAMP,
+                        last_message TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        started_at TIMESTAMP,
+                        finished_at TIMESTAMP
+                    )
+                ''')
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS job_items (
+                        id BIGSERIAL PRIMARY KEY,
+                        job_id INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+                        item_key TEXT NOT NULL,
+                        payload JSONB,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        claimed_by TEXT,
+                        lease_until TIMESTAMP,
+                        last_error TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        CONSTRAINT job_items_unique UNIQUE (job_id, item_key)
+                    )
+                ''')
+                cur.execute("CREATE INDEX IF NOT EXISTS job_items_job_status_idx ON job_items (job_id, status)")
+
                 # Migración manual por si las columnas no existen en tablas ya creadas
                 try:
                     cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS summary TEXT")
                     cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS technical_description TEXT")
                     cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS tags TEXT")
                     cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS folder_id INTEGER")
+                    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS embedding_model TEXT")
+                    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS embedding_dims INTEGER")
+                    # Referencia estable en la nube (id + ruta) para operar sin buscar por nombre
+                    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS cloud_id TEXT")
+                    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS cloud_path TEXT")
+                    # Versión del contenido según la nube (content_hash, md5Checksum, cTag)
+                    cur.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS content_version TEXT")
                 except: pass
 
             conn.commit()
@@ -250,38 +352,184 @@ class DatabaseHandler:
     
     # --- FUNCIONES DEL BOT ---
     
-    def register_file(self, telegram_id, name, f_type, cloud_url, service, content_text=None, embedding=None, folder_id=None, summary=None, technical_description=None, tags=None):
-        """Registro con ON CONFLICT corregido."""
+    def register_file(self, telegram_id, name, f_type, cloud_url, service, content_text=None, embedding=None, folder_id=None, summary=None, technical_description=None, tags=None, embedding_next=None, cloud_id=None, cloud_path=None, content_version=None):
+        """Registro con ON CONFLICT corregido.
+
+        `embedding_next` es el vector del modelo en construcción (doble escritura
+        durante una migración de embeddings); se ignora si no hay migración.
+        `cloud_id`/`cloud_path` son la referencia que devuelve `upload_with_meta`.
+        `content_version` es la versión del contenido que trae el feed de cambios.
+
+        Returns:
+            int | None: id de la fila insertada/actualizada.
+        """
         try:
-            # Convertir embedding a string JSON si es una lista/array
-            if isinstance(embedding, (list, np.ndarray)):
-                embedding = json.dumps(embedding.tolist() if isinstance(embedding, np.ndarray) else embedding)
+            embedding, emb_model, emb_dims = self._prepare_active_embedding(embedding, name)
 
             with self._connect() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         INSERT INTO files (
                             telegram_id, name, type, cloud_url, service, 
-                            content_text, embedding, folder_id, summary, technical_description, tags
+                            content_text, embedding, folder_id, summary, technical_description, tags,
+                            embedding_model, embedding_dims, cloud_id, cloud_path, content_version
                         )
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                         ON CONFLICT (name, service) 
                         DO UPDATE SET 
                             summary = COALESCE(EXCLUDED.summary, files.summary),
                             technical_description = COALESCE(EXCLUDED.technical_description, files.technical_description),
                             tags = COALESCE(EXCLUDED.tags, files.tags),
                             embedding = COALESCE(EXCLUDED.embedding, files.embedding),
+                            embedding_model = COALESCE(EXCLUDED.embedding_model, files.embedding_model),
+                            embedding_dims = COALESCE(EXCLUDED.embedding_dims, files.embedding_dims),
                             content_text = COALESCE(EXCLUDED.content_text, files.content_text),
                             cloud_url = EXCLUDED.cloud_url,
+                            cloud_id = COALESCE(EXCLUDED.cloud_id, files.cloud_id),
+                            cloud_path = COALESCE(EXCLUDED.cloud_path, files.cloud_path),
+                            content_version = COALESCE(EXCLUDED.content_version, files.content_version),
                             telegram_id = EXCLUDED.telegram_id
+                        RETURNING id
                     """, (
                         telegram_id, name, f_type, cloud_url, service, 
-                        content_text, embedding, folder_id, summary, technical_description, tags
+                        content_text, embedding, folder_id, summary, technical_description, tags,
+                        emb_model, emb_dims, cloud_id, cloud_path, content_version
                     ))
+                    file_id = cur.fetchone()[0]
                     conn.commit()
                     print(f"✅ DB: Archivo '{name}' registrado/actualizado.")
+
+            if embedding_next is not None:
+                self.update_shadow_embeddings([(file_id, embedding_next)])
+            return file_id
         except Exception as e:
             print(f"❌ ERROR CRÍTICO DB EN register_file: {e}")
+            return None
+            
+    def get_cloud_ref(self, name, service):
+        """Referencia en la nube de un archivo registrado.
+
+        Returns:
+            dict | None: {"id", "cloud_id", "cloud_path"}.
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(
+                        "SELECT id, cloud_id, cloud_path FROM files WHERE name = %s AND service = %s",
+                        (name, service)
+                    )
+                    return cur.fetchone()
+        except Exception as e:
+            print(f"❌ Error leyendo cloud_id: {e}")
+            return None
+
+    def update_cloud_ref(self, file_id, cloud_id, cloud_path=None):
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE files SET cloud_id = %s, cloud_path = COALESCE(%s, cloud_path) WHERE id = %s",
+                        (cloud_id, cloud_path, file_id)
+                    )
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error guardando cloud_id: {e}")
+            return False
+
+    def set_content_version(self, file_id, content_version):
+        """Apunta la versión del contenido de un archivo indexado antes de guardarla."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE files SET content_version = %s WHERE id = %s", (content_version, file_id))
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error guardando content_version: {e}")
+            return False
+
+    def get_files_missing_cloud_ref(self, limit=100, service=None, exclude_ids=None):
+        """Archivos sin `cloud_id` (filas anteriores a la columna) para el backfill."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id, name, service FROM files
+                        WHERE cloud_id IS NULL
+                          AND (%s::text IS NULL OR service = %s)
+                          AND NOT (id = ANY(%s::int[]))
+                        ORDER BY id
+                        LIMIT %s
+                    """, (service, service, list(exclude_ids or []), limit))
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error listando archivos sin cloud_id: {e}")
+            return []
+
+    def register_files_bulk(self, rows):
+        """Inserta/actualiza muchos archivos con un único INSERT ... ON CONFLICT.
+
+        Args:
+            rows: lista de dicts con las mismas claves que register_file
+                  (telegram_id, name, f_type, cloud_url, service, content_text,
+                  embedding, folder_id, summary, technical_description, tags,
+                  embedding_next, cloud_id, cloud_path).
+
+        Returns:
+            int: filas insertadas/actualizadas.
+        """
+        if not rows:
+            return 0
+        # Un mismo (name, service) dos veces en el lote rompe el ON CONFLICT: gana el último
+        unique = {(r["name"], r["service"]): r for r in rows}
+        values, shadows = [], {}
+        for r in unique.values():
+            emb, emb_model, emb_dims = self._prepare_active_embedding(r.get("embedding"), r["name"])
+            values.append((
+                r.get("telegram_id"), r["name"], r.get("f_type"), r.get("cloud_url"), r["service"],
+                r.get("content_text"), emb, r.get("folder_id"), r.get("summary"),
+                r.get("technical_description"), r.get("tags"), emb_model, emb_dims,
+                r.get("cloud_id"), r.get("cloud_path")
+            ))
+            if r.get("embedding_next") is not None:
+                shadows[(r["name"], r["service"])] = r["embedding_next"]
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    result = execute_values(cur, """
+                        INSERT INTO files (
+                            telegram_id, name, type, cloud_url, service,
+                            content_text, embedding, folder_id, summary, technical_description, tags,
+                            embedding_model, embedding_dims, cloud_id, cloud_path
+                        )
+                        VALUES %s
+                        ON CONFLICT (name, service)
+                        DO UPDATE SET
+                            summary = COALESCE(EXCLUDED.summary, files.summary),
+                            technical_description = COALESCE(EXCLUDED.technical_description, files.technical_description),
+                            tags = COALESCE(EXCLUDED.tags, files.tags),
+                            embedding = COALESCE(EXCLUDED.embedding, files.embedding),
+                            embedding_model = COALESCE(EXCLUDED.embedding_model, files.embedding_model),
+                            embedding_dims = COALESCE(EXCLUDED.embedding_dims, files.embedding_dims),
+                            content_text = COALESCE(EXCLUDED.content_text, files.content_text),
+                            cloud_url = EXCLUDED.cloud_url,
+                            cloud_id = COALESCE(EXCLUDED.cloud_id, files.cloud_id),
+                            cloud_path = COALESCE(EXCLUDED.cloud_path, files.cloud_path),
+                            telegram_id = EXCLUDED.telegram_id
+                        RETURNING id, name, service
+                    """, values, page_size=200, fetch=True)
+                conn.commit()
+            print(f"✅ DB: {len(result)} archivos registrados en bloque.")
+            if shadows:
+                self.update_shadow_embeddings(
+                    [(fid, shadows[(name, svc)]) for fid, name, svc in result if (name, svc) in shadows]
+                )
+            return len(result)
+        except Exception as e:
+            print(f"❌ ERROR CRÍTICO DB EN register_files_bulk: {e}")
+            return 0
             
     def search_by_name(self, keyword):
         try:
@@ -304,34 +552,110 @@ class DatabaseHandler:
             print(f"❌ Error en search_by_name: {e}")
             return []
         
-    def search_semantic(self, query_embedding, limit=5, file_types=None):
-        """Búsqueda vectorial con cálculo de similitud y soporte de filtros de tipo de archivo (nativo con pgvector)."""
+    # Otro proceso (bot, Celery, panel) puede cambiar el tipo de la columna: se relee cada poco
+    _COLUMN_TYPE_TTL = 30
+
+    def _embedding_column_type(self, column="embedding"):
+        """Tipo SQL de la columna de embeddings (p. ej. 'vector(1536)' o 'halfvec(1536)')."""
+        cache = getattr(self, "_column_type_cache", {})
+        cached = cache.get(column)
+        if cached and time.monotonic() - cached[0] < self._COLUMN_TYPE_TTL:
+            return cached[1]
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT format_type(a.atttypid, a.atttypmod)
+                        FROM pg_attribute a
+                        WHERE a.attrelid = 'files'::regclass AND a.attname = %s AND NOT a.attisdropped
+                    """, (column,))
+                    row = cur.fetchone()
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el tipo de {column}: {e}")
+            return "vector"
+        col_type = row[0] if row else "vector"
+        cache[column] = (time.monotonic(), col_type)
+        self._column_type_cache = cache
+        return col_type
+
+    def _invalidate_column_types(self):
+        self._column_type_cache = {}
+
+    @staticmethod
+    def _quantized_expr(kind, column, dims):
+        """Expresión SQL indexada para cada modo de cuantización."""
+        if kind == "halfvec":
+            return f"({column}::halfvec({dims}))"
+        if kind == "binary":
+            return f"(binary_quantize({column})::bit({dims}))"
+        return column
+
+    def search_semantic(self, query_embedding, limit=5, file_types=None, quantization=None, rescore_factor=None):
+        """Búsqueda vectorial con cálculo de similitud y soporte de filtros de tipo de archivo (nativo con pgvector).
+
+        Con `quantization` ('halfvec' / 'binary', por defecto EMBEDDING_QUANTIZATION)
+        los candidatos salen del índice compacto y solo el top-N se reordena
+        contra el vector a precisión completa.
+        """
+        kind = (quantization or EMBEDDING_QUANTIZATION).lower()
+        if kind not in QUANTIZATION_MODES:
+            kind = "none"
         try:
             with self._connect() as conn:
                 # Usamos RealDictCursor
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    query_vec_str = json.dumps(query_embedding.tolist() if isinstance(query_embedding, np.ndarray) else query_embedding)
-                    
-                    query = '''
-                        SELECT id, name, cloud_url, summary, service, tags,
-                               1 - (embedding <=> %s::vector) AS similarity 
-                        FROM files 
-                        WHERE embedding IS NOT NULL
-                    '''
-                    params = [query_vec_str]
-                    
+                    query_vec = query_embedding.tolist() if isinstance(query_embedding, np.ndarray) else list(query_embedding)
+                    query_vec_str = json.dumps(query_vec)
+                    # Casteamos la consulta al tipo real de la columna (vector o halfvec)
+                    col_type = self._embedding_column_type()
+                    base_type = col_type.split("(")[0]
+                    qcast = f"%s::{base_type}"
+
+                    where = "WHERE embedding IS NOT NULL"
+                    filter_params = []
                     if file_types and isinstance(file_types, list) and len(file_types) > 0:
                         type_conditions = []
                         for ft in file_types:
                             ft_clean = ft.replace('.', '').strip().lower()
                             type_conditions.append("name ILIKE %s OR type ILIKE %s")
-                            params.extend([f"%.{ft_clean}%", f"%{ft_clean}%"])
+                            filter_params.extend([f"%.{ft_clean}%", f"%{ft_clean}%"])
                             
                         if type_conditions:
-                            query += f" AND ({' OR '.join(type_conditions)})"
-                            
-                    query += f" ORDER BY embedding <=> %s::vector LIMIT {int(limit)}"
-                    params.append(query_vec_str)
+                            where += f" AND ({' OR '.join(type_conditions)})"
+
+                    if kind == "none":
+                        query = f'''
+                            SELECT id, name, cloud_url, summary, service, tags,
+                                   1 - (embedding <=> {qcast}) AS similarity 
+                            FROM files 
+                            {where}
+                            ORDER BY embedding <=> {qcast} LIMIT {int(limit)}
+                        '''
+                        params = [query_vec_str, *filter_params, query_vec_str]
+                    else:
+                        dims = len(query_vec)
+                        factor = rescore_factor or EMBEDDING_RESCORE_FACTOR
+                        candidates = max(int(limit) * factor, 40)
+                        expr = self._quantized_expr(kind, "embedding", dims)
+                        if kind == "binary":
+                            q_expr = f"binary_quantize({qcast})::bit({dims})"
+                            op = "<~>"
+                        else:
+                            q_expr = f"%s::halfvec({dims})"
+                            op = "<=>"
+                        query = f'''
+                            SELECT id, name, cloud_url, summary, service, tags,
+                                   1 - (embedding <=> {qcast}) AS similarity
+                            FROM (
+                                SELECT id, name, cloud_url, summary, service, tags, embedding
+                                FROM files
+                                {where}
+                                ORDER BY {expr} {op} {q_expr}
+                                LIMIT {int(candidates)}
+                            ) candidatos
+                            ORDER BY embedding <=> {qcast} LIMIT {int(limit)}
+                        '''
+                        params = [query_vec_str, *filter_params, query_vec_str, query_vec_str]
                     
                     cur.execute(query, tuple(params))
                     results = cur.fetchall()
@@ -352,6 +676,97 @@ class DatabaseHandler:
         except Exception as e:
             print(f"❌ Error semántico pgvector: {e}")
             return []
+
+    def search_semantic_exact(self, query_embedding, limit=10):
+        """Vecinos exactos por barrido secuencial (sin índices). Solo para medir recall."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    query_vec = query_embedding.tolist() if isinstance(query_embedding, np.ndarray) else list(query_embedding)
+                    base_type = self._embedding_column_type().split("(")[0]
+                    cur.execute("SET LOCAL enable_indexscan = off")
+                    cur.execute(f"""
+                        SELECT id FROM files
+                        WHERE embedding IS NOT NULL
+                        ORDER BY embedding <=> %s::{base_type}
+                        LIMIT {int(limit)}
+                    """, (json.dumps(query_vec),))
+                    return [r[0] for r in cur.fetchall()]
+        except Exception as e:
+            print(f"❌ Error en search_semantic_exact: {e}")
+            return []
+
+    def ensure_quantized_index(self, kind=None, column="embedding"):
+        """Crea el índice HNSW compacto para `kind` sobre la columna indicada.
+
+        Returns:
+            bool: True si el índice existe (o no hace falta, kind='none').
+        """
+        kind = (kind or EMBEDDING_QUANTIZATION).lower()
+        if kind == "none":
+            return True
+        if kind not in QUANTIZATION_MODES:
+            print(f"❌ Modo de cuantización desconocido: {kind}")
+            return False
+        specs = self.get_embedding_specs(use_cache=False)
+        spec = specs["building"] if column == "embedding_next" else specs["active"]
+        if not spec:
+            return False
+        dims = spec["dims"]
+        if kind == "halfvec" and dims > 4000:
+            print(f"❌ halfvec admite hasta 4000 dims en HNSW ({dims}).")
+            return False
+        expr = self._quantized_expr(kind, column, dims)
+        ops = "bit_hamming_ops" if kind == "binary" else "halfvec_cosine_ops"
+        index_name = f"files_{column}_{kind}_idx"
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON files USING hnsw ({expr} {ops})")
+                conn.commit()
+            print(f"✅ DB: Índice {index_name} listo.")
+            return True
+        except Exception as e:
+            print(f"❌ Error creando índice {kind}: {e}")
+            return False
+
+    def set_embedding_storage(self, storage):
+        """Cambia el tipo de almacenamiento de `embedding`: 'vector' (float32) o 'halfvec' (float16).
+
+        halfvec reduce a la mitad la tabla; el reescalado usa entonces los valores
+        float16 (pérdida de recall despreciable para embeddings normalizados).
+        Reconstruye el índice HNSW a precisión completa con el operador adecuado.
+
+        El ALTER reescribe la tabla con bloqueo exclusivo (es una operación de
+        mantenimiento, ver benchmark_embeddings.py --storage); el índice se crea
+        después con CONCURRENTLY para no bloquear las escrituras mientras se
+        construye. Los demás procesos ven el tipo nuevo en _COLUMN_TYPE_TTL segundos.
+        """
+        if storage not in ("vector", "halfvec"):
+            print(f"❌ Tipo de almacenamiento desconocido: {storage}")
+            return False
+        active = self.get_embedding_specs(use_cache=False).get("active")
+        if not active:
+            return False
+        dims = active["dims"]
+        ops = "halfvec_cosine_ops" if storage == "halfvec" else "vector_cosine_ops"
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DROP INDEX IF EXISTS files_embedding_idx")
+                    cur.execute(f"ALTER TABLE files ALTER COLUMN embedding TYPE {storage}({dims}) USING embedding::{storage}({dims})")
+                conn.commit()
+            self._invalidate_column_types()
+            print(f"⏳ DB: Construyendo files_embedding_idx ({ops}) sin bloquear escrituras...")
+            with self._connect() as conn:
+                conn.autocommit = True  # CREATE INDEX CONCURRENTLY no admite transacción
+                with conn.cursor() as cur:
+                    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS files_embedding_idx ON files USING hnsw (embedding {ops})")
+            print(f"✅ DB: Columna embedding almacenada como {storage}({dims}).")
+            return True
+        except Exception as e:
+            print(f"❌ Error cambiando almacenamiento de embeddings: {e}")
+            return False
     
     def search_fulltext_improved(self, query: str, limit: int = 20, file_types=None):
         """
@@ -519,7 +934,7 @@ class DatabaseHandler:
         with self._connect() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(
-                    "SELECT id, telegram_id, user_id, name, type, cloud_url, service, content_text, embedding, summary, technical_description, tags, folder_id, created_at FROM files WHERE id = %s",
+                    "SELECT id, telegram_id, user_id, name, type, cloud_url, service, content_text, embedding, summary, technical_description, tags, folder_id, created_at, cloud_id, cloud_path FROM files WHERE id = %s",
                     (file_id,)
                 )
                 return cur.fetchone()
@@ -555,7 +970,11 @@ class DatabaseHandler:
         try:
             with self._connect() as conn:
                 with conn.cursor() as cur:
-                    cur.execute("UPDATE files SET embedding = NULL, summary = NULL, content_text = NULL")
+                    cur.execute("""
+                        UPDATE files
+                        SET embedding = NULL, embedding_model = NULL, embedding_dims = NULL,
+                            summary = NULL, content_text = NULL
+                    """)
                 conn.commit()
         except Exception as e:
             print(f"❌ Error al resetear toda la DB: {e}")
@@ -600,7 +1019,44 @@ class DatabaseHandler:
             print(f"❌ Error en count_files_without_embedding: {e}")
             return 0
 
-    def update_file_embedding(self, file_id, embedding, summary=None, content_text=None, tags=None):
+    def get_pending_embedding_profile(self, limit=None, offset=0, embed_chars=120000,
+                                      summary_chars=5000, short_chars=2500):
+        """Perfil agregado por extensión de los archivos sin embedding (para el plan de indexado).
+
+        Usa el mismo orden que get_files_without_embedding, así que `limit`/`offset`
+        describen exactamente una página de /indexar. Los caracteres se suman ya
+        recortados a lo que de verdad se envía al embedding y al resumen.
+
+        Returns:
+            list[dict]: ext, files, with_text, embed_chars, summary_chars, short_texts
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(r"""
+                        SELECT ext,
+                               COUNT(*) AS files,
+                               COUNT(*) FILTER (WHERE text_len > 20) AS with_text,
+                               COALESCE(SUM(LEAST(text_len, %s)) FILTER (WHERE text_len > 20), 0) AS embed_chars,
+                               COALESCE(SUM(LEAST(text_len, %s)) FILTER (WHERE text_len > 20), 0) AS summary_chars,
+                               COUNT(*) FILTER (WHERE text_len > 20 AND text_len <= %s) AS short_texts
+                        FROM (
+                            SELECT LOWER(COALESCE(NULLIF(type, ''), substring(name from '\.([^.]+)$'), '')) AS ext,
+                                   LENGTH(TRIM(COALESCE(content_text, ''))) AS text_len
+                            FROM files
+                            WHERE embedding IS NULL
+                            ORDER BY created_at DESC
+                            LIMIT %s OFFSET %s
+                        ) pendientes
+                        GROUP BY ext
+                        ORDER BY files DESC
+                    """, (embed_chars, summary_chars, short_chars, limit, offset))
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error en get_pending_embedding_profile: {e}")
+            return []
+
+    def update_file_embedding(self, file_id, embedding, summary=None, content_text=None, tags=None, embedding_next=None):
         """Actualiza embedding, summary, content_text y tags de un archivo ya registrado.
         
         Se usa después de re-indexar un archivo desde el bot sin necesidad de re-subirlo.
@@ -612,30 +1068,364 @@ class DatabaseHandler:
             summary: Resumen del contenido (opcional)
             content_text: Texto extraído del archivo (opcional)
             tags: Etiquetas generadas por IA (opcional)
+            embedding_next: Vector del modelo en migración (doble escritura, opcional)
         """
         try:
-            emb_json = json.dumps(
-                embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
-            ) if isinstance(embedding, (list, np.ndarray)) else embedding
+            emb_json, emb_model, emb_dims = self._prepare_active_embedding(embedding, f"id={file_id}")
 
             with self._connect() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         UPDATE files
                         SET embedding = %s,
+                            embedding_model = %s,
+                            embedding_dims = %s,
                             summary = COALESCE(%s, summary),
                             content_text = COALESCE(%s, content_text),
                             tags = COALESCE(%s, tags)
                         WHERE id = %s
-                    """, (emb_json, summary, content_text, tags, file_id))
+                    """, (emb_json, emb_model, emb_dims, summary, content_text, tags, file_id))
                 conn.commit()
             print(f"✅ DB: Embedding actualizado para archivo ID={file_id}")
+            if embedding_next is not None:
+                self.update_shadow_embeddings([(file_id, embedding_next)])
             return True
         except Exception as e:
             print(f"❌ Error en update_file_embedding (id={file_id}): {e}")
             return False
 
+    # --- RE-INDEXACIÓN OFFLINE (BATCH API) ---
+
+    def get_files_for_ai_batch(self, file_ids):
+        """id, name, service y content_text de los archivos de un lote."""
+        if not file_ids:
+            return []
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id, name, service, content_text
+                        FROM files
+                        WHERE id = ANY(%s::int[])
+                        ORDER BY id
+                    """, (list(file_ids),))
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error en get_files_for_ai_batch: {e}")
+            return []
+
+    def set_files_content_text(self, rows):
+        """Guarda en bloque el texto extraído (file_id, texto) antes de enviarlo al lote."""
+        rows = [(text, fid) for fid, text in rows if text]
+        if not rows:
+            return 0
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    execute_batch(cur, "UPDATE files SET content_text = %s WHERE id = %s", rows)
+                conn.commit()
+            return len(rows)
+        except Exception as e:
+            print(f"❌ Error en set_files_content_text: {e}")
+            return 0
+
+    def apply_ai_batch_results(self, rows):
+        """Aplica en bloque los resultados de un lote offline.
+
+        Args:
+            rows: iterable de (file_id, vector | None, summary | None, tags | None).
+                Solo se escribe lo que no sea None; los vectores cuyas dims no
+                cuadren con la columna activa se descartan (el archivo sigue
+                pendiente).
+
+        Returns:
+            int: archivos que quedaron con embedding.
+        """
+        params = []
+        with_vector = 0
+        for file_id, vector, summary, tags in rows:
+            emb_json, emb_model, emb_dims = self._prepare_active_embedding(vector, f"id={file_id}")
+            if emb_json:
+                with_vector += 1
+            if emb_json or summary or tags:
+                params.append((emb_json, emb_model, emb_dims, summary, tags, file_id))
+        if not params:
+            return 0
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    execute_batch(cur, """
+                        UPDATE files
+                        SET embedding = COALESCE(%s::vector, embedding),
+                            embedding_model = COALESCE(%s, embedding_model),
+                            embedding_dims = COALESCE(%s, embedding_dims),
+                            summary = COALESCE(%s, summary),
+                            tags = COALESCE(%s, tags)
+                        WHERE id = %s
+                    """, params, page_size=500)
+                conn.commit()
+            return with_vector
+        except Exception as e:
+            print(f"❌ Error en apply_ai_batch_results: {e}")
+            return 0
+
+
+
+    # --- REGISTRO DE MODELOS DE EMBEDDING / MIGRACIÓN EN SOMBRA ---
+
+    _EMBEDDING_SPECS_TTL = 30
+
+    def get_embedding_specs(self, use_cache=True):
+        """Modelo/dims de la columna activa y de la sombra en construcción.
+
+        Returns:
+            dict: {"active": {"model", "dims", "provider"} | None, "building": {...} | None}
+        """
+        cached = getattr(self, "_embedding_specs_cache", None)
+        if use_cache and cached and time.monotonic() - cached[0] < self._EMBEDDING_SPECS_TTL:
+            return cached[1]
+
+        specs = {"active": None, "building": None}
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT model, dims, provider, status FROM embedding_models
+                        WHERE status IN ('active', 'building')
+                    """)
+                    for row in cur.fetchall():
+                        specs[row['status']] = {"model": row['model'], "dims": row['dims'],
+                                                "provider": row['provider']}
+        except Exception as e:
+            print(f"⚠️ Error leyendo registro de embeddings: {e}")
+            return cached[1] if cached else specs
+
+        self._embedding_specs_cache = (time.monotonic(), specs)
+        return specs
+
+    def _invalidate_embedding_specs(self):
+        self._embedding_specs_cache = None
+
+    def _prepare_active_embedding(self, embedding, label=""):
+        """Serializa el vector y lo etiqueta con el modelo activo.
+
+        Si las dimensiones no cuadran con la columna activa (p. ej. otro proceso
+        aún no vio un cambio de modelo) se descarta: el archivo queda pendiente
+        y el indexador lo recalcula con el modelo correcto.
+
+        Returns:
+            tuple: (embedding_json | None, modelo | None, dims | None)
+        """
+        if embedding is None:
+            return None, None, None
+        if isinstance(embedding, str):
+            # Valores legacy ya serializados: se guardan tal cual
+            return embedding, None, None
+
+        vec = embedding.tolist() if isinstance(embedding, np.ndarray) else list(embedding)
+        active = self.get_embedding_specs().get("active")
+        if active and len(vec) != active["dims"]:
+            print(f"⚠️ Embedding de {len(vec)} dims descartado para {label}: "
+                  f"la columna activa es {active['model']} ({active['dims']} dims).")
+            return None, None, None
+        return json.dumps(vec), (active or {}).get("model"), len(vec)
+
+    def start_embedding_migration(self, model, dims, provider="openai"):
+        """Crea la columna sombra `embedding_next vector(dims)` con su propio índice HNSW.
+
+        Las búsquedas siguen sirviéndose desde `embedding` hasta que se llama a
+        switch_embedding_column(). Si ya había una migración en curso se descarta.
+
+        Returns:
+            bool: True si la sombra quedó creada.
+        """
+        dims = int(dims)
+        if dims > HNSW_MAX_DIMS:
+            print(f"❌ {dims} dims superan el máximo indexable por HNSW ({HNSW_MAX_DIMS}). Usa dimensiones reducidas.")
+            return False
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM embedding_models WHERE status = 'building'")
+                    cur.execute("ALTER TABLE files DROP COLUMN IF EXISTS embedding_next")
+                    cur.execute(f"ALTER TABLE files ADD COLUMN embedding_next vector({dims})")
+                    cur.execute("""
+                        CREATE INDEX files_embedding_next_idx
+                        ON files USING hnsw (embedding_next vector_cosine_ops)
+                    """)
+                    cur.execute("""
+                        INSERT INTO embedding_models (model, dims, provider, status)
+                        VALUES (%s, %s, %s, 'building')
+                    """, (model, dims, provider))
+                conn.commit()
+            self._invalidate_embedding_specs()
+            self._invalidate_column_types()
+            # La sombra nace con el mismo índice compacto que sirve las búsquedas
+            self.ensure_quantized_index(column="embedding_next")
+            print(f"✅ DB: Migración de embeddings iniciada → {model} ({dims} dims, {provider})")
+            return True
+        except Exception as e:
+            print(f"❌ Error iniciando migración de embeddings: {e}")
+            return False
+
+    def cancel_embedding_migration(self):
+        """Descarta la columna sombra y la fila 'building' del registro."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM embedding_models WHERE status = 'building'")
+                    cur.execute("ALTER TABLE files DROP COLUMN IF EXISTS embedding_next")
+                conn.commit()
+            self._invalidate_embedding_specs()
+            return True
+        except Exception as e:
+            print(f"❌ Error cancelando migración de embeddings: {e}")
+            return False
+
+    def get_files_pending_shadow(self, limit=100):
+        """Archivos con texto pero aún sin vector en la columna sombra.
+
+        Returns:
+            list[dict]: id, name, content_text
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id, name, content_text
+                        FROM files
+                        WHERE embedding_next IS NULL
+                          AND content_text IS NOT NULL
+                          AND LENGTH(TRIM(content_text)) > 20
+                        ORDER BY id
+                        LIMIT %s
+                    """, (int(limit),))
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error en get_files_pending_shadow: {e}")
+            return []
+
+    def update_shadow_embeddings(self, rows):
+        """Escribe en lote vectores de la columna sombra.
 
+        Args:
+            rows: iterable de (file_id, vector)
+
+        Returns:
+            int: filas actualizadas (0 si no hay migración en curso).
+        """
+        building = self.get_embedding_specs().get("building")
+        if not building:
+            return 0
+        params = []
+        for file_id, vec in rows:
+            if vec is None:
+                continue
+            vec = vec.tolist() if isinstance(vec, np.ndarray) else list(vec)
+            if len(vec) != building["dims"]:
+                continue
+            params.append((json.dumps(vec), file_id))
+        if not params:
+            return 0
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    execute_batch(cur, "UPDATE files SET embedding_next = %s::vector WHERE id = %s", params)
+                conn.commit()
+            return len(params)
+        except Exception as e:
+            print(f"❌ Error en update_shadow_embeddings: {e}")
+            return 0
+
+    def get_embedding_migration_status(self):
+        """Progreso de la migración en sombra.
+
+        Returns:
+            dict: active, building, total (archivos con texto), done, pending y
+            sin_texto (archivos con vector activo pero sin texto para re-embeber).
+        """
+        specs = self.get_embedding_specs(use_cache=False)
+        status = {"active": specs["active"], "building": specs["building"],
+                  "total": 0, "done": 0, "pending": 0, "sin_texto": 0}
+        if not specs["building"]:
+            return status
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT
+                            COUNT(*) FILTER (WHERE content_text IS NOT NULL AND LENGTH(TRIM(content_text)) > 20),
+                            COUNT(*) FILTER (WHERE embedding_next IS NOT NULL),
+                            COUNT(*) FILTER (WHERE embedding_next IS NULL AND content_text IS NOT NULL
+                                             AND LENGTH(TRIM(content_text)) > 20),
+                            COUNT(*) FILTER (WHERE embedding IS NOT NULL AND embedding_next IS NULL
+                                             AND (content_text IS NULL OR LENGTH(TRIM(content_text)) <= 20))
+                        FROM files
+                    """)
+                    total, done, pending, sin_texto = cur.fetchone()
+            status.update(total=total, done=done, pending=pending, sin_texto=sin_texto)
+        except Exception as e:
+            print(f"❌ Error en get_embedding_migration_status: {e}")
+        return status
+
+    def switch_embedding_column(self):
+        """Cambio atómico: la sombra pasa a ser `embedding` y la anterior queda como `embedding_prev`.
+
+        Todo ocurre en una única transacción (el DDL de Postgres es transaccional),
+        así que las búsquedas ven la columna vieja o la nueva, nunca un estado mixto.
+        Los archivos sin vector nuevo quedan con embedding NULL y el indexador
+        normal los recalcula con el modelo nuevo.
+
+        Returns:
+            bool: True si el cambio se aplicó.
+        """
+        building = self.get_embedding_specs(use_cache=False).get("building")
+        if not building:
+            print("⚠️ No hay ninguna migración de embeddings en curso.")
+            return False
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("ALTER TABLE files DROP COLUMN IF EXISTS embedding_prev")
+                    cur.execute("ALTER TABLE files RENAME COLUMN embedding TO embedding_prev")
+                    cur.execute("ALTER TABLE files RENAME COLUMN embedding_next TO embedding")
+                    cur.execute("ALTER INDEX IF EXISTS files_embedding_idx RENAME TO files_embedding_prev_idx")
+                    cur.execute("ALTER INDEX IF EXISTS files_embedding_next_idx RENAME TO files_embedding_idx")
+                    for kind in QUANTIZATION_MODES[1:]:
+                        cur.execute(f"DROP INDEX IF EXISTS files_embedding_prev_{kind}_idx")
+                        cur.execute(f"ALTER INDEX IF EXISTS files_embedding_{kind}_idx RENAME TO files_embedding_prev_{kind}_idx")
+                        cur.execute(f"ALTER INDEX IF EXISTS files_embedding_next_{kind}_idx RENAME TO files_embedding_{kind}_idx")
+                    cur.execute("""
+                        UPDATE files
+                        SET embedding_model = CASE WHEN embedding IS NULL THEN NULL ELSE %s END,
+                            embedding_dims  = CASE WHEN embedding IS NULL THEN NULL ELSE %s END
+                    """, (building["model"], building["dims"]))
+                    cur.execute("UPDATE embedding_models SET status = 'retired' WHERE status = 'active'")
+                    cur.execute("""
+                        UPDATE embedding_models
+                        SET status = 'active', activated_at = CURRENT_TIMESTAMP
+                        WHERE status = 'building'
+                    """)
+                conn.commit()
+            self._invalidate_embedding_specs()
+            self._invalidate_column_types()
+            print(f"✅ DB: Columna embedding cambiada a {building['model']} ({building['dims']} dims)")
+            return True
+        except Exception as e:
+            print(f"❌ Error en switch_embedding_column: {e}")
+            return False
+
+    def drop_previous_embedding_column(self):
+        """Libera el espacio de `embedding_prev` (y su índice) tras validar el cambio."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("ALTER TABLE files DROP COLUMN IF EXISTS embedding_prev")
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error eliminando embedding_prev: {e}")
+            return False
 
     def clean_corrupted_files(self):
         """Blanquea solo los archivos cuyo analysis IA falló guardando mensajes de error en base de datos."""
@@ -762,6 +1552,414 @@ class DatabaseHandler:
                     return cur.fetchone()
         except: return None
 
+    # --- JOBS DURABLES ---
+
+    def create_job(self, kind, params=None, priority=0, concurrency=1):
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO jobs (kind, params, priority, concurrency)
+                        VALUES (%s, %s, %s, %s) RETURNING id
+                    """, (kind, json.dumps(params or {}), priority, max(1, int(concurrency))))
+                    job_id = cur.fetchone()[0]
+                conn.commit()
+            return job_id
+        except Exception as e:
+            print(f"❌ Error creando job {kind}: {e}")
+            return None
+
+    def add_job_items(self, job_id, items):
+        """Inserta unidades de trabajo (item_key, payload). Idempotente: repetir no duplica."""
+        if not items:
+            return 0
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, """
+                        INSERT INTO job_items (job_id, item_key, payload) VALUES %s
+                        ON CONFLICT (job_id, item_key) DO NOTHING
+                    """, [(job_id, str(key), json.dumps(payload)) for key, payload in items], page_size=500)
+                conn.commit()
+            return len(items)
+        except Exception as e:
+            print(f"❌ Error añadiendo items al job {job_id}: {e}")
+            return 0
+
+    def get_job_item_payload(self, job_id, item_key):
+        """Payload de una unidad por su clave (None si no existe)."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT payload FROM job_items WHERE job_id = %s AND item_key = %s",
+                            (job_id, str(item_key)))
+                row = cur.fetchone()
+        return row[0] if row else None
+
+    def update_job_item_payload(self, job_id, item_key, payload):
+        """Reemplaza el payload de una unidad (p. ej. para apuntar lo ya hecho antes de un reintento)."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE job_items SET payload = %s WHERE job_id = %s AND item_key = %s",
+                                (json.dumps(payload), job_id, str(item_key)))
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error actualizando la unidad {item_key} del job {job_id}: {e}")
+            return False
+
+    def mark_job_planned(self, job_id):
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE jobs SET planned = TRUE WHERE id = %s", (job_id,))
+            conn.commit()
+
+    _JOB_CLAIMABLE = """
+        (status = 'queued' AND (run_after IS NULL OR run_after <= CURRENT_TIMESTAMP))
+        OR (status = 'running' AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+    """
+
+    def claim_job(self, worker, stale_seconds, job_id=None):
+        """Toma un job en cola (o uno cuyo worker dejó de latir). Sin `job_id`, el de mayor prioridad.
+
+        Returns:
+            dict | None: {"id", "kind", "params", "priority", "concurrency", "planned"}.
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(f"""
+                        UPDATE jobs SET status = 'running', worker = %s, heartbeat_at = CURRENT_TIMESTAMP,
+                                        started_at = COALESCE(started_at, CURRENT_TIMESTAMP), run_after = NULL
+                        WHERE id = (
+                            SELECT id FROM jobs
+                            WHERE ({self._JOB_CLAIMABLE}) AND (%s::int IS NULL OR id = %s)
+                            ORDER BY priority DESC, id
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, kind, params, priority, concurrency, planned
+                    """, (worker, stale_seconds, job_id, job_id))
+                    row = cur.fetchone()
+                conn.commit()
+            return row
+        except Exception as e:
+            print(f"❌ Error reclamando job: {e}")
+            return None
+
+    def get_unfinished_jobs(self):
+        """Jobs en cola o en curso: (id, priority, status, segundos hasta run_after).
+
+        Para re-despacharlos tras un reinicio.
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT id, priority, status,
+                               COALESCE(GREATEST(EXTRACT(EPOCH FROM run_after - CURRENT_TIMESTAMP), 0), 0)::int
+                        FROM jobs
+                        WHERE status IN ('queued', 'running')
+                        ORDER BY priority DESC, id
+                    """)
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error listando jobs pendientes: {e}")
+            return []
+
+    def heartbeat_job(self, job_id, worker, lease_seconds, message=None):
+        """Renueva el latido del job y los leases de sus unidades en curso.
+
+        Returns:
+            str | None: estado del job (para detectar cancelaciones).
+        """
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE job_items SET lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE job_id = %s AND status = 'claimed' AND claimed_by = %s
+                """, (lease_seconds, job_id, worker))
+                cur.execute("""
+                    UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP,
+                                    last_message = COALESCE(%s, last_message)
+                    WHERE id = %s AND (worker = %s OR status <> 'running')
+                    RETURNING status
+                """, (message, job_id, worker))
+                row = cur.fetchone()
+            conn.commit()
+        return row[0] if row else None
+
+    def claim_job_items(self, job_id, worker, limit, lease_seconds):
+        """Reclama hasta `limit` unidades pendientes (o con lease caducado) con SKIP LOCKED."""
+        with self._connect() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    UPDATE job_items SET status = 'claimed', claimed_by = %s, attempts = attempts + 1,
+                                         lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                                         updated_at = CURRENT_TIMESTAMP
+                    WHERE id IN (
+                        SELECT id FROM job_items
+                        WHERE job_id = %s
+                          AND (status = 'pending' OR (status = 'claimed' AND lease_until < CURRENT_TIMESTAMP))
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, item_key, payload, attempts
+                """, (worker, lease_seconds, job_id, limit))
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    def claim_job_items_by_id(self, job_id, worker, item_ids, lease_seconds):
+        """Como claim_job_items, pero solo entre `item_ids` (lotes repartidos en fan-out)."""
+        with self._connect() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    UPDATE job_items SET status = 'claimed', claimed_by = %s, attempts = attempts + 1,
+                                         lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                                         updated_at = CURRENT_TIMESTAMP
+                    WHERE id IN (
+                        SELECT id FROM job_items
+                        WHERE job_id = %s AND id = ANY(%s::bigint[])
+                          AND (status = 'pending' OR (status = 'claimed' AND lease_until < CURRENT_TIMESTAMP))
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, item_key, payload, attempts
+                """, (worker, lease_seconds, job_id, list(item_ids)))
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    def get_open_job_item_ids(self, job_id):
+        """Ids de unidades pendientes (o con lease caducado), en orden."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id FROM job_items
+                    WHERE job_id = %s
+                      AND (status = 'pending' OR (status = 'claimed' AND lease_until < CURRENT_TIMESTAMP))
+                    ORDER BY id
+                """, (job_id,))
+                return [row[0] for row in cur.fetchall()]
+
+    def touch_job(self, job_id, message=None):
+        """Latido sin dueño para jobs repartidos entre tareas (fan-out). Devuelve el estado."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP,
+                                    last_message = COALESCE(%s, last_message)
+                    WHERE id = %s
+                    RETURNING status
+                """, (message, job_id))
+                row = cur.fetchone()
+            conn.commit()
+        return row[0] if row else None
+
+    def ack_job_item(self, item_id, worker):
+        """Marca la unidad como hecha. Idempotente y solo para quien la tiene reclamada."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE job_items SET status = 'done', lease_until = NULL, last_error = NULL,
+                                         updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND status = 'claimed' AND claimed_by = %s
+                """, (item_id, worker))
+            conn.commit()
+
+    def fail_job_item(self, item_id, worker, error, max_attempts):
+        """Devuelve la unidad a la cola o, agotados los intentos, la marca como fallida."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE job_items
+                    SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                        last_error = %s, claimed_by = NULL, lease_until = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND status = 'claimed' AND claimed_by = %s
+                """, (max_attempts, str(error)[:1000], item_id, worker))
+            conn.commit()
+
+    _RELEASE_ITEMS_SQL = """
+        UPDATE job_items SET status = 'pending', attempts = GREATEST(attempts - 1, 0),
+                             claimed_by = NULL, lease_until = NULL
+        WHERE job_id = %s AND status = 'claimed' AND claimed_by = %s
+    """
+
+    def release_job_items(self, job_id, worker):
+        """Devuelve a la cola, sin gastar intento, las unidades que `worker` tenía reclamadas."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self._RELEASE_ITEMS_SQL, (job_id, worker))
+            conn.commit()
+
+    def release_job(self, job_id, worker, delay_seconds):
+        """Pausa el job: sus unidades reclamadas vuelven a la cola sin gastar intento."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self._RELEASE_ITEMS_SQL, (job_id, worker))
+                cur.execute("""
+                    UPDATE jobs SET status = 'queued', worker = NULL,
+                                    run_after = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE id = %s AND status = 'running'
+                """, (delay_seconds, job_id))
+            conn.commit()
+
+    def requeue_job(self, job_id, delay_seconds=0):
+        """Devuelve a la cola un job en curso (p. ej. tras un fan-out con unidades por reintentar)."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE jobs SET status = 'queued', worker = NULL,
+                                    run_after = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE id = %s AND status = 'running'
+                """, (delay_seconds, job_id))
+            conn.commit()
+
+    def finish_job(self, job_id, status=None):
+        """Cierra el job si no le quedan unidades vivas (o fuerza `status`)."""
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                if status:
+                    cur.execute("""
+                        UPDATE jobs SET status = %s, finished_at = CURRENT_TIMESTAMP
+                        WHERE id = %s AND status IN ('queued', 'running')
+                    """, (status, job_id))
+                else:
+                    cur.execute("""
+                        UPDATE jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+                        WHERE id = %s AND status = 'running'
+                          AND NOT EXISTS (SELECT 1 FROM job_items
+                                          WHERE job_id = %s AND status IN ('pending', 'claimed'))
+                    """, (job_id, job_id))
+            conn.commit()
+
+    def cancel_job(self, job_id):
+        self.finish_job(job_id, status='cancelled')
+        return True
+
+    def get_job(self, job_id):
+        """Job con el recuento de unidades por estado."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("SELECT * FROM jobs WHERE id = %s", (job_id,))
+                    job = cur.fetchone()
+                    if not job:
+                        return None
+                    cur.execute("SELECT status, COUNT(*) AS n FROM job_items WHERE job_id = %s GROUP BY status",
+                                (job_id,))
+                    job["items"] = {row["status"]: row["n"] for row in cur.fetchall()}
+                    return job
+        except Exception as e:
+            print(f"❌ Error leyendo job {job_id}: {e}")
+            return None
+
+    def list_jobs(self, limit=20):
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT j.id, j.kind, j.status, j.priority, j.concurrency, j.last_message,
+                               j.created_at, j.started_at, j.finished_at,
+                               COUNT(i.id) AS total,
+                               COUNT(i.id) FILTER (WHERE i.status = 'done') AS done,
+                               COUNT(i.id) FILTER (WHERE i.status = 'failed') AS failed
+                        FROM jobs j LEFT JOIN job_items i ON i.job_id = j.id
+                        GROUP BY j.id
+                        ORDER BY j.id DESC
+                        LIMIT %s
+                    """, (limit,))
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error listando jobs: {e}")
+            return []
+
+    # --- SINCRONIZACIÓN INCREMENTAL ---
+
+    def get_sync_cursor(self, service):
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT cursor FROM sync_cursors WHERE service = %s", (service,))
+                    row = cur.fetchone()
+                    return row[0] if row else None
+        except Exception as e:
+            print(f"❌ Error leyendo cursor de sync ({service}): {e}")
+            return None
+
+    def save_sync_cursor(self, service, cursor):
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO sync_cursors (service, cursor, updated_at)
+                        VALUES (%s, %s, CURRENT_TIMESTAMP)
+                        ON CONFLICT (service) DO UPDATE
+                        SET cursor = EXCLUDED.cursor, updated_at = CURRENT_TIMESTAMP
+                    """, (service, cursor))
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error guardando cursor de sync ({service}): {e}")
+            return False
+
+    def reset_sync_cursor(self, service=None):
+        """Borra el cursor (o todos): la próxima sync vuelve a recorrer la nube entera."""
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    if service:
+                        cur.execute("DELETE FROM sync_cursors WHERE service = %s", (service,))
+                    else:
+                        cur.execute("DELETE FROM sync_cursors")
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error reiniciando cursores de sync: {e}")
+            return False
+
+    def get_files_index_state(self, service, names):
+        """Estado de indexación de muchos archivos en una sola consulta.
+
+        Returns:
+            dict: name -> {"id", "indexed", "cloud_id", "content_version"}; los nombres
+            ausentes no están en la BD.
+        """
+        if not names:
+            return {}
+        try:
+            with self._connect() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id, name, cloud_id, content_version,
+                               (embedding IS NOT NULL AND summary IS NOT NULL) AS indexed
+                        FROM files
+                        WHERE service = %s AND name = ANY(%s::text[])
+                    """, (service, list(names)))
+                    return {row["name"]: row for row in cur.fetchall()}
+        except Exception as e:
+            print(f"❌ Error consultando estado de indexación: {e}")
+            return {}
+
+    def mark_files_missing(self, service, cloud_ids=(), names=()):
+        """Marca como huérfanos los archivos borrados en la nube (por id o, si no hay, por nombre)."""
+        if not cloud_ids and not names:
+            return 0
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE files SET summary = 'Archivo no encontrado en la nube'
+                        WHERE service = %s AND (cloud_id = ANY(%s::text[]) OR name = ANY(%s::text[]))
+                    """, (service, list(cloud_ids), list(names)))
+                    count = cur.rowcount
+                conn.commit()
+            return count
+        except Exception as e:
+            print(f"❌ Error marcando archivos borrados: {e}")
+            return 0
+
     def delete_file_by_id(self, file_id):
         with self._connect() as conn:
             with conn.cursor() as cur:
@@ -16,6 +16,10 @@ import geopy.geocoders
 
 from src.init_services import db, dropbox_svc, drive_svc, openai_client
 from src.utils.ai_handler import AIHandler, QuotaExceededError
+from src.utils.ai_scheduler import in_ai_lane, LANE_UPLOAD
+from src.utils.cpu_executor import run_cpu
+from src.utils.rate_limiter import AsyncRateLimiter
+from src.utils.summary_batcher import summarize
 
 # Configuración SSL para mi MacBook
 ctx = ssl.create_default_context(cafile=certifi.where())
@@ -58,7 +62,8 @@ FILE_CATEGORIES = {
 
 SUPPORTED_ZIP_EXTENSIONS = {
     'pdf', 'docx', 'txt', 'jpg', 'jpeg', 'png', 'webp', 'gif',
-    'ogg', 'mp3', 'wav', 'mp4', 'm4a', 'opus', 'flac', 'webm'
+    'ogg', 'mp3', 'wav', 'mp4', 'm4a', 'opus', 'flac', 'webm',
+    'xlsx', 'xlsm', 'csv', 'tsv', 'pptx'
 }
 
 def get_file_category(file_name: str) -> str:
@@ -75,70 +80,178 @@ def get_file_category(file_name: str) -> str:
             return category
     return None
 
-async def _process_zip_contents(local_zip_path, zip_name, cloud_url, service, telegram_id, folder_id):
+# Límites de ingesta de ZIP (evitan ZIP bombs y lotes interminables)
+ZIP_MAX_MEMBERS = int(os.getenv("ZIP_MAX_MEMBERS", "200"))
+ZIP_MAX_MEMBER_BYTES = int(os.getenv("ZIP_MAX_MEMBER_BYTES", str(50 * 1024 * 1024)))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv("ZIP_MAX_TOTAL_BYTES", str(500 * 1024 * 1024)))
+ZIP_MAX_RATIO = int(os.getenv("ZIP_MAX_RATIO", "100"))
+ZIP_CONCURRENCY = int(os.getenv("ZIP_CONCURRENCY", "4"))
+ZIP_EMBED_BATCH = 64
+# Extensiones cuya extracción ya consume IA (Visión / Whisper)
+_AI_EXTRACT_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp', 'gif', 'ogg', 'mp3', 'wav', 'mp4', 'm4a', 'opus', 'flac', 'webm'}
+
+
+def _list_zip_members(local_zip_path):
+    """Worker del executor CPU: miembros soportados que respetan los límites.
+
+    Returns:
+        tuple: (lista de (nombre, tamaño), nº de miembros descartados) o (None, 0) si no es un ZIP.
+    """
     if not zipfile.is_zipfile(local_zip_path):
+        return None, 0
+    selected, skipped, total = [], 0, 0
+    with zipfile.ZipFile(local_zip_path, 'r') as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            ext = member.filename.rsplit('.', 1)[-1].lower() if '.' in member.filename else ''
+            if ext not in SUPPORTED_ZIP_EXTENSIONS:
+                continue
+            ratio = member.file_size / max(member.compress_size, 1)
+            if (member.file_size > ZIP_MAX_MEMBER_BYTES or ratio > ZIP_MAX_RATIO
+                    or total + member.file_size > ZIP_MAX_TOTAL_BYTES
+                    or len(selected) >= ZIP_MAX_MEMBERS):
+                skipped += 1
+                continue
+            total += member.file_size
+            selected.append((member.filename, member.file_size))
+    return selected, skipped
+
+
+def _extract_zip_member(local_zip_path, member_name, dest_path, max_bytes):
+    """Worker del executor CPU: copia UN miembro al disco en streaming.
+
+    Corta la copia si el contenido real supera `max_bytes` (cabeceras falseadas).
+    """
+    copied = 0
+    with zipfile.ZipFile(local_zip_path, 'r') as archive:
+        with archive.open(member_name) as source, open(dest_path, 'wb') as target:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                copied += len(chunk)
+                if copied > max_bytes:
+                    raise ValueError(f"{member_name} supera {max_bytes} bytes descomprimido")
+                target.write(chunk)
+    return copied
+
+
+async def _process_zip_contents(local_zip_path, zip_name, cloud_url, service, telegram_id, folder_id):
+    """Indexa el contenido de un ZIP sin descomprimirlo entero.
+
+    1. Lista los miembros soportados aplicando límites de tamaño/cantidad.
+    2. Procesa hasta ZIP_CONCURRENCY miembros a la vez: cada uno se extrae a un
+       temporal propio, se analiza y se borra (las llamadas a IA pasan por un
+       limitador de ritmo compartido por todo el ZIP).
+    3. Resúmenes (agrupados en peticiones JSON por summary_batcher) y
+       embeddings en lotes de ZIP_EMBED_BATCH textos, en paralelo; después un
+       único INSERT en bloque.
+    """
+    members, skipped = await run_cpu(_list_zip_members, local_zip_path, prefer="thread")
+    if not members:
         return 0
+    if skipped:
+        print(f"⚠️ ZIP {zip_name}: {skipped} miembros descartados por límites de tamaño/cantidad.")
+
+    work_dir = tempfile.mkdtemp(prefix="zip_stream_", dir="descargas")
+    limiter = AsyncRateLimiter()
+    slots = asyncio.Semaphore(ZIP_CONCURRENCY)
+    quota = {"hit": False}
+
+    async def process_member(idx, member_name, size):
+        ext = member_name.rsplit('.', 1)[-1].lower()
+        tmp_path = os.path.join(work_dir, f"{idx}.{ext}")
+        async with slots:
+            try:
+                await run_cpu(_extract_zip_member, local_zip_path, member_name, tmp_path,
+                              ZIP_MAX_MEMBER_BYTES, size_hint=size)
+                if ext in _AI_EXTRACT_EXTENSIONS:
+                    if quota["hit"]:
+                        return None
+                    async with limiter:
+                        texto = await AIHandler.extract_text(tmp_path)
+                else:
+                    texto = await AIHandler.extract_text(tmp_path)
+            except QuotaExceededError:
+                quota["hit"] = True
+                return None
+            except Exception as e:
+                print(f"⚠️ ZIP {zip_name}: error en {member_name}: {e}")
+                return None
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        if not texto or not texto.strip():
+            return None
+
+        return {
+            "telegram_id": telegram_id,
+            "name": f"{zip_name} > {member_name}",
+            "f_type": ext,
+            "cloud_url": cloud_url,
+            "service": service,
+            "content_text": texto,
+            "folder_id": folder_id,
+            "summary": None,
+            "technical_description": f"Archivo dentro de ZIP {zip_name}",
+            "tags": None,
+        }
 
-    extract_dir = tempfile.mkdtemp(prefix="zip_extract_", dir="descargas")
-    processed = 0
-    try:
-        with zipfile.ZipFile(local_zip_path, 'r') as archive:
-            for member in archive.infolist():
-                if member.is_dir():
-                    continue
-                dest_path = os.path.normpath(os.path.join(extract_dir, member.filename))
-                if not dest_path.startswith(os.path.abspath(extract_dir)):
-                    continue
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                with archive.open(member) as source, open(dest_path, 'wb') as target:
-                    target.write(source.read())
-
-        for root, _, files in os.walk(extract_dir):
-            for file_name in files:
-                ext = file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
-                if ext not in SUPPORTED_ZIP_EXTENSIONS:
-                    continue
-
-                file_path = os.path.join(root, file_name)
-                texto = await AIHandler.extract_text(file_path)
-                if not texto or not texto.strip():
-                    continue
-
-                vector = await AIHandler.get_embedding(texto)
-                if not vector:
-                    continue
-
-                summary_data = await AIHandler.generate_summary_with_tags(texto)
-                tags = ",".join(summary_data.get('tags', [])) if summary_data.get('tags') else None
-                rel_path = os.path.relpath(file_path, extract_dir).replace("\\", "/")
-                internal_name = f"{zip_name} > {rel_path}"
+    async def summarize_rows(rows):
+        if quota["hit"]:
+            return
+        results = await asyncio.gather(*(summarize(r["content_text"]) for r in rows),
+                                       return_exceptions=True)
+        for row, data in zip(rows, results):
+            if isinstance(data, QuotaExceededError):
+                quota["hit"] = True
+            elif isinstance(data, dict):
+                row["summary"] = data.get('summary')
+                row["tags"] = ",".join(data['tags']) if data.get('tags') else None
+
+    async def embed_rows(rows):
+        # Embeddings por lotes (y doble escritura si hay migración de modelo en curso)
+        building = AIHandler.get_embedding_spec("building")
+        for start in range(0, len(rows), ZIP_EMBED_BATCH):
+            batch = rows[start:start + ZIP_EMBED_BATCH]
+            texts = [r["content_text"] for r in batch]
+            try:
+                async with limiter:
+                    vectors = await AIHandler.get_embeddings_batch(texts)
+                shadow = [None] * len(batch)
+                if building:
+                    async with limiter:
+                        shadow = await AIHandler.get_embeddings_batch(
+                            texts, model=building["model"], dimensions=building["dims"])
+            except QuotaExceededError:
+                # Se registran sin vector: el indexador los completará más tarde
+                print("⚠️ Cuota de IA agotada mientras se procesaba un ZIP interno.")
+                quota["hit"] = True
+                break
+            for row, vec, vec_next in zip(batch, vectors, shadow):
+                row["embedding"] = vec
+                row["embedding_next"] = vec_next
 
-                db.register_file(
-                    telegram_id=telegram_id,
-                    name=internal_name,
-                    f_type=ext,
-                    cloud_url=cloud_url,
-                    service=service,
-                    content_text=texto,
-                    embedding=vector,
-                    folder_id=folder_id,
-                    summary=summary_data.get('summary'),
-                    technical_description=f"Archivo dentro de ZIP {zip_name}",
-                    tags=tags
-                )
-                processed += 1
-    except QuotaExceededError:
-        print("⚠️ Cuota de IA agotada mientras se procesaba un ZIP interno.")
+    try:
+        results = await asyncio.gather(*(
+            process_member(i, name, size) for i, (name, size) in enumerate(members)
+        ))
+        rows = [r for r in results if r]
+        if not rows:
+            return 0
+
+        await asyncio.gather(summarize_rows(rows), embed_rows(rows))
+
+        if quota["hit"]:
+            print(f"⚠️ ZIP {zip_name}: cuota de IA agotada; parte del contenido queda sin analizar.")
+        return db.register_files_bulk(rows)
     except Exception as e:
         print(f"❌ Error procesando ZIP interno: {e}")
+        return 0
     finally:
-        try:
-            if os.path.exists(extract_dir):
-                shutil.rmtree(extract_dir)
-        except Exception:
-            pass
-
-    return processed
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 if not os.path.exists("descargas"):
     os.makedirs("descargas")
@@ -147,6 +260,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("✨ *CloudGram Activo*", parse_mode=ParseMode.MARKDOWN)
 
 
+@in_ai_lane(LANE_UPLOAD)
 async def handle_any_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     from main import db, dropbox_svc, drive_svc
     from src.utils.ai_handler import AIHandler
@@ -250,12 +364,13 @@ async def handle_any_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # B. IA (Aislada para que errores de fitz/OpenAI no detengan la subida)
             vector = None
+            vector_next = None
             try:
                 if not is_location:
                     texto_extraido = await AIHandler.extract_text(local_path)
                 
                 if texto_extraido and texto_extraido.strip():
-                    vector = await AIHandler.get_embedding(texto_extraido)
+                    vector, vector_next = await AIHandler.get_embedding_pair(texto_extraido)
             except QuotaExceededError:
                 print("⚠️ Cuota de IA agotada detectada en bot.")
                 if msg: await msg.edit_text("⏳ *IA temporalmente saturada:* El archivo se subirá pero la búsqueda inteligente tardará un poco más en activarse.", parse_mode=ParseMode.MARKDOWN)
@@ -266,10 +381,10 @@ async def handle_any_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             svc = drive_svc if folder_id and not str(folder_id).startswith('/') else dropbox_svc
             svc_name = "drive" if svc == drive_svc else "dropbox"
             
-            url = await svc.upload(local_path, file_name, folder_id if svc_name == "drive" else (cloud_parent or "General"))
+            meta = await svc.upload_with_meta(local_path, file_name, folder_id if svc_name == "drive" else (cloud_parent or "General"))
+            url = meta["url"] if meta else None
             
             if url:
-                if isinstance(url, tuple): url = url[0]
                 
                 # D. Registro Database
                 db.register_file(
@@ -280,7 +395,10 @@ async def handle_any_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     service=svc_name,
                     content_text=texto_extraido,
                     embedding=vector,
-                    folder_id=folder_id
+                    folder_id=folder_id,
+                    embedding_next=vector_next,
+                    cloud_id=meta.get("cloud_id"),
+                    cloud_path=meta.get("cloud_path")
                 )
 
                 file_message = f"✅ *Guardado:* `{file_name}`\n🔗 [Ver en la nube]({url})"
@@ -31,6 +31,8 @@ logger = logging.getLogger(__name__)
 # Base de datos
 db = DatabaseHandler()
 logger.info("✅ DatabaseHandler inicializado")
+# El modelo/dims de embedding vigente se lee del registro `embedding_models`
+AIHandler.set_embedding_spec_loader(db.get_embedding_specs)
 
 # Dropbox Service
 dropbox_svc = DropboxService(
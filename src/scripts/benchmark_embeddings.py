@@ -0,0 +1,101 @@
+"""
+Benchmark de recall/latencia de la búsqueda semántica por modo de cuantización.
+
+Usa como consultas los propios embeddings de una muestra de archivos y compara
+cada modo (none / halfvec / binary) contra los vecinos exactos (barrido
+secuencial sin índice).
+
+Uso:
+    python src/scripts/benchmark_embeddings.py --queries 50 --k 10 --modes none,halfvec,binary
+    python src/scripts/benchmark_embeddings.py --build-indexes   # crea los índices compactos antes
+    python src/scripts/benchmark_embeddings.py --storage halfvec  # guarda `embedding` como halfvec y mide
+"""
+import sys
+import os
+import json
+import time
+import argparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.database.db_handler import DatabaseHandler, QUANTIZATION_MODES
+
+
+def _sample_queries(db, n):
+    """Toma n embeddings al azar de la tabla files para usarlos como consultas."""
+    with db._connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT embedding::text FROM files
+                WHERE embedding IS NOT NULL
+                ORDER BY random()
+                LIMIT %s
+            """, (int(n),))
+            return [json.loads(r[0]) for r in cur.fetchall()]
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def run_benchmark(queries=50, k=10, modes=QUANTIZATION_MODES, rescore_factor=None, build_indexes=False,
+                  storage=None):
+    db = DatabaseHandler()
+    if storage and not db.set_embedding_storage(storage):
+        return {}
+    if build_indexes:
+        for mode in modes:
+            db.ensure_quantized_index(mode)
+
+    vectors = _sample_queries(db, queries)
+    if not vectors:
+        print("⚠️ No hay embeddings en la BD para medir.")
+        return {}
+
+    print(f"🎯 Calculando vecinos exactos para {len(vectors)} consultas (k={k})...")
+    truth = [set(db.search_semantic_exact(v, limit=k)) for v in vectors]
+
+    report = {}
+    for mode in modes:
+        recalls, latencies = [], []
+        for vec, exact in zip(vectors, truth):
+            t0 = time.perf_counter()
+            results = db.search_semantic(vec, limit=k, quantization=mode, rescore_factor=rescore_factor)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            if exact:
+                recalls.append(len(exact & {r["id"] for r in results}) / len(exact))
+        report[mode] = {
+            "recall": sum(recalls) / len(recalls) if recalls else 0.0,
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+        }
+        r = report[mode]
+        print(f"📊 {mode:<8} recall@{k}={r['recall']:.3f}  p50={r['p50_ms']:.1f}ms  p95={r['p95_ms']:.1f}ms")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall/latencia de search_semantic por modo de cuantización")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--modes", default=",".join(QUANTIZATION_MODES))
+    parser.add_argument("--rescore-factor", type=int, default=None)
+    parser.add_argument("--build-indexes", action="store_true")
+    parser.add_argument("--storage", choices=("vector", "halfvec"), default=None,
+                        help="cambia antes el almacenamiento de `embedding` (reescribe la tabla)")
+    args = parser.parse_args()
+
+    run_benchmark(
+        queries=args.queries,
+        k=args.k,
+        modes=[m.strip() for m in args.modes.split(",") if m.strip()],
+        rescore_factor=args.rescore_factor,
+        build_indexes=args.build_indexes,
+        storage=args.storage,
+    )
@@ -1,164 +1,209 @@
 """Script de categorización mejorado con streaming de logs.
 Diseñado para ser llamado desde web_admin.py con SSE.
+
+El recorrido es concurrente (Drive: pool acotado de workers sobre una cola de
+carpetas; Dropbox: list_folder recursivo paginado) y los movimientos van en
+lote (files_move_batch_v2 / batch de Drive). El log SSE recibe contadores de
+progreso periódicos en lugar de una línea por archivo.
 """
+import os
+import time
 import asyncio
-import dropbox
 from src.init_services import dropbox_svc, drive_svc, db
 from src.handlers.message_handlers import get_file_category, FILE_CATEGORIES
 
+CATEGORIZER_WORKERS = int(os.getenv("CATEGORIZER_WORKERS", "4"))
+# Segundos entre líneas de progreso en el log
+PROGRESS_INTERVAL = float(os.getenv("CATEGORIZER_PROGRESS_INTERVAL", "2"))
+# Máximo de fallos detallados en el log (el resto solo cuenta)
+MAX_ERROR_LINES = 20
+
+CATEGORY_FOLDERS = list(FILE_CATEGORIES.keys()) + ["Otros"]
+
+
+async def _while_running(task, progress_line):
+    """Emite `progress_line()` cada PROGRESS_INTERVAL segundos hasta que `task` termina."""
+    while not task.done():
+        await asyncio.wait({task}, timeout=PROGRESS_INTERVAL)
+        if not task.done():
+            yield progress_line()
+
+
+def _progress(prefix, stats, started):
+    elapsed = time.monotonic() - started
+    rate = stats["archivos"] / elapsed if elapsed else 0
+    return (f"{prefix} 📊 {stats['archivos']} archivos, {stats['carpetas']} carpetas explorados, "
+            f"{stats['por_mover']} por mover ({rate:.0f} archivos/s)")
+
+
+def _plan(name, stats):
+    """Categoría destino o None si el archivo se queda donde está."""
+    category = get_file_category(name) or "Otros"
+    if category == "Otros":
+        stats["otros"] += 1
+        return None
+    return category
+
+
+# --- Dropbox ---
+
+async def _crawl_dropbox(stats, moves):
+    """list_folder recursivo paginado (vía feed de cambios del servicio)."""
+    excluded = {c.lower() for c in CATEGORY_FOLDERS}
+    seen_folders = set()
+    async for page, _cursor in dropbox_svc.iter_changes(None):
+        for entry in page:
+            if entry["deleted"]:
+                continue
+            path = entry["cloud_path"]
+            folders = path.strip("/").split("/")[:-1]
+            seen_folders.add(path.rsplit("/", 1)[0])
+            stats["carpetas"] = len(seen_folders)
+            # No se entra en carpetas de categoría (ya organizadas)
+            if any(f.lower() in excluded for f in folders):
+                continue
+            stats["archivos"] += 1
+            category = _plan(entry["name"], stats)
+            if category:
+                moves.append((path, f"/{category}/{entry['name']}"))
+                stats["por_mover"] += 1
+
+
+# --- Google Drive ---
+
+async def _crawl_drive(stats, files, errors):
+    """BFS concurrente: CATEGORIZER_WORKERS workers consumen una cola de carpetas."""
+    queue = asyncio.Queue()
+    queue.put_nowait('root')
+
+    async def worker():
+        while True:
+            folder_id = await queue.get()
+            try:
+                page_token = None
+                while True:
+                    resp = await drive_svc.list_folder_page(folder_id, page_token)
+                    for f in resp.get('files', []):
+                        if f.get('mimeType', '').endswith('folder'):
+                            if f['name'] not in CATEGORY_FOLDERS:
+                                stats["carpetas"] += 1
+                                queue.put_nowait(f['id'])
+                        else:
+                            stats["archivos"] += 1
+                            files.append(f)
+                    page_token = resp.get('nextPageToken')
+                    if not page_token:
+                        break
+            except Exception as e:
+                errors.append(f"[DRIVE] ⚠️  Error listando carpeta {folder_id}: {e}")
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(CATEGORIZER_WORKERS)]
+    try:
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
 
 async def categorize_with_logs():
     """Async generator que yield logs de categorización en tiempo real."""
-    
+
     # Cargar caché desde BD al inicio
     category_cache = db.load_category_cache()
-    
+
     yield "[SISTEMA] ✨ Iniciando categorización de archivos..."
     yield "[SISTEMA] Evaluando cache de carpetas..."
-    
+
     # Dropbox
     yield "[DROPBOX] 🔍 Explorando estructura de Dropbox..."
-    dbx = dropbox_svc.dbx
-    if not dbx:
+    if not dropbox_svc.dbx:
         yield "[DROPBOX] ❌ Dropbox no disponible"
     else:
-        files_moved = 0
         try:
-            def list_dropbox_recursive(path='', paths_stack=None):
-                """Genera lista de rutas a procesar sin usar async yield"""
-                if paths_stack is None:
-                    paths_stack = [path]
-                
-                all_entries = []
-                errors = []
-                while paths_stack:
-                    current_path = paths_stack.pop(0)
-                    try:
-                        res = dbx.files_list_folder(current_path)
-                        for entry in res.entries:
-                            if isinstance(entry, dropbox.files.FolderMetadata):
-                                if entry.name not in list(FILE_CATEGORIES.keys()) + ["Otros"]:
-                                    paths_stack.append(entry.path_lower)
-                            else:
-                                all_entries.append(entry)
-                    except Exception as e:
-                        errors.append(f"[DROPBOX] ⚠️  Error listando {current_path}: {e}")
-                
-                return all_entries, errors
-            
-            entries, errors = list_dropbox_recursive('')
-            
-            for error in errors:
-                yield error
-
-            for entry in entries:
-                name = entry.name
-                category = get_file_category(name) or "Otros"
-                yield f"[DROPBOX] 📄 {entry.path_lower} → {category}"
-                
-                if category == "Otros":
-                    yield f"[DROPBOX]    (Otros: no se mueve)"
-                    continue
-                
-                target_folder = f"/{category}"
-                current_folder = entry.path_lower.rsplit('/', 1)[0] if '/' in entry.path_lower else ''
-                
-                if current_folder.strip('/').lower() == category.lower():
-                    yield f"[DROPBOX]    ✓ Ya en la carpeta correcta"
-                    continue
-                
-                source = entry.path_lower
-                dest = f"{target_folder}/{name}".replace("//", "/")
-                yield f"[DROPBOX]    📤 Moviendo a {dest}"
-                
-                moved = await dropbox_svc.move_file(source, dest)
-                if moved:
-                    yield f"[DROPBOX]    ✅ Movido exitosamente"
-                    files_moved += 1
-                else:
-                    yield f"[DROPBOX]    ❌ No se pudo mover"
-            
+            stats = {"archivos": 0, "carpetas": 0, "por_mover": 0, "otros": 0}
+            moves = []
+            started = time.monotonic()
+            crawl = asyncio.create_task(_crawl_dropbox(stats, moves))
+            async for line in _while_running(crawl, lambda: _progress("[DROPBOX]", stats, started)):
+                yield line
+            await crawl
+            yield _progress("[DROPBOX]", stats, started)
+            yield f"[DROPBOX]    ({stats['otros']} en 'Otros': no se mueven)"
+
+            files_moved = 0
+            if moves:
+                yield f"[DROPBOX] 📦 Moviendo {len(moves)} archivos en lote..."
+                outcome = await dropbox_svc.move_files(moves)
+                files_moved = sum(1 for ok in outcome.values() if ok)
+                failed = [src for src, _ in moves if not outcome.get(src)]
+                for src in failed[:MAX_ERROR_LINES]:
+                    yield f"[DROPBOX]    ❌ No se pudo mover {src}"
+                if len(failed) > MAX_ERROR_LINES:
+                    yield f"[DROPBOX]    ... y {len(failed) - MAX_ERROR_LINES} fallos más"
+
             yield f"[DROPBOX] ✓ Completado. {files_moved} archivos movidos en Dropbox."
         except Exception as e:
             yield f"[DROPBOX] ❌ Error: {str(e)}"
-    
+
     # Google Drive
     yield "[DRIVE] 🔍 Explorando estructura de Google Drive..."
     try:
-        svc = drive_svc._get_service()
         files_moved_drive = 0
-        
+
         # Poblar cache de carpetas de categoría
-        for cat in list(FILE_CATEGORIES.keys()) + ["Otros"]:
+        for cat in CATEGORY_FOLDERS:
             if cat not in category_cache['drive']:
                 cat_id = await drive_svc.create_folder(cat, parent_id=None)
                 category_cache['drive'][cat] = cat_id
                 db.save_category_folder(cat, 'drive', cat_id)
                 yield f"[DRIVE] 📁 Carpeta de categoría '{cat}' creada/verificada"
 
-        
-        def list_drive_recursive(folder_id='root', path_name="root"):
-            """Lista archivos recursivamente de Google Drive"""
-            all_files = []
-            paths_stack = [(folder_id, path_name)]
-            
-            while paths_stack:
-                current_id, current_path = paths_stack.pop(0)
-                page_token = None
-                
-                while True:
-                    resp = svc.files().list(
-                        q=f"'{current_id}' in parents and trashed=false",
-                        spaces="drive",
-                        fields="nextPageToken, files(id, name, mimeType, parents)",
-                        pageToken=page_token
-                    ).execute()
-                    
-                    for f in resp.get('files', []):
-                        if f.get('mimeType', '').endswith('folder'):
-                            if f['name'] not in list(FILE_CATEGORIES.keys()) + ["Otros"]:
-                                paths_stack.append((f['id'], current_path + "/" + f['name']))
-                        else:
-                            all_files.append((f, current_path))
-                    
-                    page_token = resp.get('nextPageToken', None)
-                    if not page_token:
-                        break
-            
-            return all_files
-        
-        files = list_drive_recursive()
-        for f, path_name in files:
-            name = f['name']
-            category = get_file_category(name) or "Otros"
-            yield f"[DRIVE] 📄 {path_name}/{name} → {category}"
-            
-            if category == "Otros":
-                yield f"[DRIVE]    (Otros: no se mueve)"
+        stats = {"archivos": 0, "carpetas": 0, "por_mover": 0, "otros": 0}
+        files, errors = [], []
+        started = time.monotonic()
+        crawl = asyncio.create_task(_crawl_drive(stats, files, errors))
+        async for line in _while_running(crawl, lambda: _progress("[DRIVE]", stats, started)):
+            yield line
+        await crawl
+        for error in errors[:MAX_ERROR_LINES]:
+            yield error
+
+        pending_moves = []  # (file_id, carpeta destino, padres actuales, nombre)
+        for f in files:
+            category = _plan(f['name'], stats)
+            if not category:
                 continue
-            
             folder_cat_id = category_cache['drive'].get(category)
             if not folder_cat_id:
                 yield f"[DRIVE]    ⚠️  Carpeta {category} no en cache, creando..."
                 folder_cat_id = await drive_svc.create_folder(category, parent_id=None)
                 category_cache['drive'][category] = folder_cat_id
                 db.save_category_folder(category, 'drive', folder_cat_id)
-            
+
             parents = f.get('parents', []) or []
             if folder_cat_id in parents:
-                yield f"[DRIVE]    ✓ Ya en la carpeta correcta"
                 continue
-            
-            yield f"[DRIVE]    📤 Moviendo a carpeta {category}"
-            result = await drive_svc.move_file(f['id'], folder_cat_id)
-            if result:
-                yield f"[DRIVE]    ✅ Movido exitosamente"
-                files_moved_drive += 1
-            else:
-                yield f"[DRIVE]    ❌ No se pudo mover"
-        
+            pending_moves.append((f['id'], folder_cat_id, parents, f['name']))
+        stats["por_mover"] = len(pending_moves)
+        yield _progress("[DRIVE]", stats, started)
+        yield f"[DRIVE]    ({stats['otros']} en 'Otros': no se mueven)"
+
+        # Movimientos agrupados en peticiones batch de Drive
+        if pending_moves:
+            yield f"[DRIVE] 📦 Moviendo {len(pending_moves)} archivos en lote..."
+            outcome = await drive_svc.move_files([m[:3] for m in pending_moves])
+            files_moved_drive = sum(1 for ok in outcome.values() if ok)
+            failed = [label for file_id, _, _, label in pending_moves if not outcome.get(file_id)]
+            for label in failed[:MAX_ERROR_LINES]:
+                yield f"[DRIVE]    ❌ No se pudo mover {label}"
+            if len(failed) > MAX_ERROR_LINES:
+                yield f"[DRIVE]    ... y {len(failed) - MAX_ERROR_LINES} fallos más"
+
         yield f"[DRIVE] ✓ Completado. {files_moved_drive} archivos movidos en Google Drive."
     except Exception as e:
         yield f"[DRIVE] ❌ Error: {str(e)}"
-    
+
     yield "[SISTEMA] ✅ Categorización finalizada con éxito."
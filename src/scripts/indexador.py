@@ -9,8 +9,10 @@ import json
 import threading
 from src.database.db_handler import DatabaseHandler
 from src.utils.ai_handler import AIHandler, QuotaExceededError
+from src.utils.ai_scheduler import in_ai_lane, metered_tokens, LANE_BACKFILL
 from src.services.dropbox_service import DropboxService
 from src.services.google_drive_service import GoogleDriveService
+from src.services.onedrive_service import OneDriveService
 from telegram import Bot
 from dotenv import load_dotenv
 from datetime import datetime
@@ -19,12 +21,29 @@ load_dotenv()
 
 # Inicialización de servicios (Asegurando que usen las variables de entorno)
 db = DatabaseHandler()
+# El modelo de embedding vigente lo dicta el registro de la BD
+AIHandler.set_embedding_spec_loader(db.get_embedding_specs)
 dropbox_svc = DropboxService(
     app_key=os.getenv("DROPBOX_APP_KEY"),
     app_secret=os.getenv("DROPBOX_APP_SECRET"),
     refresh_token=os.getenv("DROPBOX_REFRESH_TOKEN")
 )
 drive_svc = GoogleDriveService()
+_onedrive_svc = None
+
+
+def _servicio(nombre):
+    """Servicio cloud por nombre. OneDrive se crea bajo demanda (valida el token al construirse)."""
+    global _onedrive_svc
+    if nombre == 'onedrive':
+        if _onedrive_svc is None:
+            _onedrive_svc = OneDriveService(
+                client_id=os.getenv("ONEDRIVE_CLIENT_ID"),
+                client_secret=os.getenv("ONEDRIVE_CLIENT_SECRET"),
+                refresh_token=os.getenv("ONEDRIVE_REFRESH_TOKEN")
+            )
+        return _onedrive_svc
+    return {'dropbox': dropbox_svc, 'drive': drive_svc}.get(nombre)
 
 def limpiar_y_recortar_texto(texto, max_chars=15000):
     if not texto: return ""
@@ -34,57 +53,150 @@ def limpiar_y_recortar_texto(texto, max_chars=15000):
         return texto[:max_chars]
     return texto
 
-async def procesar_archivos_viejos(progreso_callback=None):
+SYNC_SERVICIOS = ('dropbox', 'drive', 'onedrive')
+# Nombres que no son archivos reales (carpetas de sistema / categorías)
+NOMBRES_IGNORADOS = {".", "..", "None", "General", "Imágenes"}
+# Archivos procesados a la vez al generar embeddings pendientes
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+
+def _servicio_disponible(nombre, svc):
+    if nombre == 'dropbox':
+        return bool(svc and svc.dbx)
+    if nombre == 'onedrive':
+        return bool(svc and svc.app)
+    return svc is not None
+
+
+@in_ai_lane(LANE_BACKFILL)
+async def procesar_archivos_viejos(progreso_callback=None, servicios=SYNC_SERVICIOS, progress=None):
     """
-    Escanea Dropbox y Drive, compara con la DB e indexa lo faltante.
+    Sincronización incremental con el feed de cambios de cada nube.
+
+    La primera vez recorre todo (list_folder recursivo / files.list / delta) y
+    guarda el cursor en `sync_cursors`; las siguientes solo procesan lo nuevo,
+    cambiado o borrado. El cursor se persiste tras cada página, así que una sync
+    interrumpida se reanuda donde quedó. La existencia en la BD se comprueba con
+    una consulta por página, no una por archivo; un archivo ya indexado se vuelve
+    a procesar si el feed trae otra versión de contenido (content_hash de
+    Dropbox, md5Checksum/modifiedTime de Drive, cTag de OneDrive).
+
+    `progress` (ProgressTracker opcional) cuenta los archivos a indexar; el total
+    crece página a página según los descubre el feed.
     """
-    if progreso_callback: await progreso_callback("Iniciando escaneo global de nubes...")
+    if progreso_callback: await progreso_callback("Iniciando sincronización incremental de nubes...")
     
-    reporte = {"nuevos": 0, "errores": 0}
+    reporte = {"nuevos": 0, "errores": 0, "borrados": 0, "sin_cambios": 0}
     
     # Asegurar carpeta de descargas
     if not os.path.exists("descargas"):
         os.makedirs("descargas")
 
-    # 1. Escaneo de Dropbox
-    if progreso_callback: await progreso_callback("Escaneando archivos en Dropbox...")
-    try:
-        # Listamos archivos (list_files debe devolver metadatos completos si es posible)
-        dbx_files = await dropbox_svc.list_files("")
-        for file_item in dbx_files:
-            # Si el service devuelve solo nombres (strings), procesamos. 
-            # Si devuelve objetos, filtramos carpetas aquí.
-            name = file_item if isinstance(file_item, str) else file_item.get('name')
-            await _indexar_si_falta(name, 'dropbox', reporte, progreso_callback)
-    except Exception as e:
-        if progreso_callback: await progreso_callback(f"Error Dropbox: {str(e)}")
-
-    # 2. Escaneo de Google Drive
-    if progreso_callback: await progreso_callback("Escaneando archivos en Google Drive...")
-    try:
-        drive_files = await drive_svc.list_files(limit=50)
-        for name in drive_files:
-            await _indexar_si_falta(name, 'drive', reporte, progreso_callback)
-    except Exception as e:
-        if progreso_callback: await progreso_callback(f"Error Drive: {str(e)}")
-
-    final_msg = f"COMPLETADO: {reporte['nuevos']} nuevos, {reporte['errores']} errores."
+    for servicio in servicios:
+        svc = _servicio(servicio)
+        if not _servicio_disponible(servicio, svc):
+            continue
+        cursor = db.get_sync_cursor(servicio)
+        modo = "incremental" if cursor else "completa (primera vez)"
+        if progreso_callback: await progreso_callback(f"Sincronizando {servicio} ({modo})...")
+        try:
+            async for cambios, nuevo_cursor in svc.iter_changes(cursor):
+                await _aplicar_cambios(servicio, cambios, reporte, progreso_callback, progress)
+                if nuevo_cursor:
+                    db.save_sync_cursor(servicio, nuevo_cursor)
+        except Exception as e:
+            if progreso_callback: await progreso_callback(f"Error {servicio}: {str(e)}")
+
+    final_msg = (f"COMPLETADO: {reporte['nuevos']} nuevos, {reporte['borrados']} borrados, "
+                 f"{reporte['sin_cambios']} ya indexados, {reporte['errores']} errores.")
     if progreso_callback: await progreso_callback(final_msg)
     return final_msg
-# ... (tus otros imports se mantienen igual)
 
-async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
-    """Lógica mejorada para procesar cualquier archivo y generar resúmenes"""
+
+def _contenido_modificado(fila, cambio):
+    """True si un archivo ya indexado trae en el feed otra versión de contenido que la guardada."""
+    version = cambio.get("version")
+    return bool(fila and fila["indexed"] and version and fila.get("content_version")
+                and fila["content_version"] != version)
+
+
+async def _aplicar_cambios(servicio, cambios, reporte, progreso_callback=None, progress=None):
+    """Aplica una página del feed: marca borrados e indexa lo que falte o haya cambiado."""
+    borrados = [c for c in cambios if c["deleted"]]
+    if borrados:
+        reporte["borrados"] += db.mark_files_missing(
+            servicio,
+            cloud_ids=[c["cloud_id"] for c in borrados if c["cloud_id"]],
+            names=[c["name"] for c in borrados if not c["cloud_id"] and c["name"]],
+        )
+
+    vivos = {c["name"]: c for c in cambios
+             if not c["deleted"] and c["name"] and c["name"] not in NOMBRES_IGNORADOS}
+    estado = db.get_files_index_state(servicio, list(vivos))
+    pendientes = {name for name, cambio in vivos.items()
+                  if not (estado.get(name) or {}).get("indexed") or _contenido_modificado(estado[name], cambio)}
+    if progress:
+        progress.add_total(len(pendientes))
+    for name, cambio in vivos.items():
+        fila = estado.get(name)
+        if name not in pendientes:
+            # Ya indexado y sin cambios: como mucho completamos la referencia estable
+            if not fila["cloud_id"] and cambio["cloud_id"]:
+                db.update_cloud_ref(fila["id"], cambio["cloud_id"], cambio["cloud_path"])
+            # Filas de antes de content_version: la primera versión vista se toma como la indexada
+            if cambio.get("version") and not fila.get("content_version"):
+                db.set_content_version(fila["id"], cambio["version"])
+            reporte["sin_cambios"] += 1
+            continue
+        if _contenido_modificado(fila, cambio):
+            if progreso_callback: await progreso_callback(f"🔄 Contenido modificado: {name}")
+            fila = None  # Se re-indexa entero; register_file actualiza la fila existente
+        if not progress:
+            await _indexar_si_falta(name, servicio, reporte, progreso_callback, ref=cambio, existente=fila)
+            continue
+        errores = reporte["errores"]
+        progress.begin()
+        with metered_tokens() as meter:
+            try:
+                await _indexar_si_falta(name, servicio, reporte, progreso_callback, ref=cambio, existente=fila)
+            finally:
+                progress.end("done" if reporte["errores"] == errores else "failed", meter[0])
+
+
+async def _enlace(servicio, svc, name, ref):
+    """Enlace de visualización, por id cuando lo hay."""
+    if servicio == 'dropbox':
+        return await svc.get_link(ref.get('cloud_path') or f"/{name}")
+    if ref.get('cloud_id'):
+        return await svc.get_link(ref['cloud_id'])
+    if servicio == 'drive':
+        return await svc.get_link_by_name(name)
+    return None
+
+
+_SIN_CONSULTAR = object()
+
+
+async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None, ref=None, existente=_SIN_CONSULTAR):
+    """Lógica mejorada para procesar cualquier archivo y generar resúmenes.
+
+    `ref` ({"cloud_id", "cloud_path", "version"}) evita buscar el archivo por nombre;
+    `existente` permite pasar el estado ya consultado en bloque.
+    """
     
-    if not name or name in [".", "..", "None", "General", "Imágenes"]:
+    if not name or name in NOMBRES_IGNORADOS:
         return
 
-    existente = db.get_file_by_name_and_service(name, servicio)
-    
-    # Si ya tiene embedding y summary, saltamos
-    if existente and existente.get('embedding') and existente.get('summary'):
+    if existente is _SIN_CONSULTAR:
+        fila = db.get_file_by_name_and_service(name, servicio)
+        # Si ya tiene embedding y summary, saltamos
+        if fila and fila.get('embedding') and fila.get('summary'):
+            return
+    elif existente and existente.get('indexed'):
         return
 
+    ref = ref or {}
+
     if progreso_callback: await progreso_callback(f"Procesando: {name} ({servicio})...")
     
     local_path = os.path.join("descargas", os.path.basename(name))
@@ -94,13 +206,11 @@ async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
         success = False
         url = "link_no_disponible"
         
-        # 1. Descarga
-        if servicio == 'dropbox':
-            success = await dropbox_svc.download_file(f"/{name}", local_path)
-            if success: url = await dropbox_svc.get_link(f"/{name}")
-        elif servicio == 'drive':
-            success = await drive_svc.download_file_by_name(name, local_path)
-            if success: url = await drive_svc.get_link_by_name(name)
+        # 1. Descarga (por id si el feed lo trae)
+        svc = _servicio(servicio)
+        if svc:
+            success = await svc.download_by_ref(ref.get('cloud_id'), name, local_path)
+            if success: url = await _enlace(servicio, svc, name, ref) or url
 
         if not success or not os.path.exists(local_path):
             raise Exception("No se pudo descargar.")
@@ -108,8 +218,11 @@ async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
         # 2. Análisis IA
         texto_limpio = ""
         vector = None
+        vector_next = None
         resumen = ""
         desc_tecnica = f"Documento {extension.upper()}"
+        # La versión sólo se guarda si el contenido nuevo se analizó: si no, la próxima sync lo reintenta
+        version = ref.get('version')
 
         try:
             texto = await AIHandler.extract_text(local_path)
@@ -118,10 +231,7 @@ async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
             # Si el archivo tiene contenido real
             if texto_limpio and len(texto_limpio.strip()) > 50:
                 # Obtenemos resumen y embedding en paralelo para ganar velocidad
-                resumen, vector = await asyncio.gather(
-                    AIHandler.generate_summary(texto_limpio),
-                    AIHandler.get_embedding(texto_limpio)
-                )
+                resumen, vector, vector_next = await AIHandler.generate_summary_and_embedding(texto_limpio)
             else:
                 # Punto 2: Fallback para archivos sin texto (ZIP, EXE, etc.)
                 resumen = f"Archivo tipo .{extension} indexado por nombre. Sin contenido de texto extraíble."
@@ -135,11 +245,13 @@ async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
             resumen = f"Archivo .{extension} registrado (Cuota IA agotada)."
             vector = None
             texto_limpio = None
+            version = None
         except Exception as ai_err:
             print(f"⚠️ IA saltada para {name}: {ai_err}")
             if progreso_callback: await progreso_callback(f"⚠️ IA saltada: {ai_err}")
             resumen = f"Archivo .{extension} registrado (Análisis IA no disponible)."
             texto_limpio = None
+            version = None
         # 3. Registro en DB con las nuevas columnas
         # Asegúrate de que tu db.register_file acepte estos nuevos argumentos
         db.register_file(
@@ -151,14 +263,16 @@ async def _indexar_si_falta(name, servicio, reporte, progreso_callback=None):
             content_text=texto_limpio,
             embedding=vector,
             summary=resumen, # NUEVA
-            technical_description=desc_tecnica # NUEVA
+            technical_description=desc_tecnica, # NUEVA
+            embedding_next=vector_next,
+            cloud_id=ref.get('cloud_id'),
+            cloud_path=ref.get('cloud_path'),
+            content_version=version
         )
         
         reporte['nuevos'] += 1
         if progreso_callback: await progreso_callback(f"✅ Registrado: {name}")
-        
-        # Pausa para evitar exceder el límite de 15 peticiones/min de Gemini Free Tier
-        await asyncio.sleep(4.5)
+        # El ritmo frente al rate-limit lo marca el gobernador de cuota (ai_scheduler)
 
     except Exception as e:
         error_msg = str(e)
@@ -181,6 +295,65 @@ async def ejecutar_indexacion_completa():
     return await procesar_archivos_viejos()
 
 
+async def obtener_texto_archivo(fid, name, servicio, content_text, log):
+    """Texto listo para la IA: el `content_text` guardado o, si no hay, descarga + extracción.
+
+    Returns:
+        tuple: (texto_limpio | None, encontrado). `encontrado` es False si el
+        archivo ya no existe en la nube (queda marcado como huérfano).
+    """
+    # CASO A: Ya tenemos el texto en la BD → solo generar embedding y resumen
+    if content_text and len(content_text.strip()) > 20:
+        texto_limpio = limpiar_y_recortar_texto(content_text)
+        await log(f"   ↳ Usando content_text existente ({len(texto_limpio)} chars)")
+        return texto_limpio, True
+
+    # CASO B: Sin texto → intentar descargar y analizar
+    await log(f"   ↳ Sin content_text, descargando para análisis IA...")
+    extension = name.split('.')[-1].lower() if '.' in name else 'desconocido'
+    # Prefijo con el id: varios archivos se procesan a la vez
+    local_path = os.path.join("descargas", f"{fid}_{os.path.basename(name)}")
+    if not os.path.exists("descargas"):
+        os.makedirs("descargas")
+
+    success = False
+    file_missing = False
+    try:
+        svc = _servicio(servicio)
+        if svc:
+            # Por cloud_id si lo tenemos; si no, búsqueda por nombre en cualquier carpeta
+            ref = db.get_cloud_ref(name, servicio) or {}
+            success = await svc.download_by_ref(ref.get('cloud_id'), name, local_path)
+            if not success:
+                file_missing = True
+    except Exception as dl_err:
+        await log(f"   ⚠️ Error descargando {name}: {dl_err}")
+
+    if file_missing:
+        await log(f"   🚫 Archivo no encontrado en la nube. Marcando como huérfano.")
+        with db._connect() as conn2:
+            with conn2.cursor() as cur2:
+                cur2.execute("UPDATE files SET summary = 'Archivo no encontrado en la nube' WHERE id = %s", (fid,))
+            conn2.commit()
+        return None, False
+
+    texto_limpio = None
+    if success and os.path.exists(local_path):
+        try:
+            await log(f"   🧠 Extrayendo texto ({extension})...")
+            texto = await AIHandler.extract_text(local_path)
+            texto_limpio = limpiar_y_recortar_texto(texto)
+        except QuotaExceededError as qe:
+            await log(f"   🚨 {qe}")
+            raise qe # Re-lanzar para que el bucle superior se detenga
+        except Exception as ai_err:
+            await log(f"   ⚠️ Error IA: {ai_err}")
+        finally:
+            try: os.remove(local_path)
+            except: pass
+    return texto_limpio, True
+
+
 async def procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text, log_callback):
     """
     Procesamiento atómico de un solo archivo (Download -> Extract -> Summary -> Embedding -> DB Update).
@@ -192,65 +365,18 @@ async def procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text,
     extension = name.split('.')[-1].lower() if '.' in name else 'desconocido'
     
     try:
-        texto_limpio = None
         resumen = None
         vector = None
+        vector_next = None
 
-        # CASO A: Ya tenemos el texto en la BD → solo generar embedding y resumen
-        if content_text and len(content_text.strip()) > 20:
-            texto_limpio = limpiar_y_recortar_texto(content_text)
-            await log(f"   ↳ Usando content_text existente ({len(texto_limpio)} chars)")
-        else:
-            # CASO B: Sin texto → intentar descargar y analizar
-            await log(f"   ↳ Sin content_text, descargando para análisis IA...")
-            local_path = os.path.join("descargas", os.path.basename(name))
-            if not os.path.exists("descargas"):
-                os.makedirs("descargas")
-
-            success = False
-            file_missing = False
-            try:
-                if servicio == 'dropbox':
-                    # Usar búsqueda por nombre para encontrarlo en cualquier carpeta (similar a Drive)
-                    success = await dropbox_svc.download_file_by_name(name, local_path)
-                    if not success:
-                        file_missing = True
-                elif servicio == 'drive':
-                    success = await drive_svc.download_file_by_name(name, local_path)
-                    if not success:
-                        file_missing = True
-            except Exception as dl_err:
-                await log(f"   ⚠️ Error descargando {name}: {dl_err}")
-
-            if file_missing:
-                await log(f"   🚫 Archivo no encontrado en la nube. Marcando como huérfano.")
-                with db._connect() as conn2:
-                    with conn2.cursor() as cur2:
-                        cur2.execute("UPDATE files SET summary = 'Archivo no encontrado en la nube' WHERE id = %s", (fid,))
-                    conn2.commit()
-                return False
-
-            if success and os.path.exists(local_path):
-                try:
-                    await log(f"   🧠 Extrayendo texto ({extension})...")
-                    texto = await AIHandler.extract_text(local_path)
-                    texto_limpio = limpiar_y_recortar_texto(texto)
-                except QuotaExceededError as qe:
-                    await log(f"   🚨 {qe}")
-                    raise qe # Re-lanzar para que el bucle superior se detenga
-                except Exception as ai_err:
-                    await log(f"   ⚠️ Error IA: {ai_err}")
-                finally:
-                    try: os.remove(local_path)
-                    except: pass
+        texto_limpio, encontrado = await obtener_texto_archivo(fid, name, servicio, content_text, log)
+        if not encontrado:
+            return False
         
         # Generar embedding + resumen si tenemos texto
         if texto_limpio and len(texto_limpio.strip()) > 20:
             try:
-                resumen, vector = await asyncio.gather(
-                    AIHandler.generate_summary(texto_limpio),
-                    AIHandler.get_embedding(texto_limpio)
-                )
+                resumen, vector, vector_next = await AIHandler.generate_summary_and_embedding(texto_limpio)
             except QuotaExceededError as qe:
                 await log(f"   🚨 {qe}")
                 raise qe
@@ -259,12 +385,10 @@ async def procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text,
             # Pero aún intentamos guardar algo en la BD para marcar que lo intentamos
             vector = None
 
-        if vector:
-            import json as _json
-            import numpy as _np
-            emb_str = _json.dumps(vector.tolist() if isinstance(vector, _np.ndarray) else vector)
-        else:
-            emb_str = None
+        # Serializa y etiqueta con el modelo activo (descarta vectores de dims incompatibles)
+        emb_str, emb_model, emb_dims = db._prepare_active_embedding(vector, name)
+        if not emb_str:
+            vector = None
 
         # Siempre actualizar la fila con summary y content_text, embedding solo si hay vector
         with db._connect() as conn:
@@ -273,28 +397,38 @@ async def procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text,
                 cur.execute("""
                     UPDATE files
                     SET embedding = %s,
+                        embedding_model = %s,
+                        embedding_dims = %s,
                         summary   = COALESCE(%s, summary),
                         content_text = COALESCE(%s, content_text)
                     WHERE id = %s
-                """, (emb_str, resumen, texto_limpio, fid))
+                """, (emb_str, emb_model, emb_dims, resumen, texto_limpio, fid))
 
                 # 2. PROPAGACIÓN: Buscar duplicados por nombre en otras nubes que no tengan IA aún (solo si hay vector)
                 if vector:
                     cur.execute("""
                         UPDATE files
                         SET embedding = %s,
+                            embedding_model = %s,
+                            embedding_dims = %s,
                             summary = COALESCE(%s, summary),
                             content_text = COALESCE(%s, content_text)
                         WHERE name = %s 
                         AND id != %s
                         AND embedding IS NULL
-                    """, (emb_str, resumen, texto_limpio, name, fid))
+                        RETURNING id
+                    """, (emb_str, emb_model, emb_dims, resumen, texto_limpio, name, fid))
                     
-                    propagated = cur.rowcount
+                    duplicados = [r[0] for r in cur.fetchall()]
+                    propagated = len(duplicados)
                 else:
                     propagated = 0
                 
             conn.commit()
+
+        # Doble escritura en la columna sombra si hay una migración de modelo en curso
+        if vector and vector_next is not None:
+            db.update_shadow_embeddings([(i, vector_next) for i in [fid] + duplicados])
         
         if vector:
             await log(f"   ✅ Embedding guardado ({len(vector)} dims)")
@@ -305,14 +439,19 @@ async def procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text,
             await log(f"   ⚠️ Procesado sin embedding (sin contenido extraíble).")
             return False
 
+    except QuotaExceededError:
+        raise  # Sin cuota no es un fallo del archivo: el llamador pausa o detiene el lote
     except Exception as e:
         await log(f"   ❌ Error en {name}: {e}")
         return False
 
 
-async def generar_embeddings_pendientes(limite: int, progreso_callback=None, check_stop_callback=None):
+@in_ai_lane(LANE_BACKFILL)
+async def generar_embeddings_pendientes(limite: int, progreso_callback=None, check_stop_callback=None, progress=None):
     """
     Genera embeddings para archivos que YA están en la BD pero sin embedding.
+
+    `progress` (ProgressTracker opcional) recibe total, hechas, fallidas y tokens.
     """
     async def log(msg):
         print(f"[EMBED] {msg}")
@@ -340,6 +479,8 @@ async def generar_embeddings_pendientes(limite: int, progreso_callback=None, che
 
     total = len(pendientes)
     await log(f"📋 Encontrados: {total} archivos pendientes.")
+    if progress:
+        progress.start(total, label="embeddings")
 
     if total == 0:
         await log("✅ No hay archivos pendientes. ¡Todo indexado!")
@@ -347,91 +488,167 @@ async def generar_embeddings_pendientes(limite: int, progreso_callback=None, che
 
     reporte = {"procesados": 0, "errores": 0}
 
-    for i, (fid, name, servicio, cloud_url, content_text) in enumerate(pendientes, 1):
+    async def procesar(i, fila):
+        fid, name, servicio, cloud_url, content_text = fila
+        await log(f"[{i}/{total}] Procesando: {name} ({servicio})")
+        if not progress:
+            return await procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text, log)
+        outcome = "retry"  # Cuota agotada: la unidad sigue pendiente
+        progress.begin()
+        with metered_tokens() as meter:
+            try:
+                ok = await procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text, log)
+                outcome = "done" if ok is True else "failed"
+                return ok
+            except QuotaExceededError:
+                raise
+            except Exception:
+                outcome = "failed"
+                raise
+            finally:
+                progress.end(outcome, meter[0])
+
+    # Varios archivos a la vez: sus resúmenes viajan juntos en una petición
+    # (summary_batcher) y el ritmo lo marca el gobernador de cuota.
+    for inicio in range(0, total, EMBED_CONCURRENCY):
         # 🟢 Verificar si el usuario pidió detener el proceso
         if check_stop_callback and check_stop_callback():
             await log("🛑 Proceso detenido por el usuario.")
             break
 
-        await log(f"[{i}/{total}] Procesando: {name} ({servicio})")
-        
-        try:
-            ok = await procesar_un_archivo_core(fid, name, servicio, cloud_url, content_text, log)
-            if ok:
+        tanda = pendientes[inicio:inicio + EMBED_CONCURRENCY]
+        resultados = await asyncio.gather(
+            *(procesar(inicio + j, fila) for j, fila in enumerate(tanda, 1)),
+            return_exceptions=True
+        )
+        for r in resultados:
+            if r is True:
                 reporte["procesados"] += 1
-            else:
+            elif not isinstance(r, QuotaExceededError):
                 reporte["errores"] += 1
-        except QuotaExceededError:
+        if any(isinstance(r, QuotaExceededError) for r in resultados):
             await log("🛑 Deteniendo proceso por falta de cuota. Reintenta en unos minutos.")
             break
 
-        # Pausa para respetar rate-limit de Gemini Free Tier
-        await asyncio.sleep(4)
-
     await log(f"🏁 Completado: {reporte['procesados']} embeddings generados, {reporte['errores']} errores.")
+    if progress:
+        progress.set_status("done")
     return reporte
 
 
-async def ejecutar_embeddings_batch_sse(limite: int):
+@in_ai_lane(LANE_BACKFILL)
+async def reembeber_en_sombra(limite: int = 0, progreso_callback=None, check_stop_callback=None, lote: int = 64):
     """
-    Generador asíncrono para SSE streaming del proceso de embeddings por lotes.
-    Yields strings en formato 'data: mensaje\\n\\n'
+    Rellena la columna sombra `embedding_next` con el modelo en migración.
+
+    Re-embebe desde `content_text` (sin descargar nada de la nube) en lotes de
+    `lote` textos por llamada a la API. Las búsquedas siguen usando la columna
+    activa mientras tanto; el cambio lo hace DatabaseHandler.switch_embedding_column().
     """
-    yield "data: 5\n\n"
-    yield f"data: 🧠 Iniciando generación de embeddings (lote: {'TODOS' if limite == 0 else limite})...\n\n"
+    async def log(msg):
+        print(f"[REEMBED] {msg}")
+        if progreso_callback:
+            await progreso_callback(msg)
+
+    building = db.get_embedding_specs(use_cache=False).get("building")
+    if not building:
+        await log("ℹ️ No hay ninguna migración de embeddings en curso.")
+        return {"procesados": 0, "errores": 0}
 
-    queue = asyncio.Queue()
+    estado = db.get_embedding_migration_status()
+    await log(f"🧬 Re-embebiendo hacia {building['model']} ({building['dims']} dims): "
+              f"{estado['pending']} pendientes de {estado['total']}.")
 
-    async def callback(msg):
-        await queue.put(msg)
+    reporte = {"procesados": 0, "errores": 0}
+    fallidos = set()
+    while True:
+        if check_stop_callback and check_stop_callback():
+            await log("🛑 Proceso detenido por el usuario.")
+            break
+        restante = limite - reporte["procesados"] if limite > 0 else lote
+        if restante <= 0:
+            break
 
-    task = asyncio.create_task(generar_embeddings_pendientes(limite, callback))
+        # Sobre-pedimos lo ya fallido para no quedarnos atascados en las mismas filas
+        filas = [f for f in db.get_files_pending_shadow(min(lote, restante) + len(fallidos))
+                 if f['id'] not in fallidos][:min(lote, restante)]
+        if not filas:
+            break
 
-    while not task.done() or not queue.empty():
         try:
-            msg = await asyncio.wait_for(queue.get(), timeout=1.0)
-            yield f"data: {msg}\n\n"
-            yield "data: 50\n\n"
-        except asyncio.TimeoutError:
-            continue
+            vectores = await AIHandler.get_embeddings_batch(
+                [limpiar_y_recortar_texto(f['content_text']) for f in filas],
+                model=building["model"], dimensions=building["dims"]
+            )
+        except QuotaExceededError as qe:
+            await log(f"🚨 {qe}. Deteniendo; se puede reanudar más tarde.")
+            break
+
+        escritos = db.update_shadow_embeddings(
+            [(f['id'], v) for f, v in zip(filas, vectores) if v is not None]
+        )
+        reporte["procesados"] += escritos
+        for f, v in zip(filas, vectores):
+            if v is None:
+                fallidos.add(f['id'])
+                reporte["errores"] += 1
+        await log(f"✅ Lote: {escritos} vectores nuevos (total {reporte['procesados']}).")
 
-    resultado = await task
-    yield f"data: ✅ Finalizado: {resultado['procesados']} generados, {resultado['errores']} errores.\n\n"
-    yield "data: 100\n\n"
+    estado = db.get_embedding_migration_status()
+    await log(f"🏁 Sombra: {estado['done']}/{estado['total']} listos, {estado['pending']} pendientes.")
+    if estado['sin_texto']:
+        await log(f"ℹ️ {estado['sin_texto']} archivos sin texto guardado: se re-indexarán tras el cambio.")
+    return reporte
 
 
-async def ejecutar_indexacion_paso_a_paso():
+async def rellenar_cloud_ids(limite: int = 0, progreso_callback=None, check_stop_callback=None, servicio=None):
     """
-    Generador asíncrono que envía datos al EventSource del Dashboard.
-    Envía porcentajes y mensajes de texto.
+    Backfill de `cloud_id`/`cloud_path` para filas registradas antes de que existieran.
+
+    Busca cada archivo por nombre una única vez; a partir de ahí descargas,
+    borrados y movimientos van directos por id. Las entradas virtuales de ZIP
+    ("zip > miembro") no existen en la nube y se ignoran.
     """
-    yield "data: 5\n\n"
-    yield "data: 🔍 Iniciando sincronización de nubes...\n\n"
+    async def log(msg):
+        print(f"[CLOUD_ID] {msg}")
+        if progreso_callback:
+            await progreso_callback(msg)
 
-    queue = asyncio.Queue()
+    reporte = {"actualizados": 0, "no_encontrados": 0, "errores": 0}
+    vistos = set()
+    while True:
+        if check_stop_callback and check_stop_callback():
+            await log("🛑 Proceso detenido por el usuario.")
+            break
+        procesados = sum(reporte.values())
+        if limite > 0 and procesados >= limite:
+            break
+        lote = 50 if limite <= 0 else min(50, limite - procesados)
+        filas = db.get_files_missing_cloud_ref(lote, servicio, exclude_ids=vistos)
+        if not filas:
+            break
 
-    # Función interna para capturar logs del indexador y meterlos en la cola
-    async def callback_progreso(msg):
-        await queue.put(msg)
+        for f in filas:
+            vistos.add(f['id'])
+            svc = _servicio(f['service'])
+            if not svc or " > " in f['name']:
+                continue
+            try:
+                ref = await svc.find_ref_by_name(f['name'])
+                if ref and ref.get('cloud_id'):
+                    db.update_cloud_ref(f['id'], ref['cloud_id'], ref.get('cloud_path'))
+                    reporte["actualizados"] += 1
+                else:
+                    reporte["no_encontrados"] += 1
+            except Exception as e:
+                reporte["errores"] += 1
+                await log(f"⚠️ {f['name']} ({f['service']}): {e}")
+        await log(f"🔗 {reporte['actualizados']} referencias guardadas, "
+                  f"{reporte['no_encontrados']} no encontradas, {reporte['errores']} errores.")
 
-    # Lanzamos la indexación en una tarea separada
-    task = asyncio.create_task(procesar_archivos_viejos(callback_progreso))
-    
-    # Mientras la tarea no termine, sacamos mensajes de la cola y los enviamos al navegador
-    while not task.done() or not queue.empty():
-        try:
-            # Esperamos un mensaje con un timeout pequeño para no bloquear
-            msg = await asyncio.wait_for(queue.get(), timeout=1.0)
-            yield f"data: {msg}\n\n"
-            # Enviamos un progreso ficticio intermedio para mover la barra
-            yield f"data: 50\n\n"
-        except asyncio.TimeoutError:
-            continue
+    await log(f"🏁 Backfill de cloud_id terminado: {reporte}")
+    return reporte
 
-    resultado_final = await task
-    yield f"data: {resultado_final}\n\n"
-    yield "data: 100\n\n"
-    
 
 # --- BLOQUE DE EJECUCIÓN MANUAL ---
 if __name__ == "__main__":
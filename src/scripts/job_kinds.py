@@ -0,0 +1,278 @@
+"""Tipos de job durables (ver src/utils/jobs.py).
+
+Cada tipo define `plan` (qué unidades de trabajo hay) y `process` (cómo se
+hace una). `process` debe ser idempotente: tras una caída la misma unidad
+puede ejecutarse otra vez.
+"""
+import os
+import asyncio
+
+from src.utils.ai_handler import AIHandler, QuotaExceededError, SUMMARY_PROMPT
+from src.utils.ai_batch import (
+    get_batch_backend,
+    embedding_request,
+    chat_request,
+    parse_result_line,
+    mean_embedding,
+    chat_content,
+    ENDPOINT_EMBEDDINGS,
+    ENDPOINT_CHAT,
+    BATCH_FINAL_STATUSES,
+)
+from src.utils.embedding_providers import OpenAIEmbeddingProvider
+from src.utils.jobs import register_job_kind, JobPause
+from src.utils.cost_planner import get_plan, format_duration
+from src.scripts.indexador import (
+    db,
+    SYNC_SERVICIOS,
+    procesar_archivos_viejos,
+    procesar_un_archivo_core,
+    obtener_texto_archivo,
+    rellenar_cloud_ids,
+    reembeber_en_sombra,
+    EMBED_CONCURRENCY,
+)
+
+# Pausa extra entre archivos (el ritmo frente al rate-limit ya lo marca el
+# gobernador de cuota a partir de las cabeceras del proveedor)
+EMBED_ITEM_PAUSE = float(os.getenv("EMBED_ITEM_PAUSE", "0"))
+# Archivos por lote enviado a la Batch API y cada cuánto se consulta su estado
+AI_BATCH_CHUNK = int(os.getenv("AI_BATCH_CHUNK", "500"))
+AI_BATCH_POLL_SECONDS = int(os.getenv("AI_BATCH_POLL_SECONDS", "300"))
+
+
+# --- Embeddings: una unidad por archivo sin embedding ---
+
+async def _plan_embeddings(params, ctx):
+    limite = int(params.get("limite", 10) or 0)
+    filas = db.get_files_without_embedding(limit=limite or None)
+    await ctx.log(f"🔍 {len(filas)} archivos sin embedding"
+                  f"{' (TODOS)' if limite == 0 else f' (máx. {limite})'}.")
+    plan = get_plan(params["plan_id"]) if params.get("plan_id") else None
+    if plan:
+        await ctx.log(f"📊 Plan {plan['plan_id']}: {plan['files']} archivos previstos, "
+                      f"~{format_duration(plan['eta_seconds'])} y ~${plan['cost_usd']['total']:.2f} "
+                      f"(límite: {plan['bottleneck']}).")
+    return [(f["id"], f["id"]) for f in filas]
+
+
+async def _process_embedding(file_id, ctx):
+    f = db.get_file_by_id(file_id)
+    if not f or f["embedding"] is not None:
+        return True  # Borrado o ya embebido en una ejecución anterior
+    await ctx.log(f"Procesando: {f['name']} ({f['service']})")
+    try:
+        ok = await procesar_un_archivo_core(
+            f["id"], f["name"], f["service"], f["cloud_url"], f["content_text"], ctx.log
+        )
+    except QuotaExceededError as qe:
+        raise JobPause(f"Sin cuota de IA ({qe})", delay=qe.retry_after)
+    if EMBED_ITEM_PAUSE:
+        await asyncio.sleep(EMBED_ITEM_PAUSE)
+    return ok
+
+
+# --- Indexador: una unidad por nube (el cursor de sync ya es incremental) ---
+
+async def _plan_indexer(params, ctx):
+    servicios = params.get("servicios") or SYNC_SERVICIOS
+    return [(s, s) for s in servicios]
+
+
+async def _process_indexer(servicio, ctx):
+    # El progreso del job cuenta archivos (add_total/begin/end por archivo), no nubes
+    await procesar_archivos_viejos(ctx.log, servicios=(servicio,), progress=ctx.progress)
+    return True
+
+
+# --- Categorizador: una sola unidad (mover a la carpeta de categoría es idempotente) ---
+
+async def _plan_single(params, ctx):
+    return [("all", params)]
+
+
+async def _process_categorizer(_payload, ctx):
+    from src.scripts.categorize_with_logs import categorize_with_logs
+    async for message in categorize_with_logs():
+        await ctx.log(message)
+    return True
+
+
+# --- Backfill de cloud_id: una unidad por nube ---
+
+async def _plan_cloud_ids(params, ctx):
+    servicio = params.get("servicio")
+    servicios = (servicio,) if servicio else SYNC_SERVICIOS
+    return [(s, {"servicio": s, "limite": int(params.get("limite", 0) or 0)}) for s in servicios]
+
+
+async def _process_cloud_ids(payload, ctx):
+    await rellenar_cloud_ids(payload["limite"], ctx.log, ctx.should_stop, servicio=payload["servicio"])
+    return True
+
+
+# --- Re-embedding a columna sombra ---
+
+async def _process_reembed(payload, ctx):
+    await reembeber_en_sombra(int(payload.get("limite", 0) or 0), ctx.log, ctx.should_stop)
+    return True
+
+
+# --- Re-indexación offline por Batch API (ver src/utils/ai_batch.py) ---
+#
+# Dos fases por lote de archivos: `prep:N` obtiene los textos y envía los
+# lotes al proveedor (uno por endpoint/modelo) y crea la unidad `apply:N`,
+# que sondea pausando el job (JobPause, sin gastar intentos) hasta que el
+# proveedor termina y entonces aplica los resultados en bloque.
+
+def _batch_embedding_specs():
+    """[(rol, spec)] de los modelos de embedding a calcular por lote."""
+    specs = [("embedding", AIHandler.get_embedding_spec()),
+             ("embedding_next", AIHandler.get_embedding_spec("building"))]
+    return [(role, spec) for role, spec in specs
+            if spec and AIHandler.EMBEDDING_MODELS.get(spec["model"], {}).get("provider") == "openai"]
+
+
+def _embedding_chunks(texto):
+    texto = AIHandler._clean_embedding_text(texto)
+    step = OpenAIEmbeddingProvider.MAX_CHARS_SAFE
+    return [texto[i:i + step] for i in range(0, len(texto), step)][:OpenAIEmbeddingProvider.MAX_CHUNKS]
+
+
+async def _plan_ai_batch(params, ctx):
+    if not any(role == "embedding" for role, _ in _batch_embedding_specs()):
+        await ctx.log("⚠️ El modelo de embedding activo no es de OpenAI: usa el job de embeddings normal.")
+        return []
+    limite = int(params.get("limite", 0) or 0)
+    ids = [f["id"] for f in db.get_files_without_embedding(limit=limite or None)]
+    lotes = [ids[i:i + AI_BATCH_CHUNK] for i in range(0, len(ids), AI_BATCH_CHUNK)]
+    await ctx.log(f"📦 {len(ids)} archivos sin embedding en {len(lotes)} lotes de hasta {AI_BATCH_CHUNK} "
+                  f"(backend {get_batch_backend().name}).")
+    return [(f"prep:{n}", {"chunk": n, "file_ids": lote}) for n, lote in enumerate(lotes)]
+
+
+async def _submit_ai_batch(payload, ctx):
+    n = payload["chunk"]
+    apply_key = f"apply:{n}"
+    if await asyncio.to_thread(db.get_job_item_payload, ctx.job_id, apply_key):
+        return True  # Ya enviado en un intento anterior
+
+    filas = await asyncio.to_thread(db.get_files_for_ai_batch, payload["file_ids"])
+    await ctx.log(f"📦 Lote {n}: obteniendo el texto de {len(filas)} archivos...")
+    slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def texto_de(f):
+        async with slots:
+            return await obtener_texto_archivo(f["id"], f["name"], f["service"], f["content_text"], ctx.log)
+
+    try:
+        obtenidos = await asyncio.gather(*(texto_de(f) for f in filas))
+    except QuotaExceededError as qe:
+        raise JobPause(f"Sin cuota de IA extrayendo texto ({qe})", delay=qe.retry_after)
+
+    con_texto, sin_texto = [], []
+    for f, (texto, encontrado) in zip(filas, obtenidos):
+        if texto and len(texto.strip()) > 20:
+            con_texto.append((f, texto))
+        elif encontrado:
+            extension = f["name"].split('.')[-1].lower() if '.' in f["name"] else 'desconocido'
+            sin_texto.append((f["id"], None, f"Archivo .{extension} sin contenido de texto extraíble.", None))
+    # El texto recién extraído se guarda: un reintento no vuelve a descargar
+    await asyncio.to_thread(db.set_files_content_text,
+                            [(f["id"], texto) for f, texto in con_texto if not f["content_text"]])
+    if sin_texto:
+        await asyncio.to_thread(db.apply_ai_batch_results, sin_texto)
+    if not con_texto:
+        await ctx.log(f"⚠️ Lote {n}: ningún archivo con texto; nada que enviar.")
+        return True
+
+    backend = get_batch_backend()
+    # Cada lote enviado se apunta en el payload de `prep:N` en cuanto el proveedor
+    # lo acepta: si el intento muere a medias, el reintento no lo vuelve a pagar.
+    batches = dict(payload.get("submitted") or {})
+    metadata = {"job_id": ctx.job_id, "chunk": n}
+
+    async def enviar(role, endpoint, requests):
+        if role in batches:
+            return
+        batches[role] = await asyncio.to_thread(backend.submit, requests, endpoint, metadata)
+        await asyncio.to_thread(db.update_job_item_payload, ctx.job_id, f"prep:{n}",
+                                {**payload, "submitted": batches})
+
+    for role, spec in _batch_embedding_specs():
+        native = AIHandler.EMBEDDING_MODELS[spec["model"]]["dims"]
+        dims = spec["dims"] if spec["dims"] != native else None
+        await enviar(role, ENDPOINT_EMBEDDINGS,
+                     [embedding_request(f"{role}:{f['id']}", _embedding_chunks(texto), spec["model"], dims)
+                      for f, texto in con_texto])
+    if ctx.params.get("summaries", True):
+        await enviar("summary", ENDPOINT_CHAT,
+                     [chat_request(f"summary:{f['id']}", SUMMARY_PROMPT, texto[:5000]) for f, texto in con_texto])
+
+    await asyncio.to_thread(db.add_job_items, ctx.job_id, [
+        (apply_key, {"chunk": n, "file_ids": [f["id"] for f, _ in con_texto], "batches": batches})
+    ])
+    await ctx.log(f"🚀 Lote {n}: {len(con_texto)} archivos enviados al proveedor ({', '.join(batches)}).")
+    return True
+
+
+async def _apply_ai_batch(payload, ctx):
+    n = payload["chunk"]
+    backend = get_batch_backend()
+    infos = {}
+    for role, batch_id in payload["batches"].items():
+        infos[role] = await asyncio.to_thread(backend.status, batch_id)
+    if any(info["status"] not in BATCH_FINAL_STATUSES for info in infos.values()):
+        hechas = sum(info["completed"] for info in infos.values())
+        total = sum(info["total"] for info in infos.values())
+        raise JobPause(f"Lote {n} en curso en el proveedor ({hechas}/{total} peticiones)",
+                       delay=AI_BATCH_POLL_SECONDS)
+
+    vectores = {"embedding": {}, "embedding_next": {}}
+    resumenes = {}
+    errores = 0
+    for role, info in infos.items():
+        if info["status"] != "completed":
+            await ctx.log(f"⚠️ Lote {n} ({role}) terminó como '{info['status']}'; se aplica lo disponible.")
+        lineas = await asyncio.to_thread(lambda: list(backend.results(info)))
+        for linea in lineas:
+            custom_id, body, error = parse_result_line(linea)
+            if error or not custom_id:
+                errores += 1
+                continue
+            file_id = int(custom_id.split(":", 1)[1])
+            if role == "summary":
+                parsed = AIHandler._parse_json_response(chat_content(body) or "")
+                if isinstance(parsed, dict):
+                    resumenes[file_id] = AIHandler._normalize_summary(parsed)
+            else:
+                vectores[role][file_id] = mean_embedding(body)
+
+    filas = []
+    for file_id in payload["file_ids"]:
+        resumen = resumenes.get(file_id) or {}
+        tags = ",".join(resumen.get("tags") or []) or None
+        filas.append((file_id, vectores["embedding"].get(file_id), resumen.get("summary"), tags))
+    aplicados = await asyncio.to_thread(db.apply_ai_batch_results, filas)
+    if vectores["embedding_next"]:
+        await asyncio.to_thread(db.update_shadow_embeddings, list(vectores["embedding_next"].items()))
+    await ctx.log(f"✅ Lote {n}: {aplicados}/{len(filas)} embeddings y {len(resumenes)} resúmenes aplicados"
+                  f"{f' ({errores} peticiones con error)' if errores else ''}.")
+    return True
+
+
+async def _process_ai_batch(payload, ctx):
+    if "batches" in payload:
+        return await _apply_ai_batch(payload, ctx)
+    return await _submit_ai_batch(payload, ctx)
+
+
+# Varios archivos a la vez por lote: sus resúmenes se agrupan en una petición
+register_job_kind("embeddings", _plan_embeddings, _process_embedding, concurrency=EMBED_CONCURRENCY,
+                  priority=6, fanout=True)
+register_job_kind("indexer", _plan_indexer, _process_indexer, concurrency=len(SYNC_SERVICIOS),
+                  item_progress=False)
+register_job_kind("categorizer", _plan_single, _process_categorizer, priority=4)
+register_job_kind("cloud_ids", _plan_cloud_ids, _process_cloud_ids, concurrency=len(SYNC_SERVICIOS), priority=3)
+register_job_kind("reembed_shadow", _plan_single, _process_reembed, priority=3)
+register_job_kind("ai_batch", _plan_ai_batch, _process_ai_batch, priority=2)
@@ -25,8 +25,16 @@ Mejoras frente a la versión anterior (que daba resultados ilógicos):
    para invalidar resultados cuando se reindexa.
 
 7) **Logging claro** del score final y de cuántos vinieron de cada fuente.
+
+8) **Presupuesto de latencia por búsqueda**: el embedding de la query y el
+   reranker LLM tienen plazo propio (dentro de SEARCH_LATENCY_BUDGET). El
+   embedding se duplica (hedging) si tarda más de SEARCH_EMBED_HEDGE_AFTER.
+   Si el embedding no llega → resultados sólo léxicos; si el reranker no
+   llega → orden RRF. Los contadores de cada degradación están en
+   `get_search_latency_metrics()`.
 """
 import json
+import time
 import asyncio
 import os
 import hashlib
@@ -36,6 +44,80 @@ from typing import List, Dict, Optional, Set
 
 logger = logging.getLogger(__name__)
 
+# Presupuesto total de una búsqueda y plazo de cada etapa remota (segundos)
+SEARCH_LATENCY_BUDGET = float(os.getenv("SEARCH_LATENCY_BUDGET", "10"))
+SEARCH_EMBED_DEADLINE = float(os.getenv("SEARCH_EMBED_DEADLINE", "3"))
+SEARCH_RERANK_DEADLINE = float(os.getenv("SEARCH_RERANK_DEADLINE", "6"))
+# Segundos sin respuesta tras los que se lanza un embedding duplicado (0 = sin hedging)
+SEARCH_EMBED_HEDGE_AFTER = float(os.getenv("SEARCH_EMBED_HEDGE_AFTER", "1.2"))
+# Por debajo de este margen restante ni se intenta el reranker
+SEARCH_RERANK_MIN_BUDGET = 0.5
+
+# ---------------------------------------------------------------------------
+# Métricas de latencia y degradación (por proceso)
+# ---------------------------------------------------------------------------
+
+_latency_metrics = {
+    "searches": 0,
+    "embed_calls": 0,
+    "embed_ms_total": 0.0,
+    "embed_timeouts": 0,
+    "embed_failures": 0,
+    "embed_hedges": 0,
+    "embed_hedge_wins": 0,
+    "lexical_fallbacks": 0,
+    "rerank_calls": 0,
+    "rerank_ms_total": 0.0,
+    "rerank_timeouts": 0,
+    "rerank_errors": 0,
+    "rerank_skipped": 0,
+    "rrf_fallbacks": 0,
+}
+
+
+def get_search_latency_metrics() -> Dict:
+    """Contadores de las etapas remotas de la búsqueda y de cada degradación."""
+    m = dict(_latency_metrics)
+    embed_ms, rerank_ms = m.pop("embed_ms_total"), m.pop("rerank_ms_total")
+    m["embed_avg_ms"] = round(embed_ms / m["embed_calls"], 1) if m["embed_calls"] else 0.0
+    m["rerank_avg_ms"] = round(rerank_ms / m["rerank_calls"], 1) if m["rerank_calls"] else 0.0
+    m["budget_s"] = SEARCH_LATENCY_BUDGET
+    m["embed_deadline_s"] = SEARCH_EMBED_DEADLINE
+    m["rerank_deadline_s"] = SEARCH_RERANK_DEADLINE
+    m["hedge_after_s"] = SEARCH_EMBED_HEDGE_AFTER
+    return m
+
+
+async def _hedged(factory, hedge_after: float):
+    """Ejecuta `factory()` y, si no responde en `hedge_after` s, lanza un
+    duplicado. Devuelve la primera respuesta válida (no None) y cancela el
+    resto; None si ninguna lo es."""
+    tasks = [asyncio.ensure_future(factory())]
+    try:
+        if hedge_after > 0:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                _latency_metrics["embed_hedges"] += 1
+                tasks.append(asyncio.ensure_future(factory()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled() or task.exception() is not None:
+                    continue
+                if task.result() is not None:
+                    if task is not tasks[0]:
+                        _latency_metrics["embed_hedge_wins"] += 1
+                    return task.result()
+        # Ninguna válida: propagar el error de la original si lo hubo
+        if not tasks[0].cancelled() and tasks[0].exception() is not None:
+            raise tasks[0].exception()
+        return None
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
 # ---------------------------------------------------------------------------
 # Utilidades de texto
 # ---------------------------------------------------------------------------
@@ -72,6 +154,9 @@ _FILE_TYPE_HINTS: Dict[str, List[str]] = {
     "word": ["doc", "docx"],
     "excel": ["xls", "xlsx", "csv"],
     "hoja": ["xls", "xlsx", "csv"],
+    "presentacion": ["ppt", "pptx"],
+    "presentación": ["ppt", "pptx"],
+    "powerpoint": ["ppt", "pptx"],
     "imagen": ["jpg", "jpeg", "png", "webp", "heic", "bmp"],
     "imagenes": ["jpg", "jpeg", "png", "webp", "heic", "bmp"],
     "imágenes": ["jpg", "jpeg", "png", "webp", "heic", "bmp"],
@@ -240,8 +325,19 @@ class HybridSearchEngine:
                 logger.info(f"📦 Resultados desde REDIS para: '{query}'")
                 return cached
 
-        # 1. Embedding (con caché)
-        embedding = await self._get_embedding_cached(query)
+        loop = asyncio.get_running_loop()
+        budget_end = loop.time() + SEARCH_LATENCY_BUDGET
+        _latency_metrics["searches"] += 1
+        degraded = False
+
+        # 1. Embedding (con caché, hedging y plazo). Si no llega a tiempo,
+        #    seguimos sólo con las fuentes léxicas.
+        embedding = await self._embed_query_with_deadline(
+            query, min(SEARCH_EMBED_DEADLINE, budget_end - loop.time()),
+        )
+        if embedding is None:
+            _latency_metrics["lexical_fallbacks"] += 1
+            degraded = True
 
         # 2. Búsquedas en paralelo. Sobre-pedimos para reranking.
         over_fetch = max(limit * 3, 30)
@@ -276,15 +372,27 @@ class HybridSearchEngine:
         #    relevante semánticamente pero ausente en full-text se pierda
         #    porque el RRF favorece items que aparecen en varias listas.
         llm_applied = False
-        if self._llm_reranker_enabled() and fused:
+        rrf_fallback = False
+        rerank_timeout = min(SEARCH_RERANK_DEADLINE, budget_end - loop.time())
+        if self._llm_reranker_enabled() and fused and rerank_timeout < SEARCH_RERANK_MIN_BUDGET:
+            logger.warning("⏱️ Sin presupuesto para el reranker LLM (%.2fs). Sigo con RRF.", rerank_timeout)
+            _latency_metrics["rerank_skipped"] += 1
+            rrf_fallback = True
+        elif self._llm_reranker_enabled() and fused:
+            started = time.monotonic()
             try:
                 candidates_for_llm = self._select_llm_candidates(
                     fused, semantic, fulltext, metadata,
                 )
-                reranked = await self.ai.rerank_search_results(
-                    query=query,
-                    candidates=candidates_for_llm,
-                    top_k=len(candidates_for_llm),  # evaluar TODOS los seleccionados
+                # Copias: si vence el plazo, el reranker no debe dejar
+                # anotaciones a medias sobre los candidatos de `fused`.
+                reranked = await asyncio.wait_for(
+                    self.ai.rerank_search_results(
+                        query=query,
+                        candidates=[dict(c) for c in candidates_for_llm],
+                        top_k=len(candidates_for_llm),  # evaluar TODOS los seleccionados
+                    ),
+                    timeout=rerank_timeout,
                 )
                 # `reranked` mantiene anotaciones (`llm_score`, `llm_reason`).
                 # Hay que fusionar de vuelta con `fused` para mantener el resto.
@@ -301,8 +409,20 @@ class HybridSearchEngine:
                 llm_applied = True
                 logger.info("🤖 Re-ranking LLM aplicado a %d candidatos.",
                             len(candidates_for_llm))
+            except asyncio.TimeoutError:
+                logger.warning("⏱️ Reranker LLM superó su plazo (%.2fs). Sigo con RRF.", rerank_timeout)
+                _latency_metrics["rerank_timeouts"] += 1
+                rrf_fallback = True
             except Exception as rr_err:
                 logger.warning(f"⚠️ Reranker LLM error: {rr_err}. Sigo con RRF.")
+                _latency_metrics["rerank_errors"] += 1
+                rrf_fallback = True
+            finally:
+                _latency_metrics["rerank_calls"] += 1
+                _latency_metrics["rerank_ms_total"] += 1000 * (time.monotonic() - started)
+        if rrf_fallback:
+            _latency_metrics["rrf_fallbacks"] += 1
+            degraded = True
 
         # 5.b. Si el LLM evaluó el head y TODO es irrelevante
         #      (mejor llm_score < DISPLAY_FLOOR), asumimos que la query no
@@ -331,6 +451,13 @@ class HybridSearchEngine:
             if llm_score is not None:
                 # El LLM ya consideró léxica + semántica + summary.
                 final = max(0.0, min(1.0, llm_score))
+            elif embedding is None:
+                # Modo sólo léxico: no hay similitud semántica con la que
+                # puntuar; una coincidencia literal se muestra al menos en
+                # el umbral de visualización.
+                lex = max(float(item.get('_score_fulltext', 0) or 0),
+                          float(item.get('_score_metadata', 0) or 0))
+                final = min(1.0, max(self.DISPLAY_FLOOR, lex) * boost)
             else:
                 # Score absoluto = semantic_similarity con un pequeño nudge
                 # (cap a 1.0) si hay coincidencias literales en nombre/tags.
@@ -340,8 +467,10 @@ class HybridSearchEngine:
             item['score'] = final
 
         # 7. Filtrar por DISPLAY_FLOOR y reordenar.
+        #    Si el reranker no llegó a tiempo se respeta el orden RRF.
         filtered = [r for r in fused if r.get('combined_score', 0) >= self.DISPLAY_FLOOR]
-        filtered.sort(key=lambda x: x['combined_score'], reverse=True)
+        if not rrf_fallback:
+            filtered.sort(key=lambda x: x['combined_score'], reverse=True)
         final_results = filtered[:limit]
 
         logger.info(
@@ -349,7 +478,9 @@ class HybridSearchEngine:
             query, len(final_results), len(fused),
         )
 
-        if self.cache.is_available() and final_results:
+        # Un resultado degradado no se cachea: la próxima búsqueda puede
+        # llegar a tiempo con embedding y reranker.
+        if self.cache.is_available() and final_results and not degraded:
             self.cache.set(cache_key, final_results, ttl=600)
 
         return final_results
@@ -372,14 +503,35 @@ class HybridSearchEngine:
         raw = f"{normalize(query)}|{limit}|{ft_part}|{total}"
         return f"search:v2:{hashlib.md5(raw.encode()).hexdigest()}"
 
+    async def _embed_query_with_deadline(self, query: str, timeout: float) -> Optional[List[float]]:
+        """Embedding de la query con plazo; None si no llega o falla."""
+        started = time.monotonic()
+        try:
+            embedding = await asyncio.wait_for(self._get_embedding_cached(query),
+                                               timeout=max(timeout, 0.05))
+            if embedding is None:
+                _latency_metrics["embed_failures"] += 1
+            return embedding
+        except asyncio.TimeoutError:
+            logger.warning("⏱️ Embedding de la query superó su plazo (%.2fs). Sólo búsqueda léxica.", timeout)
+            _latency_metrics["embed_timeouts"] += 1
+            return None
+        finally:
+            _latency_metrics["embed_calls"] += 1
+            _latency_metrics["embed_ms_total"] += 1000 * (time.monotonic() - started)
+
     async def _get_embedding_cached(self, text: str) -> Optional[List[float]]:
-        cache_key = f"embedding:{hashlib.md5(normalize(text).encode()).hexdigest()}"
+        # El modelo activo forma parte de la clave: tras un cambio de modelo
+        # no se reutilizan vectores del espacio anterior.
+        spec = self.ai.get_embedding_spec() if hasattr(self.ai, "get_embedding_spec") else None
+        space = f"{spec['model']}:{spec['dims']}:" if spec else ""
+        cache_key = f"embedding:{space}{hashlib.md5(normalize(text).encode()).hexdigest()}"
         if self.cache.is_available():
             cached = self.cache.get(cache_key)
             if cached:
                 return cached
         try:
-            embedding = await self.ai.get_embedding(text)
+            embedding = await _hedged(lambda: self.ai.get_embedding(text), SEARCH_EMBED_HEDGE_AFTER)
             if embedding is not None and self.cache.is_available():
                 # Permitir tanto list como np.array
                 if hasattr(embedding, "tolist"):
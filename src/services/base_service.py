@@ -9,4 +9,47 @@ class CloudService(ABC):
 
     @abstractmethod
     async def list_files(self, path="/"):
-        pass
\ No newline at end of file
+        pass
+
+    # --- Referencias estables (cloud_id / cloud_path) ---
+
+    async def upload_with_meta(self, local_path, file_name, *args, **kwargs):
+        """Como `upload`, pero devuelve {"url", "cloud_id", "cloud_path"} (o None).
+
+        Los servicios que conocen el id remoto lo sobreescriben; por defecto solo hay URL.
+        """
+        url = await self.upload(local_path, file_name, *args, **kwargs)
+        return {"url": url, "cloud_id": None, "cloud_path": None} if url else None
+
+    async def find_ref_by_name(self, file_name):
+        """{"cloud_id", "cloud_path"} del archivo con ese nombre (para el backfill)."""
+        return None
+
+    async def download_by_ref(self, cloud_id, file_name, local_path):
+        """Descarga por id si lo tenemos; si no (o el id ya no existe), por nombre."""
+        if cloud_id:
+            try:
+                if await self.download_file_by_id(cloud_id, local_path):
+                    return True
+            except Exception as e:
+                print(f"⚠️ Descarga por id '{cloud_id}' falló ({e}). Buscando por nombre...")
+        return await self.download_file_by_name(file_name, local_path)
+
+    async def delete_by_ref(self, cloud_id, file_name):
+        """Borra por id si lo tenemos; si no, por nombre."""
+        if cloud_id:
+            return await self.delete_file_by_id(cloud_id)
+        return await self.delete_file_by_name(file_name)
+
+    # --- Sincronización incremental ---
+
+    async def iter_changes(self, cursor=None):
+        """Feed de cambios del proveedor, página a página.
+
+        Sin cursor recorre la nube entera (primera sync). Cada página es
+        `(cambios, cursor)`: los cambios son dicts {"name", "cloud_id",
+        "cloud_path", "deleted"} (solo archivos, nunca carpetas) y `cursor`, si no
+        es None, puede persistirse para reanudar tras esa página.
+        """
+        raise NotImplementedError(f"{type(self).__name__} no soporta sincronización incremental")
+        yield  # (hace de la función un generador asíncrono)
@@ -1,8 +1,18 @@
 import dropbox
 import os
-from dropbox.files import WriteMode
+import mmap
+import time
+import asyncio
+from dropbox.files import WriteMode, UploadSessionCursor, CommitInfo, RelocationPath
 from .base_service import CloudService
 
+# Subida por sesiones: tamaño de trozo (múltiplo de 4 MiB, como recomienda Dropbox)
+# y reintentos por trozo. Por debajo de un trozo se usa files_upload directo.
+DROPBOX_CHUNK_SIZE = int(os.getenv("DROPBOX_CHUNK_SIZE", str(8 * 1024 * 1024)))
+DROPBOX_CHUNK_RETRIES = int(os.getenv("DROPBOX_CHUNK_RETRIES", "4"))
+# files_move_batch_v2 admite hasta 1000 entradas por llamada
+DROPBOX_MOVE_BATCH = 1000
+
 class DropboxService(CloudService):
     # CAMBIO PRINCIPAL: Ahora recibimos 3 argumentos en lugar de 1
     def __init__(self, app_key, app_secret, refresh_token):
@@ -42,6 +52,25 @@ class DropboxService(CloudService):
         self.dbx.files_download_to_file(local_path, cloud_path)
         return True
 
+    async def download_file_by_id(self, cloud_id, local_path):
+        """Descarga directa por id ("id:...") o ruta guardada, sin búsqueda."""
+        return await self.download_file(cloud_id, local_path)
+
+    async def delete_file_by_id(self, cloud_id):
+        return await self.delete_file(cloud_id)
+
+    async def delete_file_by_name(self, file_name):
+        return await self.delete_file(f"/{file_name}")
+
+    async def find_ref_by_name(self, file_name):
+        if not self.dbx: return None
+        res = self.dbx.files_search_v2(query=file_name)
+        for match in res.matches:
+            metadata = match.metadata.get_metadata()
+            if metadata.name == file_name:
+                return {"cloud_id": metadata.id, "cloud_path": metadata.path_display}
+        return None
+
     async def download_file_by_name(self, file_name, local_path):
         """Busca un archivo por nombre en TODO el Dropbox y lo descarga."""
         if not self.dbx: return False
@@ -110,18 +139,129 @@ class DropboxService(CloudService):
             return None
 
     async def upload(self, local_path, file_name, folder="General"):
+        meta = await self.upload_with_meta(local_path, file_name, folder)
+        return meta["url"] if meta else None
+
+    async def upload_with_meta(self, local_path, file_name, folder="General"):
         if not self.dbx: return None
         cloud_path = f"/{folder}/{file_name}".replace("//", "/")
         try:
-            with open(local_path, "rb") as f:
-                self.dbx.files_upload(f.read(), cloud_path, mode=WriteMode('overwrite'))
+            size = os.path.getsize(local_path)
+            if size <= DROPBOX_CHUNK_SIZE:
+                with open(local_path, "rb") as f:
+                    metadata = self.dbx.files_upload(f.read(), cloud_path, mode=WriteMode('overwrite'))
+            else:
+                # Archivos grandes: sesión por trozos fuera del event loop
+                metadata = await asyncio.to_thread(self._upload_session, local_path, cloud_path, size)
             
             # Devolvemos directamente el enlace a la vista privada
-            return f"https://www.dropbox.com/preview{cloud_path}"
+            return {
+                "url": f"https://www.dropbox.com/preview{cloud_path}",
+                "cloud_id": getattr(metadata, "id", None),
+                "cloud_path": getattr(metadata, "path_display", None) or cloud_path,
+            }
         except Exception as e:
             print(f"❌ Error real en Dropbox: {e}")
             return None
 
+    def _send_chunk(self, send, offset, view, size):
+        """Envía el trozo que empieza en `offset` con reintentos.
+
+        Si Dropbox responde con un offset incorrecto (p. ej. un reintento de un
+        trozo que sí había llegado), se reanuda desde el offset que indica.
+
+        Returns:
+            int: offset desde el que continuar.
+        """
+        for attempt in range(DROPBOX_CHUNK_RETRIES):
+            end = min(offset + DROPBOX_CHUNK_SIZE, size)
+            try:
+                # El SDK exige `bytes`: solo se copia el trozo actual del mmap
+                send(view[offset:end].tobytes(), offset)
+                return end
+            except dropbox.exceptions.ApiError as e:
+                err = e.error
+                lookup = err.get_incorrect_offset() if getattr(err, "is_incorrect_offset", lambda: False)() else None
+                if lookup is None:
+                    raise
+                print(f"↪️ Dropbox: reanudando sesión en offset {lookup.correct_offset} (enviado {offset}).")
+                offset = lookup.correct_offset
+                if offset >= end:
+                    return offset
+            except Exception as e:
+                if attempt == DROPBOX_CHUNK_RETRIES - 1:
+                    raise
+                wait = 2 ** attempt
+                print(f"⚠️ Dropbox: fallo en trozo @{offset} ({e}). Reintento en {wait}s...")
+                time.sleep(wait)
+        raise RuntimeError(f"Dropbox: no se pudo enviar el trozo en offset {offset}")
+
+    def _upload_session(self, local_path, cloud_path, size):
+        """Subida por sesión (start/append/finish) leyendo el archivo vía mmap + memoryview.
+
+        La memoria residente queda en ~un trozo sea cual sea el tamaño del archivo.
+        """
+        with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                session = {}
+
+                def start(chunk, _offset):
+                    session["id"] = self.dbx.files_upload_session_start(chunk).session_id
+
+                offset = self._send_chunk(start, 0, view, size)
+                commit = CommitInfo(path=cloud_path, mode=WriteMode('overwrite'))
+
+                def append(chunk, at):
+                    cursor = UploadSessionCursor(session_id=session["id"], offset=at)
+                    if at + len(chunk) >= size:
+                        session["metadata"] = self.dbx.files_upload_session_finish(chunk, cursor, commit)
+                    else:
+                        self.dbx.files_upload_session_append_v2(chunk, cursor)
+
+                while offset < size:
+                    offset = self._send_chunk(append, offset, view, size)
+                print(f"✅ Dropbox: {cloud_path} subido por sesión ({size} bytes).")
+                return session.get("metadata")
+            finally:
+                view.release()
+
+    # --- sincronización incremental ---------------------------------------------
+    def _list_changes_page(self, cursor):
+        """Una página de list_folder (recursivo) / list_folder_continue."""
+        if cursor:
+            try:
+                res = self.dbx.files_list_folder_continue(cursor)
+            except dropbox.exceptions.ApiError as e:
+                # Cursor caducado: Dropbox exige volver a listar desde cero
+                if getattr(e.error, "is_reset", lambda: False)():
+                    print("↪️ Dropbox: cursor de sync reiniciado, se recorre todo de nuevo.")
+                    res = self.dbx.files_list_folder("", recursive=True)
+                else:
+                    raise
+        else:
+            res = self.dbx.files_list_folder("", recursive=True)
+
+        changes = []
+        for entry in res.entries:
+            if isinstance(entry, dropbox.files.FileMetadata):
+                changes.append({"name": entry.name, "cloud_id": entry.id,
+                                "cloud_path": entry.path_display, "deleted": False,
+                                "version": entry.content_hash})
+            elif isinstance(entry, dropbox.files.DeletedMetadata):
+                # Los borrados no traen id; se identifican por ruta/nombre
+                changes.append({"name": entry.name, "cloud_id": None,
+                                "cloud_path": entry.path_display, "deleted": True})
+        return changes, res.cursor, res.has_more
+
+    async def iter_changes(self, cursor=None):
+        if not self.dbx: return
+        while True:
+            changes, cursor, has_more = await asyncio.to_thread(self._list_changes_page, cursor)
+            yield changes, cursor
+            if not has_more:
+                break
+
     # --- operaciones adicionales ------------------------------------------------
     async def move_file(self, source_path: str, dest_path: str):
         """Mueve o renombra un archivo/carpeta dentro de Dropbox.
@@ -134,4 +274,47 @@ class DropboxService(CloudService):
             return res.metadata.path_display
         except Exception as e:
             print(f"❌ Error moviendo en Dropbox: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def _move_batch_sync(self, moves):
+        """files_move_batch_v2 + sondeo del job asíncrono. Devuelve un bool por movimiento."""
+        results = []
+        for start in range(0, len(moves), DROPBOX_MOVE_BATCH):
+            chunk = moves[start:start + DROPBOX_MOVE_BATCH]
+            launch = self.dbx.files_move_batch_v2(
+                [RelocationPath(src, dest) for src, dest in chunk], autorename=True
+            )
+            if launch.is_complete():
+                status = launch.get_complete()
+            else:
+                # RelocationBatchV2JobStatus sólo es in_progress o complete: los
+                # fallos vienen por entrada dentro de complete.entries
+                job_id = launch.get_async_job_id()
+                delay = 0.5
+                time.sleep(delay)
+                check = self.dbx.files_move_batch_check_v2(job_id)
+                while check.is_in_progress():
+                    delay = min(delay * 2, 5)
+                    time.sleep(delay)
+                    check = self.dbx.files_move_batch_check_v2(job_id)
+                status = check.get_complete()
+            results.extend(entry.is_success() for entry in status.entries)
+        return results
+
+    async def move_files(self, moves):
+        """Movimiento masivo con files_move_batch_v2.
+
+        Args:
+            moves: lista de (ruta_origen, ruta_destino).
+
+        Returns:
+            dict: ruta_origen -> True/False.
+        """
+        if not self.dbx or not moves:
+            return {}
+        try:
+            results = await asyncio.to_thread(self._move_batch_sync, list(moves))
+        except Exception as e:
+            print(f"❌ Error moviendo en lote en Dropbox: {e}")
+            return {src: False for src, _ in moves}
+        return {src: ok for (src, _), ok in zip(moves, results)}
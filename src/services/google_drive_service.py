@@ -1,200 +1,452 @@
 import os
+import io
 import json
+import time
+import random
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from .base_service import CloudService
 
+# El cliente de Google es síncrono (httplib2, no thread-safe): cada hilo del pool
+# usa su propio `service` y el event loop solo espera el resultado.
+DRIVE_MAX_WORKERS = int(os.getenv("DRIVE_MAX_WORKERS", "4"))
+DRIVE_RETRIES = int(os.getenv("DRIVE_RETRIES", "4"))
+DRIVE_NAME_CACHE_TTL = int(os.getenv("DRIVE_NAME_CACHE_TTL", "600"))
+# Máximo de peticiones por llamada al endpoint batch de Drive
+DRIVE_BATCH_SIZE = 100
+# Cursor de un listado completo a medias (primer recorrido, antes de pasar a changes.list)
+_LIST_CURSOR_PREFIX = "list:"
+
+_executor = ThreadPoolExecutor(max_workers=DRIVE_MAX_WORKERS, thread_name_prefix="drive")
+
+
+def _is_retryable(e):
+    """429/5xx, rateLimitExceeded y errores de red se reintentan; el resto no."""
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        return status in (429, 500, 502, 503, 504) or (status == 403 and "rateLimitExceeded" in str(e))
+    return isinstance(e, OSError)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
 class GoogleDriveService(CloudService):
     def __init__(self):
         self.scopes = ['https://www.googleapis.com/auth/drive.file']
         self.service = None
+        self._creds = None
+        self._local = threading.local()
+        # nombre -> (instante, {"id", "webViewLink"}): evita un `list` por operación
+        self._name_cache = {}
+
+    def _get_credentials(self):
+        if self._creds:
+            return self._creds
 
-    def _get_service(self):
-        if self.service:
-            return self.service
-            
         creds = None
         # Intentamos leer el token desde la variable de entorno (Railway)
         token_env = os.getenv('GOOGLE_DRIVE_TOKEN_JSON')
-        
+
         if token_env:
             # Cargamos las credenciales desde el texto de la variable
             token_data = json.loads(token_env)
             creds = Credentials.from_authorized_user_info(token_data, self.scopes)
-        
+
         # Si el token existe pero expiró, lo renovamos automáticamente
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
-            # Opcional: Podrías imprimir el nuevo token si quieres actualizarlo, 
+            # Opcional: Podrías imprimir el nuevo token si quieres actualizarlo,
             # pero Google suele manejar la renovación en memoria bien.
-        
+
         if not creds:
             raise Exception("❌ No se encontró GOOGLE_DRIVE_TOKEN_JSON en Railway. Configúralo en Variables.")
 
-        self.service = build('drive', 'v3', credentials=creds)
+        self._creds = creds
+        return creds
+
+    def _get_service(self):
+        """Cliente síncrono para el hilo principal (arranque, scripts)."""
+        if self.service:
+            return self.service
+        self.service = build('drive', 'v3', credentials=self._get_credentials())
         return self.service
 
+    def _thread_service(self):
+        """Cliente propio del hilo del pool (httplib2 no se comparte entre hilos)."""
+        svc = getattr(self._local, "service", None)
+        if svc is None:
+            svc = build('drive', 'v3', credentials=self._get_credentials(), cache_discovery=False)
+            self._local.service = svc
+        return svc
+
+    # ----- Ejecución fuera del event loop -----
+
+    async def _call(self, fn, *args):
+        """Ejecuta `fn(*args)` en el pool de Drive con backoff asíncrono."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(DRIVE_RETRIES):
+            try:
+                return await loop.run_in_executor(_executor, functools.partial(fn, *args))
+            except Exception as e:
+                if attempt == DRIVE_RETRIES - 1 or not _is_retryable(e):
+                    raise
+                wait = min(30, 2 ** attempt) + random.random()
+                print(f"⚠️ [Intento {attempt + 1}/{DRIVE_RETRIES}] Drive: {e}. Reintento en {wait:.1f}s...")
+                await asyncio.sleep(wait)
+
+    async def _execute(self, build_request):
+        """`build_request(service)` devuelve un HttpRequest; se construye y ejecuta en el pool."""
+        return await self._call(lambda: build_request(self._thread_service()).execute())
+
+    def _run_batch_sync(self, builders):
+        service = self._thread_service()
+        results = [None] * len(builders)
+
+        def collect(request_id, response, exception):
+            results[int(request_id)] = exception if exception is not None else response
+
+        for start in range(0, len(builders), DRIVE_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=collect)
+            for i in range(start, min(start + DRIVE_BATCH_SIZE, len(builders))):
+                batch.add(builders[i](service), request_id=str(i))
+            batch.execute()
+        return results
+
+    async def batch(self, builders):
+        """Ejecuta varias peticiones en el endpoint batch de Drive (100 por llamada).
+
+        Las que fallan con un error reintentable se reenvían con backoff.
+
+        Args:
+            builders: lista de `build_request(service) -> HttpRequest`.
+
+        Returns:
+            list: respuesta o excepción por petición, en el mismo orden.
+        """
+        results = [None] * len(builders)
+        pending = list(range(len(builders)))
+        for attempt in range(DRIVE_RETRIES):
+            round_results = await self._call(self._run_batch_sync, [builders[i] for i in pending])
+            retry = []
+            for i, res in zip(pending, round_results):
+                results[i] = res
+                if isinstance(res, Exception) and _is_retryable(res):
+                    retry.append(i)
+            if not retry or attempt == DRIVE_RETRIES - 1:
+                break
+            pending = retry
+            await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+        return results
+
+    # ----- Caché nombre → id -----
+
+    def _remember(self, file_name, meta):
+        self._name_cache[file_name] = (time.monotonic(), meta)
+
+    def _forget(self, file_name):
+        self._name_cache.pop(file_name, None)
+
+    async def _lookup(self, file_name):
+        """Metadatos {id, webViewLink} del primer archivo con ese nombre (o None)."""
+        hit = self._name_cache.get(file_name)
+        if hit and time.monotonic() - hit[0] < DRIVE_NAME_CACHE_TTL:
+            return hit[1]
+        query = f"name = '{_escape(file_name)}' and trashed = false"
+        res = await self._execute(lambda s: s.files().list(
+            q=query, spaces='drive', pageSize=1, fields="files(id, webViewLink)"
+        ))
+        files = res.get('files', [])
+        if not files:
+            self._forget(file_name)
+            return None
+        self._remember(file_name, files[0])
+        return files[0]
+
+    # ----- Operaciones -----
+
     async def list_files(self, limit=10000):
-            service = self._get_service()
             # Aumentamos el pageSize para no dejar archivos fuera
-            results = service.files().list(
-                pageSize=limit, 
-                fields="files(id, name)",
+            results = await self._execute(lambda s: s.files().list(
+                pageSize=limit,
+                fields="files(id, name, webViewLink)",
                 q="trashed = false" # No indexar la papelera
-            ).execute()
+            ))
             items = results.get('files', [])
+            for item in items:
+                self._remember(item['name'], {"id": item['id'], "webViewLink": item.get('webViewLink')})
             return [item['name'] for item in items]
-    
-    async def download_file_by_name(self, file_name, local_path):
-        service = self._get_service()
-        try:
-            # 1. Buscar el ID por nombre
-            query = f"name = '{file_name}' and trashed = false"
-            res = service.files().list(q=query, fields="files(id)").execute()
-            files = res.get('files', [])
-            if not files: return False
-            
-            file_id = files[0]['id']
-            # 2. Descargar el contenido
-            from googleapiclient.http import MediaIoBaseDownload
-            import io
-            
-            request = service.files().get_media(fileId=file_id)
-            fh = io.FileIO(local_path, 'wb')
+
+    async def list_folder_page(self, folder_id='root', page_token=None):
+        """Una página (hasta 1000) de hijos directos de una carpeta."""
+        return await self._execute(lambda s: s.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            spaces="drive", pageSize=1000, pageToken=page_token,
+            fields="nextPageToken, files(id, name, mimeType, parents)"
+        ))
+
+    def _download_sync(self, file_id, local_path):
+        request = self._thread_service().files().get_media(fileId=file_id)
+        with io.FileIO(local_path, 'wb') as fh:
             downloader = MediaIoBaseDownload(fh, request)
             done = False
             while done is False:
                 status, done = downloader.next_chunk()
-            fh.close()
-            return True
+        return True
+
+    async def download_file_by_name(self, file_name, local_path):
+        try:
+            # 1. Buscar el ID por nombre (caché)
+            meta = await self._lookup(file_name)
+            if not meta: return False
+
+            # 2. Descargar el contenido
+            try:
+                return await self._call(self._download_sync, meta['id'], local_path)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # ID cacheado obsoleto: se busca de nuevo una vez
+                self._forget(file_name)
+                meta = await self._lookup(file_name)
+                if not meta: return False
+                return await self._call(self._download_sync, meta['id'], local_path)
         except Exception as e:
             print(f"Error descargando de Drive: {e}")
             return False
 
+    async def download_file_by_id(self, file_id, local_path):
+        """Descarga directa por id, sin búsqueda por nombre."""
+        return await self._call(self._download_sync, file_id, local_path)
+
+    async def delete_file_by_id(self, file_id):
+        try:
+            await self._execute(lambda s: s.files().delete(fileId=file_id))
+            self._name_cache = {k: v for k, v in self._name_cache.items() if v[1].get('id') != file_id}
+            return True
+        except HttpError as e:
+            # Ya no existe en Drive: el objetivo (que no esté) se cumple
+            if e.resp.status == 404:
+                return True
+            print(f"❌ Error borrando en Google Drive: {e}")
+            return False
+        except Exception as e:
+            print(f"❌ Error borrando en Google Drive: {e}")
+            return False
+
+    async def delete_file_by_name(self, file_name):
+        return await self.delete_file(file_name)
+
+    async def get_link(self, file_id):
+        res = await self._execute(lambda s: s.files().get(fileId=file_id, fields='webViewLink'))
+        return res.get('webViewLink')
+
+    async def find_ref_by_name(self, file_name):
+        meta = await self._lookup(file_name)
+        return {"cloud_id": meta['id'], "cloud_path": None} if meta else None
+
     async def get_link_by_name(self, file_name):
-        service = self._get_service()
-        query = f"name = '{file_name}' and trashed = false"
-        res = service.files().list(q=query, fields="files(webViewLink)").execute()
-        files = res.get('files', [])
-        return files[0].get('webViewLink') if files else None
-    
+        meta = await self._lookup(file_name)
+        return meta.get('webViewLink') if meta else None
+
     async def delete_file(self, file_name):
         """Busca un archivo por nombre y lo elimina de Google Drive"""
         try:
-            # CAMBIO CRÍTICO: Asegurar que el servicio esté inicializado
-            service = self._get_service() 
-            
             # 1. Buscar el ID del archivo por su nombre
-            query = f"name = '{file_name}' and trashed = false"
-            response = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-            files = response.get('files', [])
-
-            if not files:
+            meta = await self._lookup(file_name)
+            if not meta:
                 print(f"⚠️ No se encontró el archivo '{file_name}' en Google Drive.")
                 return False
 
             # 2. Eliminar el archivo usando su ID
-            file_id = files[0].get('id')
-            service.files().delete(fileId=file_id).execute()
+            file_id = meta.get('id')
+            try:
+                await self._execute(lambda s: s.files().delete(fileId=file_id))
+            finally:
+                self._forget(file_name)
             print(f"✅ Archivo '{file_name}' (ID: {file_id}) eliminado de Google Drive.")
             return True
         except Exception as e:
             print(f"❌ Error borrando en Google Drive: {e}")
             return False
-        
+
     async def upload(self, local_path, file_name, folder_id=None):
-            service = self._get_service()
-            import time as _time
-            intentos = 3
-            error_last = None
-
-            for i in range(intentos):
-                try:
-                    # Si folder_id es "root" o vacío, lo tratamos como None
-                    p_id = folder_id if (folder_id and folder_id != "root") else None
-                    
-                    file_metadata = {'name': file_name}
-                    if p_id:
-                        file_metadata['parents'] = [p_id]
-                        
-                    media = MediaFileUpload(local_path, resumable=True)
-                    file = service.files().create(
-                        body=file_metadata, 
-                        media_body=media, 
-                        fields='id, webViewLink'
-                    ).execute()
-
-                    # Permisos públicos
-                    try:
-                        service.permissions().create(
-                            fileId=file.get('id'),
-                            body={'type': 'anyone', 'role': 'reader'}
-                        ).execute()
-                    except: pass
-
-                    return file.get('webViewLink')
-
-                except (BrokenPipeError, ConnectionResetError, Exception) as e:
-                    error_last = e
-                    print(f"⚠️ [Intento {i+1}/{intentos}] Error Drive Upload ({file_name}): {e}")
-                    if i < intentos - 1:
-                        _time.sleep(2 * (i + 1)) # Backoff simple
-
-            print(f"❌ Error final Drive Upload tras {intentos} intentos: {error_last}")
-            return None
+            meta = await self.upload_with_meta(local_path, file_name, folder_id)
+            return meta["url"] if meta else None
+
+    async def upload_with_meta(self, local_path, file_name, folder_id=None):
+            # Si folder_id es "root" o vacío, lo tratamos como None
+            p_id = folder_id if (folder_id and folder_id != "root") else None
+
+            file_metadata = {'name': file_name}
+            if p_id:
+                file_metadata['parents'] = [p_id]
+
+            try:
+                # La subida (reanudable) corre en el pool; reintentos con backoff asíncrono
+                file = await self._execute(lambda s: s.files().create(
+                    body=file_metadata,
+                    media_body=MediaFileUpload(local_path, resumable=True),
+                    fields='id, webViewLink'
+                ))
+            except Exception as e:
+                print(f"❌ Error final Drive Upload tras {DRIVE_RETRIES} intentos: {e}")
+                return None
+
+            self._remember(file_name, {"id": file.get('id'), "webViewLink": file.get('webViewLink')})
+
+            # Permisos públicos
+            try:
+                await self._execute(lambda s: s.permissions().create(
+                    fileId=file.get('id'),
+                    body={'type': 'anyone', 'role': 'reader'}
+                ))
+            except Exception: pass
+
+            # Drive no es jerárquico por rutas: la referencia estable es el id
+            return {"url": file.get('webViewLink'), "cloud_id": file.get('id'), "cloud_path": None}
 
     async def create_folder(self, folder_name, parent_id=None):
-        service = self._get_service()
         try:
             p_id = parent_id if (parent_id and parent_id != "root") else None
-            
+
             # PRE-CREATION ALREADY-EXISTS CHECK
             # Prevent folder duplication by reusing an existing folder if one exists
-            escaped_name = folder_name.replace("'", "\\'")
+            escaped_name = _escape(folder_name)
             query = f"mimeType='application/vnd.google-apps.folder' and name='{escaped_name}' and trashed=false"
             if p_id:
                 query += f" and '{p_id}' in parents"
             else:
                 query += " and 'root' in parents"
 
-            existing_folders = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
+            existing_folders = await self._execute(lambda s: s.files().list(q=query, spaces='drive', fields='files(id, name)'))
             if existing_folders.get('files'):
                 print(f"   [✅ GOOGLE DRIVE] Carpeta '{folder_name}' ya existente encontrada (ID: {existing_folders['files'][0]['id']})")
                 return existing_folders['files'][0]['id']
-            
+
             metadata = {
                 'name': folder_name,
                 'mimeType': 'application/vnd.google-apps.folder'
             }
             if p_id:
                 metadata['parents'] = [p_id]
-                
-            folder = service.files().create(body=metadata, fields='id').execute()
+
+            folder = await self._execute(lambda s: s.files().create(body=metadata, fields='id'))
             return folder.get('id')
         except Exception as e:
             print(f"❌ Error Drive mkdir: {e}")
             return None
 
+    @staticmethod
+    def _move_request(file_id, new_parent_id, parents):
+        kwargs = {"fileId": file_id, "fields": "id, parents"}
+        if new_parent_id:
+            kwargs["addParents"] = new_parent_id
+        remove = ",".join(p for p in (parents or []) if p != new_parent_id)
+        if remove:
+            kwargs["removeParents"] = remove
+        return lambda s: s.files().update(**kwargs)
+
     async def move_file(self, file_id: str, new_parent_id: str):
         """Mueve un archivo a otra carpeta (o renombra) en Google Drive.
         Si new_parent_id es None se deja en raíz.
         Retorna True/False.
         """
-        service = self._get_service()
         try:
             # obtener padres actuales
-            current = service.files().get(fileId=file_id, fields='parents').execute()
-            parents = current.get('parents', [])
-            remove_parents = ",".join(parents) if parents else None
-            body = {}
-            if new_parent_id:
-                body['addParents'] = new_parent_id
-            if remove_parents:
-                body['removeParents'] = remove_parents
-            service.files().update(fileId=file_id, body=body, fields='id, parents').execute()
+            current = await self._execute(lambda s: s.files().get(fileId=file_id, fields='parents'))
+            await self._execute(self._move_request(file_id, new_parent_id, current.get('parents', [])))
             return True
         except Exception as e:
             print(f"❌ Error moviendo en Drive: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    async def move_files(self, moves):
+        """Movimiento masivo vía batch.
+
+        Args:
+            moves: lista de (file_id, new_parent_id, parents_actuales o None). Los
+                padres desconocidos se consultan también en un batch.
+
+        Returns:
+            dict: file_id -> True/False.
+        """
+        if not moves:
+            return {}
+        moves = [list(m) for m in moves]
+        unknown = [m for m in moves if m[2] is None]
+        if unknown:
+            parents = await self.batch([
+                (lambda fid: lambda s: s.files().get(fileId=fid, fields='parents'))(m[0]) for m in unknown
+            ])
+            for m, res in zip(unknown, parents):
+                m[2] = res.get('parents', []) if isinstance(res, dict) else []
+
+        results = await self.batch([self._move_request(fid, dest, parents) for fid, dest, parents in moves])
+        outcome = {}
+        for (fid, _, _), res in zip(moves, results):
+            if isinstance(res, Exception):
+                print(f"❌ Error moviendo en Drive ({fid}): {res}")
+            outcome[fid] = not isinstance(res, Exception)
+        return outcome
+
+    # ----- Sincronización incremental -----
+
+    @staticmethod
+    def _change_from_file(f, removed=False):
+        # Los documentos nativos de Google no tienen md5: su versión es la fecha de modificación
+        return {"name": f.get('name'), "cloud_id": f.get('id'), "cloud_path": None,
+                "deleted": removed or bool(f.get('trashed')),
+                "version": f.get('md5Checksum') or f.get('modifiedTime')}
+
+    async def iter_changes(self, cursor=None):
+        """changes.list desde un startPageToken; sin cursor, listado completo paginado.
+
+        Durante el listado completo cada página devuelve el cursor
+        `list:<startPageToken>:<nextPageToken>`, así que un primer recorrido
+        interrumpido se reanuda en la página siguiente a la última aplicada.
+        """
+        if cursor is None or cursor.startswith(_LIST_CURSOR_PREFIX):
+            if cursor is None:
+                # El token se pide ANTES de listar: lo que cambie durante el recorrido sale en la próxima sync
+                start = (await self._execute(lambda s: s.changes().getStartPageToken())).get('startPageToken')
+                page_token = None
+            else:
+                start, page_token = cursor[len(_LIST_CURSOR_PREFIX):].split(":", 1)
+            while True:
+                res = await self._execute(lambda s: s.files().list(
+                    q="trashed = false and mimeType != 'application/vnd.google-apps.folder'",
+                    spaces='drive', pageSize=1000, pageToken=page_token,
+                    fields="nextPageToken, files(id, name, md5Checksum, modifiedTime)"
+                ))
+                page_token = res.get('nextPageToken')
+                changes = [self._change_from_file(f) for f in res.get('files', [])]
+                yield changes, (f"{_LIST_CURSOR_PREFIX}{start}:{page_token}" if page_token else start)
+                if not page_token:
+                    return
+
+        page_token = cursor
+        while page_token:
+            res = await self._execute(lambda s: s.changes().list(
+                pageToken=page_token, spaces='drive', pageSize=1000,
+                fields="nextPageToken, newStartPageToken, "
+                       "changes(fileId, removed, file(id, name, mimeType, trashed, md5Checksum, modifiedTime))"
+            ))
+            changes = []
+            for ch in res.get('changes', []):
+                f = ch.get('file') or {"id": ch.get('fileId')}
+                if f.get('mimeType') == 'application/vnd.google-apps.folder':
+                    continue
+                changes.append(self._change_from_file(f, removed=ch.get('removed', False)))
+                if changes[-1]["deleted"]:
+                    self._name_cache = {k: v for k, v in self._name_cache.items() if v[1].get('id') != f.get('id')}
+            page_token = res.get('nextPageToken')
+            yield changes, page_token or res.get('newStartPageToken')
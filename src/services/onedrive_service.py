@@ -1,12 +1,24 @@
 import os
-import msal
-import requests
+import time
 import json
+import asyncio
 import logging
+import threading
+import msal
+import aiohttp
 from .base_service import CloudService
 
 logger = logging.getLogger(__name__)
 
+# Pool keep-alive por event loop y margen de renovación del token de acceso
+ONEDRIVE_POOL_SIZE = int(os.getenv("ONEDRIVE_POOL_SIZE", "10"))
+ONEDRIVE_TOKEN_SKEW = int(os.getenv("ONEDRIVE_TOKEN_SKEW", "300"))
+# Trozo de subida por sesión (múltiplo de 320 KiB, como exige Graph)
+ONEDRIVE_CHUNK_SIZE = int(os.getenv("ONEDRIVE_CHUNK_SIZE", str(327680 * 10)))
+ONEDRIVE_CHUNK_RETRIES = int(os.getenv("ONEDRIVE_CHUNK_RETRIES", "4"))
+ONEDRIVE_SIMPLE_UPLOAD_LIMIT = 4000000
+
+
 class OneDriveService(CloudService):
     def __init__(self, client_id, client_secret, refresh_token):
         self.client_id = client_id
@@ -15,7 +27,15 @@ class OneDriveService(CloudService):
         self.authority = "https://login.microsoftonline.com/common"
         self.scopes = ["Files.ReadWrite.All"]
         self.base_url = "https://graph.microsoft.com/v1.0"
-        
+
+        # Token de acceso cacheado hasta poco antes de caducar
+        self._token = None
+        self._token_expiry = 0.0
+        self._token_lock = threading.Lock()
+        # Una ClientSession por event loop (bot, hilos de Flask y Celery tienen loops distintos):
+        # loop -> (sesión, tarea que la cierra cuando el loop termina)
+        self._sessions = {}
+
         if not all([client_id, client_secret, refresh_token]):
             self.app = None
             logger.warning("⚠️ OneDriveService: Faltan credenciales (CLIENT_ID, SECRET o REFRESH_TOKEN)")
@@ -38,42 +58,135 @@ class OneDriveService(CloudService):
             logger.error(f"❌ Error de inicialización en OneDrive: {e}")
             self.app = None
 
+    # ----- Autenticación -----
+
+    def _token_valid(self):
+        return self._token and time.time() < self._token_expiry
+
     def _get_access_token(self):
+        """Token de acceso; solo hace el round trip a MSAL cuando está a punto de caducar."""
         if not self.app:
             return None
-        try:
-            result = self.app.acquire_token_by_refresh_token(
-                self.refresh_token,
-                scopes=self.scopes
-            )
-            if "access_token" in result:
-                return result["access_token"]
-            else:
-                logger.error(f"❌ Error MSAL: {result.get('error_description', result.get('error'))}")
+        if self._token_valid():
+            return self._token
+        with self._token_lock:
+            if self._token_valid():
+                return self._token
+            try:
+                result = self.app.acquire_token_by_refresh_token(
+                    self.refresh_token,
+                    scopes=self.scopes
+                )
+                if "access_token" in result:
+                    self._token = result["access_token"]
+                    self._token_expiry = time.time() + int(result.get("expires_in", 3600)) - ONEDRIVE_TOKEN_SKEW
+                    # Microsoft puede rotar el refresh token
+                    if result.get("refresh_token"):
+                        self.refresh_token = result["refresh_token"]
+                    return self._token
+                else:
+                    logger.error(f"❌ Error MSAL: {result.get('error_description', result.get('error'))}")
+                    return None
+            except Exception as e:
+                logger.error(f"❌ Error recuperando token OneDrive: {e}")
                 return None
-        except Exception as e:
-            logger.error(f"❌ Error recuperando token OneDrive: {e}")
-            return None
 
-    def _get_headers(self):
-        token = self._get_access_token()
+    def _invalidate_token(self):
+        self._token = None
+        self._token_expiry = 0.0
+
+    async def _get_headers(self, content_type="application/json"):
+        if self._token_valid():
+            token = self._token
+        else:
+            # La renovación (MSAL es síncrono) va fuera del event loop
+            token = await asyncio.to_thread(self._get_access_token)
         if not token:
             return None
-        return {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        headers = {"Authorization": f"Bearer {token}"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
+    # ----- HTTP -----
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        # Loops ya cerrados sin pasar por la cancelación de asyncio.run: sólo se sueltan
+        for stale in [l for l in self._sessions if l.is_closed()]:
+            self._sessions.pop(stale, None)
+        session, _ = self._sessions.get(loop, (None, None))
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ONEDRIVE_POOL_SIZE, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=120),
+            )
+            # asyncio.run cancela las tareas pendientes al terminar: así la sesión
+            # de cada hilo de Flask o tarea de Celery se cierra con su loop
+            self._sessions[loop] = (session, loop.create_task(self._close_with_loop(loop, session)))
+        return session
+
+    async def _close_with_loop(self, loop, session):
+        try:
+            await asyncio.Future()
+        finally:
+            if self._sessions.get(loop, (None,))[0] is session:
+                del self._sessions[loop]
+            if not session.closed:
+                await session.close()
+
+    async def close(self):
+        """Cierra la sesión HTTP del event loop actual."""
+        try:
+            session, closer = self._sessions.pop(asyncio.get_running_loop(), (None, None))
+        except RuntimeError:
+            return
+        if closer:
+            closer.cancel()
+        if session and not session.closed:
+            await session.close()
+
+    async def _request(self, method, url, content_type="application/json", **kwargs):
+        """Petición a Graph con la sesión compartida.
+
+        Si el token fue revocado antes de tiempo (401) se renueva y se repite una
+        vez, siempre que el cuerpo se pueda reenviar (un archivo se rebobina).
+
+        Returns:
+            tuple: (status, cuerpo JSON o texto) o (None, None) sin credenciales.
+        """
+        data = kwargs.get("data")
+        replayable = data is None or isinstance(data, (bytes, bytearray, str)) or \
+            (hasattr(data, "seekable") and data.seekable())
+        offset = data.tell() if replayable and hasattr(data, "tell") else None
+        for attempt in range(2):
+            headers = await self._get_headers(content_type)
+            if not headers:
+                return None, None
+            if attempt and offset is not None:
+                data.seek(offset)  # El primer intento ya consumió el archivo
+            async with self._session().request(method, url, headers=headers, **kwargs) as resp:
+                if resp.status == 401 and attempt == 0:
+                    self._invalidate_token()
+                    if replayable:
+                        continue
+                text = await resp.text()
+                try:
+                    body = json.loads(text) if text else {}
+                except ValueError:
+                    body = text
+                return resp.status, body
+        return None, None
+
+    # ----- Operaciones -----
 
     async def list_files(self, path="root"):
         """Lista archivos en una carpeta específica id o 'root'."""
-        headers = self._get_headers()
-        if not headers: return []
-        
         endpoint = f"{self.base_url}/me/drive/{path}/children"
         try:
-            response = requests.get(endpoint, headers=headers)
-            if response.status_code == 200:
-                items = response.json().get('value', [])
+            status, body = await self._request("GET", endpoint)
+            if status == 200:
+                items = body.get('value', [])
                 return [item['name'] for item in items]
             return []
         except Exception as e:
@@ -82,39 +195,38 @@ class OneDriveService(CloudService):
 
     async def create_folder(self, folder_name, parent_id=None):
         """Crea una carpeta y devuelve su ID."""
-        headers = self._get_headers()
-        if not headers: return None
-
         # Si parent_id es None o vacío, usamos la raíz
         parent = f"items/{parent_id}" if parent_id else "root"
         endpoint = f"{self.base_url}/me/drive/{parent}/children"
-        
+
         # Primero verificar si existe para evitar duplicados
         try:
-            check_resp = requests.get(endpoint, headers=headers)
-            if check_resp.status_code == 200:
-                existing = [i for i in check_resp.json().get('value', []) if i['name'] == folder_name and 'folder' in i]
+            status, body = await self._request("GET", endpoint)
+            if status is None:
+                return None
+            if status == 200:
+                existing = [i for i in body.get('value', []) if i['name'] == folder_name and 'folder' in i]
                 if existing:
                     return existing[0]['id']
-        except: pass
+        except Exception: pass
 
         body = {
             "name": folder_name,
             "folder": {},
             "@microsoft.graph.conflictBehavior": "fail"
         }
-        
+
         try:
-            response = requests.post(endpoint, headers=headers, json=body)
-            if response.status_code in [201, 200]:
-                return response.json().get('id')
-            elif response.status_code == 409: # Conflict
+            status, resp_body = await self._request("POST", endpoint, json=body)
+            if status in [201, 200]:
+                return resp_body.get('id')
+            elif status == 409: # Conflict
                 logger.info(f"ℹ️ OneDrive: Carpeta '{folder_name}' ya existe (409). Buscando ID...")
-                check_resp = requests.get(endpoint, headers=headers)
-                existing = [i for i in check_resp.json().get('value', []) if i['name'] == folder_name]
+                status, check = await self._request("GET", endpoint)
+                existing = [i for i in check.get('value', []) if i['name'] == folder_name] if status == 200 else []
                 return existing[0]['id'] if existing else None
             else:
-                logger.error(f"❌ OneDrive create_folder failed Status: {response.status_code} Resp: {response.text}")
+                logger.error(f"❌ OneDrive create_folder failed Status: {status} Resp: {resp_body}")
             return None
         except Exception as e:
             logger.error(f"❌ Error OneDrive mkdir: {e}")
@@ -122,58 +234,97 @@ class OneDriveService(CloudService):
 
     async def upload(self, local_path, file_name, folder_id=None):
         """Sube un archivo y devuelve el enlace de visualización."""
-        headers = self._get_headers()
-        if not headers: return None
+        meta = await self.upload_with_meta(local_path, file_name, folder_id)
+        return meta["url"] if meta else None
+
+    async def _meta_from_item(self, item):
+        """{url, cloud_id, cloud_path} a partir del driveItem que devuelve Graph."""
+        if not item or not item.get('id'):
+            return None
+        url = await self.get_link(item['id'])
+        if not url:
+            return None
+        parent_path = (item.get('parentReference') or {}).get('path', '')
+        # parentReference.path viene como "/drive/root:/Carpeta"
+        parent_path = parent_path.split(':', 1)[1] if ':' in parent_path else ''
+        return {"url": url, "cloud_id": item['id'], "cloud_path": f"{parent_path}/{item.get('name', '')}"}
 
+    async def upload_with_meta(self, local_path, file_name, folder_id=None):
+        """Como upload, pero devuelve {url, cloud_id, cloud_path}."""
         file_size = os.path.getsize(local_path)
         # Para archivos > 4MB usamos sesión de subida (recomendado para estabilidad)
-        if file_size > 4000000:
+        if file_size > ONEDRIVE_SIMPLE_UPLOAD_LIMIT:
             return await self._upload_large_file(local_path, file_name, folder_id)
-        
-        # Subida simple (PUT)
+
+        # Subida simple (PUT) en streaming desde disco
         parent = f"items/{folder_id}" if folder_id else "root"
         endpoint = f"{self.base_url}/me/drive/{parent}:/{file_name}:/content"
-        
+
         try:
             with open(local_path, "rb") as f:
-                response = requests.put(endpoint, headers={"Authorization": headers["Authorization"]}, data=f)
-                if response.status_code in [200, 201]:
-                    item_id = response.json().get('id')
-                    return await self.get_link(item_id)
-                else:
-                    logger.error(f"❌ OneDrive upload failed Status: {response.status_code} Resp: {response.text}")
+                status, body = await self._request("PUT", endpoint, content_type="application/octet-stream", data=f)
+            if status in [200, 201]:
+                return await self._meta_from_item(body)
+            elif status is not None:
+                logger.error(f"❌ OneDrive upload failed Status: {status} Resp: {body}")
             return None
         except Exception as e:
             logger.error(f"❌ Error subida simple OneDrive: {e}")
             return None
 
+    async def _put_chunk(self, upload_url, chunk, start, file_size):
+        """PUT de un trozo con reintentos. La uploadUrl ya va autenticada: sin Authorization.
+
+        Returns:
+            tuple: (status, cuerpo) de Graph.
+        """
+        headers = {
+            "Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{file_size}",
+            "Content-Length": str(len(chunk))
+        }
+        for attempt in range(ONEDRIVE_CHUNK_RETRIES):
+            try:
+                async with self._session().put(upload_url, headers=headers, data=chunk) as resp:
+                    if resp.status < 500 and resp.status != 429:
+                        text = await resp.text()
+                        return resp.status, (json.loads(text) if text else {})
+                    wait = int(resp.headers.get("Retry-After", 2 ** attempt))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                wait = 2 ** attempt
+                logger.warning(f"⚠️ OneDrive: fallo en trozo @{start} ({e}).")
+            if attempt < ONEDRIVE_CHUNK_RETRIES - 1:
+                logger.warning(f"⚠️ OneDrive: reintentando trozo @{start} en {wait}s...")
+                await asyncio.sleep(wait)
+        raise RuntimeError(f"OneDrive: no se pudo subir el trozo en offset {start}")
+
     async def _upload_large_file(self, local_path, file_name, folder_id=None):
-        headers = self._get_headers()
         parent = f"items/{folder_id}" if folder_id else "root"
         endpoint = f"{self.base_url}/me/drive/{parent}:/{file_name}:/createUploadSession"
-        
+
         try:
-            session_resp = requests.post(endpoint, headers=headers, json={"item": {"@microsoft.graph.conflictBehavior": "replace"}})
-            if session_resp.status_code != 200: return None
-            
-            upload_url = session_resp.json().get('uploadUrl')
+            status, session_body = await self._request(
+                "POST", endpoint, json={"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+            )
+            if status != 200: return None
+
+            upload_url = session_body.get('uploadUrl')
             file_size = os.path.getsize(local_path)
-            chunk_size = 327680 * 10 # ~3MB por trozo (debe ser múltiplo de 327680)
-            
+
+            # Solo un trozo en memoria a la vez
             with open(local_path, "rb") as f:
                 start = 0
                 while start < file_size:
-                    chunk = f.read(chunk_size)
-                    end = start + len(chunk) - 1
-                    headers_chunk = {
-                        "Content-Range": f"bytes {start}-{end}/{file_size}",
-                        "Content-Length": str(len(chunk))
-                    }
-                    resp = requests.put(upload_url, headers=headers_chunk, data=chunk)
-                    start = end + 1
-                    if resp.status_code in [201, 200]:
-                        item_id = resp.json().get('id')
-                        return await self.get_link(item_id)
+                    f.seek(start)
+                    chunk = f.read(ONEDRIVE_CHUNK_SIZE)
+                    status, body = await self._put_chunk(upload_url, chunk, start, file_size)
+                    if status in [201, 200]:
+                        return await self._meta_from_item(body)
+                    if status != 202:
+                        logger.error(f"❌ OneDrive chunk failed Status: {status} Resp: {body}")
+                        return None
+                    # Graph indica los rangos pendientes: reanudamos desde ahí
+                    ranges = body.get("nextExpectedRanges") or [f"{start + len(chunk)}-"]
+                    start = int(ranges[0].split("-")[0])
             return None
         except Exception as e:
             print(f"❌ Error subida pesada OneDrive: {e}")
@@ -181,63 +332,77 @@ class OneDriveService(CloudService):
 
     async def get_link(self, item_id):
         """Genera un link de visualización compartido."""
-        headers = self._get_headers()
-        if not headers: return None
-        
         endpoint = f"{self.base_url}/me/drive/items/{item_id}/createLink"
         body = {"type": "view", "scope": "anonymous"}
-        
+
         try:
-            response = requests.post(endpoint, headers=headers, json=body)
-            if response.status_code in [200, 201]:
-                return response.json().get('link', {}).get('webUrl')
-            else:
-                print(f"❌ OneDrive get_link failed Status: {response.status_code} Resp: {response.text}")
+            status, resp_body = await self._request("POST", endpoint, json=body)
+            if status in [200, 201]:
+                return resp_body.get('link', {}).get('webUrl')
+            elif status is not None:
+                print(f"❌ OneDrive get_link failed Status: {status} Resp: {resp_body}")
             return None
         except Exception as e:
             print(f"❌ Error obteniendo link OneDrive: {e}")
             return None
 
     async def delete_file(self, item_id):
-        headers = self._get_headers()
-        if not headers: return False
-        
         endpoint = f"{self.base_url}/me/drive/items/{item_id}"
         try:
-            response = requests.delete(endpoint, headers=headers)
-            return response.status_code == 204
+            status, _ = await self._request("DELETE", endpoint)
+            return status == 204
         except Exception as e:
             print(f"❌ Error borrando OneDrive: {e}")
             return False
 
     async def download_file(self, item_id, local_path):
-        headers = self._get_headers()
+        headers = await self._get_headers(content_type=None)
         if not headers: return False
-        
+
         endpoint = f"{self.base_url}/me/drive/items/{item_id}/content"
         try:
-            response = requests.get(endpoint, headers=headers, stream=True)
-            if response.status_code == 200:
+            async with self._session().get(endpoint, headers=headers) as resp:
+                if resp.status != 200:
+                    return False
                 with open(local_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
                         f.write(chunk)
-                return True
-            return False
+            return True
         except Exception as e:
             print(f"❌ Error descargando OneDrive: {e}")
             return False
 
+    async def download_file_by_id(self, item_id, local_path):
+        return await self.download_file(item_id, local_path)
+
+    async def delete_file_by_id(self, item_id):
+        return await self.delete_file(item_id)
+
+    async def delete_file_by_name(self, file_name):
+        ref = await self.find_ref_by_name(file_name)
+        return await self.delete_file(ref["cloud_id"]) if ref else False
+
+    async def find_ref_by_name(self, file_name):
+        """Búsqueda en todo el drive por nombre exacto."""
+        endpoint = f"{self.base_url}/me/drive/root/search(q='{file_name}')"
+        status, body = await self._request("GET", endpoint)
+        if status != 200:
+            return None
+        for item in body.get('value', []):
+            if item['name'] == file_name:
+                parent_path = (item.get('parentReference') or {}).get('path', '')
+                parent_path = parent_path.split(':', 1)[1] if ':' in parent_path else ''
+                return {"cloud_id": item['id'], "cloud_path": f"{parent_path}/{file_name}"}
+        return None
+
     async def download_file_by_name(self, file_name, local_path):
         """Busca por nombre y descarga."""
-        headers = self._get_headers()
-        if not headers: return False
-        
         # Búsqueda usando query parameters
         endpoint = f"{self.base_url}/me/drive/root/search(q='{file_name}')"
         try:
-            response = requests.get(endpoint, headers=headers)
-            if response.status_code == 200:
-                items = response.json().get('value', [])
+            status, body = await self._request("GET", endpoint)
+            if status == 200:
+                items = body.get('value', [])
                 # Filtrar coincidencia exacta
                 matches = [i for i in items if i['name'] == file_name]
                 if matches:
@@ -248,16 +413,44 @@ class OneDriveService(CloudService):
             return False
 
     async def move_file(self, item_id, new_parent_id):
-        headers = self._get_headers()
-        if not headers: return False
-        
         endpoint = f"{self.base_url}/me/drive/items/{item_id}"
         body = {
             "parentReference": {"id": new_parent_id}
         }
         try:
-            response = requests.patch(endpoint, headers=headers, json=body)
-            return response.status_code == 200
+            status, _ = await self._request("PATCH", endpoint, json=body)
+            return status == 200
         except Exception as e:
             print(f"❌ Error moviendo OneDrive: {e}")
             return False
+
+    # ----- Sincronización incremental -----
+
+    async def iter_changes(self, cursor=None):
+        """/delta de Graph. El cursor es la nextLink/deltaLink completa."""
+        url = cursor or f"{self.base_url}/me/drive/root/delta"
+        while url:
+            status, body = await self._request("GET", url)
+            if status == 410:
+                # Token de delta caducado: Graph pide resincronizar desde cero
+                logger.info("↪️ OneDrive: deltaLink caducado, se recorre todo de nuevo.")
+                url = f"{self.base_url}/me/drive/root/delta"
+                continue
+            if status != 200:
+                raise RuntimeError(f"OneDrive delta falló Status: {status} Resp: {body}")
+            changes = []
+            for item in body.get('value', []):
+                if 'folder' in item or 'root' in item:
+                    continue
+                parent_path = (item.get('parentReference') or {}).get('path', '')
+                parent_path = parent_path.split(':', 1)[1] if ':' in parent_path else ''
+                changes.append({
+                    "name": item.get('name'), "cloud_id": item.get('id'),
+                    "cloud_path": f"{parent_path}/{item.get('name', '')}" if item.get('name') else None,
+                    "deleted": 'deleted' in item,
+                    # cTag cambia sólo con el contenido (eTag también con renombrados)
+                    "version": item.get('cTag'),
+                })
+            next_link = body.get('@odata.nextLink')
+            yield changes, next_link or body.get('@odata.deltaLink')
+            url = next_link
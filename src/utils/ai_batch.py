@@ -0,0 +1,250 @@
+# src/utils/ai_batch.py
+"""
+Modo offline para re-indexaciones masivas: Batch API del proveedor.
+
+En lugar de una llamada síncrona por archivo (que compite con el tráfico
+interactivo por el rate-limit), las peticiones de embedding y de resumen se
+escriben como JSONL (una línea por archivo, `custom_id` = id del archivo), se
+envían al endpoint de lotes y se recogen cuando el proveedor termina (hasta
+24 h, a mitad de precio y con una cuota propia).
+
+Backends (AI_BATCH_BACKEND):
+  • openai → Files + Batches API de OpenAI.
+  • local  → sustituto en disco para pruebas: guarda el JSONL en
+             AI_BATCH_LOCAL_DIR, "termina" tras AI_BATCH_LOCAL_DELAY segundos y
+             genera respuestas deterministas con el mismo formato de salida.
+
+Las funciones son síncronas (red/disco); el job las llama con asyncio.to_thread.
+El flujo completo (plan, envío, sondeo y aplicación) es el tipo de job
+`ai_batch` de src/scripts/job_kinds.py.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AI_BATCH_BACKEND = os.getenv("AI_BATCH_BACKEND", "openai").lower()
+AI_BATCH_LOCAL_DIR = os.getenv("AI_BATCH_LOCAL_DIR", os.path.join("descargas", "ai_batches"))
+AI_BATCH_LOCAL_DELAY = float(os.getenv("AI_BATCH_LOCAL_DELAY", "5"))
+AI_BATCH_COMPLETION_WINDOW = "24h"
+
+ENDPOINT_EMBEDDINGS = "/v1/embeddings"
+ENDPOINT_CHAT = "/v1/chat/completions"
+
+# Estados terminales de un lote (los mismos nombres que la Batch API)
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def embedding_request(custom_id, chunks, model, dimensions=None):
+    """Línea JSONL de embeddings. `chunks` son los trozos de un texto largo (se promedian al aplicar)."""
+    body = {"model": model, "input": chunks}
+    if dimensions:
+        body["dimensions"] = int(dimensions)
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT_EMBEDDINGS, "body": body}
+
+
+def chat_request(custom_id, system_prompt, text, model="gpt-4o-mini", max_tokens=200):
+    """Línea JSONL de chat en modo JSON."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT_CHAT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text},
+            ],
+            "max_tokens": max_tokens,
+            "response_format": {"type": "json_object"},
+        },
+    }
+
+
+def parse_result_line(line):
+    """(custom_id, body | None, error | None) de una línea del fichero de salida."""
+    data = json.loads(line)
+    response = data.get("response") or {}
+    if data.get("error") or response.get("status_code", 200) >= 400:
+        error = data.get("error") or (response.get("body") or {}).get("error") or response.get("status_code")
+        return data.get("custom_id"), None, error
+    return data.get("custom_id"), response.get("body"), None
+
+
+def mean_embedding(body):
+    """Vector de una respuesta de embeddings (promedio si el texto iba troceado)."""
+    data = sorted((body or {}).get("data") or [], key=lambda d: d.get("index", 0))
+    if not data:
+        return None
+    if len(data) == 1:
+        return data[0]["embedding"]
+    return np.mean([d["embedding"] for d in data], axis=0).tolist()
+
+
+def chat_content(body):
+    choices = (body or {}).get("choices") or []
+    return ((choices[0] or {}).get("message") or {}).get("content") if choices else None
+
+
+class OpenAIBatchBackend:
+    """Files + Batches API de OpenAI."""
+
+    name = "openai"
+
+    def __init__(self):
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    def submit(self, requests, endpoint, metadata=None):
+        client = self._get_client()
+        payload = "\n".join(json.dumps(r, ensure_ascii=False) for r in requests).encode("utf-8")
+        upload = client.files.create(file=("batch.jsonl", payload), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=upload.id,
+            endpoint=endpoint,
+            completion_window=AI_BATCH_COMPLETION_WINDOW,
+            metadata={k: str(v) for k, v in (metadata or {}).items()},
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self._get_client().batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "total": counts.total if counts else 0,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+        }
+
+    def results(self, info):
+        """Líneas de salida (y de error) de un lote terminado."""
+        client = self._get_client()
+        for file_id in (info.get("output_file_id"), info.get("error_file_id")):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield line
+
+    def cancel(self, batch_id):
+        self._get_client().batches.cancel(batch_id)
+
+
+class LocalBatchBackend:
+    """Sustituto en disco con el mismo ciclo de vida (para pruebas sin red ni coste)."""
+
+    name = "local"
+
+    _WORD_RE = re.compile(r"[A-Za-zÁÉÍÓÚáéíóúÑñ]{5,}")
+
+    def __init__(self, base_dir=AI_BATCH_LOCAL_DIR, delay=AI_BATCH_LOCAL_DELAY):
+        self.base_dir = base_dir
+        self.delay = delay
+
+    def _dir(self, batch_id):
+        return os.path.join(self.base_dir, batch_id)
+
+    def _meta(self, batch_id):
+        with open(os.path.join(self._dir(batch_id), "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_meta(self, batch_id, meta):
+        with open(os.path.join(self._dir(batch_id), "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def submit(self, requests, endpoint, metadata=None):
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        os.makedirs(self._dir(batch_id), exist_ok=True)
+        with open(os.path.join(self._dir(batch_id), "input.jsonl"), "w", encoding="utf-8") as f:
+            for r in requests:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        self._save_meta(batch_id, {"status": "in_progress", "endpoint": endpoint, "created_at": time.time(),
+                                   "total": len(requests), "metadata": metadata or {}})
+        return batch_id
+
+    def status(self, batch_id):
+        meta = self._meta(batch_id)
+        if meta["status"] == "in_progress" and time.time() - meta["created_at"] >= self.delay:
+            self._complete(batch_id, meta)
+        return {
+            "status": meta["status"],
+            "output_file_id": batch_id if meta["status"] == "completed" else None,
+            "error_file_id": None,
+            "total": meta["total"],
+            "completed": meta["total"] if meta["status"] == "completed" else 0,
+            "failed": 0,
+        }
+
+    def _complete(self, batch_id, meta):
+        with open(os.path.join(self._dir(batch_id), "input.jsonl"), encoding="utf-8") as src, \
+                open(os.path.join(self._dir(batch_id), "output.jsonl"), "w", encoding="utf-8") as out:
+            for line in src:
+                request = json.loads(line)
+                body = self._fake_response(request)
+                out.write(json.dumps({
+                    "id": f"req_{uuid.uuid4().hex[:8]}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": body},
+                    "error": None,
+                }, ensure_ascii=False) + "\n")
+        meta["status"] = "completed"
+        self._save_meta(batch_id, meta)
+
+    def _fake_response(self, request):
+        body = request["body"]
+        if request["url"] == ENDPOINT_EMBEDDINGS:
+            from src.utils.ai_handler import AIHandler
+            dims = body.get("dimensions") or AIHandler.EMBEDDING_MODELS.get(body["model"], {}).get("dims", 1536)
+            data = []
+            for i, text in enumerate(body["input"]):
+                seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+                vec = np.random.default_rng(seed).standard_normal(dims)
+                data.append({"index": i, "embedding": (vec / np.linalg.norm(vec)).tolist()})
+            return {"data": data, "model": body["model"]}
+        text = body["messages"][-1]["content"]
+        first = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0][:200]
+        tags = [w.lower() for w, _ in Counter(self._WORD_RE.findall(text)).most_common(3)]
+        return {"choices": [{"message": {"content": json.dumps({"summary": first, "tags": tags},
+                                                               ensure_ascii=False)}}]}
+
+    def results(self, info):
+        path = os.path.join(self._dir(info["output_file_id"]), "output.jsonl") if info.get("output_file_id") else None
+        if not path or not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+    def cancel(self, batch_id):
+        meta = self._meta(batch_id)
+        if meta["status"] not in BATCH_FINAL_STATUSES:
+            meta["status"] = "cancelled"
+            self._save_meta(batch_id, meta)
+
+
+_backend = None
+
+
+def get_batch_backend():
+    """Backend configurado en AI_BATCH_BACKEND (openai por defecto)."""
+    global _backend
+    if _backend is None:
+        _backend = LocalBatchBackend() if AI_BATCH_BACKEND == "local" else OpenAIBatchBackend()
+    return _backend
@@ -3,18 +3,30 @@
 Manejador de IA para CloudGram Pro - Compatible con Gemini API
 Soporta: Embeddings, Transcripción de Audio, Análisis de Imágenes, Resúmenes
 """
-import fitz  # PyMuPDF
 import docx
 import re
 from PIL import Image
 import os
-import numpy as np 
-import base64
 import json
+import time
+import asyncio
 import logging
-from datetime import datetime
+import logging.handlers
+import queue
+import atexit
 from dotenv import load_dotenv
-from openai import OpenAI, AsyncOpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, DefaultAsyncHttpxClient
+from src.utils.pdf_extractor import extract_pdf_text
+from src.utils.audio_pipeline import needs_pipeline, transcribe_in_chunks, WHISPER_MAX_BYTES, VIDEO_EXTENSIONS
+from src.utils.video_extractor import describe_video
+from src.utils.office_extractor import extract_office_text, OFFICE_EXTENSIONS
+from src.utils.image_prep import prepare_for_vision, find_cached_description, remember_description
+from src.utils.cpu_executor import run_cpu, CPUTaskTimeout
+from src.utils.embedding_providers import (
+    OpenAIEmbeddingProvider, LocalEmbeddingProvider, register_provider, get_provider
+)
+from src.utils.ai_scheduler import ai_scheduled, estimate_tokens, LANE_SEARCH
+from src.utils.quota_governor import response_hook, retry_after_from_headers
 
 load_dotenv()
 
@@ -35,6 +47,83 @@ def _get_openai_key():
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+AI_DEBUG_LOG = os.path.join("data", "ai_debug.log")
+_ai_debug_logger = None
+
+
+def _get_ai_debug_logger():
+    """Log de depuración de la IA en data/ai_debug.log sin bloquear el event loop.
+
+    Los mensajes pasan por una cola (QueueHandler) y un hilo aparte
+    (QueueListener) es el único que escribe en el fichero.
+    """
+    global _ai_debug_logger
+    if _ai_debug_logger is None:
+        os.makedirs(os.path.dirname(AI_DEBUG_LOG), exist_ok=True)
+        file_handler = logging.FileHandler(AI_DEBUG_LOG, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        debug = logging.getLogger("cloudgram.ai_debug")
+        debug.setLevel(logging.INFO)
+        debug.propagate = False
+        debug.addHandler(logging.handlers.QueueHandler(log_queue))
+        _ai_debug_logger = debug
+    return _ai_debug_logger
+
+def _read_docx_text(file_path):
+    """Worker del executor CPU: texto de los párrafos de un DOCX."""
+    doc = docx.Document(file_path)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+
+def _read_binary_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def _read_text_file(file_path):
+    """Worker del executor CPU: lectura tolerante de un TXT."""
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+
+# Tokens estimados por petición para el presupuesto compartido (ver ai_scheduler)
+# Visión: tokens de salida y nivel de detalle (la imagen ya llega reducida, ver image_prep)
+VISION_MAX_TOKENS = int(os.getenv("VISION_MAX_TOKENS", "1000"))
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto")
+# Vídeo: fotogramas en detalle bajo (coste fijo por imagen) y salida por lote
+VIDEO_FRAME_TOKENS = 85
+VIDEO_MAX_TOKENS = int(os.getenv("VIDEO_MAX_TOKENS", "600"))
+RERANK_TOKENS_ESTIMATE = 2500
+
+SUMMARY_PROMPT = (
+    "Eres un archivista experto. Resume el siguiente texto en máximo 2 frases cortas en español. "
+    "Luego genera entre 3 y 5 hashtags relevantes en español, sin símbolos extras, sin emojis y en formato de lista JSON. "
+    "Responde únicamente en JSON con las claves 'summary' y 'tags'."
+)
+SUMMARY_BATCH_PROMPT = (
+    "Eres un archivista experto. Recibirás un JSON con una lista 'documents' de objetos {\"i\", \"text\"}. "
+    "Para CADA documento: resume el texto en máximo 2 frases cortas en español y genera entre 3 y 5 hashtags "
+    "relevantes en español, sin símbolos extras ni emojis. No mezcles contenido entre documentos. "
+    "Responde únicamente en JSON con el formato "
+    '{"items": [{"i": <i>, "summary": "<resumen>", "tags": ["tag1", "tag2"]}, ...]} '
+    "con un elemento por cada documento recibido."
+)
+# Tokens de salida reservados por documento en un lote de resúmenes
+SUMMARY_BATCH_OUTPUT_TOKENS = 150
+
+
+def _uses_local_embeddings(args, kwargs):
+    """True si la llamada de embeddings va a un modelo local (no gasta cuota)."""
+    model = kwargs.get("model") or (args[1] if len(args) > 1 else None)
+    if model is None:
+        model = AIHandler.get_embedding_spec()["model"]
+    return AIHandler.EMBEDDING_MODELS.get(model, {}).get("provider") == "local"
+
+
 class QuotaExceededError(Exception):
     """Excepción para cuando se agota la cuota (429) de la API de Gemini u OpenAI."""
     def __init__(self, message, retry_after=None):
@@ -58,7 +147,44 @@ class AIHandler:
     """
     
     # Modelos
-    EMBEDDING_MODEL = "text-embedding-3-small"  # OpenAI — 1536 dims
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")  # OpenAI — 1536 dims
+    # Dimensiones reducidas opcionales (parámetro `dimensions=` de los modelos v3).
+    # Vacío = dimensiones nativas del modelo.
+    EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None
+
+    # Registro de modelos de embedding conocidos: proveedor, dimensiones nativas
+    # y si aceptan `dimensions=` para truncar el vector (Matryoshka).
+    # Los modelos "local/..." corren en CPU (ver src/utils/embedding_providers.py).
+    # OJO: los índices HNSW de pgvector admiten como máximo 2000 dims en `vector`,
+    # así que text-embedding-3-large solo es indexable con dimensiones reducidas.
+    EMBEDDING_MODELS = {
+        "text-embedding-3-small": {"provider": "openai", "dims": 1536, "supports_dimensions": True},
+        "text-embedding-3-large": {"provider": "openai", "dims": 3072, "supports_dimensions": True},
+        "text-embedding-ada-002": {"provider": "openai", "dims": 1536, "supports_dimensions": False},
+        "local/paraphrase-multilingual-MiniLM-L12-v2": {
+            "provider": "local", "dims": 384, "supports_dimensions": False,
+            "hf_name": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+        },
+        "local/paraphrase-multilingual-mpnet-base-v2": {
+            "provider": "local", "dims": 768, "supports_dimensions": False,
+            "hf_name": "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
+        },
+    }
+    # Modelo local adicional configurable por entorno (cualquier sentence-transformers)
+    if os.getenv("LOCAL_EMBEDDING_MODEL") and os.getenv("LOCAL_EMBEDDING_DIMS"):
+        EMBEDDING_MODELS[f"local/{os.getenv('LOCAL_EMBEDDING_MODEL').split('/')[-1]}"] = {
+            "provider": "local", "dims": int(os.getenv("LOCAL_EMBEDDING_DIMS")),
+            "supports_dimensions": False, "hf_name": os.getenv("LOCAL_EMBEDDING_MODEL"),
+        }
+
+    # Spec de embedding vigente (modelo + dims), leída del registro de la BD.
+    # `_embedding_spec_loader` lo inyecta quien tenga acceso a la BD
+    # (init_services / indexador); se refresca cada EMBEDDING_SPEC_TTL segundos
+    # para que un cambio de modelo en otro proceso se propague solo.
+    EMBEDDING_SPEC_TTL = 30
+    _embedding_spec_loader = None
+    _embedding_specs = None
+    _embedding_specs_ts = 0.0
     GEMINI_CHAT_MODELS = ["gemini-2.0-flash", "gemini-1.5-flash"]
     OPENAI_CHAT_MODEL = "gpt-4o"
     
@@ -82,7 +208,8 @@ class AIHandler:
                 logger.info("🔄 GEMINI_API_KEY cambió — recreando cliente Gemini con la nueva clave.")
             AIHandler._async_client_gemini = AsyncOpenAI(
                 api_key=current_key,
-                base_url=GEMINI_BASE_URL
+                base_url=GEMINI_BASE_URL,
+                http_client=DefaultAsyncHttpxClient(event_hooks={"response": [response_hook("gemini")]}),
             )
             AIHandler._gemini_key_used = current_key
         return AIHandler._async_client_gemini
@@ -92,7 +219,11 @@ class AIHandler:
         """Retorna cliente asíncrono real de OpenAI (auto-invalidable)."""
         current_key = _get_openai_key()
         if AIHandler._async_client_openai is None or AIHandler._openai_key_used != current_key:
-            AIHandler._async_client_openai = AsyncOpenAI(api_key=current_key)
+            # El hook alimenta el gobernador de cuota con las cabeceras x-ratelimit-*
+            AIHandler._async_client_openai = AsyncOpenAI(
+                api_key=current_key,
+                http_client=DefaultAsyncHttpxClient(event_hooks={"response": [response_hook("openai")]}),
+            )
             AIHandler._openai_key_used = current_key
         return AIHandler._async_client_openai
 
@@ -113,74 +244,183 @@ class AIHandler:
             except: pass
         logger.info("🔌 Clientes asíncronos de IA cerrados.")
 
+    # --- REGISTRO DE MODELOS DE EMBEDDING ---
+
+    @staticmethod
+    def resolve_embedding_spec(model=None, dims=None):
+        """Normaliza (modelo, dims) contra EMBEDDING_MODELS.
+
+        Returns:
+            dict: {"model", "dims", "native_dims", "provider"}
+
+        Raises:
+            ValueError: si el modelo no está registrado o las dims no son válidas.
+        """
+        model = model or AIHandler.EMBEDDING_MODEL
+        info = AIHandler.EMBEDDING_MODELS.get(model)
+        if not info:
+            raise ValueError(f"Modelo de embedding desconocido: {model}")
+        native = info["dims"]
+        dims = int(dims) if dims else native
+        if dims != native and not info["supports_dimensions"]:
+            raise ValueError(f"{model} no admite dimensiones reducidas (solo {native}).")
+        if dims <= 0 or dims > native:
+            raise ValueError(f"Dimensiones inválidas para {model}: {dims} (máx. {native}).")
+        return {"model": model, "dims": dims, "native_dims": native, "provider": info["provider"]}
+
+    @staticmethod
+    def set_embedding_spec_loader(loader):
+        """Inyecta el callable que devuelve {"active": {...}, "building": {...}|None}."""
+        AIHandler._embedding_spec_loader = loader
+        AIHandler._embedding_specs = None
+        AIHandler._embedding_specs_ts = 0.0
+
+    @staticmethod
+    def _get_embedding_specs():
+        """Specs activa y en construcción, con caché corta sobre el registro de la BD."""
+        now = time.monotonic()
+        if (AIHandler._embedding_specs is not None
+                and now - AIHandler._embedding_specs_ts < AIHandler.EMBEDDING_SPEC_TTL):
+            return AIHandler._embedding_specs
+
+        specs = None
+        if AIHandler._embedding_spec_loader:
+            try:
+                specs = AIHandler._embedding_spec_loader()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo leer el registro de embeddings: {e}")
+        if not specs or not specs.get("active"):
+            specs = {
+                "active": AIHandler.resolve_embedding_spec(None, AIHandler.EMBEDDING_DIMENSIONS),
+                "building": (specs or {}).get("building"),
+            }
+        AIHandler._embedding_specs = specs
+        AIHandler._embedding_specs_ts = now
+        return specs
+
     @staticmethod
-    async def get_embedding(text):
+    def get_embedding_spec(role="active"):
+        """Spec ({"model", "dims"}) del vector activo o del que se está construyendo ("building")."""
+        return AIHandler._get_embedding_specs().get(role)
+
+    @staticmethod
+    def invalidate_embedding_spec():
+        """Fuerza releer el registro en la próxima llamada (tras un cambio de modelo)."""
+        AIHandler._embedding_specs = None
+
+    @staticmethod
+    def get_embedding_provider(model):
+        """Proveedor (openai / local) que genera los vectores de `model`."""
+        info = AIHandler.EMBEDDING_MODELS.get(model)
+        if not info:
+            raise ValueError(f"Modelo de embedding desconocido: {model}")
+        return get_provider(info["provider"])
+
+    @staticmethod
+    def _clean_embedding_text(text):
+        """Limpieza preventiva para evitar errores de codificación."""
+        text = (text or "").replace('\x00', '').strip()
+        # Mantener solo caracteres imprimibles y espacios
+        return ''.join(c for c in text if c.isprintable() or c in '\n\t ')
+
+    @staticmethod
+    def _raise_if_quota(e, context):
+        """Convierte un 429 del proveedor en QuotaExceededError.
+
+        Se detecta por tipo/estado (openai.RateLimitError), no por el texto del
+        error; la espera sale de las cabeceras retry-after / x-ratelimit-reset-*
+        de la respuesta (el gobernador de cuota ya la registró en el hook httpx).
         """
-        Convierte texto en un vector usando OpenAI text-embedding-3-small.
+        if not (isinstance(e, RateLimitError) or getattr(e, "status_code", None) == 429):
+            return
+        response = getattr(e, "response", None)
+        retry = retry_after_from_headers(response.headers if response is not None else None)
+        if retry is None:
+            parsed = AIHandler._parse_retry_after(str(e))
+            retry = float(parsed) if parsed else None
+        retry = int(retry + 0.999) if retry else None
+        wait_msg = f" (Reintenta en {retry}s)" if retry else ""
+        logger.error(f"🚨 Cuota de OpenAI agotada en {context}: {e}")
+        raise QuotaExceededError(f"Cuota de OpenAI agotada en {context}{wait_msg}", retry_after=retry) from e
+
+    @staticmethod
+    async def get_embedding_pair(text):
+        """Doble escritura durante una migración de modelo.
+
+        Returns:
+            tuple: (vector_activo, vector_sombra). El segundo es None si no hay
+            ninguna migración en curso.
+        """
+        building = AIHandler.get_embedding_spec("building")
+        if not building:
+            return await AIHandler.get_embedding(text), None
+        return await asyncio.gather(
+            AIHandler.get_embedding(text),
+            AIHandler.get_embedding(text, model=building["model"], dimensions=building["dims"]),
+        )
+
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(a[0]), skip_if=_uses_local_embeddings)
+    async def get_embeddings_batch(texts, model=None, dimensions=None):
+        """Embeddings de varios textos en una sola llamada al proveedor.
+
+        Returns:
+            list: Un vector (o None) por texto, en el mismo orden.
+        """
+        if model is None:
+            spec = AIHandler.get_embedding_spec()
+            model, dimensions = spec["model"], spec["dims"]
+
+        clean = [AIHandler._clean_embedding_text(t) for t in texts]
+        if not any(clean):
+            return [None] * len(texts)
+        provider = AIHandler.get_embedding_provider(model)
+        try:
+            vectors = await provider.embed(clean, model, dimensions)
+            logger.info(f"✅ Lote de {sum(1 for v in vectors if v)} embeddings generado con {model}")
+            return vectors
+        except Exception as e:
+            AIHandler._raise_if_quota(e, "lote de embeddings")
+            logger.error(f"❌ Error en lote de embeddings ({provider.name}): {e}")
+            return [None] * len(texts)
+
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(a[0]), skip_if=_uses_local_embeddings)
+    async def get_embedding(text, model=None, dimensions=None):
+        """
+        Convierte texto en un vector usando el modelo de embedding activo.
         
         Args:
             text: Texto a convertir en embedding
+            model: Modelo explícito (por defecto el activo en el registro)
+            dimensions: Dimensiones reducidas opcionales (solo modelos v3)
             
         Returns:
-            list: Vector de 1536 dimensiones o None si hay error
+            list: Vector con las dimensiones del modelo activo o None si hay error
             
         Note:
-            OpenAI text-embedding-3-small produce 1536 dimensiones.
-            Si ya tenías embeddings de Gemini (768 dims) en la DB,
-            debes re-indexar con: UPDATE files SET embedding = NULL
+            El modelo y las dimensiones vigentes se leen del registro
+            `embedding_models` de la BD; para cambiarlos usa la migración en
+            sombra (ver DatabaseHandler.start_embedding_migration). Los textos
+            largos se fragmentan y promedian dentro de cada proveedor.
         """
+        text = AIHandler._clean_embedding_text(text)
         if not text:
             return None
-        
-        # OpenAI admite ~8192 tokens; usamos ~24000 chars como límite conservador
-        MAX_CHARS_SAFE = 24000
-        
-        # Limpieza preventiva para evitar errores de codificación
-        text = text.replace('\x00', '').strip()
-        # Mantener solo caracteres imprimibles y espacios
-        text = ''.join(c for c in text if c.isprintable() or c in '\n\t ')
-        if not text:
-            return None
-        
-        model_name = AIHandler.EMBEDDING_MODEL
+
+        if model is None:
+            spec = AIHandler.get_embedding_spec()
+            model, dimensions = spec["model"], spec["dims"]
         
         try:
-            client = AIHandler._get_openai_client()
-            
-            if len(text) <= MAX_CHARS_SAFE:
-                response = await client.embeddings.create(
-                    model=model_name,
-                    input=text
-                )
-                vector = response.data[0].embedding
-                logger.info(f"✅ Embedding generado con {model_name} ({len(vector)} dims)")
-                return vector
-            else:
-                # Fragmentar texto largo y promediar
-                logger.info(f"✂️ Fragmentando texto largo para embedding ({len(text)} chars)...")
-                chunks = [text[i:i + MAX_CHARS_SAFE] for i in range(0, len(text), MAX_CHARS_SAFE)]
-                
-                # Solo procesamos los primeros 5 trozos para evitar latencia extrema
-                all_embeddings = []
-                for chunk in chunks[:5]:
-                    res = await client.embeddings.create(
-                        model=model_name,
-                        input=chunk
-                    )
-                    all_embeddings.append(res.data[0].embedding)
-                
-                avg_embedding = np.mean(all_embeddings, axis=0).tolist()
-                logger.info(f"✅ Embedding promediado generado ({len(avg_embedding)} dims)")
-                return avg_embedding
-                
+            provider = AIHandler.get_embedding_provider(model)
+            vector = (await provider.embed([text], model, dimensions))[0]
+            if vector is not None:
+                logger.info(f"✅ Embedding generado con {model} ({len(vector)} dims)")
+            return vector
         except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "quota" in error_msg.lower() or "rate_limit" in error_msg.lower():
-                retry = AIHandler._parse_retry_after(error_msg)
-                wait_msg = f" (Reintenta en {retry}s)" if retry else ""
-                logger.error(f"🚨 Cuota de OpenAI agotada en embedding: {error_msg}")
-                raise QuotaExceededError(f"Cuota de OpenAI agotada{wait_msg}", retry_after=retry)
-            logger.error(f"❌ Error crítico en Embeddings (OpenAI): {e}")
+            AIHandler._raise_if_quota(e, "embedding")
+            logger.error(f"❌ Error crítico en Embeddings ({model}): {e}")
             return None
 
     @staticmethod
@@ -194,9 +434,6 @@ class AIHandler:
         Returns:
             str: Descripción de la imagen o mensaje de error
         """
-        client = AIHandler._get_openai_client()
-        model = "gpt-4o-mini"
-        
         ext = file_path.lower().split('.')[-1]
         mime_types = {
             'jpg': 'image/jpeg',
@@ -206,11 +443,44 @@ class AIHandler:
             'gif': 'image/gif'
         }
         mime_type = mime_types.get(ext, 'image/jpeg')
-        
+
         try:
             with open(file_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+                data = image_file.read()
+        except Exception as e:
+            logger.error(f"❌ Error leyendo imagen para Visión: {e}")
+            return ""
+        return await AIHandler.analyze_image_bytes(data, mime_type)
+
+    @staticmethod
+    async def analyze_image_bytes(data, mime_type="image/jpeg", near_duplicates=True):
+        """
+        Igual que analyze_image_vision pero con la imagen ya en memoria
+        (p. ej. páginas de un PDF rasterizadas sin pasar por disco).
 
+        La imagen se reduce y limpia antes de enviarla (ver image_prep) y, si
+        ya se describió la misma imagen (o una casi idéntica con las mismas
+        dimensiones, salvo con near_duplicates=False), se reutiliza esa descripción sin llamar a Visión.
+        
+        Returns:
+            str: Descripción de la imagen o "" si hay error
+        """
+        image = await prepare_for_vision(data, mime_type)
+        cached = await find_cached_description(image, near_duplicates=near_duplicates)
+        if cached:
+            return cached
+        result = await AIHandler._vision_request(image)
+        await remember_description(image, result)
+        return result
+
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: a[0].tokens + VISION_MAX_TOKENS)
+    async def _vision_request(image):
+        """Llamada a gpt-4o-mini Visión con una imagen ya preparada."""
+        client = AIHandler._get_openai_client()
+        model = "gpt-4o-mini"
+        
+        try:
             response = await client.chat.completions.create(
                 model=model,
                 messages=[
@@ -229,33 +499,97 @@ class AIHandler:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:{mime_type};base64,{base64_image}"
+                                    "url": f"data:{image.mime_type};base64,{image.b64}",
+                                    "detail": VISION_DETAIL
                                 }
                             }
                         ]
                     }
                 ],
-                max_tokens=1500
+                max_tokens=VISION_MAX_TOKENS
             )
             result = response.choices[0].message.content
-            logger.info(f"✅ Imagen analizada con {model}: {len(result)} chars")
+            logger.info(
+                f"✅ Imagen analizada con {model}: {len(result)} chars "
+                f"({image.width}x{image.height}, {image.size_in // 1024}→{image.size_out // 1024} KB)"
+            )
             return result
 
         except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "quota" in error_msg.lower() or "rate_limit" in error_msg.lower():
-                retry = AIHandler._parse_retry_after(error_msg)
-                wait_msg = f" (Reintenta en {retry}s)" if retry else ""
-                logger.error(f"🚨 Cuota de OpenAI agotada en Visión: {error_msg}")
-                raise QuotaExceededError(f"Cuota de OpenAI agotada en Visión{wait_msg}", retry_after=retry)
+            AIHandler._raise_if_quota(e, "Visión")
             logger.error(f"❌ Error en Visión IA (OpenAI): {e}")
             return ""
 
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: VIDEO_FRAME_TOKENS * len(a[0]) + VIDEO_MAX_TOKENS)
+    async def describe_video_frames(frames):
+        """
+        Describe varios fotogramas de un vídeo en una sola petición a Visión.
+
+        Args:
+            frames: lista de (segundo, jpeg_b64) en orden cronológico (ver video_extractor).
+
+        Returns:
+            str: Descripción conjunta o "" si hay error
+        """
+        client = AIHandler._get_openai_client()
+        model = "gpt-4o-mini"
+        content = [{
+            "type": "text",
+            "text": (
+                "Estas imágenes son fotogramas de un mismo vídeo en orden cronológico, cada uno precedido de su instante. "
+                "Responde en español con un único bloque de texto (sin formato markdown ni títulos) describiendo lo que "
+                "se ve: escenas, lugares, personas, objetos y acciones, y transcribe literalmente cualquier texto visible. "
+                "No describas cada fotograma por separado si se repiten y no inventes lo que no se vea."
+            )
+        }]
+        for second, b64 in frames:
+            content.append({"type": "text", "text": f"Fotograma en {int(second) // 60:02d}:{int(second) % 60:02d}"})
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{b64}", "detail": "low"}
+            })
+
+        try:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": content}],
+                max_tokens=VIDEO_MAX_TOKENS
+            )
+            result = response.choices[0].message.content
+            logger.info(f"✅ {len(frames)} fotograma(s) de vídeo descritos con {model}: {len(result)} chars")
+            return result
+        except Exception as e:
+            AIHandler._raise_if_quota(e, "Visión (vídeo)")
+            logger.error(f"❌ Error en Visión IA (vídeo): {e}")
+            return ""
+
+    @staticmethod
+    async def extract_video_text(file_path):
+        """
+        Texto indexable de un vídeo: lo que se ve (fotogramas clave) y lo que
+        se oye (transcripción), obtenidos en paralelo.
+        """
+        visual, audio = await asyncio.gather(
+            describe_video(file_path, AIHandler.describe_video_frames),
+            AIHandler.transcribe_audio(file_path),
+        )
+        parts = []
+        if visual:
+            parts.append(f"[Vídeo]\n{visual}")
+        if audio:
+            parts.append(f"[Audio]\n{audio}")
+        return "\n\n".join(parts)
+
     @staticmethod
     async def transcribe_audio(file_path):
         """
         Transcribe audio usando OpenAI Whisper API (whisper-1).
         Soporta: flac, mp3, mp4, mpeg, mpga, m4a, ogg, wav, webm.
+
+        Las grabaciones largas y los vídeos pasan por audio_pipeline (pista de
+        audio extraída, silencios recortados y tramos transcritos en paralelo);
+        las notas de voz cortas, o sin ffmpeg, van en una sola petición.
         
         Args:
             file_path: Ruta al archivo de audio
@@ -263,48 +597,65 @@ class AIHandler:
         Returns:
             str: Transcripción del audio o string vacío si hay error
         """
-        if not os.path.exists("data"):
-            os.makedirs("data")
-        log_file = "data/ai_debug.log"
+        debug = _get_ai_debug_logger()
+        file_name = os.path.basename(file_path)
+        debug.info(f"Transcribiendo con Whisper: {file_path}")
 
         try:
-            client = AIHandler._get_openai_client()
-            file_name = os.path.basename(file_path)
-
-            with open(log_file, "a", encoding="utf-8") as log:
-                log.write(f"\n[{datetime.now()}] Transcribiendo con Whisper: {file_path}\n")
-
-            with open(file_path, "rb") as audio_file:
-                transcript = await client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=(file_name, audio_file),
-                    language="es"
-                )
-
-            text_result = transcript.text.strip()
+            text_result = None
+            if needs_pipeline(file_path):
+                try:
+                    text_result = await transcribe_in_chunks(file_path, AIHandler._whisper_request, log=debug.info)
+                except QuotaExceededError:
+                    raise
+                except Exception as e:
+                    debug.warning(f"⚠️ Pipeline de audio falló ({e}); se intenta en una sola petición")
+                    logger.warning(f"⚠️ Pipeline de audio falló para {file_name}: {e}")
+                    if os.path.getsize(file_path) > WHISPER_MAX_BYTES:
+                        raise
+            else:
+                if os.path.getsize(file_path) > WHISPER_MAX_BYTES:
+                    raise ValueError("el archivo supera los 25 MB de Whisper y ffmpeg no está disponible")
+            if text_result is None:
+                data = await run_cpu(_read_binary_file, file_path, prefer="thread")
+                text_result = await AIHandler._whisper_request(file_name, data)
 
-            with open(log_file, "a", encoding="utf-8") as log:
-                log.write(f"✅ Whisper OK. Caracteres: {len(text_result)}\n")
+            text_result = text_result.strip()
+            debug.info(f"✅ Whisper OK. Caracteres: {len(text_result)}")
             logger.info(f"✅ Audio transcrito con Whisper ({len(text_result)} chars)")
             return text_result
 
+        except QuotaExceededError:
+            raise
         except Exception as e:
             error_msg = str(e)
-            if "429" in error_msg or "quota" in error_msg.lower() or "rate_limit" in error_msg.lower():
-                retry = AIHandler._parse_retry_after(error_msg)
-                wait_msg = f" (Reintenta en {retry}s)" if retry else ""
-                logger.error(f"🚨 Cuota de OpenAI agotada en Audio (Whisper): {error_msg}")
-                raise QuotaExceededError(f"Cuota de OpenAI agotada en Audio{wait_msg}", retry_after=retry)
-            with open(log_file, "a", encoding="utf-8") as log:
-                log.write(f"❌ ERROR CRÍTICO Whisper: {error_msg}\n")
+            debug.error(f"❌ ERROR CRÍTICO Whisper: {error_msg}")
             logger.error(f"❌ Error en transcripción Whisper: {error_msg}")
             return ""
 
+    @staticmethod
+    @ai_scheduled()
+    async def _whisper_request(file_name, data):
+        """Una petición a whisper-1 con el audio ya en memoria (≤ 25 MB)."""
+        client = AIHandler._get_openai_client()
+        try:
+            transcript = await client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(file_name, data),
+                language="es"
+            )
+            return transcript.text
+        except Exception as e:
+            AIHandler._raise_if_quota(e, "Audio")
+            raise
+
     @staticmethod
     async def extract_text(file_path):
         """
         Extrae texto de diferentes tipos de archivo.
-        Soporta: PDF, DOCX, TXT, imágenes (via Vision), audio (via transcripción).
+        Soporta: PDF, DOCX, TXT, hojas de cálculo (xlsx/csv), presentaciones (pptx),
+        imágenes (via Vision), audio (via transcripción) y vídeo (fotogramas
+        clave + transcripción).
         
         Args:
             file_path: Ruta al archivo
@@ -323,46 +674,40 @@ class AIHandler:
             if ext in ['jpg', 'jpeg', 'png', 'webp', 'gif']:
                 text = await AIHandler.analyze_image_vision(file_path)
             
+            # Vídeo - Fotogramas clave con Visión + transcripción del audio
+            elif ext in VIDEO_EXTENSIONS:
+                text = await AIHandler.extract_video_text(file_path)
+
             # Audio - Transcribir
-            elif ext in ['ogg', 'mp3', 'wav', 'mp4', 'm4a', 'opus', 'flac', 'webm']:
+            elif ext in ['ogg', 'mp3', 'wav', 'm4a', 'opus', 'flac']:
                 text = await AIHandler.transcribe_audio(file_path)
             
-            # PDF - Extraer texto
+            # PDF - Extraer texto en el pool de procesos (OCR con Visión si está escaneado)
             elif ext == 'pdf':
-                with fitz.open(file_path) as doc:
-                    text = " ".join([page.get_text() for page in doc])
-                
-                # Si es un PDF escaneado (sin texto), intentar OCR con Visión
-                if len(text.strip()) < 10:
-                    logger.info("📄 PDF parece escaneado, usando Visión...")
-                    with fitz.open(file_path) as doc:
-                        if len(doc) > 0:
-                            # Procesar máximo 3 páginas para no exceder límites
-                            pages_to_process = min(len(doc), 3)
-                            extracted_texts = []
-                            for i in range(pages_to_process):
-                                page = doc.load_page(i)
-                                pix = page.get_pixmap()
-                                temp_img = f"{file_path}_ocr_p{i}.jpg"
-                                pix.save(temp_img)
-                                page_text = await AIHandler.analyze_image_vision(temp_img)
-                                extracted_texts.append(f"[Página {i+1}]\n{page_text}")
-                                if os.path.exists(temp_img):
-                                    os.remove(temp_img)
-                            text = "\n\n".join(extracted_texts)
-
-            # DOCX
+                # Páginas de un mismo formulario se parecen demasiado: sólo se
+                # reutilizan descripciones de páginas idénticas
+                text = await extract_pdf_text(
+                    file_path,
+                    ocr_callback=lambda data, mime: AIHandler.analyze_image_bytes(data, mime, near_duplicates=False),
+                )
+
+            # DOCX (parseo CPU en el executor compartido)
             elif ext == 'docx':
-                doc = docx.Document(file_path)
-                text = "\n".join([para.text for para in doc.paragraphs])
+                text = await run_cpu(_read_docx_text, file_path, size_hint=os.path.getsize(file_path))
             
+            # Hojas de cálculo y presentaciones (esquema + muestra, en streaming)
+            elif ext in OFFICE_EXTENSIONS:
+                text = await extract_office_text(file_path)
+
             # TXT
             elif ext == 'txt':
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    text = f.read()
+                text = await run_cpu(_read_text_file, file_path, prefer="thread")
 
         except QuotaExceededError:
             raise
+        except CPUTaskTimeout as e:
+            logger.error(f"⏱️ extract_text ({ext}) abortado por timeout: {e}")
+            text = ""
         except Exception as e:
             logger.error(f"❌ Error real en extract_text ({ext}): {str(e)}")
             text = ""
@@ -384,6 +729,21 @@ class AIHandler:
                 return None
 
     @staticmethod
+    def _normalize_summary(parsed):
+        """{'summary', 'tags'} de la respuesta del modelo, con tags siempre como lista."""
+        summary = str(parsed.get('summary') or '').strip()
+        tags = parsed.get('tags', [])
+        if isinstance(tags, str):
+            tags = [t.strip('# ').strip() for t in tags.split(',') if t.strip()]
+        if not isinstance(tags, list):
+            tags = []
+        return {
+            'summary': summary or 'Resumen no disponible.',
+            'tags': [str(t).strip('# ').strip() for t in tags if t]
+        }
+
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(a[0]))
     async def generate_summary_with_tags(text):
         """
         Genera un resumen y hashtags relevantes en JSON.
@@ -394,18 +754,12 @@ class AIHandler:
         if not text or len(text.strip()) < 10:
             return {'summary': 'Sin contenido para resumir.', 'tags': []}
 
-        prompt = (
-            "Eres un archivista experto. Resume el siguiente texto en máximo 2 frases cortas en español. "
-            "Luego genera entre 3 y 5 hashtags relevantes en español, sin símbolos extras, sin emojis y en formato de lista JSON. "
-            "Responde únicamente en JSON con las claves 'summary' y 'tags'."
-        )
-
         try:
             client = AIHandler._get_openai_client()
             response = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
-                    {"role": "system", "content": prompt},
+                    {"role": "system", "content": SUMMARY_PROMPT},
                     {"role": "user", "content": text[:5000]}
                 ],
                 max_tokens=200
@@ -413,17 +767,8 @@ class AIHandler:
             raw = response.choices[0].message.content.strip()
             parsed = AIHandler._parse_json_response(raw)
             if parsed and isinstance(parsed, dict):
-                summary = parsed.get('summary', '').strip()
-                tags = parsed.get('tags', [])
-                if isinstance(tags, str):
-                    tags = [t.strip('# ').strip() for t in tags.split(',') if t.strip()]
-                if not isinstance(tags, list):
-                    tags = []
                 logger.info("✅ Resumen + tags generado con gpt-4o-mini")
-                return {
-                    'summary': summary or 'Resumen no disponible.',
-                    'tags': [t for t in tags if t]
-                }
+                return AIHandler._normalize_summary(parsed)
 
             # Fallback si el modelo no devuelve JSON válido
             hashtags = re.findall(r"#([A-Za-zÁÉÍÓÚáéíóúÑñ0-9_]+)", raw)
@@ -433,19 +778,83 @@ class AIHandler:
             }
 
         except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "quota" in error_msg.lower() or "rate_limit" in error_msg.lower():
-                retry = AIHandler._parse_retry_after(error_msg)
-                wait_msg = f" (Reintenta en {retry}s)" if retry else ""
-                logger.error(f"🚨 Cuota de OpenAI agotada en Resumen: {error_msg}")
-                raise QuotaExceededError(f"Cuota de OpenAI agotada en Resumen{wait_msg}", retry_after=retry)
+            AIHandler._raise_if_quota(e, "Resumen")
             logger.error(f"❌ Error generando resumen con tags (OpenAI): {e}")
             return {'summary': 'Resumen no disponible.', 'tags': []}
 
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(a[0]) + SUMMARY_BATCH_OUTPUT_TOKENS * len(a[0]))
+    async def _summarize_pack(texts):
+        """Una sola petición JSON con varios documentos. Devuelve {índice: resultado};
+        los índices que falten (respuesta incompleta o error) los resuelve el caller."""
+        payload = json.dumps(
+            {"documents": [{"i": i, "text": t} for i, t in enumerate(texts)]},
+            ensure_ascii=False
+        )
+        try:
+            client = AIHandler._get_openai_client()
+            response = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": SUMMARY_BATCH_PROMPT},
+                    {"role": "user", "content": payload}
+                ],
+                max_tokens=SUMMARY_BATCH_OUTPUT_TOKENS * len(texts) + 50,
+                response_format={"type": "json_object"},
+            )
+            parsed = AIHandler._parse_json_response(response.choices[0].message.content) or {}
+            results = {}
+            for item in parsed.get("items", []):
+                try:
+                    i = int(item.get("i"))
+                except (TypeError, ValueError):
+                    continue
+                if 0 <= i < len(texts) and item.get("summary"):
+                    results[i] = AIHandler._normalize_summary(item)
+            logger.info(f"✅ Lote de resúmenes: {len(results)}/{len(texts)} en una petición")
+            return results
+        except Exception as e:
+            AIHandler._raise_if_quota(e, "Resumen")
+            logger.error(f"❌ Error en lote de resúmenes (OpenAI): {e}")
+            return {}
+
+    @staticmethod
+    async def generate_summaries_batch(texts):
+        """
+        Resumen + tags de varios documentos cortos en una sola petición.
+
+        Args:
+            texts: Lista de textos (ver summary_batcher para el empaquetado)
+
+        Returns:
+            list[dict]: {'summary', 'tags'} alineado con `texts`. Lo que el
+            modelo no devuelva se resume individualmente.
+        """
+        results = [None] * len(texts)
+        pack = []
+        for i, text in enumerate(texts):
+            if not text or len(text.strip()) < 10:
+                results[i] = {'summary': 'Sin contenido para resumir.', 'tags': []}
+            else:
+                pack.append(i)
+        if len(pack) > 1:
+            by_pos = await AIHandler._summarize_pack([texts[i] for i in pack])
+            for pos, i in enumerate(pack):
+                results[i] = by_pos.get(pos)
+        missing = [i for i in range(len(texts)) if results[i] is None]
+        if missing:
+            fallback = await asyncio.gather(*(AIHandler.generate_summary_with_tags(texts[i]) for i in missing))
+            for i, result in zip(missing, fallback):
+                results[i] = result
+        return results
+
     @staticmethod
     async def generate_summary(text):
         """
         Genera un resumen ejecutivo del texto usando GPT-4o-mini (OpenAI).
+
+        Los textos cortos que se resumen a la vez (indexador, jobs, ZIP) se
+        agrupan en una sola petición (ver src/utils/summary_batcher.py).
         
         Args:
             text: Texto a resumir
@@ -453,10 +862,33 @@ class AIHandler:
         Returns:
             str: Resumen del texto (máximo 2 frases)
         """
-        result = await AIHandler.generate_summary_with_tags(text)
+        from src.utils.summary_batcher import summarize
+        result = await summarize(text)
         return result.get('summary', 'Resumen no disponible.')
 
     @staticmethod
+    async def generate_summary_and_embedding(text):
+        """Resumen y par de embeddings en paralelo.
+
+        Si una de las dos llamadas falla (p. ej. QuotaExceededError) la otra se
+        cancela, en lugar de seguir gastando cuota en un resultado que se descarta.
+
+        Returns:
+            tuple: (resumen, vector_activo, vector_sombra)
+        """
+        summary = asyncio.ensure_future(AIHandler.generate_summary(text))
+        embedding = asyncio.ensure_future(AIHandler.get_embedding_pair(text))
+        try:
+            resumen, (vector, vector_next) = await asyncio.gather(summary, embedding)
+        except BaseException:
+            summary.cancel()
+            embedding.cancel()
+            await asyncio.gather(summary, embedding, return_exceptions=True)
+            raise
+        return resumen, vector, vector_next
+
+    @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(list(a[1:3])), lane=LANE_SEARCH)
     async def answer_document_question(file_name, question, content_text):
         """Responde preguntas específicas sobre un documento ya indexado."""
         if not question:
@@ -482,10 +914,7 @@ class AIHandler:
             logger.info("✅ Respuesta de documento generada con gpt-4o-mini")
             return answer
         except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "quota" in error_msg.lower() or "rate_limit" in error_msg.lower():
-                retry = AIHandler._parse_retry_after(error_msg)
-                raise QuotaExceededError(f"Cuota de OpenAI agotada{(' (Reintenta en '+retry+'s)' if retry else '')}", retry_after=retry)
+            AIHandler._raise_if_quota(e, "preguntas")
             logger.error(f"❌ Error respondiendo pregunta de documento: {e}")
             return "No pude responder esa pregunta en este momento."
 
@@ -510,16 +939,15 @@ class AIHandler:
         try:
             client = AIHandler._get_openai_client()
 
-            # 1. Test Embedding (text-embedding-3-small)
+            # 1. Test Embedding (modelo activo del registro, con su proveedor)
+            spec = AIHandler.get_embedding_spec()
             try:
-                resp = await client.embeddings.create(
-                    model=AIHandler.EMBEDDING_MODEL, input="test"
-                )
-                dims = len(resp.data[0].embedding)
-                results["details"].append(f"Embedding ({AIHandler.EMBEDDING_MODEL}, {dims} dims): OK ✅")
-                results["models_available"]["embedding"].append(AIHandler.EMBEDDING_MODEL)
+                provider = AIHandler.get_embedding_provider(spec["model"])
+                dims = len((await provider.embed(["test"], spec["model"], spec["dims"]))[0])
+                results["details"].append(f"Embedding ({spec['model']}, {dims} dims): OK ✅")
+                results["models_available"]["embedding"].append(spec["model"])
             except Exception as e:
-                results["details"].append(f"Embedding ({AIHandler.EMBEDDING_MODEL}): FAIL ❌ ({str(e)[:60]})")
+                results["details"].append(f"Embedding ({spec['model']}): FAIL ❌ ({str(e)[:60]})")
 
             # 2. Test Chat / Visión (gpt-4o-mini)
             try:
@@ -574,14 +1002,15 @@ class AIHandler:
     @staticmethod
     def get_embedding_dimensions():
         """
-        Retorna las dimensiones de los embeddings de OpenAI.
+        Retorna las dimensiones del embedding activo.
         
         Returns:
-            int: Número de dimensiones (1536 para text-embedding-3-small)
+            int: Número de dimensiones (1536 para text-embedding-3-small nativo)
         """
-        return 1536  # OpenAI text-embedding-3-small produce embeddings de 1536 dimensiones
+        return AIHandler.get_embedding_spec()["dims"]
         
     @staticmethod
+    @ai_scheduled(tokens=lambda a, k: estimate_tokens(a[0]), lane=LANE_SEARCH)
     async def analyze_search_intent(query_text):
         """
         Usa OpenAI para entender la intención de búsqueda del usuario.
@@ -639,12 +1068,7 @@ class AIHandler:
                 logger.info(f"✅ Intención extraída con OpenAI ({model}): {result_text}")
                 return json.loads(result_text)
             except Exception as model_error:
-                error_msg = str(model_error)
-                if "429" in error_msg or "quota" in error_msg.lower():
-                    retry = AIHandler._parse_retry_after(error_msg)
-                    wait_msg = f" (Reintenta en {retry}s)" if retry else ""
-                    logger.error(f"🚨 Cuota agotada en OpenAI: {error_msg}")
-                    raise QuotaExceededError(f"Cuota de OpenAI agotada{wait_msg}", retry_after=retry)
+                AIHandler._raise_if_quota(model_error, "búsqueda")
 
                 logger.warning(f"⚠️ OpenAI ({model}) falló: {model_error}")
                 return {"semantic_query": query_text, "file_types": []}
@@ -659,6 +1083,7 @@ class AIHandler:
 
 
     @staticmethod
+    @ai_scheduled(tokens=lambda a, k: RERANK_TOKENS_ESTIMATE, lane=LANE_SEARCH)
     async def rerank_search_results(query: str,
                                     candidates: list,
                                     top_k: int = 10) -> list:
@@ -803,3 +1228,13 @@ class AIHandler:
             c['llm_score'] = None
 
         return head + tail
+
+
+# Proveedores de embeddings disponibles (ver AIHandler.EMBEDDING_MODELS)
+register_provider(OpenAIEmbeddingProvider(
+    AIHandler._get_openai_client,
+    {m: i["dims"] for m, i in AIHandler.EMBEDDING_MODELS.items() if i["provider"] == "openai"},
+))
+register_provider(LocalEmbeddingProvider(
+    {m: i["hf_name"] for m, i in AIHandler.EMBEDDING_MODELS.items() if i["provider"] == "local"},
+))
@@ -0,0 +1,331 @@
+# src/utils/ai_scheduler.py
+"""
+Planificador central de llamadas a la IA con carriles de prioridad.
+
+Todas las llamadas de AIHandler que consumen cuota del proveedor pasan por
+`ai_scheduled`. Cada llamada pertenece a un carril:
+
+  • search   → búsquedas interactivas (/buscar, inline, /buscar_ia, preguntas)
+  • upload   → subidas interactivas (upload_process, handle_any_file)
+  • backfill → trabajos masivos (indexador, embeddings pendientes, jobs)
+
+El carril se toma del contexto (`ai_lane` / `in_ai_lane`); sin marcar, se
+asume `upload`. Dos mecanismos lo hacen efectivo:
+
+  1. Admisión por proceso: como mucho AI_MAX_INFLIGHT llamadas en vuelo; al
+     liberarse un hueco entra el mejor carril en espera (y, dentro de él, el
+     que más lleva esperando). Funciona entre event loops de distintos hilos.
+  2. Cuota compartida (Redis vía state_store, o memoria): el token bucket de
+     quota_governor, alimentado por las cabeceras x-ratelimit-* del proveedor
+     (o, sin ellas, un presupuesto fijo de peticiones/tokens por minuto). Cada
+     carril solo puede gastar su fracción (AI_LANE_SHARES), de modo que el
+     backfill deja margen a lo interactivo aunque corra en otro proceso
+     (Celery, Flask, bot). Tras un 429 el backfill se congela hasta que pase
+     el `retry-after` que dio el proveedor.
+
+`get_ai_scheduler_stats()` expone profundidad de cola, tiempos de espera y
+consumo del minuto en curso (también de los otros procesos).
+"""
+from __future__ import annotations
+
+import os
+import time
+import heapq
+import socket
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+
+from src.utils.state_store import state_store
+from src.utils.quota_governor import get_governor, in_background
+
+logger = logging.getLogger(__name__)
+
+LANE_SEARCH = "search"
+LANE_UPLOAD = "upload"
+LANE_BACKFILL = "backfill"
+# Orden = prioridad (0 la más alta)
+LANES = (LANE_SEARCH, LANE_UPLOAD, LANE_BACKFILL)
+_PRIORITY = {lane: i for i, lane in enumerate(LANES)}
+
+AI_MAX_INFLIGHT = int(os.getenv("AI_MAX_INFLIGHT", "8"))
+# Presupuesto global por minuto (0 = sin límite)
+AI_REQUESTS_PER_MINUTE = int(os.getenv("AI_REQUESTS_PER_MINUTE", "400"))
+AI_TOKENS_PER_MINUTE = int(os.getenv("AI_TOKENS_PER_MINUTE", "0"))
+# Fracción del presupuesto que puede consumir cada carril
+AI_LANE_SHARES = {
+    LANE_SEARCH: 1.0,
+    LANE_UPLOAD: float(os.getenv("AI_UPLOAD_SHARE", "0.9")),
+    LANE_BACKFILL: float(os.getenv("AI_BACKFILL_SHARE", "0.6")),
+}
+# Proveedor cuyas cabeceras de rate-limit gobiernan la admisión (ver quota_governor)
+AI_PROVIDER = "openai"
+
+BUDGET_KEY_FMT = "cloudgram:ai_budget:{unit}:{window}"
+STATS_KEY = "cloudgram:ai_sched_stats"
+STATS_PUBLISH_EVERY = 5
+STATS_MAX_AGE = 60
+
+_lane = contextvars.ContextVar("ai_lane", default=LANE_UPLOAD)
+# Ya dentro de una llamada admitida (llamadas anidadas no vuelven a hacer cola)
+_admitted = contextvars.ContextVar("ai_admitted", default=False)
+# Acumulador de tokens estimados del bloque en curso (ver metered_tokens)
+_token_meter = contextvars.ContextVar("ai_token_meter", default=None)
+
+
+@contextmanager
+def ai_lane(lane):
+    """Marca el carril de las llamadas a la IA dentro del bloque (y de las tareas que cree)."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def in_ai_lane(lane):
+    """Decorador de corrutinas: todo lo que llamen a la IA va por `lane`."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with ai_lane(lane):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_lane():
+    return _lane.get()
+
+
+@contextmanager
+def metered_tokens():
+    """Suma en `meter[0]` los tokens estimados de las llamadas admitidas dentro del bloque.
+
+    Lo usa el progreso de los jobs para calcular tokens/min por unidad de trabajo.
+    """
+    meter = [0]
+    token = _token_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _token_meter.reset(token)
+
+
+def estimate_tokens(text):
+    """Estimación gruesa (≈4 caracteres por token) para el presupuesto compartido."""
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    return len(text) // 4 + 1 if isinstance(text, str) else 0
+
+
+class AIScheduler:
+    """Admisión con prioridad por proceso + presupuesto compartido por minuto."""
+
+    def __init__(self, max_inflight=AI_MAX_INFLIGHT):
+        self.max_inflight = max(1, max_inflight)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._waiters = []  # heap de (prioridad, seq, loop, future)
+        self._seq = itertools.count()
+        self._stats = {lane: {"admitted": 0, "waiting": 0, "wait_total": 0.0, "wait_max": 0.0,
+                              "budget_waits": 0, "quota_errors": 0}
+                       for lane in LANES}
+        self._published = 0.0
+        self._proc = f"{socket.gethostname()}:{os.getpid()}"
+
+    # --- admisión local ---
+
+    async def _acquire_slot(self, lane):
+        with self._lock:
+            if self._inflight < self.max_inflight and not self._waiters:
+                self._inflight += 1
+                return
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            heapq.heappush(self._waiters, (_PRIORITY[lane], next(self._seq), loop, fut))
+            self._stats[lane]["waiting"] += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = fut.done() and not fut.cancelled()
+                self._waiters = [w for w in self._waiters if w[3] is not fut]
+                heapq.heapify(self._waiters)
+            if granted:
+                self._release_slot()
+            raise
+        finally:
+            with self._lock:
+                self._stats[lane]["waiting"] -= 1
+
+    def _release_slot(self):
+        with self._lock:
+            while self._waiters:
+                _, _, loop, fut = heapq.heappop(self._waiters)
+                try:
+                    # El hueco pasa directamente al siguiente (sin decrementar)
+                    loop.call_soon_threadsafe(self._grant, fut)
+                    return
+                except RuntimeError:
+                    continue  # Su event loop ya está cerrado
+            self._inflight -= 1
+
+    def _grant(self, fut):
+        if fut.done():
+            self._release_slot()
+        else:
+            fut.set_result(None)
+
+    # --- presupuesto compartido ---
+
+    async def _wait_budget(self, lane, tokens):
+        """Espera a que la llamada quepa en la cuota compartida.
+
+        Con cabeceras de rate-limit recientes manda el gobernador (token bucket
+        real del proveedor); sin ellas, el presupuesto fijo por minuto. Las
+        consultas a Redis van en un hilo para no frenar el event loop.
+        """
+        while True:
+            wait = await asyncio.to_thread(self._try_budget, lane, tokens)
+            if not wait:
+                return
+            self._stats[lane]["budget_waits"] += 1
+            await asyncio.sleep(min(max(wait, 0.05), 60))
+
+    def _try_budget(self, lane, tokens):
+        """Síncrono: segundos a esperar, o 0 tras apuntar la llamada en la cuota compartida."""
+        share = AI_LANE_SHARES.get(lane, 1.0)
+        governor = get_governor(AI_PROVIDER)
+        wait = governor.cooldown_remaining() if lane == LANE_BACKFILL else 0.0
+        if not wait:
+            wait = governor.wait_time(tokens, share)
+            if wait is None:
+                wait = self._fixed_budget_wait(share, tokens)
+        if wait:
+            return wait
+        governor.spend(tokens)
+        window = int(time.time() // 60)
+        state_store.incr_with_ttl(BUDGET_KEY_FMT.format(unit="req", window=window), 120)
+        if tokens:
+            state_store.incr_with_ttl(BUDGET_KEY_FMT.format(unit="tok", window=window), 120, tokens)
+        return 0.0
+
+    @staticmethod
+    def _fixed_budget_wait(share, tokens):
+        window = int(time.time() // 60)
+        for unit, limit, amount in (("req", AI_REQUESTS_PER_MINUTE, 1),
+                                    ("tok", AI_TOKENS_PER_MINUTE, tokens)):
+            if limit <= 0 or amount <= 0:
+                continue
+            used = state_store.get_json(BUDGET_KEY_FMT.format(unit=unit, window=window)) or 0
+            if used + amount > limit * share and used > 0:
+                return 60 - time.time() % 60 + 0.05
+        return 0.0
+
+    # --- API ---
+
+    async def run(self, lane, tokens, coro_factory):
+        lane = lane if lane in _PRIORITY else LANE_UPLOAD
+        started = time.monotonic()
+        await self._wait_budget(lane, tokens)
+        await self._acquire_slot(lane)
+        waited = time.monotonic() - started
+        stats = self._stats[lane]
+        stats["admitted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        if time.time() - self._published >= STATS_PUBLISH_EVERY:
+            self._published = time.time()
+            in_background(self._publish)
+        token = _admitted.set(True)
+        try:
+            return await coro_factory()
+        finally:
+            _admitted.reset(token)
+            self._release_slot()
+
+    def note_quota_exceeded(self, lane, retry_after=None):
+        self._stats[lane]["quota_errors"] += 1
+        in_background(get_governor(AI_PROVIDER).note_rate_limited, retry_after)
+
+    def snapshot(self):
+        with self._lock:
+            lanes = {}
+            for lane, s in self._stats.items():
+                lanes[lane] = {
+                    "queue_depth": s["waiting"],
+                    "admitted": s["admitted"],
+                    "avg_wait_ms": round(1000 * s["wait_total"] / s["admitted"], 1) if s["admitted"] else 0.0,
+                    "max_wait_ms": round(1000 * s["wait_max"], 1),
+                    "budget_waits": s["budget_waits"],
+                    "quota_errors": s["quota_errors"],
+                }
+            return {"inflight": self._inflight, "max_inflight": self.max_inflight, "lanes": lanes, "ts": time.time()}
+
+    def _publish(self):
+        now = time.time()
+        try:
+            shared = state_store.get_json(STATS_KEY) or {}
+            shared = {k: v for k, v in shared.items() if now - v.get("ts", 0) < STATS_MAX_AGE}
+            shared[self._proc] = self.snapshot()
+            state_store.set_json(STATS_KEY, shared, ttl=STATS_MAX_AGE * 2)
+        except Exception as e:
+            logger.warning(f"ai_scheduler: no se pudieron publicar métricas: {e}")
+
+
+scheduler = AIScheduler()
+
+
+def ai_scheduled(tokens=None, lane: Optional[str] = None, skip_if=None):
+    """Decorador para las corrutinas de AIHandler que llaman al proveedor.
+
+    Args:
+        tokens: función (args, kwargs) → tokens estimados de la petición.
+        lane: carril fijo (si no, el del contexto).
+        skip_if: función (args, kwargs) → True si la llamada no gasta cuota
+            (p. ej. embeddings con un modelo local).
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _admitted.get() or (skip_if and skip_if(args, kwargs)):
+                return await func(*args, **kwargs)
+            effective = lane or _lane.get()
+            estimate = tokens(args, kwargs) if tokens else 0
+            meter = _token_meter.get()
+            if meter is not None:
+                meter[0] += estimate
+            from src.utils.ai_handler import QuotaExceededError
+            try:
+                return await scheduler.run(effective, estimate, lambda: func(*args, **kwargs))
+            except QuotaExceededError as qe:
+                scheduler.note_quota_exceeded(effective, qe.retry_after)
+                raise
+        return wrapper
+    return decorator
+
+
+def get_ai_scheduler_stats():
+    """Métricas de admisión de este proceso, de los demás y consumo del minuto en curso."""
+    window = int(time.time() // 60)
+    now = time.time()
+    shared = state_store.get_json(STATS_KEY) or {}
+    return {
+        "process": scheduler.snapshot(),
+        "processes": {k: v for k, v in shared.items() if now - v.get("ts", 0) < STATS_MAX_AGE},
+        "budget": {
+            "requests_used": state_store.get_json(BUDGET_KEY_FMT.format(unit="req", window=window)) or 0,
+            "requests_per_minute": AI_REQUESTS_PER_MINUTE,
+            "tokens_used": state_store.get_json(BUDGET_KEY_FMT.format(unit="tok", window=window)) or 0,
+            "tokens_per_minute": AI_TOKENS_PER_MINUTE,
+            "lane_shares": AI_LANE_SHARES,
+            "backfill_cooldown_s": round(get_governor(AI_PROVIDER).cooldown_remaining(), 1),
+            "provider_headroom": get_governor(AI_PROVIDER).headroom(),
+        },
+    }
@@ -0,0 +1,209 @@
+# src/utils/audio_pipeline.py
+"""
+Preparación de audio para Whisper: extracción, recorte de silencios y trozos.
+
+Whisper acepta como mucho 25 MB por petición y tarda proporcionalmente a la
+duración, así que las grabaciones largas (reuniones, vídeos) se procesan así:
+
+  1. ffmpeg decodifica una vez la pista de audio (también de mp4/webm) con
+     el filtro `silencedetect` para saber la duración y dónde están las pausas.
+  2. `plan_chunks` corta la línea de tiempo en tramos de voz: se quitan el
+     silencio inicial/final y las pausas de más de AUDIO_MAX_GAP segundos, y
+     los tramos largos se parten en una pausa cercana a AUDIO_CHUNK_SECONDS.
+  3. Cada tramo se transcodifica a FLAC mono 16 kHz en memoria (pipe, sin
+     ficheros temporales), muy por debajo del límite de tamaño.
+  4. Los tramos se transcriben en paralelo (AUDIO_CONCURRENCY) y se unen en
+     orden con una marca [hh:mm:ss] del instante original de cada uno.
+
+Sin ffmpeg (FFMPEG_BINARY) o con notas de voz pequeñas se envía el archivo
+tal cual en una sola petición, como antes.
+"""
+import os
+import re
+import shutil
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+AUDIO_CHUNK_SECONDS = float(os.getenv("AUDIO_CHUNK_SECONDS", "300"))
+AUDIO_CONCURRENCY = int(os.getenv("AUDIO_CONCURRENCY", "4"))
+# Pausas más largas que esto se recortan (y separan trozos)
+AUDIO_MAX_GAP = float(os.getenv("AUDIO_MAX_GAP", "10"))
+AUDIO_SILENCE_DB = os.getenv("AUDIO_SILENCE_DB", "-35dB")
+AUDIO_SILENCE_MIN = float(os.getenv("AUDIO_SILENCE_MIN", "0.5"))
+# Por debajo de este tamaño una nota de voz va directa (no compensa trocear)
+AUDIO_DIRECT_MAX_BYTES = int(os.getenv("AUDIO_DIRECT_MAX_BYTES", str(4 * 1024 * 1024)))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "600"))
+
+# Límite de Whisper por petición
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+VIDEO_EXTENSIONS = ("mp4", "webm", "mov", "mkv", "avi")
+# Margen de audio que se conserva alrededor de cada tramo de voz
+_PAD = 0.25
+# Tramos más cortos que esto no se envían (chasquidos, respiraciones)
+_MIN_SPEECH = 0.4
+# Un tramo que pasa de max_chunk por menos de esta fracción no se parte: el
+# corte dejaría una cola de segundos (o décimas) como petición aparte
+_CHUNK_SLACK = 0.1
+
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_START_RE = re.compile(r"silence_start:\s*(-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end:\s*(\d+(?:\.\d+)?)")
+
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BINARY) is not None
+
+
+def needs_pipeline(path):
+    """True si conviene extraer/trocear antes de mandar a Whisper."""
+    if not ffmpeg_available():
+        return False
+    ext = path.lower().rsplit(".", 1)[-1]
+    return ext in VIDEO_EXTENSIONS or os.path.getsize(path) > AUDIO_DIRECT_MAX_BYTES
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def parse_duration(stderr):
+    """Duración en segundos de la línea `Duration:` de ffmpeg (0 si no aparece)."""
+    match = _DURATION_RE.search(stderr)
+    if not match:
+        return 0.0
+    h, m, s = match.groups()
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def parse_silencedetect(stderr):
+    """(duración, [(inicio, fin), ...]) a partir de la salida de `silencedetect`."""
+    duration = parse_duration(stderr)
+    silences, start = [], None
+    for line in stderr.splitlines():
+        started = _SILENCE_START_RE.search(line)
+        if started:
+            start = max(0.0, float(started.group(1)))
+            continue
+        ended = _SILENCE_END_RE.search(line)
+        if ended and start is not None:
+            silences.append((start, float(ended.group(1))))
+            start = None
+    if start is not None and duration:
+        silences.append((start, duration))  # silencio hasta el final
+    return duration, silences
+
+
+def plan_chunks(duration, silences, max_chunk=AUDIO_CHUNK_SECONDS, max_gap=AUDIO_MAX_GAP):
+    """Tramos (inicio, fin) a transcribir, en segundos de la grabación original.
+
+    Se quitan el silencio de los extremos y las pausas de más de `max_gap`; un
+    tramo que supere `max_chunk` (con un margen de _CHUNK_SLACK) se parte en la
+    pausa más tardía de su segunda mitad (o a la fuerza si no hay ninguna), así
+    que ningún trozo resultante es una cola diminuta.
+    """
+    if duration <= 0:
+        return []
+    silences = sorted((max(0.0, s), min(duration, e)) for s, e in silences if e > s)
+
+    # 1. Tramos de voz entre silencios largos (y los extremos)
+    speech, cursor = [], 0.0
+    for s, e in silences:
+        if s <= cursor + _PAD and cursor == 0.0:
+            cursor = max(cursor, e - _PAD)  # silencio inicial
+        elif e >= duration - _PAD:
+            speech.append((cursor, min(duration, s + _PAD)))  # silencio final
+            cursor = duration
+        elif e - s > max_gap:
+            speech.append((cursor, s + _PAD))
+            cursor = e - _PAD
+    if cursor < duration:
+        speech.append((cursor, duration))
+    speech = [(max(0.0, a), b) for a, b in speech if b - a >= _MIN_SPEECH]
+
+    # 2. Partir los tramos largos en pausas cortas
+    pauses = [(s + e) / 2 for s, e in silences]
+    chunks = []
+    for start, end in speech:
+        while end - start > max_chunk * (1 + _CHUNK_SLACK):
+            limit = start + max_chunk
+            candidates = [p for p in pauses if start + max_chunk / 2 <= p <= limit]
+            cut = candidates[-1] if candidates else limit
+            chunks.append((start, cut))
+            start = cut
+        chunks.append((start, end))
+    return [(round(a, 2), round(b, 2)) for a, b in chunks]
+
+
+async def _run_ffmpeg(*args, capture="stderr"):
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", *args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=FFMPEG_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"ffmpeg superó {FFMPEG_TIMEOUT:.0f}s")
+    if proc.returncode != 0:
+        tail = stderr.decode("utf-8", "ignore").strip().splitlines()[-1:] or [""]
+        raise RuntimeError(f"ffmpeg terminó con código {proc.returncode}: {tail[0]}")
+    return stdout if capture == "stdout" else stderr.decode("utf-8", "ignore")
+
+
+async def detect_silences(path):
+    """(duración, silencios) de la pista de audio de `path`."""
+    stderr = await _run_ffmpeg(
+        "-i", path, "-vn", "-af", f"silencedetect=noise={AUDIO_SILENCE_DB}:d={AUDIO_SILENCE_MIN}",
+        "-f", "null", "-",
+    )
+    return parse_silencedetect(stderr)
+
+
+async def extract_chunk(path, start, end):
+    """Tramo [start, end) como FLAC mono 16 kHz en memoria."""
+    return await _run_ffmpeg(
+        "-ss", f"{start:.2f}", "-t", f"{end - start:.2f}", "-i", path,
+        "-vn", "-ac", "1", "-ar", "16000", "-f", "flac", "pipe:1",
+        capture="stdout",
+    )
+
+
+async def transcribe_in_chunks(path, transcribe_chunk, log=None):
+    """Transcribe `path` por tramos en paralelo.
+
+    Args:
+        transcribe_chunk: coroutine `(nombre, bytes) -> str` (una petición a Whisper).
+        log: función opcional para el log de depuración.
+
+    Returns:
+        str: Texto unido en orden; con varios tramos, cada uno precedido de
+        su marca [hh:mm:ss].
+    """
+    log = log or logger.info
+    duration, silences = await detect_silences(path)
+    chunks = plan_chunks(duration, silences)
+    kept = sum(b - a for a, b in chunks)
+    log(f"🎙️ {os.path.basename(path)}: {duration:.0f}s, {len(chunks)} tramo(s), "
+        f"{duration - kept:.0f}s de silencio recortados")
+    if not chunks:
+        return ""
+
+    sem = asyncio.Semaphore(AUDIO_CONCURRENCY)
+
+    async def run(i, start, end):
+        async with sem:
+            data = await extract_chunk(path, start, end)
+            if len(data) > WHISPER_MAX_BYTES:
+                raise RuntimeError(f"tramo {i} de {len(data) // (1024 * 1024)} MB supera el límite de Whisper")
+            return await transcribe_chunk(f"tramo_{i:03d}.flac", data)
+
+    texts = await asyncio.gather(*(run(i, a, b) for i, (a, b) in enumerate(chunks)))
+    if len(chunks) == 1:
+        return texts[0].strip()
+    return "\n".join(f"[{format_timestamp(a)}] {t.strip()}"
+                     for (a, _), t in zip(chunks, texts) if t and t.strip())
@@ -0,0 +1,275 @@
+# src/utils/cost_planner.py
+"""
+Plan en seco (dry-run) de una indexación masiva: cuánto va a costar y tardar.
+
+Antes de lanzar /indexar → "embed_all", /run-embeddings o un job de
+embeddings, `plan_pending_index` mira los archivos sin embedding (sólo un
+agregado por extensión en SQL, sin descargar nada) y estima:
+
+  • Descargas: archivos sin content_text que hay que bajar de la nube.
+  • Llamadas: embeddings (una por archivo y modelo, activo + sombra si hay
+    migración), resúmenes (agrupados como hace summary_batcher), Visión
+    (imágenes, PDFs escaneados, fotogramas de vídeo) y minutos de Whisper.
+  • Tokens: del largo real de content_text cuando existe; si no, de un
+    tamaño típico por tipo (PLAN_PRIORS), porque la tabla files no guarda el
+    tamaño del archivo.
+  • Coste en USD con la tabla AI_PRICES (sobrescribible por entorno).
+  • Duración: el máximo entre lo que permite la cuota (límites de las
+    cabeceras del proveedor o presupuesto fijo, con la fracción del carril
+    backfill) y lo que permite la concurrencia del job (EMBED_CONCURRENCY).
+
+El plan se guarda en state_store con un `plan_id`; el job que lo ejecuta lo
+lleva en sus parámetros y `plan_progress` compara su avance con lo previsto.
+"""
+import os
+import math
+import time
+import uuid
+import logging
+
+from src.utils.state_store import state_store
+from src.utils.ai_scheduler import (
+    AI_REQUESTS_PER_MINUTE, AI_TOKENS_PER_MINUTE, AI_LANE_SHARES, LANE_BACKFILL, AI_PROVIDER,
+)
+from src.utils.quota_governor import get_quota_headroom
+from src.utils.summary_batcher import SUMMARY_BATCH_ENABLED, SUMMARY_BATCH_MAX_DOCS, SUMMARY_BATCH_DOC_CHARS
+from src.utils.audio_pipeline import VIDEO_EXTENSIONS, AUDIO_CONCURRENCY, AUDIO_CHUNK_SECONDS
+from src.utils.office_extractor import OFFICE_EXTENSIONS, OFFICE_MAX_CHARS
+from src.utils.video_extractor import VIDEO_FRAME_BUDGET, VIDEO_FRAMES_PER_REQUEST
+
+logger = logging.getLogger(__name__)
+
+PLAN_KEY_FMT = "cloudgram:index_plan:{plan_id}"
+PLAN_TTL = 2 * 24 * 3600
+
+# Lo que de verdad se envía por archivo (ver AIHandler / OpenAIEmbeddingProvider)
+EMBED_MAX_CHARS = 24000 * 5
+SUMMARY_MAX_CHARS = 5000
+SUMMARY_OUTPUT_TOKENS = 150
+VISION_OUTPUT_TOKENS = 500
+# Concurrencia de los jobs de embeddings (la misma variable que usa el indexador)
+PLAN_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+# USD por millón de tokens, por minuto de audio o por imagen
+AI_PRICES = {
+    "text-embedding-3-small": float(os.getenv("AI_PRICE_EMBED_SMALL", "0.02")),
+    "text-embedding-3-large": float(os.getenv("AI_PRICE_EMBED_LARGE", "0.13")),
+    "text-embedding-ada-002": float(os.getenv("AI_PRICE_EMBED_ADA", "0.10")),
+    "chat_input": float(os.getenv("AI_PRICE_CHAT_INPUT", "0.15")),
+    "chat_output": float(os.getenv("AI_PRICE_CHAT_OUTPUT", "0.60")),
+    "whisper_minute": float(os.getenv("AI_PRICE_WHISPER_MINUTE", "0.006")),
+    "vision_image": float(os.getenv("AI_PRICE_VISION_IMAGE", "0.004")),
+    "vision_frame": float(os.getenv("AI_PRICE_VISION_FRAME", "0.0005")),
+}
+
+# Tamaño típico del texto extraído y segundos de trabajo por archivo sin texto
+PLAN_PRIORS = {
+    "pdf": {"chars": 12000, "seconds": 6},
+    "document": {"chars": 8000, "seconds": 4},
+    "office": {"chars": OFFICE_MAX_CHARS // 2, "seconds": 5},
+    "image": {"chars": 1200, "seconds": 8},
+    "audio": {"chars": 900 * float(os.getenv("PLAN_AUDIO_MINUTES", "3")), "seconds": 25,
+              "minutes": float(os.getenv("PLAN_AUDIO_MINUTES", "3"))},
+    "video": {"chars": 2500, "seconds": 45, "minutes": float(os.getenv("PLAN_VIDEO_MINUTES", "2"))},
+    "other": {"chars": 0, "seconds": 3},
+}
+# Fracción de PDFs sin texto que acaban en OCR y páginas por PDF escaneado
+PLAN_PDF_SCANNED_RATIO = float(os.getenv("PLAN_PDF_SCANNED_RATIO", "0.15"))
+PLAN_PDF_OCR_PAGES = int(os.getenv("PDF_OCR_PAGE_BUDGET", "3"))
+# Segundos por archivo que ya tiene texto (sólo resumen + embedding)
+PLAN_TEXT_SECONDS = 1.5
+
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp", "gif")
+AUDIO_EXTENSIONS = ("ogg", "mp3", "wav", "m4a", "opus", "flac")
+
+
+def file_category(ext):
+    ext = (ext or "").lower()
+    if ext == "pdf":
+        return "pdf"
+    if ext in ("docx", "txt"):
+        return "document"
+    if ext in OFFICE_EXTENSIONS:
+        return "office"
+    if ext in IMAGE_EXTENSIONS:
+        return "image"
+    if ext in AUDIO_EXTENSIONS:
+        return "audio"
+    if ext in VIDEO_EXTENSIONS:
+        return "video"
+    return "other"
+
+
+def _rate_limits():
+    """(rpm, tpm, origen) disponibles para el carril backfill (0 = sin límite)."""
+    share = AI_LANE_SHARES.get(LANE_BACKFILL, 1.0)
+    headroom = get_quota_headroom(AI_PROVIDER)
+    if headroom.get("age_s") is not None and (headroom.get("requests") or headroom.get("tokens")):
+        rpm = (headroom.get("requests") or {}).get("limit", 0)
+        tpm = (headroom.get("tokens") or {}).get("limit", 0)
+        return rpm * share, tpm * share, "cabeceras del proveedor"
+    return AI_REQUESTS_PER_MINUTE * share, AI_TOKENS_PER_MINUTE * share, "presupuesto configurado"
+
+
+def build_plan(profile, embed_models, limite=0, offset=0):
+    """Plan a partir del perfil agregado (DatabaseHandler.get_pending_embedding_profile).
+
+    Args:
+        profile: filas {ext, files, with_text, embed_chars, summary_chars, short_texts}.
+        embed_models: modelos de embedding a calcular por archivo (activo y, si
+            hay migración en curso, el de la columna sombra).
+    """
+    files = downloads = 0
+    calls = {"embedding": 0, "summary": 0, "vision": 0, "video_frames": 0, "whisper_minutes": 0.0}
+    embed_tokens = summary_in = summary_out = vision_out = 0
+    image_calls = 0  # peticiones de Visión con una imagen en detalle alto
+    whisper_chunks = 0  # peticiones a Whisper: cada archivo se trocea por separado
+    short_texts = long_texts = 0
+    work_seconds = 0.0
+    groups = {}
+
+    for row in profile:
+        n, with_text = int(row["files"]), int(row["with_text"])
+        category = file_category(row["ext"])
+        prior = PLAN_PRIORS[category]
+        missing = n - with_text
+        files += n
+        downloads += missing
+        group = groups.setdefault(category, {"category": category, "files": 0, "with_text": 0})
+        group["files"] += n
+        group["with_text"] += with_text
+
+        # Texto que ya está en la BD
+        embed_tokens += int(row["embed_chars"]) // 4
+        summary_in += int(row["summary_chars"]) // 4
+        short_texts += int(row["short_texts"])
+        long_texts += with_text - int(row["short_texts"])
+        work_seconds += with_text * PLAN_TEXT_SECONDS
+
+        # Texto que habrá que extraer (tamaño típico por tipo)
+        work_seconds += missing * prior["seconds"]
+        extracted = missing if prior["chars"] else 0
+        if extracted:
+            chars = prior["chars"]
+            embed_tokens += extracted * min(chars, EMBED_MAX_CHARS) // 4
+            summary_in += extracted * min(chars, SUMMARY_MAX_CHARS) // 4
+            if chars <= SUMMARY_BATCH_DOC_CHARS:
+                short_texts += extracted
+            else:
+                long_texts += extracted
+        if category == "image":
+            image_calls += missing
+        elif category == "pdf":
+            image_calls += math.ceil(missing * PLAN_PDF_SCANNED_RATIO) * PLAN_PDF_OCR_PAGES
+        elif category in ("audio", "video"):
+            calls["whisper_minutes"] += missing * prior["minutes"]
+            whisper_chunks += missing * math.ceil(60 * prior["minutes"] / AUDIO_CHUNK_SECONDS)
+            if category == "video":
+                batches = missing * math.ceil(VIDEO_FRAME_BUDGET / max(1, VIDEO_FRAMES_PER_REQUEST))
+                calls["video_frames"] += missing * VIDEO_FRAME_BUDGET
+                calls["vision"] += batches
+                vision_out += batches * VISION_OUTPUT_TOKENS
+
+    calls["vision"] += image_calls
+    vision_out += image_calls * VISION_OUTPUT_TOKENS
+    with_summary = short_texts + long_texts
+    calls["embedding"] = with_summary * len(embed_models)
+    if SUMMARY_BATCH_ENABLED:
+        calls["summary"] = math.ceil(short_texts / max(1, SUMMARY_BATCH_MAX_DOCS)) + long_texts
+    else:
+        calls["summary"] = with_summary
+    summary_out = with_summary * SUMMARY_OUTPUT_TOKENS
+
+    cost = {
+        "embedding": sum(embed_tokens * AI_PRICES.get(m, 0.0) / 1e6 for m in embed_models),
+        "summary": (summary_in * AI_PRICES["chat_input"] + summary_out * AI_PRICES["chat_output"]) / 1e6,
+        "vision": (image_calls * AI_PRICES["vision_image"] + calls["video_frames"] * AI_PRICES["vision_frame"]
+                   + vision_out * AI_PRICES["chat_output"] / 1e6),
+        "whisper": calls["whisper_minutes"] * AI_PRICES["whisper_minute"],
+    }
+    cost["total"] = sum(cost.values())
+    cost = {k: round(v, 4) for k, v in cost.items()}
+
+    requests = calls["embedding"] + calls["summary"] + calls["vision"] + whisper_chunks
+    tokens_in = embed_tokens * len(embed_models) + summary_in
+    tokens_out = summary_out + vision_out
+
+    rpm, tpm, source = _rate_limits()
+    concurrency = max(1, PLAN_CONCURRENCY)
+    bounds = {
+        "concurrencia": work_seconds / concurrency,
+        "peticiones/min": 60 * requests / rpm if rpm else 0.0,
+        "tokens/min": 60 * (tokens_in + tokens_out) / tpm if tpm else 0.0,
+    }
+    bottleneck = max(bounds, key=bounds.get)
+
+    return {
+        "limite": limite,
+        "offset": offset,
+        "files": files,
+        "downloads": downloads,
+        "groups": sorted(groups.values(), key=lambda g: -g["files"]),
+        "embed_models": list(embed_models),
+        "calls": {**calls, "whisper_minutes": round(calls["whisper_minutes"], 1), "whisper_chunks": whisper_chunks},
+        "requests": requests,
+        "tokens": {"input": tokens_in, "output": tokens_out},
+        "cost_usd": cost,
+        "eta_seconds": round(max(bounds.values())),
+        "bottleneck": bottleneck,
+        "limits": {"rpm": round(rpm), "tpm": round(tpm), "concurrency": concurrency,
+                   "audio_concurrency": AUDIO_CONCURRENCY, "source": source},
+    }
+
+
+def plan_pending_index(db, limite=0, offset=0):
+    """Plan de los archivos sin embedding (todos, o `limite` desde `offset`), guardado con un plan_id."""
+    from src.utils.ai_handler import AIHandler
+    models = []
+    for role in ("active", "building"):
+        spec = AIHandler.get_embedding_spec(role)
+        if spec and spec["model"] not in models:
+            models.append(spec["model"])
+    profile = db.get_pending_embedding_profile(
+        limit=limite or None, offset=offset, embed_chars=EMBED_MAX_CHARS,
+        summary_chars=SUMMARY_MAX_CHARS, short_chars=SUMMARY_BATCH_DOC_CHARS,
+    )
+    plan = build_plan(profile, models, limite, offset)
+    plan["plan_id"] = uuid.uuid4().hex[:10]
+    plan["created_at"] = time.time()
+    state_store.set_json(PLAN_KEY_FMT.format(plan_id=plan["plan_id"]), plan, ttl=PLAN_TTL)
+    return plan
+
+
+def get_plan(plan_id):
+    return state_store.get_json(PLAN_KEY_FMT.format(plan_id=plan_id)) if plan_id else None
+
+
+def plan_progress(plan, done, failed=0, started_at=None):
+    """Avance real frente al plan: fracción hecha, tiempo previsto vs transcurrido y ETA proyectada."""
+    total = max(1, plan.get("files") or 0)
+    processed = done + failed
+    fraction = min(1.0, processed / total)
+    elapsed = max(0.0, time.time() - started_at) if started_at else 0.0
+    expected_elapsed = plan.get("eta_seconds", 0) * fraction
+    projected = elapsed / fraction - elapsed if fraction and elapsed else plan.get("eta_seconds", 0)
+    return {
+        "planned_files": plan.get("files", 0),
+        "done": done,
+        "failed": failed,
+        "pct": round(100 * fraction, 1),
+        "elapsed_s": round(elapsed),
+        "planned_elapsed_s": round(expected_elapsed),
+        "pace": round(expected_elapsed / elapsed, 2) if elapsed else None,
+        "eta_s": round(projected),
+        "planned_eta_s": plan.get("eta_seconds", 0),
+        "planned_cost_usd": plan.get("cost_usd", {}).get("total", 0),
+    }
+
+
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    if seconds < 90:
+        return f"{seconds} s"
+    if seconds < 5400:
+        return f"{round(seconds / 60)} min"
+    return f"{seconds / 3600:.1f} h"
@@ -0,0 +1,139 @@
+# src/utils/cpu_executor.py
+"""
+Executor compartido y acotado para trabajo CPU (parseo de PDF/DOCX/ZIP, base64...).
+
+Lo usan el bot, los endpoints de Flask y las tareas de Celery (todos pasan por
+AIHandler.extract_text), así que un archivo grande ya no congela el event loop.
+
+  • Enrutado por tamaño: tareas pequeñas → pool de hilos; a partir de
+    CPU_PROCESS_THRESHOLD bytes → pool de procesos (en procesos daemon, como los
+    workers prefork de Celery, siempre hilos: no pueden tener hijos).
+  • Acotado: como mucho CPU_MAX_QUEUE tareas en vuelo + en cola por proceso;
+    el resto espera sin bloquear el loop.
+  • Timeout por tarea (CPU_TASK_TIMEOUT) → CPUTaskTimeout.
+  • Métricas de cola (get_executor_metrics) para /stats y el dashboard.
+"""
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CPU_THREAD_WORKERS = int(os.getenv("CPU_THREAD_WORKERS", "0")) or min(8, (os.cpu_count() or 1) + 2)
+CPU_PROCESS_WORKERS = int(os.getenv("CPU_PROCESS_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+CPU_MAX_QUEUE = int(os.getenv("CPU_MAX_QUEUE", "64"))
+CPU_PROCESS_THRESHOLD = int(os.getenv("CPU_PROCESS_THRESHOLD", str(1024 * 1024)))
+CPU_TASK_TIMEOUT = float(os.getenv("CPU_TASK_TIMEOUT", "120"))
+
+
+class CPUTaskTimeout(TimeoutError):
+    """La tarea CPU superó su tiempo máximo."""
+
+
+class _BoundedExecutor:
+    def __init__(self):
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # Semáforo entre hilos/loops: el bot, cada hilo de Flask y Celery tienen su propio loop
+        self._slots = threading.BoundedSemaphore(CPU_MAX_QUEUE)
+        self._metrics = {
+            "submitted": 0, "completed": 0, "failed": 0, "timeouts": 0,
+            "in_flight": 0, "waiting": 0, "max_depth": 0,
+            "thread_tasks": 0, "process_tasks": 0, "total_wait_ms": 0.0,
+        }
+
+    # ----- pools -----
+
+    def _pool(self, kind):
+        with self._lock:
+            if kind == "process" and not multiprocessing.current_process().daemon:
+                if self._processes is None:
+                    self._processes = ProcessPoolExecutor(max_workers=CPU_PROCESS_WORKERS)
+                return self._processes, "process"
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=CPU_THREAD_WORKERS, thread_name_prefix="cpu")
+            return self._threads, "thread"
+
+    def _bump(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self._metrics[key] += value
+            depth = self._metrics["in_flight"] + self._metrics["waiting"]
+            self._metrics["max_depth"] = max(self._metrics["max_depth"], depth)
+
+    # ----- API -----
+
+    async def run(self, func, *args, size_hint: int = 0, prefer: Optional[str] = None,
+                  timeout: Optional[float] = None):
+        kind = prefer or ("process" if size_hint >= CPU_PROCESS_THRESHOLD else "thread")
+        t0 = time.monotonic()
+
+        # Esperar hueco sin bloquear el loop
+        self._bump(waiting=1)
+        try:
+            while not self._slots.acquire(blocking=False):
+                await asyncio.sleep(0.05)
+        finally:
+            self._bump(waiting=-1)
+
+        pool, kind = self._pool(kind)
+        self._bump(submitted=1, in_flight=1, total_wait_ms=(time.monotonic() - t0) * 1000,
+                   **{f"{kind}_tasks": 1})
+        future = pool.submit(func, *args)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future),
+                                            timeout=timeout or CPU_TASK_TIMEOUT)
+            self._bump(completed=1)
+            return result
+        except asyncio.TimeoutError:
+            # En procesos no se puede interrumpir la tarea; se libera el hueco igualmente
+            future.cancel()
+            self._bump(timeouts=1)
+            logger.warning(f"⏱️ Tarea CPU {getattr(func, '__name__', func)} superó {timeout or CPU_TASK_TIMEOUT}s")
+            raise CPUTaskTimeout(f"{getattr(func, '__name__', 'tarea')} superó el tiempo máximo")
+        except Exception:
+            self._bump(failed=1)
+            raise
+        finally:
+            self._bump(in_flight=-1)
+            self._slots.release()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            m = dict(self._metrics)
+        started = m["submitted"] or 1
+        m["avg_wait_ms"] = round(m.pop("total_wait_ms") / started, 1)
+        m["queue_depth"] = m["in_flight"] + m["waiting"]
+        m["capacity"] = CPU_MAX_QUEUE
+        return m
+
+
+_executor = _BoundedExecutor()
+
+
+async def run_cpu(func, *args, size_hint: int = 0, prefer: Optional[str] = None,
+                  timeout: Optional[float] = None):
+    """Ejecuta `func(*args)` en el executor compartido.
+
+    Args:
+        size_hint: tamaño aproximado de la entrada en bytes (decide hilo vs proceso).
+        prefer: 'thread' o 'process' para forzar el pool.
+        timeout: segundos máximos (por defecto CPU_TASK_TIMEOUT).
+
+    Raises:
+        CPUTaskTimeout: si la tarea supera el tiempo máximo.
+    """
+    return await _executor.run(func, *args, size_hint=size_hint, prefer=prefer, timeout=timeout)
+
+
+def get_executor_metrics() -> dict:
+    """Contadores del executor de este proceso (cola, en vuelo, timeouts...)."""
+    return _executor.metrics()
@@ -0,0 +1,162 @@
+# src/utils/embedding_providers.py
+"""
+Proveedores de embeddings intercambiables para AIHandler.
+
+  • openai → API de OpenAI (text-embedding-3-*), con lotes y `dimensions=`.
+  • local  → modelo sentence-transformers en CPU (sin red ni cuota).
+             Dependencia OPCIONAL: `pip install sentence-transformers`
+             (LOCAL_EMBEDDING_BACKEND=onnx usa ONNX Runtime si está instalado).
+
+Cada modelo del registro (AIHandler.EMBEDDING_MODELS) declara su proveedor; los
+vectores de proveedores distintos viven en espacios distintos y nunca se mezclan
+en la misma columna (ver tabla `embedding_models`).
+"""
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingProvider:
+    """Interfaz mínima: un vector (o None) por texto, en el mismo orden."""
+
+    name = "base"
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None) -> List[Optional[list]]:
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Embeddings vía API de OpenAI. Los errores (429 incluidos) se propagan al caller."""
+
+    name = "openai"
+
+    # OpenAI admite ~8192 tokens; usamos ~24000 chars como límite conservador
+    MAX_CHARS_SAFE = 24000
+    # Máximo de trozos promediados por texto largo (evita latencia extrema)
+    MAX_CHUNKS = 5
+
+    def __init__(self, client_getter: Callable, native_dims: Dict[str, int]):
+        self._client_getter = client_getter
+        self._native_dims = native_dims
+
+    def _kwargs(self, model, dimensions):
+        """`dimensions` solo si difiere de las nativas del modelo."""
+        kwargs = {"model": model}
+        if dimensions and int(dimensions) != self._native_dims.get(model):
+            kwargs["dimensions"] = int(dimensions)
+        return kwargs
+
+    async def embed(self, texts, model, dimensions=None):
+        client = self._client_getter()
+        kwargs = self._kwargs(model, dimensions)
+        results: List[Optional[list]] = [None] * len(texts)
+
+        short_idx, short_txt = [], []
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            if len(text) <= self.MAX_CHARS_SAFE:
+                short_idx.append(i)
+                short_txt.append(text)
+                continue
+            # Fragmentar texto largo y promediar
+            logger.info(f"✂️ Fragmentando texto largo para embedding ({len(text)} chars)...")
+            chunks = [text[j:j + self.MAX_CHARS_SAFE] for j in range(0, len(text), self.MAX_CHARS_SAFE)]
+            res = await client.embeddings.create(input=chunks[:self.MAX_CHUNKS], **kwargs)
+            results[i] = np.mean([d.embedding for d in res.data], axis=0).tolist()
+
+        if short_txt:
+            response = await client.embeddings.create(input=short_txt, **kwargs)
+            for item in response.data:
+                results[short_idx[item.index]] = item.embedding
+        return results
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """sentence-transformers en CPU.
+
+    El modelo se carga una sola vez por proceso; `encode` corre en un hilo
+    (torch/ONNX liberan el GIL y usan todos los núcleos) para no bloquear el
+    event loop. Los textos largos se trocean en ventanas y se promedian, igual
+    que en el proveedor de OpenAI.
+    """
+
+    name = "local"
+
+    WINDOW_CHARS = int(os.getenv("LOCAL_EMBEDDING_WINDOW_CHARS", "1500"))
+    MAX_WINDOWS = int(os.getenv("LOCAL_EMBEDDING_MAX_WINDOWS", "8"))
+    BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+
+    def __init__(self, hf_names: Dict[str, str]):
+        self._hf_names = hf_names
+        self._models: dict = {}
+        self._lock = threading.Lock()
+
+    def _load(self, model: str):
+        if model in self._models:
+            return self._models[model]
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError(
+                "El proveedor local requiere `sentence-transformers` (pip install sentence-transformers)."
+            ) from e
+        hf_name = self._hf_names.get(model, model)
+        backend = os.getenv("LOCAL_EMBEDDING_BACKEND", "torch")
+        logger.info(f"📦 Cargando modelo local de embeddings {hf_name} (backend={backend})...")
+        kwargs = {"device": "cpu"}
+        if backend != "torch":
+            kwargs["backend"] = backend
+        self._models[model] = SentenceTransformer(hf_name, **kwargs)
+        return self._models[model]
+
+    def _encode_sync(self, texts, model):
+        # Un solo encode a la vez: el modelo ya paraleliza internamente por núcleos
+        with self._lock:
+            st_model = self._load(model)
+            windows, owners = [], []
+            for i, text in enumerate(texts):
+                if not text:
+                    continue
+                for j in range(0, min(len(text), self.WINDOW_CHARS * self.MAX_WINDOWS), self.WINDOW_CHARS):
+                    windows.append(text[j:j + self.WINDOW_CHARS])
+                    owners.append(i)
+            if not windows:
+                return [None] * len(texts)
+            vectors = st_model.encode(
+                windows, batch_size=self.BATCH_SIZE, normalize_embeddings=True, show_progress_bar=False
+            )
+
+        results: List[Optional[list]] = [None] * len(texts)
+        for i in set(owners):
+            rows = [vectors[k] for k, owner in enumerate(owners) if owner == i]
+            vec = np.mean(rows, axis=0)
+            norm = np.linalg.norm(vec)
+            results[i] = (vec / norm if norm else vec).tolist()
+        return results
+
+    async def embed(self, texts, model, dimensions=None):
+        return await asyncio.to_thread(self._encode_sync, list(texts), model)
+
+
+_PROVIDERS: Dict[str, EmbeddingProvider] = {}
+
+
+def register_provider(provider: EmbeddingProvider):
+    """Registra (o reemplaza) un proveedor por su nombre."""
+    _PROVIDERS[provider.name] = provider
+
+
+def get_provider(name: str) -> EmbeddingProvider:
+    provider = _PROVIDERS.get(name)
+    if provider is None:
+        raise ValueError(f"Proveedor de embeddings no registrado: {name}")
+    return provider
@@ -0,0 +1,228 @@
+# src/utils/image_prep.py
+"""
+Preparación de imágenes antes de mandarlas a Visión.
+
+Antes se enviaba el archivo tal cual (fotos de móvil de 4000 px y varios MB
+en base64, con su EXIF/GPS incluido) y el proveedor lo reducía por su cuenta.
+Ahora, en el executor CPU y sin tocar disco:
+
+  • Se aplica la orientación EXIF y se descartan los metadatos.
+  • Se reduce a la resolución que Visión usa de verdad en detalle alto
+    (lado largo ≤ VISION_MAX_SIDE, lado corto ≤ VISION_SHORT_SIDE).
+  • Se re-codifica como JPEG (VISION_JPEG_QUALITY) y se pasa a base64.
+  • Se calcula un dHash de VISION_HASH_SIZE² bits.
+
+Con el SHA-256 del original y el dHash se reutilizan descripciones ya hechas
+(state_store, VISION_CACHE_TTL): la misma imagen reenviada no vuelve a
+llamar a Visión, y una casi idéntica (recompresión de Telegram, reenvío
+re-escalado) tampoco si tiene las mismas dimensiones preparadas y el dHash
+está a distancia de Hamming ≤ VISION_HASH_DISTANCE. La distancia es
+deliberadamente pequeña: Visión transcribe el texto visible, y dos recibos o
+capturas con la misma maqueta quedan a pocos bits; reutilizar la descripción
+de otra imagen indexaría un texto ajeno. La búsqueda de vecinos usa bandas:
+con distancia ≤ d al menos una de d+1 bandas del hash coincide exacta, así
+que basta con mirar d+1 claves.
+
+La caché vive en state_store (Redis): las funciones públicas son corrutinas
+que hacen esas lecturas y escrituras en un hilo, fuera del event loop.
+"""
+import io
+import os
+import asyncio
+import base64
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from src.utils.state_store import state_store
+from src.utils.cpu_executor import run_cpu
+
+logger = logging.getLogger(__name__)
+
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "2048"))
+VISION_SHORT_SIDE = int(os.getenv("VISION_SHORT_SIDE", "768"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_DEDUPE = os.getenv("VISION_DEDUPE", "1").lower() not in ("0", "false", "no", "off")
+VISION_HASH_SIZE = int(os.getenv("VISION_HASH_SIZE", "16"))
+VISION_HASH_DISTANCE = int(os.getenv("VISION_HASH_DISTANCE", "2"))
+VISION_CACHE_TTL = int(os.getenv("VISION_CACHE_TTL", str(30 * 24 * 3600)))
+# Candidatos guardados por banda (las bandas muy comunes no crecen sin límite)
+VISION_BAND_MAX_ENTRIES = 32
+
+DESC_KEY_FMT = "cloudgram:vision_desc:{sha}"
+BAND_KEY_FMT = "cloudgram:vision_phash:{band}:{value}"
+
+# Tiles de 512 px que factura Visión en detalle alto (+ un coste base)
+VISION_TILE = 512
+VISION_TILE_TOKENS = 170
+VISION_BASE_TOKENS = 85
+
+_metrics = {"images": 0, "exact_hits": 0, "near_hits": 0, "prep_failures": 0,
+            "bytes_in": 0, "bytes_out": 0}
+
+
+@dataclass
+class PreparedImage:
+    """Imagen lista para Visión (o el original si Pillow no pudo abrirla)."""
+    b64: str
+    mime_type: str
+    sha: str
+    phash: Optional[int] = None
+    width: int = 0
+    height: int = 0
+    size_in: int = 0
+    size_out: int = 0
+
+    @property
+    def tokens(self):
+        """Tokens de entrada estimados de la imagen (para el presupuesto compartido)."""
+        if not self.width or not self.height:
+            return VISION_BASE_TOKENS + 4 * VISION_TILE_TOKENS
+        tiles = -(-self.width // VISION_TILE) * -(-self.height // VISION_TILE)
+        return VISION_BASE_TOKENS + tiles * VISION_TILE_TOKENS
+
+
+# --- Funciones de worker (nivel de módulo para poder serializarlas) ---
+
+def _target_size(width, height):
+    scale = min(1.0, VISION_MAX_SIDE / max(width, height), VISION_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _dhash(img, size):
+    """Hash de diferencias horizontal: un bit por par de píxeles vecinos."""
+    from PIL import Image
+    small = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    px = list(small.getdata())
+    value = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (px[base + col] > px[base + col + 1])
+    return value
+
+
+def _prepare_worker(data):
+    """Worker del executor CPU: (base64 JPEG, ancho, alto, tamaño, dHash)."""
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as img:
+        img.seek(0)  # GIF/WebP animados: el primer fotograma
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        size = _target_size(*img.size)
+        if size != img.size:
+            img = img.resize(size, Image.LANCZOS)
+        phash = _dhash(img, VISION_HASH_SIZE)
+        out = io.BytesIO()
+        # Sin exif=/icc_profile= → el JPEG sale sin metadatos
+        img.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    jpeg = out.getvalue()
+    return base64.b64encode(jpeg).decode("ascii"), size[0], size[1], len(jpeg), phash
+
+
+def _encode_worker(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+async def prepare_for_vision(data, mime_type="image/jpeg"):
+    """Reduce, limpia y codifica `data` para Visión.
+
+    Si Pillow no reconoce el formato se devuelve el original en base64 (el
+    proveedor decidirá), sin dHash.
+    """
+    sha = hashlib.sha256(data).hexdigest()
+    _metrics["images"] += 1
+    _metrics["bytes_in"] += len(data)
+    try:
+        b64, width, height, size_out, phash = await run_cpu(_prepare_worker, data, size_hint=len(data))
+        _metrics["bytes_out"] += size_out
+        return PreparedImage(b64=b64, mime_type="image/jpeg", sha=sha, phash=phash,
+                             width=width, height=height, size_in=len(data), size_out=size_out)
+    except Exception as e:
+        _metrics["prep_failures"] += 1
+        logger.warning(f"⚠️ No se pudo preparar la imagen para Visión ({e}); se envía el original.")
+        b64 = await run_cpu(_encode_worker, data, prefer="thread")
+        _metrics["bytes_out"] += len(data)
+        return PreparedImage(b64=b64, mime_type=mime_type, sha=sha, size_in=len(data), size_out=len(data))
+
+
+# --- Caché de descripciones ---
+
+def _bands(phash):
+    """(índice, valor) de las VISION_HASH_DISTANCE + 1 bandas del hash."""
+    bits = VISION_HASH_SIZE * VISION_HASH_SIZE
+    count = VISION_HASH_DISTANCE + 1
+    bands, start = [], 0
+    for i in range(count):
+        width = bits // count + (1 if i < bits % count else 0)
+        bands.append((i, (phash >> (bits - start - width)) & ((1 << width) - 1)))
+        start += width
+    return bands
+
+
+async def find_cached_description(image, near_duplicates=True):
+    """Descripción ya generada para la misma imagen (o una casi idéntica), o None."""
+    return await asyncio.to_thread(_find_cached_description, image, near_duplicates)
+
+
+async def remember_description(image, text):
+    """Guarda la descripción para reutilizarla con reenvíos y casi duplicados."""
+    await asyncio.to_thread(_remember_description, image, text)
+
+
+def _find_cached_description(image, near_duplicates):
+    if not VISION_DEDUPE:
+        return None
+    cached = state_store.get_json(DESC_KEY_FMT.format(sha=image.sha))
+    if cached:
+        _metrics["exact_hits"] += 1
+        return cached.get("text")
+    if not near_duplicates or image.phash is None or not image.width:
+        return None
+    best = None
+    for band, value in _bands(image.phash):
+        for entry in state_store.get_json(BAND_KEY_FMT.format(band=band, value=value)) or []:
+            # [phash, sha, ancho, alto]: sólo candidatos con las mismas dimensiones preparadas
+            if len(entry) < 4 or (entry[2], entry[3]) != (image.width, image.height):
+                continue
+            phash_hex, sha = entry[0], entry[1]
+            distance = bin(int(phash_hex, 16) ^ image.phash).count("1")
+            if distance <= VISION_HASH_DISTANCE and (best is None or distance < best[0]):
+                best = (distance, sha)
+    if best is None:
+        return None
+    cached = state_store.get_json(DESC_KEY_FMT.format(sha=best[1]))
+    if not cached:
+        return None
+    _metrics["near_hits"] += 1
+    logger.info(f"♻️ Visión: imagen casi idéntica a una ya descrita (distancia {best[0]}), se reutiliza.")
+    return cached.get("text")
+
+
+def _remember_description(image, text):
+    if not VISION_DEDUPE or not text:
+        return
+    state_store.set_json(DESC_KEY_FMT.format(sha=image.sha), {"text": text}, ttl=VISION_CACHE_TTL)
+    if image.phash is None or not image.width:
+        return
+    entry = [format(image.phash, "x"), image.sha, image.width, image.height]
+    for band, value in _bands(image.phash):
+        key = BAND_KEY_FMT.format(band=band, value=value)
+        entries = [e for e in (state_store.get_json(key) or []) if e[1] != image.sha]
+        entries.append(entry)
+        state_store.set_json(key, entries[-VISION_BAND_MAX_ENTRIES:], ttl=VISION_CACHE_TTL)
+
+
+def get_image_prep_metrics():
+    """Contadores de este proceso: imágenes, aciertos de caché y bytes ahorrados."""
+    m = dict(_metrics)
+    m["saved_calls"] = m["exact_hits"] + m["near_hits"]
+    m["bytes_ratio"] = round(m["bytes_out"] / m["bytes_in"], 3) if m["bytes_in"] else 0.0
+    return m
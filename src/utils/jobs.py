@@ -0,0 +1,519 @@
+# src/utils/jobs.py
+"""
+Subsistema de jobs durables.
+
+Un job (tabla `jobs`) se descompone en unidades de trabajo (`job_items`) que
+se reclaman con lease, se confirman (ack) de forma idempotente y, si el
+proceso muere, vuelven a quedar disponibles cuando su lease caduca. Así un
+reinicio o un deploy no pierde progreso: el job se reanuda donde se quedó.
+
+API:
+  • register_job_kind(kind, plan, process, ...)  → declara un tipo de job.
+  • submit_job(kind, params)                      → crea y despacha un job.
+  • run_job(job_id)                               → ejecuta/reanuda (async).
+  • resume_jobs()                                 → re-despacha jobs huérfanos.
+  • run_job_batch / aggregate_job                 → fan-out en Celery (ver abajo).
+  • read_job_log(job_id, since)                   → líneas de log para SSE.
+  • job_progress_key(job_id)                      → clave de su progreso (src/utils/progress.py).
+
+Despacho:
+  • Celery si está disponible (tarea genérica `celery_app.run_job`).
+  • Hilos daemon en el propio proceso como fallback, con como mucho
+    JOB_LOCAL_WORKERS jobs simultáneos.
+
+Fan-out: los tipos con `fanout=True` (p. ej. embeddings), si hay Celery, no
+se procesan en una única tarea: tras planificar, sus unidades se reparten en
+lotes de JOB_FANOUT_BATCH como un chord de tareas `process_job_batch` (cada una
+reintenta con countdown si se agota la cuota) cuyo callback `aggregate_job`
+suma el informe. Un lote no lanza por el error de una unidad (lo cuenta como
+"error"); si aun así una tarea del chord falla, su errback `fanout_failed`
+re-encola el job en lugar de dejarlo 'running' sin latido. Más workers ⇒ más
+lotes en paralelo.
+
+Los tipos concretos (embeddings, indexer, ...) viven en src/scripts/job_kinds.py
+y se cargan bajo demanda para no arrastrar servicios cloud al importar esto.
+"""
+from __future__ import annotations
+
+import os
+import socket
+import asyncio
+import logging
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from src.utils.state_store import state_store
+from src.utils.ai_scheduler import in_ai_lane, metered_tokens, LANE_BACKFILL
+from src.utils.progress import ProgressTracker
+
+logger = logging.getLogger(__name__)
+
+# Duración del lease de una unidad reclamada (el latido lo renueva)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Un job 'running' sin latido durante este tiempo se considera huérfano
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "20"))
+# Intentos por unidad antes de marcarla como fallida
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Jobs simultáneos en el fallback de hilos
+JOB_LOCAL_WORKERS = int(os.getenv("JOB_LOCAL_WORKERS", "2"))
+# Espera antes de reanudar un job pausado por cuota
+JOB_PAUSE_SECONDS = int(os.getenv("JOB_PAUSE_SECONDS", "300"))
+# Unidades por tarea Celery en los jobs con fan-out
+JOB_FANOUT_BATCH = int(os.getenv("JOB_FANOUT_BATCH", "10"))
+# Reintentos de un lote por cuota agotada antes de devolver sus unidades a la cola
+JOB_FANOUT_RETRIES = int(os.getenv("JOB_FANOUT_RETRIES", "5"))
+# Líneas de log que se conservan por job
+JOB_LOG_LINES = 500
+JOB_LOG_TTL = 7 * 24 * 3600
+
+JOB_DEFAULT_PRIORITY = 5  # 0 (baja) .. 9 (alta)
+
+JOB_LOG_KEY_FMT = "cloudgram:job_log:{job_id}:lines"
+JOB_LATEST_KEY_FMT = "cloudgram:job_latest:{kind}"
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobPause(Exception):
+    """Lanzada por `process` para pausar el job (p. ej. cuota agotada) y reanudarlo luego."""
+
+    def __init__(self, message="", delay=None):
+        super().__init__(message)
+        self.delay = JOB_PAUSE_SECONDS if delay is None else delay
+
+
+@dataclass
+class JobKind:
+    kind: str
+    # plan(params, ctx) -> lista de (item_key, payload)
+    plan: Callable[[dict, "JobContext"], Awaitable[list]]
+    # process(payload, ctx) -> True (hecho) / False (fallo definitivo); excepción = reintentable
+    process: Callable[[Any, "JobContext"], Awaitable[bool]]
+    concurrency: int = 1
+    priority: int = JOB_DEFAULT_PRIORITY
+    # Repartir las unidades en tareas Celery (chord) en lugar de una sola tarea
+    fanout: bool = False
+    # False si `process` lleva su propio progreso en ctx.progress (p. ej. archivos
+    # de cada nube): entonces las unidades no cuentan en él
+    item_progress: bool = True
+
+
+_KINDS: dict = {}
+_kinds_loaded = False
+
+
+def register_job_kind(kind, plan, process, concurrency=1, priority=JOB_DEFAULT_PRIORITY, fanout=False,
+                      item_progress=True):
+    _KINDS[kind] = JobKind(kind, plan, process, concurrency, priority, fanout, item_progress)
+
+
+def get_job_kind(kind) -> Optional[JobKind]:
+    global _kinds_loaded
+    if not _kinds_loaded:
+        _kinds_loaded = True
+        import src.scripts.job_kinds  # noqa: F401  (registra los tipos al importarse)
+    return _KINDS.get(kind)
+
+
+_db = None
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        from src.database.db_handler import DatabaseHandler
+        _db = DatabaseHandler()
+    return _db
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+# --- LOG POR JOB ---
+
+def _append_log(job_id, message):
+    """Anexa una línea al ring buffer del job. `seq` cuenta todas las líneas emitidas.
+
+    Atómico en Redis: los lotes de un fan-out escriben el mismo log desde varios workers.
+    """
+    state_store.append_capped(JOB_LOG_KEY_FMT.format(job_id=job_id), message, JOB_LOG_LINES, JOB_LOG_TTL)
+
+
+def read_job_log(job_id, since=0):
+    """Líneas nuevas desde `since`. Devuelve (líneas, nuevo_since)."""
+    seq, lines = state_store.read_capped(JOB_LOG_KEY_FMT.format(job_id=job_id))
+    nuevas = min(max(seq - since, 0), len(lines))
+    return (lines[-nuevas:] if nuevas else []), seq
+
+
+def job_progress_key(job_id):
+    return f"job:{job_id}"
+
+
+def latest_job_id(kind):
+    value = state_store.get_json(JOB_LATEST_KEY_FMT.format(kind=kind))
+    return int(value) if value else None
+
+
+class JobContext:
+    """Lo que ve `plan`/`process`: parámetros, log y aviso de parada."""
+
+    def __init__(self, job_id, worker, params):
+        self.job_id = job_id
+        self.worker = worker
+        self.params = params or {}
+        self.stopped = False
+        self.last_message = None
+        # Contadores compartidos con el resto de workers del mismo job
+        self.progress = ProgressTracker(job_progress_key(job_id))
+
+    async def log(self, message):
+        print(f"[JOB {self.job_id}] {message}")
+        self.last_message = str(message)[:500]
+        _append_log(self.job_id, str(message))
+
+    def should_stop(self):
+        return self.stopped
+
+
+# --- EJECUCIÓN ---
+
+async def _heartbeat_loop(db, ctx):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            status = await asyncio.to_thread(
+                db.heartbeat_job, ctx.job_id, ctx.worker, JOB_LEASE_SECONDS, ctx.last_message
+            )
+        except Exception as e:
+            print(f"⚠️ Latido del job {ctx.job_id} falló: {e}")
+            continue
+        if status != 'running':
+            # Cancelado, o lo ha tomado otro worker tras darnos por muertos
+            ctx.stopped = True
+            return
+
+
+async def _process_item(db, kind, ctx, item):
+    """Procesa una unidad y la confirma. Devuelve "done", "failed" o "retry"."""
+    if not kind.item_progress:
+        return await _run_item(db, kind, ctx, item)
+    ctx.progress.begin()
+    outcome = "retry"
+    with metered_tokens() as meter:
+        try:
+            outcome = await _run_item(db, kind, ctx, item)
+            return outcome
+        finally:
+            ctx.progress.end(outcome, meter[0])
+
+
+async def _run_item(db, kind, ctx, item):
+    try:
+        ok = await kind.process(item["payload"], ctx)
+    except JobPause:
+        raise
+    except Exception as e:
+        await ctx.log(f"⚠️ Unidad {item['item_key']} falló (intento {item['attempts']}): {e}")
+        await asyncio.to_thread(db.fail_job_item, item["id"], ctx.worker, e, JOB_MAX_ATTEMPTS)
+        return "failed" if item["attempts"] >= JOB_MAX_ATTEMPTS else "retry"
+    if ok is False:
+        await asyncio.to_thread(db.fail_job_item, item["id"], ctx.worker, "fallo definitivo", 0)
+        return "failed"
+    await asyncio.to_thread(db.ack_job_item, item["id"], ctx.worker)
+    return "done"
+
+
+async def _process_items(db, kind, ctx, items, concurrency, between_chunks=None, raise_errors=True):
+    """Procesa `items` de `concurrency` en `concurrency`. Devuelve el recuento por resultado.
+
+    Un JobPause (cuota agotada) se propaga cuando termina la tanda en curso, para
+    que ninguna unidad hermana siga corriendo tras devolver las demás a la cola.
+    Con `raise_errors=False` el resto de excepciones de una unidad (p. ej. la BD
+    al confirmarla) se cuentan como "error" y la unidad vuelve a la cola.
+    """
+    report = {"done": 0, "failed": 0, "retry": 0, "error": 0}
+    step = max(1, concurrency)
+    for i in range(0, len(items), step):
+        if ctx.should_stop():
+            break
+        outcomes = await asyncio.gather(*(_process_item(db, kind, ctx, it) for it in items[i:i + step]),
+                                        return_exceptions=True)
+        pause = None
+        for outcome in outcomes:
+            if isinstance(outcome, JobPause):
+                pause = pause or outcome
+            elif isinstance(outcome, Exception) and not raise_errors:
+                await ctx.log(f"⚠️ Error procesando una unidad: {outcome}")
+                report["error"] += 1
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                report[outcome] += 1
+        if pause:
+            raise pause
+        if between_chunks:
+            await between_chunks()
+    return report
+
+
+@in_ai_lane(LANE_BACKFILL)
+async def run_job(job_id=None, worker=None):
+    """Ejecuta (o reanuda) un job. Sin `job_id`, toma el de mayor prioridad disponible.
+
+    Returns:
+        dict: {"job_id", "status"} o {"status": "idle"} si no había nada que reclamar.
+    """
+    db = _get_db()
+    worker = worker or _worker_id()
+    job = await asyncio.to_thread(db.claim_job, worker, JOB_STALE_SECONDS, job_id)
+    if not job:
+        return {"job_id": job_id, "status": "idle"}
+
+    job_id = job["id"]
+    ctx = JobContext(job_id, worker, job["params"])
+    kind = get_job_kind(job["kind"])
+    if not kind:
+        await ctx.log(f"❌ Tipo de job desconocido: {job['kind']}")
+        await asyncio.to_thread(db.finish_job, job_id, 'failed')
+        return {"job_id": job_id, "status": "failed"}
+
+    heartbeat = asyncio.create_task(_heartbeat_loop(db, ctx))
+    try:
+        if not job["planned"]:
+            await ctx.log(f"🗂️ Planificando job {job['kind']}...")
+            items = await kind.plan(ctx.params, ctx)
+            await asyncio.to_thread(db.add_job_items, job_id, items)
+            await asyncio.to_thread(db.mark_job_planned, job_id)
+            await ctx.log(f"📋 {len(items)} unidades de trabajo.")
+        else:
+            await ctx.log("♻️ Reanudando job desde su último punto de control.")
+        counts = (await asyncio.to_thread(db.get_job, job_id) or {}).get("items", {})
+        if kind.item_progress:
+            ctx.progress.start(sum(counts.values()), label=job["kind"],
+                               done=counts.get("done", 0), failed=counts.get("failed", 0))
+        else:
+            ctx.progress.start(0, label=job["kind"])  # El total lo va sumando `process`
+
+        if kind.fanout and await asyncio.to_thread(_fan_out, db, job, ctx):
+            return {"job_id": job_id, "status": "fanned_out"}
+
+        while not ctx.should_stop():
+            items = await asyncio.to_thread(
+                db.claim_job_items, job_id, worker, max(1, job["concurrency"]), JOB_LEASE_SECONDS
+            )
+            if not items:
+                break
+            await _process_items(db, kind, ctx, items, job["concurrency"])
+    except JobPause as pause:
+        await ctx.log(f"⏸️ Job en pausa {pause.delay}s: {pause}")
+        ctx.progress.set_status("paused")
+        await asyncio.to_thread(db.release_job, job_id, worker, pause.delay)
+        _dispatch(job_id, job["priority"], countdown=pause.delay)
+        return {"job_id": job_id, "status": "paused"}
+    except Exception as e:
+        await ctx.log(f"❌ Error en el job: {e}")
+        await asyncio.to_thread(db.finish_job, job_id, 'failed')
+        ctx.progress.set_status("failed")
+        return {"job_id": job_id, "status": "failed"}
+    finally:
+        heartbeat.cancel()
+
+    await asyncio.to_thread(db.finish_job, job_id)
+    final = await asyncio.to_thread(db.get_job, job_id) or {}
+    counts = final.get("items", {})
+    if final.get("status"):
+        ctx.progress.set_status(final["status"])
+    await ctx.log(f"🏁 Job {final.get('status', '?')}: {counts.get('done', 0)} hechas, "
+                  f"{counts.get('failed', 0)} fallidas.")
+    return {"job_id": job_id, "status": final.get("status"), "items": counts}
+
+
+# --- FAN-OUT (CELERY) ---
+
+def _fan_out(db, job, ctx):
+    """Reparte las unidades abiertas del job en un chord de lotes. False si no aplica."""
+    celery = _celery()
+    if not celery:
+        return False
+    ids = db.get_open_job_item_ids(job["id"])
+    if not ids:
+        return False
+    from celery import chord
+
+    priority = 9 - job["priority"]
+    header = [
+        celery.signature('celery_app.process_job_batch', args=[job["id"], ids[i:i + JOB_FANOUT_BATCH]],
+                         priority=priority)
+        for i in range(0, len(ids), JOB_FANOUT_BATCH)
+    ]
+    callback = celery.signature('celery_app.aggregate_job', kwargs={"job_id": job["id"]}, priority=priority)
+    # Si una tarea del chord falla, el callback no se llama: el errback re-encola el job
+    callback.link_error(celery.signature('celery_app.job_fanout_failed', kwargs={"job_id": job["id"]},
+                                         priority=priority))
+    chord(header)(callback)
+    ctx.last_message = f"🚀 {len(ids)} unidades repartidas en {len(header)} tareas."
+    _append_log(job["id"], ctx.last_message)
+    db.touch_job(job["id"], ctx.last_message)
+    return True
+
+
+@in_ai_lane(LANE_BACKFILL)
+async def run_job_batch(job_id, item_ids, worker=None):
+    """Procesa un lote de unidades de un job repartido (una tarea del chord).
+
+    Propaga JobPause (cuota agotada) tras devolver sus unidades a la cola, para
+    que la tarea Celery reintente con countdown. Los errores de una unidad no
+    tumban el lote (y con él el chord): se cuentan en "error".
+
+    Returns:
+        dict: recuento {"done", "failed", "retry", "error", "skipped"}.
+    """
+    db = _get_db()
+    worker = worker or _worker_id()
+    job = await asyncio.to_thread(db.get_job, job_id)
+    kind = get_job_kind(job["kind"]) if job else None
+    if not kind or job["status"] != 'running':
+        return {"done": 0, "failed": 0, "retry": 0, "error": 0, "skipped": len(item_ids)}
+
+    ctx = JobContext(job_id, worker, job["params"])
+
+    async def touch():
+        status = await asyncio.to_thread(db.touch_job, job_id, ctx.last_message)
+        ctx.stopped = status != 'running'
+
+    items = await asyncio.to_thread(db.claim_job_items_by_id, job_id, worker, item_ids, JOB_LEASE_SECONDS)
+    try:
+        report = await _process_items(db, kind, ctx, items, job["concurrency"], between_chunks=touch,
+                                      raise_errors=False)
+    finally:
+        # Lo no procesado (pausa o cancelación) vuelve a la cola sin gastar intento
+        await asyncio.to_thread(db.release_job_items, job_id, worker)
+    report["skipped"] = len(item_ids) - len(items)
+    return report
+
+
+def aggregate_job(job_id, reports):
+    """Callback del chord: suma los informes de los lotes y cierra (o re-encola) el job."""
+    db = _get_db()
+    totals = {}
+    for report in reports or []:
+        for key, value in (report or {}).items():
+            totals[key] = totals.get(key, 0) + value
+
+    db.finish_job(job_id)
+    job = db.get_job(job_id) or {}
+    if job.get("status") == 'running':
+        # Quedan unidades por reintentar, lotes pausados por cuota o con errores: nueva ronda
+        delay = JOB_PAUSE_SECONDS if totals.get("paused") or totals.get("error") else 0
+        db.requeue_job(job_id, delay)
+        _dispatch(job_id, job.get("priority", JOB_DEFAULT_PRIORITY), countdown=delay)
+        _append_log(job_id, f"🔁 Ronda terminada {totals}; quedan unidades, re-encolado en {delay}s.")
+    else:
+        if job.get("status"):
+            ProgressTracker(job_progress_key(job_id)).set_status(job["status"])
+        counts = job.get("items", {})
+        _append_log(job_id, f"🏁 Job {job.get('status', '?')}: {counts.get('done', 0)} hechas, "
+                            f"{counts.get('failed', 0)} fallidas.")
+    return {"job_id": job_id, "status": job.get("status"), "report": totals}
+
+
+def fanout_failed(job_id, error):
+    """Errback del chord: una tarea de lote falló sin informe, así que no hubo
+    `aggregate_job`. Se cierra la ronda igual, re-encolando con espera."""
+    _append_log(job_id, f"❌ Un lote del job falló: {error}")
+    return aggregate_job(job_id, [{"error": 1}])
+
+
+# --- DESPACHO ---
+
+_local_slots = threading.BoundedSemaphore(max(1, JOB_LOCAL_WORKERS))
+
+
+def _celery():
+    try:
+        from celery_app import celery
+        return celery
+    except Exception:
+        return None
+
+
+def _run_local(job_id):
+    """Un hilo por job despachado; al conseguir hueco toma el job disponible de
+    mayor prioridad (no necesariamente `job_id`), así la prioridad se respeta
+    también sin Celery."""
+    with _local_slots:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(run_job(None))
+        except Exception as e:
+            print(f"❌ Hilo de jobs abortado (despachado para el job {job_id}): {e}")
+        finally:
+            loop.close()
+
+
+def _dispatch(job_id, priority=JOB_DEFAULT_PRIORITY, countdown=0):
+    """Envía el job a Celery o, si no está disponible, a un hilo local."""
+    celery = _celery()
+    if celery:
+        # En el transporte Redis de Celery 0 es la prioridad más alta
+        task = celery.send_task('celery_app.run_job', args=[job_id],
+                                priority=9 - priority, countdown=countdown or None)
+        return "celery", task.id
+
+    if countdown:
+        timer = threading.Timer(countdown, _run_local, args=(job_id,))
+        timer.daemon = True
+        timer.start()
+    else:
+        threading.Thread(target=_run_local, args=(job_id,), daemon=True).start()
+    return "thread", None
+
+
+def submit_job(kind, params=None, priority=None, concurrency=None):
+    """Crea un job persistente y lo despacha.
+
+    Returns:
+        dict | None: {"job_id", "backend", "task_id"}; None si no se pudo crear.
+    """
+    spec = get_job_kind(kind)
+    if not spec:
+        raise ValueError(f"Tipo de job desconocido: {kind}")
+    priority = spec.priority if priority is None else max(0, min(9, int(priority)))
+    concurrency = spec.concurrency if concurrency is None else int(concurrency)
+
+    job_id = _get_db().create_job(kind, params, priority, concurrency)
+    if not job_id:
+        return None
+    state_store.set_json(JOB_LATEST_KEY_FMT.format(kind=kind), job_id)
+    backend, task_id = _dispatch(job_id, priority)
+    return {"job_id": job_id, "backend": backend, "task_id": task_id}
+
+
+def cancel_job(job_id):
+    """Cancela el job; el worker lo detecta en su siguiente latido."""
+    ok = _get_db().cancel_job(job_id)
+    if ok:
+        ProgressTracker(job_progress_key(job_id)).set_status("cancelled")
+        _append_log(job_id, "🛑 Job cancelado por el usuario.")
+    return ok
+
+
+def resume_jobs():
+    """Re-despacha los jobs que quedaron a medias tras un reinicio o deploy.
+
+    Los pausados esperan a su `run_after`; los 'running' se despachan con retraso: si su worker sigue vivo el latido lo
+    impide y la tarea termina sin hacer nada; si murió, para entonces ya es huérfano.
+    """
+    pendientes = _get_db().get_unfinished_jobs()
+    for job_id, priority, status, wait in pendientes:
+        countdown = JOB_STALE_SECONDS + JOB_HEARTBEAT_SECONDS if status == 'running' else wait
+        _dispatch(job_id, priority, countdown=countdown)
+    if pendientes:
+        print(f"♻️ {len(pendientes)} jobs re-despachados.")
+    return len(pendientes)
@@ -0,0 +1,302 @@
+# src/utils/office_extractor.py
+"""
+Extracción de texto de hojas de cálculo y presentaciones (xlsx, csv, pptx).
+
+Una hoja de cálculo no se indexa volcando todas sus celdas: para el
+embedding basta con un texto compacto de esquema + muestra.
+
+  • Las filas se leen en streaming (openpyxl en modo read_only / módulo csv),
+    así que la memoria no depende del tamaño del libro.
+  • Por hoja: nº de filas, columnas con su tipo dominante (número, fecha,
+    texto) y una muestra de OFFICE_ROW_BUDGET filas (las primeras
+    OFFICE_HEAD_ROWS más un muestreo por reservorio del resto, con semilla
+    fija para que una re-indexación dé el mismo texto).
+  • Como mucho OFFICE_SCAN_ROWS filas leídas por hoja y OFFICE_MAX_CHARS
+    caracteres en total.
+  • Las presentaciones se leen del ZIP con iterparse, diapositiva a
+    diapositiva (texto y notas), sin python-pptx. El orden y las notas de
+    cada diapositiva salen de presentation.xml y de los .rels, no del número
+    del nombre de archivo.
+
+Los workers corren en el executor CPU compartido (procesos para archivos grandes).
+"""
+from __future__ import annotations
+
+import os
+import re
+import csv
+import random
+import zipfile
+import posixpath
+import logging
+import datetime as dt
+import xml.etree.ElementTree as ET
+
+from src.utils.cpu_executor import run_cpu
+
+logger = logging.getLogger(__name__)
+
+OFFICE_ROW_BUDGET = int(os.getenv("OFFICE_ROW_BUDGET", "60"))
+OFFICE_HEAD_ROWS = int(os.getenv("OFFICE_HEAD_ROWS", "20"))
+OFFICE_SCAN_ROWS = int(os.getenv("OFFICE_SCAN_ROWS", "200000"))
+OFFICE_MAX_SHEETS = int(os.getenv("OFFICE_MAX_SHEETS", "20"))
+OFFICE_MAX_COLUMNS = int(os.getenv("OFFICE_MAX_COLUMNS", "30"))
+OFFICE_MAX_CHARS = int(os.getenv("OFFICE_MAX_CHARS", "20000"))
+OFFICE_CELL_CHARS = 60
+
+SPREADSHEET_EXTENSIONS = ("xlsx", "xlsm", "csv", "tsv")
+PRESENTATION_EXTENSIONS = ("pptx",)
+OFFICE_EXTENSIONS = SPREADSHEET_EXTENSIONS + PRESENTATION_EXTENSIONS
+
+_NUMBER_RE = re.compile(r"^[-+]?(\d{1,3}([.,\s]\d{3})*|\d+)([.,]\d+)?\s*[%€$]?$")
+_DATE_RE = re.compile(r"^\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}")
+_DRAWING_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_PRESENTATION_NS = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+_DOC_RELS_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_SLIDE_RE = re.compile(r"^ppt/slides/slide(\d+)\.xml$")
+
+
+def _cell_type(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return "texto"
+    if isinstance(value, (int, float)):
+        return "número"
+    if isinstance(value, (dt.date, dt.time, dt.datetime)):
+        return "fecha"
+    text = str(value).strip()
+    if not text:
+        return None
+    if _DATE_RE.match(text):
+        return "fecha"
+    if _NUMBER_RE.match(text):
+        return "número"
+    return "texto"
+
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, dt.datetime):
+        value = value.date() if not (value.hour or value.minute or value.second) else value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = " ".join(str(value).split())
+    return text if len(text) <= OFFICE_CELL_CHARS else text[:OFFICE_CELL_CHARS - 1] + "…"
+
+
+class _SheetSampler:
+    """Resumen en streaming de una hoja: esquema, recuento y muestra acotada."""
+
+    def __init__(self, name):
+        self.name = name
+        self.header = None
+        self.rows = 0
+        self.width = 0
+        self.truncated = False
+        self.types = {}  # columna -> {tipo: recuento}
+        self.sample = []  # (índice, fila)
+        self._rng = random.Random(0)
+
+    def add(self, row):
+        """Añade una fila; False cuando ya no hace falta leer más."""
+        row = list(row[:OFFICE_MAX_COLUMNS])
+        while row and (row[-1] is None or row[-1] == ""):
+            row.pop()
+        if not row:
+            return True
+        if self.header is None:
+            kinds = [_cell_type(v) for v in row]
+            if all(k in (None, "texto") for k in kinds):
+                self.header = [_cell_text(v) or f"col{i + 1}" for i, v in enumerate(row)]
+                return True
+            self.header = []
+        self.width = max(self.width, len(row))
+        for i, value in enumerate(row):
+            kind = _cell_type(value)
+            if kind:
+                counts = self.types.setdefault(i, {})
+                counts[kind] = counts.get(kind, 0) + 1
+
+        index = self.rows
+        self.rows += 1
+        budget = max(OFFICE_ROW_BUDGET, OFFICE_HEAD_ROWS)
+        if len(self.sample) < budget:
+            self.sample.append((index, row))
+        else:
+            # Reservorio sobre las filas que no son cabecera de la muestra
+            j = self._rng.randint(0, index - OFFICE_HEAD_ROWS)
+            if j < budget - OFFICE_HEAD_ROWS:
+                self.sample[OFFICE_HEAD_ROWS + j] = (index, row)
+        if self.rows >= OFFICE_SCAN_ROWS:
+            self.truncated = True
+            return False
+        return True
+
+    def render(self):
+        if not self.rows and not self.header:
+            return ""
+        width = max(self.width, len(self.header or []))
+        names = [(self.header[i] if self.header and i < len(self.header) else f"col{i + 1}")
+                 for i in range(width)]
+        columns = []
+        for i, name in enumerate(names):
+            counts = self.types.get(i)
+            kind = max(counts, key=counts.get) if counts else "vacía"
+            columns.append(f"{name} ({kind})")
+        total = f"{self.rows}+" if self.truncated else str(self.rows)
+        lines = [f"Hoja «{self.name}»: {total} filas × {width} columnas",
+                 "Columnas: " + ", ".join(columns)]
+        if self.sample:
+            shown = len(self.sample)
+            label = "Filas" if shown == self.rows else f"Muestra ({shown} de {total} filas)"
+            lines.append(f"{label}:")
+            for _, row in sorted(self.sample, key=lambda item: item[0]):
+                lines.append(" | ".join(_cell_text(v) for v in row))
+        return "\n".join(lines)
+
+
+def _join_limited(parts):
+    text, used = [], 0
+    for part in parts:
+        if not part:
+            continue
+        if used + len(part) > OFFICE_MAX_CHARS:
+            text.append(part[:max(0, OFFICE_MAX_CHARS - used)])
+            break
+        text.append(part)
+        used += len(part) + 2
+    return "\n\n".join(text)
+
+
+# --- Funciones de worker (nivel de módulo para poder serializarlas) ---
+
+def _read_xlsx_text(path):
+    """Worker: esquema + muestra de cada hoja de un xlsx (openpyxl read_only)."""
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        parts = []
+        for ws in wb.worksheets[:OFFICE_MAX_SHEETS]:
+            sampler = _SheetSampler(ws.title)
+            for row in ws.iter_rows(values_only=True):
+                if not sampler.add(row):
+                    break
+            parts.append(sampler.render())
+        if len(wb.worksheets) > OFFICE_MAX_SHEETS:
+            parts.append(f"(… {len(wb.worksheets) - OFFICE_MAX_SHEETS} hojas más sin indexar)")
+        return _join_limited(parts)
+    finally:
+        wb.close()
+
+
+def _read_csv_text(path):
+    """Worker: esquema + muestra de un CSV/TSV leído en streaming."""
+    csv.field_size_limit(1024 * 1024)
+    with open(path, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+        head = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(head, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel_tab if path.lower().endswith(".tsv") else csv.excel
+        sampler = _SheetSampler(os.path.basename(path))
+        for row in csv.reader(f, dialect):
+            if not sampler.add(row):
+                break
+    return _join_limited([sampler.render()])
+
+
+def _rels_targets(archive, part):
+    """{rId: (tipo, ruta en el ZIP)} de las relaciones de `part` (vacío si no tiene)."""
+    folder, name = posixpath.split(part)
+    rels = posixpath.join(folder, "_rels", f"{name}.rels")
+    if rels not in archive.NameToInfo:
+        return {}
+    targets = {}
+    with archive.open(rels) as xml:
+        for _, elem in ET.iterparse(xml, events=("end",)):
+            if elem.tag != f"{_RELS_NS}Relationship" or elem.get("TargetMode") == "External":
+                continue
+            target = elem.get("Target", "")
+            path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+            targets[elem.get("Id")] = (elem.get("Type", "").rsplit("/", 1)[-1], path)
+    return targets
+
+
+def _pptx_slide_order(archive):
+    """Rutas de las diapositivas en el orden de la presentación (<p:sldIdLst>).
+
+    El número del nombre (slide7.xml) no es la posición: al reordenar en
+    PowerPoint sólo cambia la lista de presentation.xml. Sin ella (archivo
+    raro o dañado) se cae al orden numérico de los nombres.
+    """
+    if "ppt/presentation.xml" in archive.NameToInfo:
+        targets = _rels_targets(archive, "ppt/presentation.xml")
+        order = []
+        with archive.open("ppt/presentation.xml") as xml:
+            for _, elem in ET.iterparse(xml, events=("end",)):
+                if elem.tag == f"{_PRESENTATION_NS}sldId":
+                    target = targets.get(elem.get(f"{_DOC_RELS_NS}id"))
+                    if target and target[1] in archive.NameToInfo:
+                        order.append(target[1])
+        if order:
+            return order
+    numbered = [(int(m.group(1)), name) for name in archive.namelist() if (m := _SLIDE_RE.match(name))]
+    return [name for _, name in sorted(numbered)]
+
+
+def _drawing_text(archive, name):
+    """Párrafos de texto (a:p / a:t) de una parte del pptx, unidos con " / "."""
+    paragraphs, current = [], []
+    with archive.open(name) as xml:
+        for _, elem in ET.iterparse(xml, events=("end",)):
+            if elem.tag == f"{_DRAWING_NS}t" and elem.text:
+                current.append(elem.text)
+            elif elem.tag == f"{_DRAWING_NS}p":
+                if current:
+                    paragraphs.append("".join(current).strip())
+                current = []
+                elem.clear()
+    return " / ".join(p for p in paragraphs if p)
+
+
+def _read_pptx_text(path):
+    """Worker: texto de cada diapositiva (y sus notas) de un pptx, en el orden de la presentación."""
+    parts = []
+    with zipfile.ZipFile(path) as archive:
+        for number, slide in enumerate(_pptx_slide_order(archive), start=1):
+            line = f"Diapositiva {number}: {_drawing_text(archive, slide)}".rstrip()
+            # Las notas se enlazan desde los rels de la diapositiva, no por el número del nombre
+            notes = next((target for kind, target in _rels_targets(archive, slide).values()
+                          if kind == "notesSlide" and target in archive.NameToInfo), None)
+            if notes:
+                notes_text = _drawing_text(archive, notes)
+                if notes_text:
+                    line += f"\nNotas: {notes_text}"
+            parts.append(line)
+    return _join_limited(parts)
+
+
+_WORKERS = {
+    "xlsx": _read_xlsx_text,
+    "xlsm": _read_xlsx_text,
+    "csv": _read_csv_text,
+    "tsv": _read_csv_text,
+    "pptx": _read_pptx_text,
+}
+
+
+async def extract_office_text(path):
+    """Texto compacto (esquema + muestra, o diapositivas) de un archivo de oficina.
+
+    Returns:
+        str: Texto extraído ("" si el formato no está soportado).
+    """
+    ext = path.lower().rsplit(".", 1)[-1]
+    worker = _WORKERS.get(ext)
+    if not worker:
+        return ""
+    return await run_cpu(worker, path, size_hint=os.path.getsize(path))
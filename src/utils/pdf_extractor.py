@@ -0,0 +1,95 @@
+# src/utils/pdf_extractor.py
+"""
+Extracción de texto de PDFs fuera del event loop.
+
+  • El texto se extrae en el executor CPU compartido (procesos para PDFs
+    grandes: PyMuPDF no libera el GIL), repartiendo los PDFs grandes en tramos
+    de PDF_SHARD_PAGES páginas.
+  • Los PDFs escaneados se rasterizan a JPEG en memoria (sin ficheros
+    temporales) y el OCR con Visión corre en paralelo con un límite.
+  • PDF_PAGE_BUDGET / PDF_OCR_PAGE_BUDGET acotan cuántas páginas se procesan.
+"""
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+
+import fitz  # PyMuPDF
+
+from src.utils.cpu_executor import run_cpu
+
+logger = logging.getLogger(__name__)
+
+PDF_PAGE_BUDGET = int(os.getenv("PDF_PAGE_BUDGET", "300"))
+PDF_SHARD_PAGES = int(os.getenv("PDF_SHARD_PAGES", "40"))
+PDF_OCR_PAGE_BUDGET = int(os.getenv("PDF_OCR_PAGE_BUDGET", "3"))
+PDF_OCR_CONCURRENCY = int(os.getenv("PDF_OCR_CONCURRENCY", "3"))
+PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", "110"))
+
+# Menos de este número de caracteres útiles ⇒ PDF escaneado
+MIN_TEXT_CHARS = 10
+
+
+# --- Funciones de worker (nivel de módulo para poder serializarlas) ---
+
+def _page_count(path):
+    with fitz.open(path) as doc:
+        return len(doc)
+
+
+def _extract_page_range(path, start, stop):
+    with fitz.open(path) as doc:
+        return " ".join(doc.load_page(i).get_text() for i in range(start, min(stop, len(doc))))
+
+
+def _render_pages_jpeg(path, pages, dpi):
+    """Rasteriza las páginas indicadas y devuelve los JPEG como bytes."""
+    images = []
+    with fitz.open(path) as doc:
+        for i in pages:
+            if i >= len(doc):
+                break
+            pix = doc.load_page(i).get_pixmap(dpi=dpi)
+            images.append(pix.tobytes("jpeg"))
+    return images
+
+
+async def extract_pdf_text(path, ocr_callback=None):
+    """Texto de un PDF; si está escaneado, OCR de las primeras páginas vía `ocr_callback`.
+
+    Args:
+        path: Ruta al PDF.
+        ocr_callback: coroutine `(jpeg_bytes, mime) -> str` (p. ej. AIHandler.analyze_image_bytes).
+
+    Returns:
+        str: Texto extraído ("" si no hay nada).
+    """
+    size = os.path.getsize(path)
+    total = await run_cpu(_page_count, path, prefer="thread")
+    budget = min(total, PDF_PAGE_BUDGET)
+    if total > budget:
+        logger.info(f"📄 PDF de {total} páginas: se procesan las primeras {budget} (PDF_PAGE_BUDGET).")
+
+    shards = [(s, min(s + PDF_SHARD_PAGES, budget)) for s in range(0, budget, PDF_SHARD_PAGES)]
+    parts = await asyncio.gather(*(
+        run_cpu(_extract_page_range, path, a, b, size_hint=size) for a, b in shards
+    ))
+    text = " ".join(parts)
+
+    if len(text.strip()) >= MIN_TEXT_CHARS or not ocr_callback or total == 0:
+        return text
+
+    # PDF escaneado → OCR concurrente con Visión
+    ocr_pages = list(range(min(total, PDF_OCR_PAGE_BUDGET)))
+    logger.info(f"📄 PDF parece escaneado, OCR de {len(ocr_pages)} página(s) con Visión...")
+    images = await run_cpu(_render_pages_jpeg, path, ocr_pages, PDF_OCR_DPI, size_hint=size)
+
+    sem = asyncio.Semaphore(PDF_OCR_CONCURRENCY)
+
+    async def ocr(i, data):
+        async with sem:
+            page_text = await ocr_callback(data, "image/jpeg")
+        return f"[Página {i + 1}]\n{page_text}"
+
+    return "\n\n".join(await asyncio.gather(*(ocr(i, d) for i, d in enumerate(images))))
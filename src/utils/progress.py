@@ -0,0 +1,291 @@
+# src/utils/progress.py
+"""
+Progreso real de procesos largos (jobs, sincronización, embeddings).
+
+Antes el SSE del panel enviaba un `data: 50` inventado tras cada línea de log,
+y cada pestaña abierta montaba su propio bucle de sondeo. Ahora:
+
+  • ProgressTracker cuenta total / hechas / fallidas / en curso con contadores
+    atómicos del state_store (INCRBY en Redis). Así varios workers Celery del
+    mismo job suman sobre las mismas claves.
+  • Las unidades terminadas y sus tokens estimados se apuntan también en cubos
+    por minuto. De los últimos PROGRESS_WINDOW_MINUTES salen los items/min, los
+    tokens/min y la ETA.
+  • progress_snapshot(key) devuelve ese modelo como dict.
+  • progress_stream(key, ...) genera eventos SSE estructurados:
+        {"type": "progress", "total", "done", "failed", "in_flight", ...}
+        {"type": "log", "message"}
+        {"type": "end", "message", "status"}
+    Hay un único hilo por proceso y clave que sondea el state_store y reparte
+    los eventos a todas las pestañas suscritas. Las que se unen tarde reciben
+    el último progreso y las líneas de log recientes.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_WINDOW_MINUTES = int(os.getenv("PROGRESS_WINDOW_MINUTES", "5"))
+PROGRESS_POLL_SECONDS = float(os.getenv("PROGRESS_POLL_SECONDS", "1"))
+PROGRESS_TTL = 7 * 24 * 3600
+PROGRESS_MIN_SPAN_SECONDS = 15
+# Comentario SSE para que proxies y navegador no corten una conexión en silencio
+PROGRESS_KEEPALIVE_SECONDS = 15
+# Líneas de log que se reenvían a una pestaña que se une tarde
+PROGRESS_REPLAY_LINES = 50
+
+PROGRESS_KEY_FMT = "cloudgram:progress:{key}:{field}"
+PROGRESS_RATE_KEY_FMT = "cloudgram:progress:{key}:rate:{minute}:{unit}"
+
+PROGRESS_FINAL_STATUSES = ("done", "failed", "cancelled")
+_COUNTERS = ("total", "done", "failed", "in_flight", "tokens")
+
+
+def _key(key, field):
+    return PROGRESS_KEY_FMT.format(key=key, field=field)
+
+
+class ProgressTracker:
+    """Contadores compartidos de un proceso. Cualquier worker puede crear el suyo con la misma `key`."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def start(self, total, label=None, done=0, failed=0):
+        """(Re)inicia el progreso. Al reanudar, se pasan las unidades ya hechas o fallidas."""
+        for field, value in (("total", total), ("done", done), ("failed", failed), ("in_flight", 0), ("tokens", 0)):
+            state_store.set_json(_key(self.key, field), int(value), ttl=PROGRESS_TTL)
+        meta = {"label": label or self.key, "status": "running", "started_at": time.time()}
+        state_store.set_json(_key(self.key, "meta"), meta, ttl=PROGRESS_TTL)
+
+    def add_total(self, n):
+        """Para procesos que descubren su trabajo por páginas (feed de cambios de una nube)."""
+        if n:
+            state_store.incr_with_ttl(_key(self.key, "total"), PROGRESS_TTL, int(n))
+
+    def begin(self):
+        state_store.incr_with_ttl(_key(self.key, "in_flight"), PROGRESS_TTL, 1)
+
+    def end(self, outcome, tokens=0):
+        """Cierra una unidad: "done", "failed" o "retry" (vuelve a la cola, sólo libera el hueco)."""
+        state_store.incr_with_ttl(_key(self.key, "in_flight"), PROGRESS_TTL, -1)
+        if tokens:
+            state_store.incr_with_ttl(_key(self.key, "tokens"), PROGRESS_TTL, int(tokens))
+        if outcome not in ("done", "failed"):
+            return
+        state_store.incr_with_ttl(_key(self.key, outcome), PROGRESS_TTL, 1)
+        minute = int(time.time() // 60)
+        ttl = (PROGRESS_WINDOW_MINUTES + 2) * 60
+        state_store.incr_with_ttl(PROGRESS_RATE_KEY_FMT.format(key=self.key, minute=minute, unit="items"), ttl, 1)
+        if tokens:
+            state_store.incr_with_ttl(PROGRESS_RATE_KEY_FMT.format(key=self.key, minute=minute, unit="tokens"),
+                                      ttl, int(tokens))
+
+    def set_status(self, status):
+        meta = state_store.get_json(_key(self.key, "meta")) or {"label": self.key, "started_at": time.time()}
+        meta["status"] = status
+        if status in PROGRESS_FINAL_STATUSES:
+            meta["finished_at"] = time.time()
+        state_store.set_json(_key(self.key, "meta"), meta, ttl=PROGRESS_TTL)
+
+
+def progress_snapshot(key):
+    """Estado actual del progreso `key` (None si nunca se inició).
+
+    Returns:
+        dict: total, done, failed, in_flight, pending, pct, items_per_min,
+        tokens_per_min, eta_s (None sin ritmo medible), elapsed_s, status, label.
+    """
+    meta = state_store.get_json(_key(key, "meta"))
+    if not meta:
+        return None
+    counts = {field: int(state_store.get_json(_key(key, field)) or 0) for field in _COUNTERS}
+    now = time.time()
+    started = meta.get("started_at") or now
+    end = meta.get("finished_at") or now
+
+    minute = int(now // 60)
+    window_start = (minute - PROGRESS_WINDOW_MINUTES + 1) * 60
+    items = tokens = 0
+    for m in range(minute - PROGRESS_WINDOW_MINUTES + 1, minute + 1):
+        items += int(state_store.get_json(PROGRESS_RATE_KEY_FMT.format(key=key, minute=m, unit="items")) or 0)
+        tokens += int(state_store.get_json(PROGRESS_RATE_KEY_FMT.format(key=key, minute=m, unit="tokens")) or 0)
+    # Suelo de unos segundos para que las primeras unidades no disparen el ritmo
+    span = max(PROGRESS_MIN_SPAN_SECONDS, now - max(window_start, started))
+    items_per_min = 60 * items / span
+    tokens_per_min = 60 * tokens / span
+
+    processed = counts["done"] + counts["failed"]
+    pending = max(0, counts["total"] - processed)
+    running = meta.get("status") == "running"
+    return {
+        "key": key,
+        "label": meta.get("label"),
+        "status": meta.get("status"),
+        "total": counts["total"],
+        "done": counts["done"],
+        "failed": counts["failed"],
+        "in_flight": max(0, counts["in_flight"]) if running else 0,
+        "pending": pending,
+        "pct": round(100 * processed / counts["total"], 1) if counts["total"] else 0.0,
+        "tokens": counts["tokens"],
+        "items_per_min": round(items_per_min, 1),
+        "tokens_per_min": round(tokens_per_min),
+        "eta_s": round(60 * pending / items_per_min) if running and items_per_min else None,
+        "elapsed_s": round(max(0.0, end - started)),
+    }
+
+
+def sse_event(event):
+    """Un evento SSE (mensaje por defecto) con el dict `event` como JSON."""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+# --- DIFUSIÓN A VARIAS PESTAÑAS ---
+
+class _Feed:
+    """Un hilo que sondea el progreso (y el log) de una clave y lo reparte a sus suscriptores."""
+
+    def __init__(self, hub, key, log_reader, is_finished, done_message):
+        self.hub = hub
+        self.key = key
+        self.log_reader = log_reader
+        self.is_finished = is_finished
+        self.done_message = done_message
+        self.subscribers = []
+        self.recent = deque(maxlen=PROGRESS_REPLAY_LINES)
+        self.last_progress = None
+        self.ended = None
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue()
+        with self.lock:
+            for event in self.recent:
+                q.put(event)
+            if self.last_progress:
+                q.put(self.last_progress)
+            if self.ended:
+                q.put(self.ended)
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def _broadcast(self, event):
+        with self.lock:
+            if event["type"] == "log":
+                self.recent.append(event)
+            for q in self.subscribers:
+                q.put(event)
+
+    def _step(self, since):
+        """Una vuelta de sondeo. Devuelve (nuevo_since, terminado)."""
+        lines = []
+        if self.log_reader:
+            lines, since = self.log_reader(since)
+            for line in lines:
+                self._broadcast({"type": "log", "message": line})
+
+        snapshot = progress_snapshot(self.key)
+        if snapshot:
+            event = {"type": "progress", **snapshot}
+            if event != self.last_progress:
+                self.last_progress = event
+                self._broadcast(event)
+
+        if lines:
+            return since, False
+        status = snapshot["status"] if snapshot else None
+        if status not in PROGRESS_FINAL_STATUSES and self.is_finished:
+            status = self.is_finished()
+        return since, status in PROGRESS_FINAL_STATUSES
+
+    def run(self):
+        since = 0
+        try:
+            while True:
+                since, finished = self._step(since)
+                if finished:
+                    snapshot = self.last_progress or {}
+                    self.ended = {"type": "end", "message": self.done_message, "status": snapshot.get("status")}
+                    self._broadcast(self.ended)
+                    return
+                if self.hub.release_if_idle(self):
+                    return
+                time.sleep(PROGRESS_POLL_SECONDS)
+        except Exception as e:
+            logger.warning(f"⚠️ Feed de progreso {self.key} abortado: {e}")
+            self._broadcast({"type": "end", "message": f"❌ Error leyendo el progreso: {e}", "status": None})
+        finally:
+            self.hub.release(self)
+
+
+class _ProgressHub:
+    def __init__(self):
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, log_reader, is_finished, done_message):
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = _Feed(self, key, log_reader, is_finished, done_message)
+                self._feeds[key] = feed
+                threading.Thread(target=feed.run, name=f"progress-{key}", daemon=True).start()
+            return feed, feed.subscribe()
+
+    def release(self, feed):
+        with self._lock:
+            if self._feeds.get(feed.key) is feed:
+                del self._feeds[feed.key]
+
+    def release_if_idle(self, feed):
+        """Retira el feed si nadie lo escucha (bajo el mismo cerrojo que `subscribe`)."""
+        with self._lock:
+            with feed.lock:
+                if feed.subscribers:
+                    return False
+            if self._feeds.get(feed.key) is feed:
+                del self._feeds[feed.key]
+            return True
+
+
+_hub = _ProgressHub()
+
+
+def progress_stream(key, log_reader=None, is_finished=None, done_message="[✅ FINALIZADO] Proceso completado"):
+    """Generador SSE (síncrono, para Flask) del progreso `key`, compartido entre pestañas.
+
+    Args:
+        key: clave del ProgressTracker.
+        log_reader: `(since) -> (líneas, nuevo_since)` (p. ej. read_job_log).
+        is_finished: `() -> estado` para detectar finales que no pasan por el
+            tracker (p. ej. un job cancelado); se consulta sólo sin líneas nuevas.
+        done_message: mensaje del evento "end".
+    """
+    feed, q = _hub.subscribe(key, log_reader, is_finished, done_message)
+    try:
+        while True:
+            try:
+                event = q.get(timeout=PROGRESS_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield sse_event(event)
+            if event["type"] == "end":
+                return
+    finally:
+        feed.unsubscribe(q)
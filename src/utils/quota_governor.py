@@ -0,0 +1,245 @@
+# src/utils/quota_governor.py
+"""
+Gobernador de cuota de IA compartido entre procesos.
+
+Lee las cabeceras de rate-limit de cada respuesta del proveedor (hook de
+respuesta del cliente httpx de AsyncOpenAI):
+
+  x-ratelimit-limit-requests / x-ratelimit-remaining-requests / x-ratelimit-reset-requests
+  x-ratelimit-limit-tokens   / x-ratelimit-remaining-tokens   / x-ratelimit-reset-tokens
+  retry-after / retry-after-ms (en los 429)
+
+y mantiene con ellas un token bucket en state_store (Redis entre bot, Flask y
+Celery): la última foto de las cabeceras más lo gastado por todos los procesos
+desde entonces, con recarga lineal hasta el `reset` que anuncia el proveedor.
+ai_scheduler consulta `wait_time()` antes de admitir una llamada y espera lo
+necesario para no llegar al 429; cada carril deja una reserva
+(`1 - AI_LANE_SHARES[carril]`) para los de más prioridad.
+
+`headroom()` / `get_quota_headroom()` alimentan /stats y el dashboard.
+
+Todo es síncrono (state_store/redis-py): desde corrutinas se llama en un hilo
+(`asyncio.to_thread` o `in_background`), nunca directamente en el event loop.
+"""
+from __future__ import annotations
+
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from src.utils.state_store import state_store
+
+logger = logging.getLogger(__name__)
+
+QUOTA_KEY_FMT = "cloudgram:ai_quota:{provider}"
+SPENT_KEY_FMT = "cloudgram:ai_quota_spent:{provider}:{seq}:{unit}"
+COOLDOWN_KEY_FMT = "cloudgram:ai_cooldown_until:{provider}"
+# Una foto de cabeceras más vieja que esto ya no se usa para frenar
+QUOTA_SNAPSHOT_MAX_AGE = int(os.getenv("AI_QUOTA_SNAPSHOT_MAX_AGE", "120"))
+# Enfriamiento tras un 429 sin retry-after
+AI_QUOTA_COOLDOWN = int(os.getenv("AI_QUOTA_COOLDOWN", "60"))
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value) -> Optional[float]:
+    """'6m0s' / '1.5s' / '20ms' / '12' → segundos."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNIT_SECONDS[u] for n, u in parts)
+
+
+def retry_after_from_headers(headers) -> Optional[float]:
+    """Segundos de espera que pide un 429 (retry-after-ms, retry-after o el reset más cercano)."""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    for name in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        seconds = parse_reset(headers.get(name))
+        if seconds:
+            return seconds
+    return None
+
+
+_background_tasks: set = set()
+
+
+def in_background(func, *args):
+    """Lanza `func(*args)` en un hilo sin que el event loop la espere (escrituras en Redis)."""
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    _background_tasks.add(task)  # asyncio sólo guarda referencias débiles a las tareas
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaGovernor:
+    """Token bucket distribuido alimentado por las cabeceras del proveedor."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    # --- entrada: respuestas del proveedor ---
+
+    def observe(self, headers, status_code=200):
+        """Registra una respuesta. Lo llama el hook httpx (debe ser barato y no lanzar)."""
+        try:
+            now = time.time()
+            snap = {"ts": now, "seq": int(now * 1000)}
+            for unit in ("requests", "tokens"):
+                limit = _int(headers.get(f"x-ratelimit-limit-{unit}"))
+                remaining = _int(headers.get(f"x-ratelimit-remaining-{unit}"))
+                reset = parse_reset(headers.get(f"x-ratelimit-reset-{unit}"))
+                if limit is None or remaining is None:
+                    continue
+                snap[unit] = {"limit": limit, "remaining": remaining, "reset_at": now + (reset or 60)}
+            if "requests" in snap or "tokens" in snap:
+                state_store.set_json(QUOTA_KEY_FMT.format(provider=self.provider), snap,
+                                     ttl=QUOTA_SNAPSHOT_MAX_AGE * 2)
+            if status_code == 429:
+                self.note_rate_limited(retry_after_from_headers(headers))
+        except Exception as e:
+            logger.warning(f"quota_governor: cabeceras no interpretables ({e})")
+
+    def note_rate_limited(self, retry_after=None):
+        """Un 429 congela el backfill en todos los procesos durante `retry_after`."""
+        try:
+            delay = float(retry_after) if retry_after else AI_QUOTA_COOLDOWN
+        except (TypeError, ValueError):
+            delay = AI_QUOTA_COOLDOWN
+        key = COOLDOWN_KEY_FMT.format(provider=self.provider)
+        until = time.time() + delay
+        if until > (state_store.get_json(key) or 0):
+            state_store.set_json(key, until, ttl=int(delay) + 1)
+
+    def cooldown_remaining(self):
+        until = state_store.get_json(COOLDOWN_KEY_FMT.format(provider=self.provider))
+        return max(0.0, float(until) - time.time()) if until else 0.0
+
+    # --- bucket ---
+
+    def _snapshot(self):
+        snap = state_store.get_json(QUOTA_KEY_FMT.format(provider=self.provider))
+        if not snap or time.time() - snap.get("ts", 0) > QUOTA_SNAPSHOT_MAX_AGE:
+            return None
+        return snap
+
+    def _available(self, snap, unit, now):
+        """(disponible, límite, segundos por unidad recargada) o None si no hay datos."""
+        info = snap.get(unit)
+        if not info:
+            return None
+        limit, remaining, reset_at = info["limit"], info["remaining"], info["reset_at"]
+        spent = state_store.get_json(SPENT_KEY_FMT.format(provider=self.provider, seq=snap["seq"], unit=unit)) or 0
+        window = max(reset_at - snap["ts"], 0.001)
+        if now >= reset_at:
+            refilled = limit - remaining
+        else:
+            refilled = (limit - remaining) * (now - snap["ts"]) / window
+        available = min(limit, remaining + refilled) - spent
+        per_unit = window / max(limit - remaining, 1)
+        return available, limit, per_unit
+
+    def has_data(self):
+        return self._snapshot() is not None
+
+    def wait_time(self, tokens=0, share=1.0):
+        """Segundos a esperar para que la llamada quepa dejando la reserva `1 - share`.
+
+        0 si cabe ya; None si no hay cabeceras recientes (el caller decide).
+        """
+        snap = self._snapshot()
+        if not snap:
+            return None
+        now = time.time()
+        wait = 0.0
+        for unit, amount in (("requests", 1), ("tokens", tokens)):
+            if amount <= 0:
+                continue
+            state = self._available(snap, unit, now)
+            if not state:
+                continue
+            available, limit, per_unit = state
+            reserve = limit * (1 - share)
+            missing = amount + reserve - available
+            if missing > 0 and available < limit:
+                wait = max(wait, missing * per_unit)
+        return wait
+
+    def spend(self, tokens=0):
+        """Descuenta una llamada admitida del bucket compartido."""
+        snap = self._snapshot()
+        if not snap:
+            return
+        ttl = QUOTA_SNAPSHOT_MAX_AGE * 2
+        state_store.incr_with_ttl(SPENT_KEY_FMT.format(provider=self.provider, seq=snap["seq"], unit="requests"), ttl)
+        if tokens:
+            state_store.incr_with_ttl(
+                SPENT_KEY_FMT.format(provider=self.provider, seq=snap["seq"], unit="tokens"), ttl, int(tokens)
+            )
+
+    def headroom(self):
+        """Margen actual por unidad: {"requests": {...}, "tokens": {...}, "cooldown_s", "age_s"}."""
+        snap = self._snapshot()
+        result = {"provider": self.provider, "cooldown_s": round(self.cooldown_remaining(), 1)}
+        if not snap:
+            result["age_s"] = None
+            return result
+        now = time.time()
+        result["age_s"] = round(now - snap["ts"], 1)
+        for unit in ("requests", "tokens"):
+            state = self._available(snap, unit, now)
+            if not state:
+                continue
+            available, limit, _ = state
+            result[unit] = {
+                "available": max(0, int(available)),
+                "limit": limit,
+                "pct": round(100 * max(0, available) / limit, 1) if limit else 0.0,
+                "reset_in_s": round(max(0.0, snap[unit]["reset_at"] - now), 1),
+            }
+        return result
+
+
+_governors: dict = {}
+
+
+def get_governor(provider="openai") -> QuotaGovernor:
+    if provider not in _governors:
+        _governors[provider] = QuotaGovernor(provider)
+    return _governors[provider]
+
+
+def response_hook(provider):
+    """Hook de respuesta para httpx.AsyncClient(event_hooks={"response": [...]})."""
+    governor = get_governor(provider)
+
+    async def _hook(response):
+        in_background(governor.observe, response.headers, response.status_code)
+    return _hook
+
+
+def get_quota_headroom(provider="openai"):
+    return get_governor(provider).headroom()
@@ -0,0 +1,57 @@
+# src/utils/rate_limiter.py
+"""
+Limitador asíncrono para llamadas a la IA dentro de un mismo lote.
+
+Token bucket (`rate` llamadas/seg con ráfagas de `burst`) + tope de llamadas
+en vuelo (`concurrency`). Se instancia por lote (p. ej. un ZIP) y vive en el
+event loop que lo crea.
+"""
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+from typing import Optional
+
+AI_CALLS_PER_SECOND = float(os.getenv("AI_CALLS_PER_SECOND", "3"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+
+
+class AsyncRateLimiter:
+    """Uso: `async with limiter: await llamada_ia(...)`."""
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[int] = None,
+                 concurrency: Optional[int] = None):
+        self.rate = rate or AI_CALLS_PER_SECOND
+        self.burst = burst or max(1, int(self.rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._sem = asyncio.Semaphore(concurrency or AI_MAX_CONCURRENCY)
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self):
+        self._sem.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
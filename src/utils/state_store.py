@@ -2,7 +2,8 @@
 """
 Almacén de estado compartido entre workers / procesos.
 
-API mínima: get / set / delete / incr_with_ttl.
+API mínima: get / set / delete / incr_with_ttl, más append_capped / read_capped
+(lista acotada con contador de elementos añadidos, atómica entre workers).
 
 Backend:
   • REDIS si REDIS_URL / REDIS_BROKER_URL / REDIS_URI están configurados.
@@ -64,14 +65,29 @@ class _MemoryBackend:
             self._expires.pop(key, None)
         return existed
 
-    def incr_with_ttl(self, key: str, ttl: int) -> int:
+    def incr_with_ttl(self, key: str, ttl: int, amount: int = 1) -> int:
         with self._lock:
             self._cleanup(key)
-            current = int(self._data.get(key, 0)) + 1
+            current = int(self._data.get(key, 0)) + amount
             self._data[key] = str(current)
             self._expires.setdefault(key, time.time() + ttl)
         return current
 
+    def append_capped(self, key: str, value: str, max_len: int, ttl: int) -> int:
+        with self._lock:
+            self._cleanup(key)
+            seq, items = self._data.get(key) or (0, [])
+            items = (items + [value])[-max_len:]
+            self._data[key] = (seq + 1, items)
+            self._expires[key] = time.time() + ttl
+        return seq + 1
+
+    def read_capped(self, key: str):
+        with self._lock:
+            self._cleanup(key)
+            seq, items = self._data.get(key) or (0, [])
+        return seq, list(items)
+
 
 class _RedisBackend:
     def __init__(self, url: str):
@@ -110,16 +126,41 @@ class _RedisBackend:
             logger.warning(f"state_store.delete redis error: {e}")
             return False
 
-    def incr_with_ttl(self, key: str, ttl: int) -> int:
+    def incr_with_ttl(self, key: str, ttl: int, amount: int = 1) -> int:
         try:
             pipe = self.client.pipeline()
-            pipe.incr(key)
+            pipe.incrby(key, amount)
             pipe.expire(key, ttl, nx=True)  # sólo poner TTL si no había uno
             result = pipe.execute()
             return int(result[0])
         except Exception as e:
             logger.warning(f"state_store.incr_with_ttl redis error: {e}")
-            return 1
+            return amount
+
+    # Lista en `key` y contador de añadidos en `key:seq`, en una transacción MULTI/EXEC
+    def append_capped(self, key: str, value: str, max_len: int, ttl: int) -> int:
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.incr(f"{key}:seq")
+            pipe.rpush(key, value)
+            pipe.ltrim(key, -max_len, -1)
+            pipe.expire(key, ttl)
+            pipe.expire(f"{key}:seq", ttl)
+            return int(pipe.execute()[0])
+        except Exception as e:
+            logger.warning(f"state_store.append_capped redis error: {e}")
+            return 0
+
+    def read_capped(self, key: str):
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.get(f"{key}:seq")
+            pipe.lrange(key, 0, -1)
+            seq, items = pipe.execute()
+            return int(seq or 0), items
+        except Exception as e:
+            logger.warning(f"state_store.read_capped redis error: {e}")
+            return 0, []
 
 
 class StateStore:
@@ -171,8 +212,16 @@ class StateStore:
     def delete(self, key: str) -> bool:
         return self._backend.delete(key)
 
-    def incr_with_ttl(self, key: str, ttl: int) -> int:
-        return self._backend.incr_with_ttl(key, ttl)
+    def incr_with_ttl(self, key: str, ttl: int, amount: int = 1) -> int:
+        return self._backend.incr_with_ttl(key, ttl, amount)
+
+    def append_capped(self, key: str, value: str, max_len: int, ttl: int) -> int:
+        """Añade `value` a una lista que conserva los últimos `max_len`. Devuelve el total añadido (seq)."""
+        return self._backend.append_capped(key, value, max_len, ttl)
+
+    def read_capped(self, key: str):
+        """(seq, elementos) de una lista de append_capped, leídos de forma consistente."""
+        return self._backend.read_capped(key)
 
 
 # Singleton de módulo. Se inicializa al primer import.
@@ -0,0 +1,92 @@
+# src/utils/summary_batcher.py
+"""
+Agrupador de resúmenes: junta los textos cortos que se piden a la vez en
+una sola petición JSON (AIHandler.generate_summaries_batch).
+
+Cada llamada a `summarize(text)` se encola en el lote abierto de su event
+loop. El lote se envía al llenarse (SUMMARY_BATCH_TOKENS tokens estimados o
+SUMMARY_BATCH_MAX_DOCS documentos) o, como muy tarde, SUMMARY_BATCH_WINDOW
+segundos después del primer texto. Los textos largos (más de
+SUMMARY_BATCH_DOC_CHARS) siguen yendo de uno en uno. En un backfill con
+varios archivos en paralelo esto divide varias veces el número de
+peticiones de chat.
+"""
+import os
+import asyncio
+import logging
+
+from src.utils.ai_scheduler import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_BATCH_ENABLED = os.getenv("SUMMARY_BATCH", "1").lower() not in ("0", "false", "no", "off")
+SUMMARY_BATCH_WINDOW = float(os.getenv("SUMMARY_BATCH_WINDOW", "0.4"))
+SUMMARY_BATCH_TOKENS = int(os.getenv("SUMMARY_BATCH_TOKENS", "6000"))
+SUMMARY_BATCH_MAX_DOCS = int(os.getenv("SUMMARY_BATCH_MAX_DOCS", "12"))
+SUMMARY_BATCH_DOC_CHARS = int(os.getenv("SUMMARY_BATCH_DOC_CHARS", "2500"))
+
+
+class SummaryBatcher:
+    """Un lote abierto por event loop; cada loop solo toca el suyo."""
+
+    def __init__(self):
+        self._open = {}  # loop -> {"items": [(texto, future)], "tokens": int, "timer": TimerHandle}
+        # asyncio sólo guarda referencias débiles: sin esto un lote en vuelo
+        # podría recolectarse y sus callers esperarían para siempre
+        self._sending = set()
+        self.stats = {"requests": 0, "documents": 0}
+
+    async def summarize(self, text):
+        from src.utils.ai_handler import AIHandler
+        if (not SUMMARY_BATCH_ENABLED or not text or len(text.strip()) < 10
+                or len(text) > SUMMARY_BATCH_DOC_CHARS):
+            return await AIHandler.generate_summary_with_tags(text)
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        batch = self._open.setdefault(loop, {"items": [], "tokens": 0, "timer": None})
+        batch["items"].append((text, fut))
+        batch["tokens"] += estimate_tokens(text)
+        if batch["tokens"] >= SUMMARY_BATCH_TOKENS or len(batch["items"]) >= SUMMARY_BATCH_MAX_DOCS:
+            self._flush(loop)
+        elif batch["timer"] is None:
+            batch["timer"] = loop.call_later(SUMMARY_BATCH_WINDOW, self._flush, loop)
+        return await fut
+
+    def _flush(self, loop):
+        batch = self._open.pop(loop, None)
+        if not batch:
+            return
+        if batch["timer"] is not None:
+            batch["timer"].cancel()
+        task = loop.create_task(self._send(batch["items"]))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, items):
+        from src.utils.ai_handler import AIHandler
+        live = [(text, fut) for text, fut in items if not fut.done()]
+        if not live:
+            return
+        self.stats["requests"] += 1
+        self.stats["documents"] += len(live)
+        try:
+            results = await AIHandler.generate_summaries_batch([text for text, _ in live])
+        except Exception as e:
+            # QuotaExceededError incluida: cada caller la recibe como si hubiera
+            # hecho su propia petición
+            for _, fut in live:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), result in zip(live, results):
+            if not fut.done():
+                fut.set_result(result)
+
+
+summary_batcher = SummaryBatcher()
+
+
+async def summarize(text):
+    """{'summary', 'tags'} de `text`, agrupado con los demás textos cortos en curso."""
+    return await summary_batcher.summarize(text)
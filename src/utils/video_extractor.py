@@ -0,0 +1,136 @@
+# src/utils/video_extractor.py
+"""
+Indexado de vídeo por fotogramas clave.
+
+Antes un vídeo se trataba como audio y la imagen se ignoraba. Ahora:
+
+  • ffmpeg decodifica sólo los fotogramas clave (`-skip_frame nokey`) y se
+    queda con los que cambian de escena (`select=gt(scene,…)`), ya reducidos
+    a VIDEO_FRAME_WIDTH px y como JPEG por pipe (sin ficheros temporales).
+  • Si el vídeo es casi estático (menos de 2 cambios de escena) se toman
+    fotogramas equiespaciados con búsquedas rápidas (`-ss` antes de `-i`).
+  • Como mucho VIDEO_FRAME_BUDGET fotogramas, repartidos por todo el vídeo.
+  • ffmpeg corre dentro del executor CPU compartido (con -threads
+    VIDEO_FFMPEG_THREADS), así que los vídeos compiten por los mismos huecos
+    acotados que PDFs y ZIPs en lugar de lanzar procesos sin límite.
+  • Los fotogramas se describen en lotes de VIDEO_FRAMES_PER_REQUEST por
+    petición a Visión vía `describe_callback`.
+
+El texto resultante se une a la transcripción del audio en AIHandler.extract_text.
+"""
+from __future__ import annotations
+
+import os
+import re
+import base64
+import asyncio
+import logging
+import subprocess
+
+from src.utils.cpu_executor import run_cpu
+from src.utils.audio_pipeline import FFMPEG_BINARY, ffmpeg_available, parse_duration, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+VIDEO_FRAME_BUDGET = int(os.getenv("VIDEO_FRAME_BUDGET", "8"))
+VIDEO_FRAMES_PER_REQUEST = int(os.getenv("VIDEO_FRAMES_PER_REQUEST", "4"))
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.3"))
+VIDEO_FRAME_WIDTH = int(os.getenv("VIDEO_FRAME_WIDTH", "512"))
+VIDEO_FFMPEG_THREADS = int(os.getenv("VIDEO_FFMPEG_THREADS", "1"))
+VIDEO_SAMPLE_TIMEOUT = float(os.getenv("VIDEO_SAMPLE_TIMEOUT", "300"))
+# Tope de candidatos que se leen antes de repartir el presupuesto
+VIDEO_MAX_CANDIDATES = 200
+# Menos cambios de escena que esto ⇒ muestreo equiespaciado
+VIDEO_MIN_SCENES = 2
+
+_PTS_TIME_RE = re.compile(r"pts_time:\s*(\d+(?:\.\d+)?)")
+_JPEG_SOI = b"\xff\xd8\xff"
+
+
+# --- Funciones de worker (nivel de módulo para poder serializarlas) ---
+
+def _ffmpeg(args, timeout):
+    result = subprocess.run(
+        [FFMPEG_BINARY, "-nostdin", "-hide_banner", "-threads", str(VIDEO_FFMPEG_THREADS), *args],
+        capture_output=True, timeout=timeout,
+    )
+    if result.returncode != 0:
+        tail = result.stderr.decode("utf-8", "ignore").strip().splitlines()[-1:] or [""]
+        raise RuntimeError(f"ffmpeg terminó con código {result.returncode}: {tail[0]}")
+    return result.stdout, result.stderr.decode("utf-8", "ignore")
+
+
+def _split_jpegs(data):
+    """Separa la salida de image2pipe en JPEGs (0xFFD8FF no aparece dentro de un JPEG)."""
+    starts = [m.start() for m in re.finditer(re.escape(_JPEG_SOI), data)]
+    return [data[a:b] for a, b in zip(starts, starts[1:] + [len(data)])]
+
+
+def _spread(items, budget):
+    """`budget` elementos repartidos uniformemente (conservando primero y último)."""
+    if len(items) <= budget:
+        return items
+    if budget == 1:
+        return items[:1]
+    step = (len(items) - 1) / (budget - 1)
+    return [items[round(i * step)] for i in range(budget)]
+
+
+def _sample_keyframes(path, budget, threshold, width, timeout):
+    """Worker: [(segundo, JPEG en base64), ...] de los cambios de escena (o equiespaciados)."""
+    scale = f"scale='min({width},iw)':-2"
+    stdout, stderr = _ffmpeg([
+        "-skip_frame", "nokey", "-i", path, "-an",
+        "-vf", f"select='eq(n\\,0)+gt(scene\\,{threshold})',showinfo,{scale}",
+        "-vsync", "vfr", "-frames:v", str(VIDEO_MAX_CANDIDATES),
+        "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", "5", "pipe:1",
+    ], timeout)
+    times = [float(t) for t in _PTS_TIME_RE.findall(stderr)]
+    frames = list(zip(times, _split_jpegs(stdout)))
+
+    duration = parse_duration(stderr)
+    if len(frames) < VIDEO_MIN_SCENES and duration > 0 and budget > 1:
+        frames = []
+        for i in range(budget):
+            at = duration * (i + 0.5) / budget
+            data, _ = _ffmpeg([
+                "-ss", f"{at:.2f}", "-i", path, "-an", "-frames:v", "1", "-vf", scale,
+                "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", "5", "pipe:1",
+            ], timeout)
+            if data:
+                frames.append((at, data))
+
+    return [(t, base64.b64encode(jpeg).decode("ascii")) for t, jpeg in _spread(frames, budget)]
+
+
+async def describe_video(path, describe_callback):
+    """Descripción visual de un vídeo a partir de sus fotogramas clave.
+
+    Args:
+        path: Ruta al vídeo.
+        describe_callback: coroutine `([(segundo, jpeg_b64), ...]) -> str`
+            (p. ej. AIHandler.describe_video_frames).
+
+    Returns:
+        str: Descripciones de cada lote con su marca [hh:mm:ss] ("" sin ffmpeg
+        o si no se pudo leer la imagen).
+    """
+    if not ffmpeg_available() or VIDEO_FRAME_BUDGET <= 0:
+        return ""
+    try:
+        frames = await run_cpu(
+            _sample_keyframes, path, VIDEO_FRAME_BUDGET, VIDEO_SCENE_THRESHOLD, VIDEO_FRAME_WIDTH,
+            VIDEO_SAMPLE_TIMEOUT, prefer="thread", timeout=VIDEO_SAMPLE_TIMEOUT + 5,
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron extraer fotogramas de {os.path.basename(path)}: {e}")
+        return ""
+    if not frames:
+        return ""
+    logger.info(f"🎞️ {os.path.basename(path)}: {len(frames)} fotograma(s) clave para Visión")
+
+    size = max(1, VIDEO_FRAMES_PER_REQUEST)
+    batches = [frames[i:i + size] for i in range(0, len(frames), size)]
+    texts = await asyncio.gather(*(describe_callback(batch) for batch in batches))
+    return "\n".join(f"[{format_timestamp(batch[0][0])}] {text.strip()}"
+                     for batch, text in zip(batches, texts) if text and text.strip())
@@ -0,0 +1,48 @@
+"""Envío de lotes offline: cada lote aceptado se apunta en `prep:N` y un reintento no lo reenvía."""
+import importlib.util
+import types
+import unittest
+from unittest import mock
+
+_DEPS = ("psycopg2", "openai", "telegram", "dropbox", "dotenv")
+HAS_DEPS = all(importlib.util.find_spec(m) for m in _DEPS)
+
+FILAS = [{"id": 1, "name": "a.txt", "service": "drive", "content_text": "texto de prueba " * 10}]
+
+
+@unittest.skipUnless(HAS_DEPS, "requiere las dependencias de requirements.txt")
+class SubmitAiBatchTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_reintento_solo_envia_los_roles_pendientes(self):
+        from src.scripts import job_kinds
+
+        fake_db = mock.MagicMock()
+        fake_db.get_job_item_payload.return_value = None
+        fake_db.get_files_for_ai_batch.return_value = FILAS
+        backend = mock.MagicMock()
+        backend.submit.side_effect = ["batch-emb", RuntimeError("caída de red"), "batch-sum"]
+        specs = [("embedding", {"model": "text-embedding-3-small", "dims": 1536})]
+        ctx = types.SimpleNamespace(job_id=5, params={}, log=mock.AsyncMock())
+
+        with mock.patch.object(job_kinds, "db", fake_db), \
+                mock.patch.object(job_kinds, "get_batch_backend", return_value=backend), \
+                mock.patch.object(job_kinds, "_batch_embedding_specs", return_value=specs), \
+                mock.patch.object(job_kinds, "obtener_texto_archivo",
+                                  mock.AsyncMock(return_value=(FILAS[0]["content_text"], True))):
+            payload = {"chunk": 0, "file_ids": [1]}
+            with self.assertRaises(RuntimeError):
+                await job_kinds._submit_ai_batch(payload, ctx)
+            fake_db.update_job_item_payload.assert_called_once_with(
+                5, "prep:0", {**payload, "submitted": {"embedding": "batch-emb"}})
+
+            # El reintento llega con el payload guardado: sólo falta el resumen
+            await job_kinds._submit_ai_batch(fake_db.update_job_item_payload.call_args.args[2], ctx)
+
+        self.assertEqual(backend.submit.call_count, 3)
+        self.assertEqual(backend.submit.call_args.args[1], job_kinds.ENDPOINT_CHAT)
+        items = fake_db.add_job_items.call_args.args[1]
+        self.assertEqual(items[0][1]["batches"], {"embedding": "batch-emb", "summary": "batch-sum"})
+
+
+if __name__ == "__main__":
+    unittest.main()
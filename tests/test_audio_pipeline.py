@@ -0,0 +1,27 @@
+"""Plan de trozos para Whisper: sin silencios en los extremos y sin colas diminutas."""
+import unittest
+
+from src.utils.audio_pipeline import plan_chunks, _CHUNK_SLACK, _MIN_SPEECH
+
+
+class PlanChunksTest(unittest.TestCase):
+
+    def test_sin_cola_diminuta_tras_partir(self):
+        chunks = plan_chunks(1000, [(0, 1), (250, 251), (290, 291), (600, 700)], max_chunk=300)
+        self.assertEqual(chunks, [(0.75, 290.5), (290.5, 600.25), (699.75, 1000)])
+
+    def test_ningun_trozo_corto_ni_demasiado_largo(self):
+        for duration in (299, 301, 329, 331, 601, 1000.3):
+            with self.subTest(duration=duration):
+                chunks = plan_chunks(duration, [], max_chunk=300)
+                self.assertEqual((chunks[0][0], chunks[-1][1]), (0.0, round(duration, 2)))
+                for start, end in chunks:
+                    self.assertGreaterEqual(end - start, max(_MIN_SPEECH, 300 * _CHUNK_SLACK))
+                    self.assertLessEqual(end - start, 300 * (1 + _CHUNK_SLACK))
+
+    def test_pausa_larga_separa_tramos(self):
+        self.assertEqual(plan_chunks(100, [(40, 60)], max_chunk=300), [(0.0, 40.25), (59.75, 100)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+"""Plan en seco: las peticiones a Whisper se cuentan por archivo, no sobre los minutos sumados."""
+import math
+import unittest
+from unittest import mock
+
+from src.utils import cost_planner
+
+
+def _fila(ext, files):
+    return {"ext": ext, "files": files, "with_text": 0, "embed_chars": 0, "summary_chars": 0, "short_texts": 0}
+
+
+class WhisperChunksTest(unittest.TestCase):
+
+    def _chunks(self, profile, audio_minutes, video_minutes):
+        priors = {**cost_planner.PLAN_PRIORS,
+                  "audio": {**cost_planner.PLAN_PRIORS["audio"], "minutes": audio_minutes},
+                  "video": {**cost_planner.PLAN_PRIORS["video"], "minutes": video_minutes}}
+        with mock.patch.object(cost_planner, "PLAN_PRIORS", priors), \
+                mock.patch.object(cost_planner, "AUDIO_CHUNK_SECONDS", 300):
+            return cost_planner.build_plan(profile, ["text-embedding-3-small"])["calls"]["whisper_chunks"]
+
+    def test_cada_archivo_corto_es_una_peticion(self):
+        # 10 audios de 3 min son 30 min, pero 10 peticiones (no ceil(1800/300) = 6)
+        self.assertEqual(self._chunks([_fila("mp3", 10)], 3, 2), 10)
+
+    def test_archivos_largos_se_trocean_uno_a_uno(self):
+        self.assertEqual(self._chunks([_fila("mp3", 4), _fila("mp4", 3)], 12, 2),
+                         4 * math.ceil(12 * 60 / 300) + 3)
+
+    def test_sin_audio_no_hay_peticiones(self):
+        self.assertEqual(self._chunks([_fila("pdf", 5)], 3, 2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
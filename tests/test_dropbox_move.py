@@ -0,0 +1,44 @@
+"""Movimiento en lote de Dropbox: sondeo del job asíncrono hasta que termina."""
+import importlib.util
+import unittest
+from unittest import mock
+
+HAS_DEPS = all(importlib.util.find_spec(m) for m in ("dropbox", "dotenv"))
+
+
+def _entry(ok):
+    return mock.Mock(**{"is_success.return_value": ok})
+
+
+def _status(in_progress, entries=()):
+    status = mock.Mock(spec=["is_in_progress", "is_complete", "get_complete"])
+    status.is_in_progress.return_value = in_progress
+    status.is_complete.return_value = not in_progress
+    status.get_complete.return_value = mock.Mock(entries=list(entries))
+    return status
+
+
+@unittest.skipUnless(HAS_DEPS, "requiere dropbox")
+class MoveFilesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_job_asincrono_en_curso_y_luego_completo(self):
+        from src.services import dropbox_service
+        service = dropbox_service.DropboxService.__new__(dropbox_service.DropboxService)
+        service.dbx = mock.Mock()
+        launch = mock.Mock(**{"is_complete.return_value": False, "get_async_job_id.return_value": "job-1"})
+        service.dbx.files_move_batch_v2.return_value = launch
+        service.dbx.files_move_batch_check_v2.side_effect = [
+            _status(True),
+            _status(False, [_entry(True), _entry(False)]),
+        ]
+        moves = [("/a.pdf", "/Docs/a.pdf"), ("/b.pdf", "/Docs/b.pdf")]
+
+        with mock.patch.object(dropbox_service.time, "sleep"):
+            result = await service.move_files(moves)
+
+        self.assertEqual(result, {"/a.pdf": True, "/b.pdf": False})
+        self.assertEqual(service.dbx.files_move_batch_check_v2.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
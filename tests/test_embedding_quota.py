@@ -0,0 +1,91 @@
+"""Cuota de IA agotada durante el job de embeddings: la unidad se pausa, no se da por fallida."""
+import importlib.util
+import unittest
+from unittest import mock
+
+_DEPS = ("psycopg2", "openai", "telegram", "dropbox", "dotenv")
+HAS_DEPS = all(importlib.util.find_spec(m) for m in _DEPS)
+
+FILA = {"id": 1, "name": "informe.txt", "service": "drive", "cloud_url": None,
+        "content_text": "texto de prueba " * 20, "embedding": None}
+
+
+@unittest.skipUnless(HAS_DEPS, "requiere las dependencias de requirements.txt")
+class EmbeddingQuotaTest(unittest.IsolatedAsyncioTestCase):
+
+    def _patches(self, job_kinds, indexador, AIHandler, QuotaExceededError):
+        fake_db = mock.MagicMock()
+        fake_db.get_file_by_id.return_value = FILA
+        return [
+            mock.patch.object(job_kinds, "db", fake_db),
+            mock.patch.object(indexador, "db", fake_db),
+            mock.patch.object(AIHandler, "generate_summary",
+                              mock.AsyncMock(side_effect=QuotaExceededError("sin cuota", retry_after=30))),
+            mock.patch.object(AIHandler, "get_embedding_pair", mock.AsyncMock(return_value=([0.1] * 8, None))),
+        ]
+
+    async def test_core_propaga_la_cuota(self):
+        from src.scripts import job_kinds, indexador
+        from src.utils.ai_handler import AIHandler, QuotaExceededError
+
+        patches = self._patches(job_kinds, indexador, AIHandler, QuotaExceededError)
+        for p in patches:
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+
+        with self.assertRaises(QuotaExceededError):
+            await indexador.procesar_un_archivo_core(
+                FILA["id"], FILA["name"], FILA["service"], None, FILA["content_text"], None
+            )
+
+    async def test_unidad_queda_pendiente_y_el_job_en_pausa(self):
+        from src.utils import jobs
+        from src.scripts import job_kinds, indexador
+        from src.utils.ai_handler import AIHandler, QuotaExceededError
+
+        patches = self._patches(job_kinds, indexador, AIHandler, QuotaExceededError)
+        for p in patches:
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+
+        job_db = mock.MagicMock()
+        ctx = jobs.JobContext(990001, "test-worker", {})
+        ctx.progress.start(1, label="embeddings")
+        item = {"id": 7, "item_key": "1", "payload": FILA["id"], "attempts": 1}
+
+        with self.assertRaises(jobs.JobPause) as caught:
+            await jobs._process_item(job_db, jobs.get_job_kind("embeddings"), ctx, item)
+
+        self.assertEqual(caught.exception.delay, 30)
+        job_db.fail_job_item.assert_not_called()
+        job_db.ack_job_item.assert_not_called()
+        from src.utils.progress import progress_snapshot
+        snapshot = progress_snapshot(jobs.job_progress_key(990001))
+        self.assertEqual((snapshot["done"], snapshot["failed"], snapshot["pending"]), (0, 0, 1))
+
+    async def test_generar_pendientes_no_cuenta_la_cuota_como_fallo(self):
+        from src.scripts import job_kinds, indexador
+        from src.utils.ai_handler import AIHandler, QuotaExceededError
+        from src.utils.progress import ProgressTracker, progress_snapshot
+
+        patches = self._patches(job_kinds, indexador, AIHandler, QuotaExceededError)
+        for p in patches:
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        filas = [(FILA["id"], FILA["name"], FILA["service"], None, FILA["content_text"]),
+                 (2, "otro.txt", "drive", None, FILA["content_text"])]
+        cur = indexador.db._connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+        cur.fetchall.return_value = filas
+
+        progress = ProgressTracker("test-embeddings-quota")
+        reporte = await indexador.generar_embeddings_pendientes(0, progress=progress)
+
+        self.assertEqual(reporte, {"procesados": 0, "errores": 0})
+        snapshot = progress_snapshot("test-embeddings-quota")
+        # Las unidades sin cuota salen como "retry": siguen pendientes, no fallidas
+        self.assertEqual((snapshot["done"], snapshot["failed"], snapshot["pending"], snapshot["in_flight"]),
+                         (0, 0, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Fan-out de jobs en Celery: cuota agotada en un lote → reintento con countdown y re-encolado."""
+import os
+import importlib.util
+import unittest
+from unittest import mock
+
+from src.utils import jobs
+
+
+class _QuotaKind:
+    """Tipo de job de prueba: la unidad "quota" agota la cuota, el resto se hace."""
+
+    item_progress = True
+
+    def __init__(self):
+        self.processed = []
+
+    async def process(self, payload, ctx):
+        self.processed.append(payload)
+        if payload == "quota":
+            raise jobs.JobPause("sin cuota", delay=30)
+        return True
+
+
+def _job_db(items):
+    db = mock.MagicMock()
+    db.get_job.return_value = {"id": 1, "kind": "test_quota", "status": "running", "params": {},
+                               "concurrency": 4, "priority": 5}
+    db.claim_job_items_by_id.return_value = items
+    db.touch_job.return_value = "running"
+    return db
+
+
+class RunJobBatchTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pausa_tras_la_tanda_y_devuelve_unidades(self):
+        kind = _QuotaKind()
+        items = [{"id": i, "item_key": p, "payload": p, "attempts": 1} for i, p in enumerate(["a", "quota", "b"])]
+        db = _job_db(items)
+        with mock.patch.object(jobs, "_get_db", return_value=db), \
+                mock.patch.object(jobs, "get_job_kind", return_value=kind):
+            with self.assertRaises(jobs.JobPause) as caught:
+                await jobs.run_job_batch(1, [0, 1, 2], worker="w")
+
+        self.assertEqual(caught.exception.delay, 30)
+        # Las hermanas de la tanda terminan (y se confirman) antes de propagar la pausa
+        self.assertEqual(sorted(kind.processed), ["a", "b", "quota"])
+        self.assertEqual(db.ack_job_item.call_count, 2)
+        db.fail_job_item.assert_not_called()
+        db.release_job_items.assert_called_once_with(1, "w")
+
+    async def test_error_de_bd_en_una_unidad_no_tumba_el_lote(self):
+        kind = _QuotaKind()
+        kind.process = mock.AsyncMock(side_effect=[True, RuntimeError("boom")])
+        items = [{"id": i, "item_key": p, "payload": p, "attempts": 1} for i, p in enumerate(["a", "b"])]
+        db = _job_db(items)
+        db.fail_job_item.side_effect = ConnectionError("BD caída")
+        with mock.patch.object(jobs, "_get_db", return_value=db), \
+                mock.patch.object(jobs, "get_job_kind", return_value=kind):
+            report = await jobs.run_job_batch(1, [0, 1], worker="w")
+
+        self.assertEqual((report["done"], report["error"]), (1, 1))
+        db.release_job_items.assert_called_once_with(1, "w")
+
+
+class AggregateJobTest(unittest.TestCase):
+
+    def test_lotes_pausados_reencolan_el_job_con_retraso(self):
+        db = mock.MagicMock()
+        db.get_job.return_value = {"id": 1, "status": "running", "priority": 5, "items": {"pending": 3}}
+        with mock.patch.object(jobs, "_get_db", return_value=db), \
+                mock.patch.object(jobs, "_dispatch") as dispatch:
+            result = jobs.aggregate_job(1, [{"done": 2}, {"paused": 3}])
+
+        self.assertEqual(result["report"], {"done": 2, "paused": 3})
+        db.requeue_job.assert_called_once_with(1, jobs.JOB_PAUSE_SECONDS)
+        dispatch.assert_called_once_with(1, 5, countdown=jobs.JOB_PAUSE_SECONDS)
+
+    def test_lote_fallido_reencola_el_job(self):
+        db = mock.MagicMock()
+        db.get_job.return_value = {"id": 1, "status": "running", "priority": 5, "items": {"pending": 3}}
+        with mock.patch.object(jobs, "_get_db", return_value=db), \
+                mock.patch.object(jobs, "_dispatch") as dispatch:
+            jobs.fanout_failed(1, RuntimeError("lote caído"))
+
+        db.requeue_job.assert_called_once_with(1, jobs.JOB_PAUSE_SECONDS)
+        dispatch.assert_called_once_with(1, 5, countdown=jobs.JOB_PAUSE_SECONDS)
+
+
+@unittest.skipUnless(importlib.util.find_spec("celery") and importlib.util.find_spec("dotenv"),
+                     "requiere celery")
+class ProcessJobBatchTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, {"REDIS_URL": os.getenv("REDIS_URL", "redis://localhost:6379/0")}):
+            import celery_app
+        self.task = celery_app.process_job_batch
+
+    def test_cuota_agotada_reintenta_con_countdown(self):
+        retry = mock.Mock(side_effect=RuntimeError("retry"))
+        with mock.patch("src.utils.jobs.run_job_batch", mock.AsyncMock(side_effect=jobs.JobPause("q", delay=30))), \
+                mock.patch.object(self.task, "retry", retry):
+            with self.assertRaises(RuntimeError):
+                self.task.run(1, [10, 11])
+        retry.assert_called_once_with(countdown=30, max_retries=jobs.JOB_FANOUT_RETRIES)
+
+    def test_sin_reintentos_informa_lote_pausado(self):
+        self.task.push_request(retries=jobs.JOB_FANOUT_RETRIES)
+        self.addCleanup(self.task.pop_request)
+        with mock.patch("src.utils.jobs.run_job_batch", mock.AsyncMock(side_effect=jobs.JobPause("q", delay=30))):
+            self.assertEqual(self.task.run(1, [10, 11]), {"paused": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+"""Log por job: ring buffer con `seq` monótono aunque escriban varios workers a la vez."""
+import threading
+import unittest
+from unittest import mock
+
+from src.utils import jobs
+
+
+class JobLogTest(unittest.TestCase):
+
+    def test_escrituras_concurrentes_no_pierden_lineas(self):
+        job_id = 990101
+
+        def escribir(n):
+            for i in range(50):
+                jobs._append_log(job_id, f"{n}:{i}")
+
+        hilos = [threading.Thread(target=escribir, args=(n,)) for n in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        lines, seq = jobs.read_job_log(job_id)
+        self.assertEqual(seq, 400)
+        self.assertEqual(len(lines), 400)
+
+    def test_ring_buffer_y_lectura_incremental(self):
+        job_id = 990102
+        with mock.patch.object(jobs, "JOB_LOG_LINES", 3):
+            for i in range(5):
+                jobs._append_log(job_id, f"línea {i}")
+
+        self.assertEqual(jobs.read_job_log(job_id), (["línea 2", "línea 3", "línea 4"], 5))
+        self.assertEqual(jobs.read_job_log(job_id, since=4), (["línea 4"], 5))
+        self.assertEqual(jobs.read_job_log(job_id, since=5), ([], 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Texto de presentaciones: orden de diapositivas y notas según presentation.xml y los .rels."""
+import os
+import tempfile
+import unittest
+import zipfile
+
+from src.utils.office_extractor import _read_pptx_text
+
+_P = "http://schemas.openxmlformats.org/presentationml/2006/main"
+_A = "http://schemas.openxmlformats.org/drawingml/2006/main"
+_R = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PKG = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def _rels(*relations):
+    body = "".join(f'<Relationship Id="{rid}" Type="{_R}/{kind}" Target="{target}"/>'
+                   for rid, kind, target in relations)
+    return f'<?xml version="1.0"?><Relationships xmlns="{_PKG}">{body}</Relationships>'
+
+
+def _text_part(root, text):
+    return (f'<?xml version="1.0"?><p:{root} xmlns:p="{_P}" xmlns:a="{_A}"><p:cSld><p:spTree><p:sp>'
+            f'<p:txBody><a:p><a:r><a:t>{text}</a:t></a:r></a:p></p:txBody>'
+            f'</p:sp></p:spTree></p:cSld></p:{root}>')
+
+
+def _reordered_deck(path):
+    """slide1..slide3 reordenadas a 3, 1, 2; las notas no siguen la numeración de las diapositivas."""
+    ids = "".join(f'<p:sldId id="{256 + i}" r:id="{rid}"/>' for i, rid in enumerate(("rId13", "rId11", "rId12")))
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("ppt/presentation.xml",
+                         f'<?xml version="1.0"?><p:presentation xmlns:p="{_P}" xmlns:r="{_R}">'
+                         f'<p:sldIdLst>{ids}</p:sldIdLst></p:presentation>')
+        archive.writestr("ppt/_rels/presentation.xml.rels", _rels(
+            ("rId11", "slide", "slides/slide1.xml"),
+            ("rId12", "slide", "slides/slide2.xml"),
+            ("rId13", "slide", "slides/slide3.xml"),
+        ))
+        for n in (1, 2, 3):
+            archive.writestr(f"ppt/slides/slide{n}.xml", _text_part("sld", f"Contenido {n}"))
+        # Las notas de slide3 están en notesSlide1 y las de slide1 en notesSlide2; slide2 no tiene
+        archive.writestr("ppt/slides/_rels/slide3.xml.rels", _rels(("rId2", "notesSlide", "../notesSlides/notesSlide1.xml")))
+        archive.writestr("ppt/slides/_rels/slide1.xml.rels", _rels(("rId2", "notesSlide", "../notesSlides/notesSlide2.xml")))
+        archive.writestr("ppt/notesSlides/notesSlide1.xml", _text_part("notes", "Notas de la 3"))
+        archive.writestr("ppt/notesSlides/notesSlide2.xml", _text_part("notes", "Notas de la 1"))
+
+
+class PptxTextTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".pptx")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_orden_de_la_presentacion_y_notas_por_rels(self):
+        _reordered_deck(self.path)
+        self.assertEqual(_read_pptx_text(self.path).split("\n\n"), [
+            "Diapositiva 1: Contenido 3\nNotas: Notas de la 3",
+            "Diapositiva 2: Contenido 1\nNotas: Notas de la 1",
+            "Diapositiva 3: Contenido 2",
+        ])
+
+    def test_sin_presentation_xml_usa_el_orden_numerico(self):
+        with zipfile.ZipFile(self.path, "w") as archive:
+            for n in (10, 2):
+                archive.writestr(f"ppt/slides/slide{n}.xml", _text_part("sld", f"Contenido {n}"))
+        self.assertEqual(_read_pptx_text(self.path),
+                         "Diapositiva 1: Contenido 2\n\nDiapositiva 2: Contenido 10")
+
+
+if __name__ == "__main__":
+    unittest.main()
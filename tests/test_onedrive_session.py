@@ -0,0 +1,79 @@
+"""OneDrive: sesión HTTP por event loop que se cierra con el loop, y reintento tras 401 con el cuerpo rebobinado."""
+import asyncio
+import importlib.util
+import io
+import unittest
+from unittest import mock
+
+HAS_DEPS = all(importlib.util.find_spec(m) for m in ("aiohttp", "msal"))
+
+
+def _service():
+    from src.services.onedrive_service import OneDriveService
+    service = OneDriveService(None, None, None)  # Sin credenciales: no llama a MSAL
+    service._token, service._token_expiry = "token", float("inf")
+    return service
+
+
+class _Response:
+    def __init__(self, status):
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def text(self):
+        return "{}"
+
+
+@unittest.skipUnless(HAS_DEPS, "requiere aiohttp y msal")
+class OneDriveSessionTest(unittest.TestCase):
+
+    def test_la_sesion_se_cierra_al_terminar_asyncio_run(self):
+        service = _service()
+
+        async def use():
+            return service._session()
+
+        sessions = [asyncio.run(use()) for _ in range(2)]
+        self.assertTrue(all(s.closed for s in sessions))
+        self.assertEqual(service._sessions, {})
+
+    def test_reintento_tras_401_reenvia_el_archivo_completo(self):
+        service = _service()
+        bodies = []
+
+        def request(method, url, headers, data):
+            bodies.append(data.read())
+            return _Response(401 if len(bodies) == 1 else 201)
+
+        session = mock.Mock(request=request)
+        with mock.patch.object(service, "_session", return_value=session), \
+                mock.patch.object(service, "_get_access_token", return_value="token"):
+            status, _ = asyncio.run(service._request("PUT", "https://graph", data=io.BytesIO(b"contenido")))
+
+        self.assertEqual(status, 201)
+        self.assertEqual(bodies, [b"contenido", b"contenido"])
+
+    def test_cuerpo_no_rebobinable_no_se_reintenta(self):
+        service = _service()
+        calls = []
+
+        async def stream():
+            yield b"contenido"
+
+        def request(method, url, headers, data):
+            calls.append(data)
+            return _Response(401)
+
+        with mock.patch.object(service, "_session", return_value=mock.Mock(request=request)):
+            status, _ = asyncio.run(service._request("PUT", "https://graph", data=stream()))
+
+        self.assertEqual((status, len(calls)), (401, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
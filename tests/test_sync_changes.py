@@ -0,0 +1,72 @@
+"""Sync incremental: re-indexación de archivos con contenido nuevo y cursor reanudable de Drive."""
+import importlib.util
+import unittest
+from unittest import mock
+
+HAS_DEPS = all(importlib.util.find_spec(m) for m in ("psycopg2", "openai", "telegram", "dropbox", "dotenv"))
+HAS_GOOGLE = importlib.util.find_spec("googleapiclient") is not None
+
+
+def _cambio(name, version):
+    return {"name": name, "cloud_id": f"id-{name}", "cloud_path": f"/{name}", "deleted": False, "version": version}
+
+
+@unittest.skipUnless(HAS_DEPS, "requiere las dependencias de requirements.txt")
+class AplicarCambiosTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_reindexa_solo_lo_modificado(self):
+        from src.scripts import indexador
+
+        fake_db = mock.MagicMock()
+        fake_db.get_files_index_state.return_value = {
+            "igual.pdf": {"id": 1, "indexed": True, "cloud_id": "id-igual.pdf", "content_version": "h1"},
+            "cambiado.pdf": {"id": 2, "indexed": True, "cloud_id": "id-cambiado.pdf", "content_version": "h1"},
+            "antiguo.pdf": {"id": 3, "indexed": True, "cloud_id": "id-antiguo.pdf", "content_version": None},
+        }
+        cambios = [_cambio("igual.pdf", "h1"), _cambio("cambiado.pdf", "h2"),
+                   _cambio("antiguo.pdf", "h9"), _cambio("nuevo.pdf", "h3")]
+        reporte = {"nuevos": 0, "errores": 0, "borrados": 0, "sin_cambios": 0}
+
+        with mock.patch.object(indexador, "db", fake_db), \
+                mock.patch.object(indexador, "_indexar_si_falta", mock.AsyncMock()) as indexar:
+            await indexador._aplicar_cambios("dropbox", cambios, reporte)
+
+        procesados = {c.args[0]: c.kwargs["existente"] for c in indexar.call_args_list}
+        self.assertEqual(procesados, {"cambiado.pdf": None, "nuevo.pdf": None})
+        self.assertEqual(reporte["sin_cambios"], 2)
+        fake_db.set_content_version.assert_called_once_with(3, "h9")
+
+
+@unittest.skipUnless(HAS_GOOGLE, "requiere google-api-python-client")
+class DriveCursorTest(unittest.IsolatedAsyncioTestCase):
+
+    def _service(self, pages):
+        from src.services.google_drive_service import GoogleDriveService
+        service = GoogleDriveService.__new__(GoogleDriveService)
+        responses = iter([{"startPageToken": "77"}] + pages)
+        service._execute = mock.AsyncMock(side_effect=lambda fn: next(responses))
+        return service
+
+    async def test_listado_inicial_devuelve_cursor_reanudable_por_pagina(self):
+        service = self._service([
+            {"files": [{"id": "a", "name": "a.pdf", "md5Checksum": "m1"}], "nextPageToken": "p2"},
+            {"files": [{"id": "b", "name": "b.gdoc", "modifiedTime": "2026-01-01T00:00:00Z"}]},
+        ])
+        pages = [page async for page in service.iter_changes(None)]
+
+        self.assertEqual([cursor for _, cursor in pages], ["list:77:p2", "77"])
+        self.assertEqual([c["version"] for changes, _ in pages for c in changes], ["m1", "2026-01-01T00:00:00Z"])
+
+    async def test_reanuda_el_listado_desde_el_cursor(self):
+        from src.services.google_drive_service import GoogleDriveService
+        service = GoogleDriveService.__new__(GoogleDriveService)
+        service._execute = mock.AsyncMock(return_value={"files": [{"id": "b", "name": "b.pdf"}]})
+
+        pages = [page async for page in service.iter_changes("list:77:p2")]
+
+        self.assertEqual(pages[-1][1], "77")
+        self.assertEqual(service._execute.await_count, 1)  # Sin pedir un startPageToken nuevo
+
+
+if __name__ == "__main__":
+    unittest.main()
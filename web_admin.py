@@ -13,11 +13,8 @@ from flask_wtf.csrf import CSRFProtect
 
 # --- NÚCLEO DEL PROYECTO ---
 from src.database.db_handler import DatabaseHandler
-from src.scripts.indexador import ejecutar_indexacion_completa, ejecutar_indexacion_paso_a_paso, ejecutar_embeddings_batch_sse
-from src.services.dropbox_service import DropboxService
-from src.services.google_drive_service import GoogleDriveService
 from src.services.onedrive_service import OneDriveService
-from src.init_services import onedrive_svc, dropbox_svc
+from src.init_services import onedrive_svc, dropbox_svc, drive_svc
 from src.scripts.refresh_drive_token import refresh_google_token
 
 try:
@@ -104,11 +101,59 @@ else:
 # Antes usábamos `app.stop_embeddings` y `app.auth_flows` en memoria, lo cual
 # se rompe con multi-worker Gunicorn. Ahora delegamos al state_store.
 from src.utils.state_store import state_store
+from src.utils.quota_governor import get_quota_headroom
 
 EMBED_STOP_KEY = "cloudgram:embed_stop"
 AUTH_FLOW_KEY_FMT = "cloudgram:auth_flow:{provider}:{user_id}"
 AUTH_FLOW_TTL = 600  # 10 min para completar un flujo OAuth
 
+# Jobs durables (Celery o hilos locales detrás de la misma API)
+from src.utils.jobs import submit_job, cancel_job, latest_job_id, read_job_log, resume_jobs, job_progress_key
+from src.utils.progress import progress_snapshot, progress_stream, sse_event
+from src.utils.cost_planner import plan_pending_index, get_plan, plan_progress
+
+
+def _submit_job_response(kind, params=None):
+    try:
+        job = submit_job(kind, params)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+    if not job:
+        return {"status": "error", "message": "No se pudo crear el job (revisa los logs)."}, 500
+    # Sin task_id: el dashboard sigue el log del job por SSE sea cual sea el backend
+    return {"status": "success", "backend": job["backend"], "job_id": job["job_id"]}, 200
+
+
+def _job_log_response(job_id, done_message):
+    """SSE de un job hasta que termina: eventos log / progress / end (ver src/utils/progress.py).
+
+    Todas las pestañas que miran el mismo job comparten un único sondeo por proceso.
+    """
+    if not job_id:
+        def vacio():
+            yield sse_event({"type": "end", "message": "No hay proceso en ejecución.", "status": None})
+        return Response(vacio(), mimetype='text/event-stream')
+
+    def job_status():
+        job = db.get_job(job_id)
+        return job["status"] if job else "done"
+
+    stream = progress_stream(
+        job_progress_key(job_id),
+        log_reader=lambda since: read_job_log(job_id, since),
+        is_finished=job_status,
+        done_message=done_message,
+    )
+    return Response(stream_with_context(stream), mimetype='text/event-stream')
+
+
+# Sin Celery los jobs corren en hilos de este proceso: retomar los que quedaron a medias
+if not get_celery_app():
+    try:
+        resume_jobs()
+    except Exception as e:
+        print(f"⚠️ No se pudieron reanudar jobs: {e}")
+
 # --- SISTEMA ANTI-DORMICIÓN (KEEP-ALIVE) ---
 def run_keep_alive():
     url = os.environ.get('RENDER_EXTERNAL_URL')
@@ -351,7 +396,8 @@ def dashboard():
             redis_configured=redis_configured,
             drive_status=drive_status,
             dropbox_status=dropbox_status,
-            onedrive_status=onedrive_status
+            onedrive_status=onedrive_status,
+            ai_quota=get_quota_headroom()
         )
 
     except Exception as e:
@@ -359,7 +405,7 @@ def dashboard():
         return render_template("dashboard.html",
                                total_total=0, total_ia=0, total_fotos=0, total_pending=0,
             db_status=False, redis_status=False, redis_configured=False,
-            drive_status=False, dropbox_status=False, onedrive_status=False)
+            drive_status=False, dropbox_status=False, onedrive_status=False, ai_quota=None)
 
 @app.route('/delete/<int:file_id>')
 @login_required
@@ -378,13 +424,12 @@ def delete_file(file_id):
         try:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-            if service == 'dropbox':
-                success_cloud = loop.run_until_complete(DropboxService.delete_file(f"/{name}"))
-            elif service == 'drive':
-                success_cloud = loop.run_until_complete(GoogleDriveService.delete_file(name))
-            elif service == 'onedrive':
-                if onedrive_svc:
-                    success_cloud = loop.run_until_complete(onedrive_svc.delete_file(name))
+            svc = {'dropbox': dropbox_svc, 'drive': drive_svc, 'onedrive': onedrive_svc}.get(service)
+            if svc:
+                # Por cloud_id si está registrado; si no, búsqueda por nombre
+                success_cloud = loop.run_until_complete(svc.delete_by_ref(file_info.get('cloud_id'), name))
+            if service == 'onedrive' and onedrive_svc:
+                loop.run_until_complete(onedrive_svc.close())
             loop.close()
         except Exception as e:
             print(f"⚠️ Error Cloud Delete: {e}")
@@ -414,11 +459,28 @@ def reset_all():
     try:
         db.reset_all_embeddings()
         db.log_event("WARNING", "SISTEMA", "Reinicio total de Embeddings e IA ejecutado manualmente.")
-        flash("♻️ Todos los embeddings y resúmenes han sido borrados. Ejecuta el Indexador IA para recalcular todo.", "warning")
+        flash("♻️ Todos los embeddings y resúmenes han sido borrados. Ejecuta el Indexador IA o la "
+              "re-indexación por lotes (Batch API) para recalcular todo.", "warning")
     except Exception as e:
         flash(f"Error al resetear todo: {e}", "error")
     return redirect(url_for('dashboard'))
 
+@app.route('/ai-batch/start', methods=['POST'])
+@login_required
+def ai_batch_start():
+    """Re-indexación offline de los archivos sin embedding vía Batch API (job `ai_batch`)."""
+    try:
+        limite = int(request.form.get('limite', 0))
+    except (ValueError, TypeError):
+        limite = 0
+    body, code = _submit_job_response('ai_batch', {"limite": limite})
+    if code == 200:
+        flash(f"📦 Re-indexación por lotes encolada (job #{body['job_id']}). "
+              f"El proveedor puede tardar horas; el progreso está en /jobs/{body['job_id']}.", "info")
+    else:
+        flash(f"❌ {body['message']}", "error")
+    return redirect(url_for('dashboard'))
+
 @app.route('/clean-corrupted', methods=['POST'])
 @login_required
 def clean_corrupted():
@@ -433,21 +495,8 @@ def clean_corrupted():
 @app.route('/run-indexer', methods=['POST'])
 @login_required
 def run_indexer_endpoint():
-    celery = get_celery_app()
-    if celery:
-        task = celery.send_task('celery_app.run_full_indexer')
-        return {"status": "success", "backend": "celery", "task_id": task.id}, 200
-
-    def thread_wrapper():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            loop.run_until_complete(ejecutar_indexacion_completa())
-        finally:
-            loop.close()
-
-    threading.Thread(target=thread_wrapper, daemon=True).start()
-    return {"status": "success", "backend": "thread"}, 200
+    """Sincronización de nubes como job durable (una unidad por nube)."""
+    return _submit_job_response('indexer')
 
 @app.route('/celery-task-status')
 @login_required
@@ -466,91 +515,20 @@ def celery_task_status():
 @app.route('/run-categorizer', methods=['POST'])
 @login_required
 def run_categorizer_endpoint():
-    """Inicia en background el script de categorización de archivos ya en la nube con SSE logging."""
-    from queue import Queue
-    
-    if not hasattr(app, 'categorizer_queue'):
-        app.categorizer_queue = Queue()
-    else:
-        # Limpiar queue anterior si existe
-        try:
-            while not app.categorizer_queue.empty():
-                app.categorizer_queue.get_nowait()
-        except:
-            pass
-    
-    def thread_wrapper():
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            async def run_categorizer_async():
-                try:
-                    from src.scripts.categorize_with_logs import categorize_with_logs
-                    async for message in categorize_with_logs():
-                        app.categorizer_queue.put(message)
-                    app.categorizer_queue.put(None)  # Señal de fin
-                except ImportError as e:
-                    app.categorizer_queue.put(f"[ERROR] Importación fallida: {str(e)}")
-                    app.categorizer_queue.put(None)
-                except Exception as e:
-                    import traceback
-                    error_msg = f"[ERROR] {str(e)}"
-                    app.categorizer_queue.put(error_msg)
-                    app.categorizer_queue.put(None)
-            
-            loop.run_until_complete(run_categorizer_async())
-        except Exception as e:
-            import traceback
-            print(f"[ERROR en thread] {str(e)}")
-            traceback.print_exc()
-            app.categorizer_queue.put(f"[ERROR] Fallo en thread: {str(e)}")
-            app.categorizer_queue.put(None)
-        finally:
-            loop.close()
-
-    threading.Thread(target=thread_wrapper, daemon=True).start()
-    return {"status": "success", "message": "Categorización iniciada"}, 200
+    """Inicia como job la categorización de archivos ya en la nube; el log va por SSE."""
+    return _submit_job_response('categorizer')
 
 @app.route('/progress-categorizer')
 @login_required
 def progress_categorizer():
     """SSE endpoint para streaming de logs del categorizer."""
-    def generate():
-        if not hasattr(app, 'categorizer_queue'):
-            yield f"data: {json.dumps({'message': '[INFO] No hay categorización en progreso'})}\n\n"
-            return
-        
-        while True:
-            try:
-                message = app.categorizer_queue.get(timeout=1)
-                if message is None:  # Fin del proceso
-                    yield f"data: {json.dumps({'message': '[FINALIZADO] ✅ Categorización completada'})}\n\n"
-                    break
-                yield f"data: {json.dumps({'message': message})}\n\n"
-            except:
-                # Queue vacío o timeout
-                continue
-    
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    return _job_log_response(latest_job_id('categorizer'), '[FINALIZADO] ✅ Categorización completada')
 
 @app.route('/progress-indexer')
-
 @login_required
 def progress_indexer():
-    def generate():
-        loop = asyncio.new_event_loop()
-        gen = ejecutar_indexacion_paso_a_paso()
-        try:
-            while True:
-                try:
-                    msg = loop.run_until_complete(anext(gen))
-                    yield msg
-                except StopAsyncIteration:
-                    break
-        finally:
-            loop.close()
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    """SSE del último job de sincronización (ya no lanza una sync por cada pestaña conectada)."""
+    return _job_log_response(latest_job_id('indexer'), '[✅ FINALIZADO] Sincronización completada')
 
 @app.route('/run-embeddings', methods=['POST'])
 @login_required
@@ -561,58 +539,36 @@ def run_embeddings_endpoint():
     except (ValueError, TypeError):
         limite = 10
 
-    celery = get_celery_app()
-    if celery:
-        task = celery.send_task('celery_app.generate_embeddings', args=[limite])
-        return {"status": "success", "backend": "celery", "task_id": task.id}, 200
-
-    if not hasattr(app, 'embed_queue'):
-        app.embed_queue = None
-
-    from queue import Queue
-    app.embed_queue = Queue()
-    app.embed_limite = limite
+    params = {"limite": limite}
+    if request.form.get('plan_id'):
+        params["plan_id"] = request.form['plan_id']
 
-    def thread_wrapper():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            async def run():
-                from src.scripts.indexador import generar_embeddings_pendientes
-
-                async def cb(msg):
-                    app.embed_queue.put(msg)
-
-                # Pasamos la función que verifica si el usuario pidió detenerse
-                def check_stop():
-                    return state_store.get_bool(EMBED_STOP_KEY, default=False)
-
-                result = await generar_embeddings_pendientes(limite, cb, check_stop)
-                app.embed_queue.put(f"✅ Finalizado: {result['procesados']} embeddings, {result['errores']} errores.")
-                app.embed_queue.put(None)  # Señal de fin
-
-            loop.run_until_complete(run())
-        except Exception as e:
-            app.embed_queue.put(f"[❌ ERROR] {e}")
-            app.embed_queue.put(None)
-        finally:
-            loop.close()
-
-    threading.Thread(target=thread_wrapper, daemon=True).start()
     state_store.delete(EMBED_STOP_KEY)  # Resetear flag de parada al iniciar
-    return {"status": "success", "backend": "thread", "limite": limite}, 200
+    body, code = _submit_job_response('embeddings', params)
+    return {**body, "limite": limite}, code
+
+@app.route('/index-plan')
+@login_required
+def index_plan():
+    """Plan en seco de los pendientes de embedding: llamadas, tokens, coste y duración estimados."""
+    try:
+        limite = int(request.args.get('limite', 0))
+    except (ValueError, TypeError):
+        limite = 0
+    return jsonify(plan_pending_index(db, limite=limite))
 
 @app.route('/stop-embeddings', methods=['POST'])
 @login_required
 def stop_embeddings_endpoint():
-    """Establece el flag de parada para detener el proceso de embeddings.
+    """Cancela el job de embeddings en curso.
 
-    Persistido en Redis (vía state_store) con TTL de 1h por si el worker
-    quedó huérfano.
+    El worker lo detecta en su siguiente latido y termina la unidad actual.
+    El flag en Redis (TTL 1h) se mantiene para las tareas Celery heredadas.
     """
     state_store.set_bool(EMBED_STOP_KEY, True, ttl=3600)
-    if hasattr(app, 'embed_queue') and app.embed_queue:
-        app.embed_queue.put("🛑 Recibida petición de parada. Finalizando lote...")
+    job_id = latest_job_id('embeddings')
+    if job_id:
+        cancel_job(job_id)
     return {"status": "success", "message": "Petición de parada enviada"}, 200
 
 
@@ -620,23 +576,138 @@ def stop_embeddings_endpoint():
 @login_required
 def progress_embeddings():
     """SSE endpoint para streaming del progreso de embeddings."""
-    def generate():
-        if not hasattr(app, 'embed_queue') or app.embed_queue is None:
-            yield f"data: {json.dumps({'message': 'No hay proceso en ejecución.'})}\n\n"
-            return
+    return _job_log_response(latest_job_id('embeddings'), '[✅ FINALIZADO] Proceso completado')
 
-        while True:
-            try:
-                msg = app.embed_queue.get(timeout=1)
-                if msg is None:
-                    yield f"data: {json.dumps({'message': '[✅ FINALIZADO] Proceso completado'})}\n\n"
-                    break
-                yield f"data: {json.dumps({'message': msg})}\n\n"
-            except Exception:
-                continue
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+@app.route('/jobs')
+@login_required
+def jobs_list():
+    """Últimos jobs durables con su avance."""
+    return jsonify(db.list_jobs(int(request.args.get('limit', 20))))
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_detail(job_id):
+    job = db.get_job(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job no encontrado"}), 404
+    params = job.get("params") or {}
+    plan = get_plan(params["plan_id"]) if isinstance(params, dict) and params.get("plan_id") else None
+    if plan:
+        started = job["started_at"].timestamp() if job.get("started_at") else None
+        job["plan"] = plan_progress(plan, job["items"].get("done", 0), job["items"].get("failed", 0), started)
+    job["progress"] = progress_snapshot(job_progress_key(job_id))
+    return jsonify(job)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def job_cancel(job_id):
+    cancel_job(job_id)
+    return jsonify({"status": "success", "job_id": job_id})
+
+@app.route('/jobs/<int:job_id>/progress')
+@login_required
+def job_progress(job_id):
+    """SSE con el log de un job concreto."""
+    return _job_log_response(job_id, '[✅ FINALIZADO] Job terminado')
+
+
+@app.route('/executor-metrics')
+@login_required
+def executor_metrics():
+    """Profundidad de cola y contadores del executor CPU de este proceso web."""
+    from src.utils.cpu_executor import get_executor_metrics
+    return jsonify(get_executor_metrics())
+
+@app.route('/ai-scheduler')
+@login_required
+def ai_scheduler_metrics():
+    """Admisión de llamadas a la IA: cola y espera por carril, presupuesto compartido del minuto."""
+    from src.utils.ai_scheduler import get_ai_scheduler_stats
+    return jsonify(get_ai_scheduler_stats())
+
+@app.route('/ai-quota')
+@login_required
+def ai_quota():
+    """Margen de cuota del proveedor según sus cabeceras x-ratelimit-* (compartido entre procesos)."""
+    return jsonify({"openai": get_quota_headroom("openai"), "gemini": get_quota_headroom("gemini")})
+
+@app.route('/embedding-migration')
+@login_required
+def embedding_migration_status():
+    """Estado del registro de modelos y progreso de la columna sombra."""
+    return jsonify(db.get_embedding_migration_status())
+
+@app.route('/embedding-migration/start', methods=['POST'])
+@login_required
+def embedding_migration_start():
+    """Crea la columna sombra para (modelo, dims) y lanza el re-embedding en background.
+
+    Las búsquedas siguen sirviéndose con el modelo activo hasta /embedding-migration/switch.
+    """
+    from src.utils.ai_handler import AIHandler
+    try:
+        model = request.form.get('model') or None
+        spec = AIHandler.resolve_embedding_spec(
+            model,
+            # EMBEDDING_DIMENSIONS solo aplica al modelo por defecto del entorno
+            request.form.get('dims') or (None if model else AIHandler.EMBEDDING_DIMENSIONS)
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if not db.start_embedding_migration(spec["model"], spec["dims"], spec["provider"]):
+        return jsonify({"status": "error", "message": "No se pudo crear la columna sombra (revisa los logs)."}), 500
+    AIHandler.invalidate_embedding_spec()
+    db.log_event("INFO", "SISTEMA", f"Migración de embeddings iniciada → {spec['model']} ({spec['dims']} dims)")
+
+    body, code = _submit_job_response('reembed_shadow', {"limite": 0})
+    return {**body, **spec}, code
+
+@app.route('/embedding-migration/switch', methods=['POST'])
+@login_required
+def embedding_migration_switch():
+    """Cambio atómico a la columna sombra. Con pendientes exige force=1."""
+    from src.utils.ai_handler import AIHandler
+    estado = db.get_embedding_migration_status()
+    if not estado["building"]:
+        return jsonify({"status": "error", "message": "No hay ninguna migración en curso."}), 400
+    if estado["pending"] and request.form.get('force') != '1':
+        return jsonify({"status": "error",
+                        "message": f"Aún quedan {estado['pending']} archivos por re-embeber.",
+                        **estado}), 409
+
+    if not db.switch_embedding_column():
+        return jsonify({"status": "error", "message": "Falló el cambio de columna (revisa los logs)."}), 500
+    AIHandler.invalidate_embedding_spec()
+    db.log_event("WARNING", "SISTEMA",
+                 f"Embeddings cambiados a {estado['building']['model']} ({estado['building']['dims']} dims)")
+    return jsonify({"status": "success", "active": estado["building"]})
+
+@app.route('/embedding-migration/cancel', methods=['POST'])
+@login_required
+def embedding_migration_cancel():
+    from src.utils.ai_handler import AIHandler
+    ok = db.cancel_embedding_migration()
+    AIHandler.invalidate_embedding_spec()
+    return jsonify({"status": "success" if ok else "error"}), (200 if ok else 500)
+
+@app.route('/sync/reset', methods=['POST'])
+@login_required
+def sync_reset():
+    """Olvida el cursor de sincronización (de un servicio o de todos): la próxima sync será completa."""
+    servicio = request.form.get('service') or None
+    ok = db.reset_sync_cursor(servicio)
+    return jsonify({"status": "success" if ok else "error", "service": servicio or "todos"}), (200 if ok else 500)
+
+@app.route('/cloud-ids/backfill', methods=['POST'])
+@login_required
+def cloud_ids_backfill():
+    """Rellena cloud_id/cloud_path de las filas antiguas en background."""
+    limite = int(request.form.get('limit', 0) or 0)
+    servicio = request.form.get('service') or None
 
+    return _submit_job_response('cloud_ids', {"limite": limite, "servicio": servicio})
 
 @app.route('/download-db')
 @login_required
@@ -962,7 +1033,6 @@ def archivos_errores():
 def embed_single(file_id):
     """Genera el embedding para un archivo individual. Devuelve JSON."""
     import json as _json
-    import numpy as _np
 
     try:
         # 1. Leer el registro de la BD
@@ -1007,21 +1077,23 @@ def embed_single(file_id):
                                 refresh_token=os.getenv("DROPBOX_REFRESH_TOKEN")
                             )
                             ok = False
+                            cloud_id = (db.get_cloud_ref(name, service) or {}).get('cloud_id')
                             if service == 'dropbox':
                                 try:
-                                    ok = await svc.download_file(f"/{name}", local_path)
+                                    ok = await svc.download_file(cloud_id or f"/{name}", local_path)
                                 except Exception as e:
                                     if "not_found" in str(e).lower():
                                         return {"ok": False, "error": f"Archivo '{name}' no encontrado en Dropbox. Posiblemente fue borrado manualmentne."}
                                     raise e
                             elif service == 'drive':
                                 drive = GoogleDriveService()
-                                ok = await drive.download_file_by_name(name, local_path)
+                                ok = await drive.download_by_ref(cloud_id, name, local_path)
                                 if not ok:
                                     return {"ok": False, "error": f"Archivo '{name}' no encontrado en Google Drive."}
                             elif service == 'onedrive':
                                 if onedrive_svc:
-                                    ok = await onedrive_svc.download_file_by_name(name, local_path)
+                                    ok = await onedrive_svc.download_by_ref(cloud_id, name, local_path)
+                                    await onedrive_svc.close()
                                     if not ok:
                                         return {"ok": False, "error": f"Archivo '{name}' no encontrado en OneDrive."}
                             
@@ -1041,28 +1113,15 @@ def embed_single(file_id):
                     texto = texto[:15000]
 
                     # Generar embedding y resumen en paralelo
-                    resumen, vector = await asyncio.gather(
-                        AIHandler.generate_summary(texto),
-                        AIHandler.get_embedding(texto)
-                    )
+                    resumen, vector, vector_next = await AIHandler.generate_summary_and_embedding(texto)
 
                     if not vector:
                         return {"ok": False, "error": "La IA no pudo generar el embedding"}
 
-                    # Guardar en BD
-                    emb_str = _json.dumps(
-                        vector.tolist() if isinstance(vector, _np.ndarray) else vector
-                    )
-                    with db._connect() as conn2:
-                        with conn2.cursor() as cur2:
-                            cur2.execute("""
-                                UPDATE files
-                                SET embedding    = %s,
-                                    summary      = COALESCE(%s, summary),
-                                    content_text = COALESCE(%s, content_text)
-                                WHERE id = %s
-                            """, (emb_str, resumen, texto, fid))
-                        conn2.commit()
+                    # Guardar en BD (etiquetado con el modelo activo + doble escritura)
+                    if not db.update_file_embedding(fid, vector, summary=resumen, content_text=texto,
+                                                    embedding_next=vector_next):
+                        return {"ok": False, "error": "No se pudo guardar el embedding en la BD"}
 
                     return {"ok": True, "dims": len(vector), "summary": resumen[:120] if resumen else ""}
 